@@ -3,6 +3,6 @@
 # pylint: disable=invalid-name  # Module name "backend-python" required by existing structure
 
 from .handler import Handler
-from .model_factory import create_model_and_fusion_map
+from .model_factory import ModelOptions, create_model_and_fusion_map
 
-__all__ = ["Handler", "create_model_and_fusion_map"]
+__all__ = ["Handler", "ModelOptions", "create_model_and_fusion_map"]
@@ -7,6 +7,9 @@ including run-length encoding and adapter subpass execution.
 
 from __future__ import annotations
 
+import math
+from dataclasses import dataclass
+
 import torch
 
 
@@ -41,15 +44,98 @@ def run_length_encode(data: list[int]) -> list[tuple[int, int]]:
     return encoded
 
 
+# Adapter weights are perturbed with noise drawn from a counter-based RNG: the
+# noise of a weight is a hash of its index, the seed, the layer and the weight
+# matrix, so any population member's noise can be regenerated on the device
+# instead of being stored.
+_MASK32 = 0xFFFFFFFF
+_DOWN_STREAM = 0
+_UP_STREAM = 1
+_INIT_STREAM = 2
+
+# Number of noise values generated at once when aggregating an update
+_NOISE_CHUNK_ELEMENTS = 1 << 24
+
+# Rate at which the ES step size follows the length of the selected steps
+_SIGMA_DAMPING = 0.2
+
+
+def _mul32(x: torch.Tensor, c: int) -> torch.Tensor:
+    """`x * c mod 2**32` for 32-bit values held in int64, without overflow."""
+    low = x * (c & 0xFFFF)
+    high = ((x * (c >> 16)) & 0xFFFF) << 16
+    return (low + high) & _MASK32
+
+
+def _hash32(x: torch.Tensor) -> torch.Tensor:
+    """Integer hash of 32-bit values held in int64 (lowbias32)."""
+    x = x ^ (x >> 16)
+    x = _mul32(x, 0x7FEB352D)
+    x = x ^ (x >> 15)
+    x = _mul32(x, 0x846CA68B)
+    return x ^ (x >> 16)
+
+
+def noise_keys(seeds: torch.Tensor, layer_idx: int, stream: int) -> torch.Tensor:
+    """Returns the RNG key of each seed for one weight matrix of a layer."""
+    seeds = seeds.long()
+    key = (seeds & _MASK32) ^ _hash32((seeds >> 32) & _MASK32)
+    tag = _hash32(torch.tensor(layer_idx * 4 + stream + 1, device=seeds.device))
+    return _hash32(key ^ tag)
+
+
+def counter_normal(keys: torch.Tensor, counters: torch.Tensor) -> torch.Tensor:
+    """
+    Standard normal float32 noise for the broadcast `keys` and `counters`.
+
+    Each value only depends on its key and counter.
+    """
+    counters = _hash32((counters.long() * 2) & _MASK32)
+    bits_1 = _hash32(counters ^ keys) >> 8
+    bits_2 = _hash32((counters + 1) ^ keys) >> 8
+    u_1 = (bits_1.to(torch.float32) + 0.5) * 2.0**-24
+    u_2 = bits_2.to(torch.float32) * 2.0**-24
+    return torch.sqrt(-2.0 * torch.log(u_1)) * torch.cos(2.0 * math.pi * u_2)
+
+
+@dataclass
+class _SegmentBucket:
+    """Segments of similar lengths, run as one pair of batched matmuls."""
+
+    # Indices of the segments in the bucket
+    segments: torch.Tensor
+    # Length every segment of the bucket is padded to
+    segment_len: int
+    # Token index and padded row of every token of the bucket
+    token_ids: torch.Tensor
+    token_rows: torch.Tensor
+
+
 class AdapterSubpass:
-    """Handles execution of adapter operations during model inference."""
+    """Handles execution of adapter operations during model inference.
+
+    Consecutive tokens with the same adapter and seed form a segment. Per
+    layer, the weights of all segments are gathered once. Segments are then
+    grouped by length into buckets of lengths in `(L / 2, L]`, and the tokens
+    of each bucket, padded to its longest segment, go through one batched
+    down-projection and one batched up-projection, whose result is added to
+    the fused QKV output. Padding thus at most doubles the rows of the
+    matmuls, whatever the mix of prefills and decodes.
+
+    Adapter `a` of layer `l` uses the weights `adapter_at_layer[l][0][a]`, laid
+    out as `[3 * max_rank, hidden_size]` (the Q, K and V chunks of `rank` rows
+    each), and `adapter_at_layer[l][1][a]`, laid out as
+    `[d_q + d_k + d_v, max_rank]`, whose first `rank` columns are used. For an
+    `EsAdapter` and a non-zero seed, both are perturbed by `sigma` times the
+    noise of the seed, which is regenerated for every pass.
+    """
 
     def __init__(
         self,
         adapter_at_layer: list[tuple[torch.Tensor, torch.Tensor]],
         adapter_indices: list[int],
         adapter_extras: dict[int, Adapter],
-        rand_seeds: torch.Tensor,
+        rand_seeds: list[int],
         qo_indptr: list[int],
     ):
         self.adapter_at_layer = adapter_at_layer
@@ -59,59 +145,180 @@ class AdapterSubpass:
         self.adapter_indices_rle = run_length_encode(self.adapter_indices)
         self.qo_indptr = qo_indptr
 
-    def execute(
-        self,
-        layer_idx: int,
-        xs: torch.Tensor,
-        q_state: torch.Tensor,
-        k_state: torch.Tensor,
-        v_state: torch.Tensor,
-    ):
-        """Execute adapter operations for the given layer and tensors."""
+        w_down, w_up = adapter_at_layer[0]
+        device = w_down.device
+        max_rank = w_up.shape[-1]
+
+        # The requests with an adapter come first in the batch, and
+        # `rand_seeds` holds the seed of each of their tokens.
+        token_adapters = []
         i = 0
         for adapter_index, count in self.adapter_indices_rle:
+            num_tokens = qo_indptr[i + count] - qo_indptr[i]
+            token_adapters.extend([adapter_index] * num_tokens)
+            i += count
 
-            x_start = self.qo_indptr[i]
-            x_end = self.qo_indptr[i + count]
-            x = xs[x_start:x_end]
-
-            rand_seeds = self.rand_seeds[i : i + count]
-
-            assert x.shape[0] == rand_seeds.shape[0], "Batch size must match seeds."
-
-            # DOWN noise uses 3 equal chunks of size `rank` each (Q/K/V).
-            w_down = self.adapter_at_layer[layer_idx][0][adapter_index]
-            w_up = self.adapter_at_layer[layer_idx][1][
-                adapter_index
-            ]  # (rank, d_q+d_k+d_v)
-            adapter_info = self.adapter_extras[adapter_index]
-
+        # Segments, i.e. runs of tokens with the same adapter and seed
+        segments = []
+        start = 0
+        for (adapter_index, seed), count in run_length_encode(
+            list(zip(token_adapters, rand_seeds))  # type: ignore[arg-type]
+        ):
+            segments.append((adapter_index, seed, start, start + count))
+            start += count
+        self.num_tokens = start
+
+        # Bucket `k` holds the segments of `2**(k-1) < length <= 2**k` tokens.
+        bucket_segments: dict[int, list[int]] = {}
+        for segment, (_, _, begin, end) in enumerate(segments):
+            bucket_segments.setdefault((end - begin - 1).bit_length(), []).append(
+                segment
+            )
+        self.buckets = []
+        for _, members in sorted(bucket_segments.items()):
+            segment_len = max(segments[s][3] - segments[s][2] for s in members)
+            token_ids = []
+            token_rows = []
+            for i, segment in enumerate(members):
+                begin, end = segments[segment][2:]
+                token_ids.extend(range(begin, end))
+                token_rows.extend(range(i * segment_len, i * segment_len + end - begin))
+            self.buckets.append(
+                _SegmentBucket(
+                    segments=torch.as_tensor(members, dtype=torch.long, device=device),
+                    segment_len=segment_len,
+                    token_ids=torch.as_tensor(
+                        token_ids, dtype=torch.long, device=device
+                    ),
+                    token_rows=torch.as_tensor(
+                        token_rows, dtype=torch.long, device=device
+                    ),
+                )
+            )
+
+        # Down-projection rows of each segment, rearranged as `[3, max_rank]`
+        # so that all ranks share one layout. Unused rows are zeroed by
+        # `rank_mask`, which also carries the `alpha / rank` scaling.
+        down_rows = []
+        rank_mask = []
+        noisy_segments = []
+        sigmas = []
+        for segment, (adapter_index, seed, _, _) in enumerate(segments):
+            adapter_info = adapter_extras[adapter_index]
             rank = adapter_info.rank
-            out_indptr = adapter_info.out_features_indptr  # built from [d_q, d_k, d_v]
-
-            qkv_down = x @ w_down
-            d_q, d_k, d_v = torch.split(qkv_down, [rank, rank, rank], dim=-1)
-
-            w_up_q = w_up[:, out_indptr[0] : out_indptr[1]]  # (rank, d_q)
-            w_up_k = w_up[:, out_indptr[1] : out_indptr[2]]  # (rank, d_k)
-            w_up_v = w_up[:, out_indptr[2] : out_indptr[3]]  # (rank, d_v)
-
-            u_q = d_q @ w_up_q
-            u_k = d_k @ w_up_k
-            u_v = d_v @ w_up_v
-
-            # ===== 3) Combine mean + noise =====
             scaling = adapter_info.alpha / float(rank)
+            for chunk in range(3):
+                down_rows.extend(
+                    chunk * rank + j if j < rank else 0 for j in range(max_rank)
+                )
+                rank_mask.extend(scaling if j < rank else 0.0 for j in range(max_rank))
+            if isinstance(adapter_info, EsAdapter) and seed != 0:
+                noisy_segments.append(segment)
+                sigmas.append(adapter_info.sigma)
+
+        self.out_features_indptr = (
+            adapter_extras[segments[0][0]].out_features_indptr
+            if segments
+            else [0, 0, 0, 0]
+        )
+        self.segment_adapters = torch.as_tensor(
+            [adapter_index for adapter_index, _, _, _ in segments],
+            dtype=torch.long,
+            device=device,
+        )
+        self.down_rows = torch.as_tensor(
+            down_rows, dtype=torch.long, device=device
+        ).view(len(segments), 3 * max_rank)
+        self.rank_mask = torch.as_tensor(
+            rank_mask, dtype=w_down.dtype, device=device
+        ).view(len(segments), 3, max_rank)
+
+        self.noisy_segments = torch.as_tensor(
+            noisy_segments, dtype=torch.long, device=device
+        )
+        self.noise_seeds = torch.as_tensor(
+            [segments[segment][1] for segment in noisy_segments],
+            dtype=torch.long,
+            device=device,
+        )
+        self.noise_sigmas = torch.as_tensor(
+            sigmas, dtype=torch.float32, device=device
+        ).view(-1, 1, 1)
 
-            q_final = scaling * u_q
-            k_final = scaling * u_k
-            v_final = scaling * u_v
-
-            q_state[x_start:x_end].add_(q_final)
-            k_state[x_start:x_end].add_(k_final)
-            v_state[x_start:x_end].add_(v_final)
-
-            i += count
+    def execute(
+        self,
+        layer_idx: int,
+        xs: torch.Tensor,
+        qkv_state: torch.Tensor,
+    ):
+        """Add the adapter outputs of the given layer to `qkv_state` in place."""
+        num_segments = self.segment_adapters.numel()
+        if num_segments == 0:
+            return
+
+        w_down_all, w_up_all = self.adapter_at_layer[layer_idx]
+        max_rank = w_up_all.shape[-1]
+        hidden_size = xs.shape[-1]
+        out_indptr = self.out_features_indptr
+
+        # [segments, 3 * max_rank, hidden] and [segments, max_rank, d_q + d_k + d_v]
+        w_down = w_down_all[self.segment_adapters[:, None], self.down_rows]
+        w_up = w_up_all[self.segment_adapters].transpose(1, 2)
+
+        if self.noisy_segments.numel() > 0:
+            # Noise is indexed like the stored weights it perturbs.
+            noisy = self.noisy_segments
+            hidden_ids = torch.arange(hidden_size, device=xs.device)
+            down_noise = counter_normal(
+                noise_keys(self.noise_seeds, layer_idx, _DOWN_STREAM)[:, None, None],
+                self.down_rows[noisy][..., None] * hidden_size + hidden_ids,
+            )
+            up_counters = (
+                torch.arange(out_indptr[3], device=xs.device) * max_rank
+                + torch.arange(max_rank, device=xs.device)[:, None]
+            )
+            up_noise = counter_normal(
+                noise_keys(self.noise_seeds, layer_idx, _UP_STREAM)[:, None, None],
+                up_counters,
+            )
+            w_down = w_down.index_add(
+                0,
+                noisy,
+                (self.noise_sigmas * down_noise).to(w_down.dtype),
+            )
+            w_up = w_up.index_add(
+                0, noisy, (self.noise_sigmas * up_noise).to(w_up.dtype)
+            )
+
+        # Scaled, and zero beyond each rank
+        w_down = (
+            w_down.view(num_segments, 3, max_rank, hidden_size)
+            * self.rank_mask[..., None]
+        ).view(num_segments, 3 * max_rank, hidden_size)
+
+        # Block-diagonal up-projection, [segments, 3 * max_rank, d_q + d_k + d_v]:
+        # the rank rows of chunk c only feed the output columns of chunk c.
+        w_up_blocks = w_up.new_zeros(num_segments, 3, max_rank, out_indptr[3])
+        for chunk in range(3):
+            cols = slice(out_indptr[chunk], out_indptr[chunk + 1])
+            w_up_blocks[:, chunk, :, cols] = w_up[:, :, cols]
+        w_up_blocks = w_up_blocks.view(num_segments, 3 * max_rank, out_indptr[3])
+
+        for bucket in self.buckets:
+            if len(self.buckets) == 1:
+                bucket_w_down, bucket_w_up = w_down, w_up_blocks
+            else:
+                bucket_w_down = w_down[bucket.segments]
+                bucket_w_up = w_up_blocks[bucket.segments]
+            num_rows = bucket.segments.numel() * bucket.segment_len
+            x = xs.new_zeros(num_rows, hidden_size)
+            x[bucket.token_rows] = xs[bucket.token_ids]
+            x = x.view(-1, bucket.segment_len, hidden_size)
+
+            down = torch.bmm(x, bucket_w_down.transpose(1, 2))
+            up = torch.bmm(down, bucket_w_up).view(-1, out_indptr[3])
+
+            qkv_state.index_add_(0, bucket.token_ids, up[bucket.token_rows])
 
 
 class Adapter:
@@ -136,3 +343,126 @@ class Adapter:
         self.out_features_indptr = [0]
         for feature_size in out_features:
             self.out_features_indptr.append(self.out_features_indptr[-1] + feature_size)
+
+
+class EsAdapter(Adapter):
+    """
+    LoRA adapter trained by an evolution strategy.
+
+    The stored weights are the mean of the search distribution. A forward pass
+    with seed `s != 0` evaluates the population member `mean + sigma * noise(s)`
+    (see `AdapterSubpass`), and `update` moves the mean towards the best
+    members from their scores and seeds.
+    """
+
+    def __init__(
+        self,
+        adapter_id: int,
+        rank: int,
+        alpha: float,
+        out_features: list[int],
+        population_size: int,
+        mu_fraction: float,
+        sigma: float,
+    ):
+        super().__init__(adapter_id, rank, alpha, out_features)
+        self.population_size = population_size
+        self.mu_fraction = mu_fraction
+        self.sigma = sigma
+
+    def initialize(
+        self, adapter_at_layer: list[tuple[torch.Tensor, torch.Tensor]], slot: int
+    ):
+        """Writes the initial mean into `slot`: random down-projections, zero
+        up-projections."""
+        for layer_idx, (w_down_all, w_up_all) in enumerate(adapter_at_layer):
+            w_down = w_down_all[slot]
+            hidden_size = w_down.shape[-1]
+            counters = torch.arange(
+                3 * self.rank * hidden_size, device=w_down.device
+            ).view(3 * self.rank, hidden_size)
+            keys = noise_keys(
+                torch.tensor([self.adapter_id], device=w_down.device),
+                layer_idx,
+                _INIT_STREAM,
+            )
+            w_down.zero_()
+            w_down[: 3 * self.rank] = (
+                counter_normal(keys, counters) * hidden_size**-0.5
+            ).to(w_down.dtype)
+            w_up_all[slot].zero_()
+
+    def update(
+        self,
+        adapter_at_layer: list[tuple[torch.Tensor, torch.Tensor]],
+        slot: int,
+        scores: list[float],
+        seeds: list[int],
+        max_sigma: float,
+    ):
+        """
+        Moves the mean, held in `slot`, towards the best-scoring population
+        members.
+
+        The best `mu_fraction` of the members are recombined with log-decreasing
+        weights. Per layer and weight matrix, their noise is regenerated and
+        reduced in one batched pass. The step size then grows if the selected
+        step is longer than a random one and shrinks otherwise, up to
+        `max_sigma`.
+        """
+        if len(scores) != len(seeds):
+            raise ValueError(
+                f"Got {len(scores)} scores for {len(seeds)} seeds in the update "
+                f"of adapter {self.adapter_id}."
+            )
+        if not scores:
+            return
+
+        order = sorted(range(len(scores)), key=lambda i: scores[i], reverse=True)
+        mu = min(len(order), max(1, int(self.mu_fraction * len(order))))
+        raw_weights = [math.log(mu + 0.5) - math.log(i + 1) for i in range(mu)]
+        weights = [w / sum(raw_weights) for w in raw_weights]
+        mu_eff = 1.0 / sum(w * w for w in weights)
+        selected = [seeds[i] for i in order[:mu]]
+        # Seed 0 is the unperturbed mean, whose noise is zero.
+        weights = [0.0 if seed == 0 else w for seed, w in zip(selected, weights)]
+
+        device = adapter_at_layer[0][0].device
+        seeds_tensor = torch.as_tensor(selected, dtype=torch.long, device=device)
+        weights_tensor = torch.as_tensor(weights, dtype=torch.float32, device=device)
+
+        step_norm_sq = torch.zeros((), dtype=torch.float32, device=device)
+        step_numel = 0
+        rank = self.rank
+        for layer_idx, (w_down_all, w_up_all) in enumerate(adapter_at_layer):
+            hidden_size = w_down_all.shape[-1]
+            max_rank = w_up_all.shape[-1]
+            down_counters = torch.arange(3 * rank, device=device)[
+                :, None
+            ] * hidden_size + torch.arange(hidden_size, device=device)
+            up_counters = torch.arange(w_up_all.shape[1], device=device)[
+                :, None
+            ] * max_rank + torch.arange(rank, device=device)
+            for stream, counters, weight in (
+                (_DOWN_STREAM, down_counters, w_down_all[slot, : 3 * rank]),
+                (_UP_STREAM, up_counters, w_up_all[slot, :, :rank]),
+            ):
+                keys = noise_keys(seeds_tensor, layer_idx, stream)
+                step = torch.zeros(counters.shape, dtype=torch.float32, device=device)
+                chunk = max(1, _NOISE_CHUNK_ELEMENTS // counters.numel())
+                for begin in range(0, mu, chunk):
+                    noise = counter_normal(
+                        keys[begin : begin + chunk, None, None], counters
+                    )
+                    step += torch.tensordot(
+                        weights_tensor[begin : begin + chunk], noise, dims=1
+                    )
+                weight.add_((self.sigma * step).to(weight.dtype))
+                step_norm_sq += step.square().sum()
+                step_numel += step.numel()
+
+        # A random selection gives `sqrt(mu_eff) * step ~ N(0, I)`.
+        step_ratio = math.sqrt(mu_eff * step_norm_sq.item() / max(1, step_numel))
+        self.sigma = min(
+            max_sigma, self.sigma * math.exp(_SIGMA_DAMPING * (step_ratio - 1.0))
+        )
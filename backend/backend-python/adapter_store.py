@@ -0,0 +1,393 @@
+"""
+Host-memory adapter store and the serialized adapter format.
+
+The device only has `max_num_adapters` adapter slots (see `adapter_at_layer`
+in the handler), but the controller may address many more adapters. The
+`AdapterStore` keeps every adapter's weights in host memory and pages them
+into the slots on demand, evicting the least recently used adapter that the
+current batch does not need. Adapters whose weights are changed on the device
+(evolution-strategy updates) are copied back to the host when evicted.
+
+Serialized adapters only hold the `rank` rows and columns that are actually
+used, per layer, as float32, float16, bfloat16, or int8 with one float32 scale
+per row.
+"""
+
+from __future__ import annotations
+
+from collections import OrderedDict
+
+import msgspec
+import torch
+
+from adapter import Adapter, EsAdapter
+
+ADAPTER_FORMAT_VERSION = 1
+
+ADAPTER_ENCODINGS = {
+    "float32": torch.float32,
+    "float16": torch.float16,
+    "bfloat16": torch.bfloat16,
+    "int8": torch.int8,
+}
+
+
+class _SerializedLayer(msgspec.Struct):
+    """Weights of one layer: `down` is `[3 * rank, hidden]`, `up` is `[d, rank]`."""
+
+    down: bytes
+    up: bytes
+    # Per-row float32 scales of the int8 encoding
+    down_scales: bytes = b""
+    up_scales: bytes = b""
+
+
+class _SerializedEsState(msgspec.Struct):
+    """Search state of an evolution-strategy adapter."""
+
+    population_size: int
+    mu_fraction: float
+    sigma: float
+
+
+class _SerializedAdapter(msgspec.Struct):
+    """An adapter as sent over the wire."""
+
+    version: int
+    name: str
+    encoding: str
+    rank: int
+    alpha: float
+    hidden_size: int
+    out_features: list[int]
+    layers: list[_SerializedLayer]
+    es: _SerializedEsState | None = None
+
+
+def _to_bytes(tensor: torch.Tensor) -> bytes:
+    return tensor.contiguous().cpu().view(torch.uint8).numpy().tobytes()
+
+
+def _from_bytes(
+    data: bytes, dtype: torch.dtype, shape: tuple[int, ...]
+) -> torch.Tensor:
+    return torch.frombuffer(bytearray(data), dtype=torch.uint8).view(dtype).view(shape)
+
+
+def _encode(tensor: torch.Tensor, encoding: str) -> tuple[bytes, bytes]:
+    """Encodes a 2D tensor, returning its data and (for int8) row scales."""
+    if encoding != "int8":
+        return _to_bytes(tensor.to(ADAPTER_ENCODINGS[encoding])), b""
+    tensor = tensor.to(torch.float32)
+    scales = tensor.abs().amax(dim=1, keepdim=True).clamp_min(1e-12) / 127.0
+    quantized = torch.round(tensor / scales).clamp(-127, 127).to(torch.int8)
+    return _to_bytes(quantized), _to_bytes(scales)
+
+
+def _decode(
+    data: bytes,
+    scales: bytes,
+    encoding: str,
+    shape: tuple[int, int],
+    dtype: torch.dtype,
+) -> torch.Tensor:
+    """Inverse of `_encode`, returning a tensor of `dtype`."""
+    tensor = _from_bytes(data, ADAPTER_ENCODINGS[encoding], shape)
+    if encoding == "int8":
+        tensor = tensor.to(torch.float32) * _from_bytes(
+            scales, torch.float32, (shape[0], 1)
+        )
+    return tensor.to(dtype)
+
+
+def serialize_adapter(
+    adapter: Adapter,
+    down: list[torch.Tensor],
+    up: list[torch.Tensor],
+    encoding: str = "float16",
+    name: str = "",
+) -> bytes:
+    """Serializes the per-layer `[3 * rank, hidden]` and `[d, rank]` weights."""
+    if encoding not in ADAPTER_ENCODINGS:
+        raise ValueError(
+            f"Unknown adapter encoding '{encoding}', "
+            f"expected one of {list(ADAPTER_ENCODINGS)}."
+        )
+
+    layers = []
+    for layer_down, layer_up in zip(down, up):
+        down_data, down_scales = _encode(layer_down, encoding)
+        up_data, up_scales = _encode(layer_up, encoding)
+        layers.append(
+            _SerializedLayer(
+                down=down_data,
+                up=up_data,
+                down_scales=down_scales,
+                up_scales=up_scales,
+            )
+        )
+
+    es = None
+    if isinstance(adapter, EsAdapter):
+        es = _SerializedEsState(
+            population_size=adapter.population_size,
+            mu_fraction=adapter.mu_fraction,
+            sigma=adapter.sigma,
+        )
+    return msgspec.msgpack.encode(
+        _SerializedAdapter(
+            version=ADAPTER_FORMAT_VERSION,
+            name=name,
+            encoding=encoding,
+            rank=adapter.rank,
+            alpha=adapter.alpha,
+            hidden_size=down[0].shape[-1] if down else 0,
+            out_features=adapter.out_features,
+            layers=layers,
+            es=es,
+        )
+    )
+
+
+def deserialize_adapter(
+    data: bytes, adapter_id: int, dtype: torch.dtype
+) -> tuple[Adapter, list[torch.Tensor], list[torch.Tensor]]:
+    """Decodes an adapter into host tensors of `dtype`."""
+    try:
+        serialized = msgspec.msgpack.decode(data, type=_SerializedAdapter)
+    except msgspec.DecodeError as exc:
+        raise ValueError(f"Invalid adapter data: {exc}") from exc
+    if serialized.version != ADAPTER_FORMAT_VERSION:
+        raise ValueError(f"Unsupported adapter format version {serialized.version}.")
+    if serialized.encoding not in ADAPTER_ENCODINGS:
+        raise ValueError(f"Unknown adapter encoding '{serialized.encoding}'.")
+
+    rank = serialized.rank
+    out_size = sum(serialized.out_features)
+    down = []
+    up = []
+    for layer in serialized.layers:
+        down.append(
+            _decode(
+                layer.down,
+                layer.down_scales,
+                serialized.encoding,
+                (3 * rank, serialized.hidden_size),
+                dtype,
+            )
+        )
+        up.append(
+            _decode(
+                layer.up, layer.up_scales, serialized.encoding, (out_size, rank), dtype
+            )
+        )
+
+    adapter: Adapter
+    if serialized.es is not None:
+        adapter = EsAdapter(
+            adapter_id=adapter_id,
+            rank=rank,
+            alpha=serialized.alpha,
+            out_features=serialized.out_features,
+            population_size=serialized.es.population_size,
+            mu_fraction=serialized.es.mu_fraction,
+            sigma=serialized.es.sigma,
+        )
+    else:
+        adapter = Adapter(adapter_id, rank, serialized.alpha, serialized.out_features)
+    return adapter, down, up
+
+
+class AdapterStore:
+    """Adapters in host memory, paged into the device slots of `adapter_at_layer`."""
+
+    def __init__(
+        self,
+        adapter_at_layer: list[tuple[torch.Tensor, torch.Tensor]],
+        max_num_adapters: int,
+        pin_memory: bool = False,
+    ):
+        self.adapter_at_layer = adapter_at_layer
+        self.max_num_adapters = max_num_adapters
+        self.pin_memory = pin_memory
+
+        self._adapters: dict[int, Adapter] = {}
+        # Host weights, absent for adapters that were created on the device
+        # and never left their slot
+        self._host_weights: dict[int, tuple[list[torch.Tensor], list[torch.Tensor]]] = (
+            {}
+        )
+        # Resident adapters and their slots, least recently used first
+        self._slots: OrderedDict[int, int] = OrderedDict()
+        self._free_slots = list(reversed(range(adapter_at_layer[0][0].shape[0])))
+        # Resident adapters whose slot holds newer weights than the host
+        self._dirty: set[int] = set()
+
+        self.hits = 0
+        self.loads = 0
+        self.evictions = 0
+
+    def __contains__(self, adapter_ptr: object) -> bool:
+        return adapter_ptr in self._adapters
+
+    def get(self, adapter_ptr: int) -> Adapter | None:
+        """Returns the adapter at `adapter_ptr`, if any."""
+        return self._adapters.get(adapter_ptr)
+
+    def _check_ptr(self, adapter_ptr: int) -> None:
+        if not 0 <= adapter_ptr < self.max_num_adapters:
+            raise ValueError(
+                f"Adapter pointer {adapter_ptr} out of range "
+                f"[0, {self.max_num_adapters})."
+            )
+
+    def add(
+        self,
+        adapter_ptr: int,
+        adapter: Adapter,
+        down: list[torch.Tensor],
+        up: list[torch.Tensor],
+    ) -> None:
+        """Stores an adapter with its host weights, replacing any previous one."""
+        self._check_ptr(adapter_ptr)
+        w_down, w_up = self.adapter_at_layer[0]
+        if len(down) != len(self.adapter_at_layer) or len(up) != len(down):
+            raise ValueError(
+                f"Adapter has {len(down)} layers, the model has "
+                f"{len(self.adapter_at_layer)}."
+            )
+        if not 0 < adapter.rank <= w_up.shape[-1]:
+            raise ValueError(
+                f"Adapter rank {adapter.rank} out of range [1, {w_up.shape[-1]}]."
+            )
+        if down[0].shape[-1] != w_down.shape[-1] or up[0].shape[0] != w_up.shape[1]:
+            raise ValueError(
+                f"Adapter shapes {tuple(down[0].shape)} and {tuple(up[0].shape)} "
+                f"do not match the model."
+            )
+
+        if self.pin_memory:
+            down = [tensor.pin_memory() for tensor in down]
+            up = [tensor.pin_memory() for tensor in up]
+        self._release(adapter_ptr)
+        self._adapters[adapter_ptr] = adapter
+        self._host_weights[adapter_ptr] = (down, up)
+
+    def create(self, adapter_ptr: int, adapter: Adapter) -> int:
+        """Registers an adapter whose weights are written in its slot, returned."""
+        self._check_ptr(adapter_ptr)
+        self._release(adapter_ptr)
+        self._adapters[adapter_ptr] = adapter
+        slot = self.acquire([adapter_ptr])[adapter_ptr]
+        self._dirty.add(adapter_ptr)
+        return slot
+
+    def mark_dirty(self, adapter_ptr: int) -> None:
+        """Records that the slot of a resident adapter was written to."""
+        if adapter_ptr not in self._slots:
+            raise ValueError(f"Adapter {adapter_ptr} is not resident.")
+        self._dirty.add(adapter_ptr)
+
+    def _release(self, adapter_ptr: int) -> None:
+        """Forgets an adapter and frees its slot."""
+        slot = self._slots.pop(adapter_ptr, None)
+        if slot is not None:
+            self._free_slots.append(slot)
+        self._dirty.discard(adapter_ptr)
+        self._adapters.pop(adapter_ptr, None)
+        self._host_weights.pop(adapter_ptr, None)
+
+    def acquire(self, adapter_ptrs) -> dict[int, int]:
+        """
+        Makes the given adapters resident and returns their slots.
+
+        Adapters that are missing from the device are loaded into free slots,
+        or into the slots of the least recently used adapters not requested.
+        """
+        needed = list(dict.fromkeys(adapter_ptrs))
+        if len(needed) > len(self._slots) + len(self._free_slots):
+            raise ValueError(
+                f"A batch uses {len(needed)} adapters, but only "
+                f"{len(self._slots) + len(self._free_slots)} fit on the device."
+            )
+
+        slots = {}
+        for adapter_ptr in needed:
+            if adapter_ptr not in self._adapters:
+                raise ValueError(f"Adapter {adapter_ptr} does not exist.")
+            slot = self._slots.get(adapter_ptr)
+            if slot is not None:
+                self._slots.move_to_end(adapter_ptr)
+                self.hits += 1
+            else:
+                slot = self._take_slot(set(needed))
+                self._load(adapter_ptr, slot)
+                self._slots[adapter_ptr] = slot
+            slots[adapter_ptr] = slot
+        return slots
+
+    def _take_slot(self, keep: set[int]) -> int:
+        if self._free_slots:
+            return self._free_slots.pop()
+        victim = next(ptr for ptr in self._slots if ptr not in keep)
+        if victim in self._dirty:
+            self._host_weights[victim] = self._read_slot(victim)
+            self._dirty.discard(victim)
+        self.evictions += 1
+        return self._slots.pop(victim)
+
+    def _load(self, adapter_ptr: int, slot: int) -> None:
+        rank = self._adapters[adapter_ptr].rank
+        host_weights = self._host_weights.get(adapter_ptr)
+        for layer_idx, (w_down, w_up) in enumerate(self.adapter_at_layer):
+            w_down[slot].zero_()
+            w_up[slot].zero_()
+            if host_weights is not None:
+                down, up = host_weights
+                w_down[slot, : 3 * rank].copy_(down[layer_idx], non_blocking=True)
+                w_up[slot, :, :rank].copy_(up[layer_idx], non_blocking=True)
+        self.loads += 1
+
+    def _read_slot(
+        self, adapter_ptr: int
+    ) -> tuple[list[torch.Tensor], list[torch.Tensor]]:
+        slot = self._slots[adapter_ptr]
+        rank = self._adapters[adapter_ptr].rank
+        down = []
+        up = []
+        for w_down, w_up in self.adapter_at_layer:
+            down.append(w_down[slot, : 3 * rank].to("cpu", copy=True))
+            up.append(w_up[slot, :, :rank].to("cpu", copy=True))
+        if self.pin_memory:
+            down = [tensor.pin_memory() for tensor in down]
+            up = [tensor.pin_memory() for tensor in up]
+        return down, up
+
+    def host_weights(
+        self, adapter_ptr: int
+    ) -> tuple[list[torch.Tensor], list[torch.Tensor]]:
+        """Returns the current per-layer down and up weights of an adapter."""
+        if adapter_ptr not in self._adapters:
+            raise ValueError(f"Adapter {adapter_ptr} does not exist.")
+        if adapter_ptr in self._dirty:
+            self._host_weights[adapter_ptr] = self._read_slot(adapter_ptr)
+            self._dirty.discard(adapter_ptr)
+        return self._host_weights[adapter_ptr]
+
+    def stats(self) -> dict[str, int]:
+        """Returns the number of stored and resident adapters, and slot traffic."""
+        return {
+            "adapters": len(self._adapters),
+            "resident": len(self._slots),
+            "hits": self.hits,
+            "loads": self.loads,
+            "evictions": self.evictions,
+        }
+
+
+__all__ = [
+    "ADAPTER_ENCODINGS",
+    "AdapterStore",
+    "deserialize_adapter",
+    "serialize_adapter",
+]
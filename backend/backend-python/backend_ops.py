@@ -0,0 +1,48 @@
+"""
+Selection of the kernel library that backs the `ops` namespace.
+
+The handler and the models call a FlashInfer-compatible `ops` module. It is
+resolved once here, in order of preference:
+
+1. `pie_metal.ops` on Apple Silicon, `flashinfer` elsewhere (native kernels).
+2. `torch_ops`, the portable PyTorch implementation, when neither is installed.
+"""
+
+from __future__ import annotations
+
+from types import ModuleType
+
+from platform_detection import is_apple_silicon
+
+NATIVE_BACKEND_NAME = "pie-metal" if is_apple_silicon() else "flashinfer"
+
+native_ops: ModuleType | None
+if is_apple_silicon():
+    try:
+        import pie_metal.ops as native_ops  # type: ignore[import-not-found,no-redef]
+    except ImportError:
+        native_ops = None
+else:
+    try:
+        import flashinfer as native_ops  # type: ignore[import-not-found,no-redef]
+    except ImportError:
+        native_ops = None
+
+NATIVE_OPS_AVAILABLE = native_ops is not None
+
+if native_ops is not None:
+    ops: ModuleType = native_ops
+    BACKEND_NAME = NATIVE_BACKEND_NAME
+else:
+    import torch_ops as ops  # type: ignore[no-redef]
+
+    BACKEND_NAME = "torch"
+
+
+__all__ = [
+    "BACKEND_NAME",
+    "NATIVE_BACKEND_NAME",
+    "NATIVE_OPS_AVAILABLE",
+    "native_ops",
+    "ops",
+]
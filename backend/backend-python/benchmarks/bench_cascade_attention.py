@@ -0,0 +1,167 @@
+"""
+Benchmark cascade attention on a decode batch that shares a long prefix.
+
+All requests fork from the same `prefix_len`-token prompt and have a short
+private suffix. The batch runs through `TorchL4maBackend` twice: once as is,
+which gathers the prefix pages once per request, and once with the shared
+prefix detected by `prepare_shared_prefix`, which reads them once for the
+whole batch and merges the partial results by log-sum-exp.
+
+Example:
+    python benchmarks/bench_cascade_attention.py --batch_size 64 --prefix_len 4096
+"""
+
+from __future__ import annotations
+
+import dataclasses
+import statistics
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+
+BACKEND_DIR = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(BACKEND_DIR))
+
+# pylint: disable=wrong-import-position
+from model.l4ma_runtime import AttentionSpec, DefaultRope, RuntimeInputs
+from model.l4ma_torch import TorchL4maBackend
+from shared_prefix import prepare_shared_prefix
+
+
+def _make_batch(
+    batch_size: int,
+    prefix_len: int,
+    suffix_len: int,
+    page_size: int,
+    num_kv_heads: int,
+    head_size: int,
+    dtype: torch.dtype,
+    device: str,
+):
+    """Builds a decode batch whose requests share their first prefix pages."""
+    prefix_pages = prefix_len // page_size
+    seq_len = prefix_pages * page_size + suffix_len
+    pages_per_req = -(-seq_len // page_size)
+    suffix_pages = pages_per_req - prefix_pages
+    num_pages = prefix_pages + batch_size * suffix_pages
+
+    kv_cache = torch.randn(
+        num_pages, 2, page_size, num_kv_heads, head_size, dtype=dtype, device=device
+    )
+    kv_page_ptrs = [
+        list(range(prefix_pages))
+        + list(
+            range(
+                prefix_pages + b * suffix_pages, prefix_pages + (b + 1) * suffix_pages
+            )
+        )
+        for b in range(batch_size)
+    ]
+    qo_indptr = list(range(batch_size + 1))
+    masks = [np.ones(seq_len, dtype=np.bool_) for _ in range(batch_size)]
+
+    def as_tensor(values: list[int]) -> torch.Tensor:
+        return torch.as_tensor(values, dtype=torch.int32, device=device)
+
+    inputs = RuntimeInputs(
+        num_tokens=batch_size,
+        kv_cache_at_layer=[kv_cache],
+        kv_page_indices=as_tensor(sum(kv_page_ptrs, [])),
+        kv_page_indptr=as_tensor([b * pages_per_req for b in range(batch_size + 1)]),
+        kv_last_page_lens=as_tensor(
+            [seq_len - (pages_per_req - 1) * page_size] * batch_size
+        ),
+        qo_indptr=as_tensor(qo_indptr),
+        custom_mask=torch.as_tensor(np.concatenate(masks), device=device),
+        single_token_inference_mode=True,
+    )
+    shared_prefix = prepare_shared_prefix(
+        kv_page_ptrs, qo_indptr, masks, page_size, device
+    )
+    return inputs, shared_prefix
+
+
+def _time(fn, device: str, warmup: int, iters: int) -> float:
+    """Returns the median latency of `fn` in milliseconds."""
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(iters):
+        if device.startswith("cuda"):
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        fn()
+        if device.startswith("cuda"):
+            torch.cuda.synchronize()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+def main(
+    device: str = "cpu",
+    dtype: str = "float32",
+    batch_size: int = 64,
+    prefix_len: int = 4096,
+    suffix_len: int = 32,
+    page_size: int = 16,
+    num_query_heads: int = 32,
+    num_key_value_heads: int = 8,
+    head_size: int = 128,
+    warmup: int = 2,
+    iters: int = 10,
+):
+    """Runs the benchmark and prints the latency with and without cascade."""
+    torch_dtype = getattr(torch, dtype)
+    inputs, shared_prefix = _make_batch(
+        batch_size,
+        prefix_len,
+        suffix_len,
+        page_size,
+        num_key_value_heads,
+        head_size,
+        torch_dtype,
+        device,
+    )
+    cascade_inputs = dataclasses.replace(inputs, shared_prefix=shared_prefix)
+    kv_cache = inputs.kv_cache_at_layer[0]
+    query = torch.randn(
+        batch_size, num_query_heads, head_size, dtype=torch_dtype, device=device
+    )
+    backend = TorchL4maBackend()
+    spec = AttentionSpec(
+        num_query_heads=num_query_heads,
+        num_key_value_heads=num_key_value_heads,
+        head_size=head_size,
+        dtype=torch_dtype,
+        device=device,
+        rope=DefaultRope(theta=10000.0),
+    )
+
+    def run(runtime_inputs: RuntimeInputs):
+        # Include the per-pass planning, which all layers of a pass share.
+        context = backend.create_forward_context(spec=spec, inputs=runtime_inputs)
+        return context.run_attention(0, query, kv_cache)
+
+    with torch.inference_mode():
+        max_err = (run(inputs).float() - run(cascade_inputs).float()).abs().max().item()
+        paged_ms = _time(lambda: run(inputs), device, warmup, iters)
+        cascade_ms = _time(lambda: run(cascade_inputs), device, warmup, iters)
+
+    print(
+        f"batch={batch_size} prefix={prefix_len} suffix={suffix_len} "
+        f"heads={num_query_heads}/{num_key_value_heads} head_size={head_size} "
+        f"device={device} dtype={dtype}"
+    )
+    print(f"  per-request attention: {paged_ms:8.3f} ms")
+    print(f"  cascade attention:     {cascade_ms:8.3f} ms")
+    print(f"  speedup:               {paged_ms / cascade_ms:8.2f}x")
+    print(f"  max abs error:         {max_err:.2e}")
+
+
+if __name__ == "__main__":
+    import fire
+
+    fire.Fire(main)
@@ -0,0 +1,156 @@
+"""
+Benchmark model startup with and without the cached fused parameters.
+
+Writes a GPT OSS checkpoint with random weights, storing the attention
+projections separately and the experts as MXFP4 blocks and scales, as the
+published checkpoints do. It then times `load_model` three ways: with the
+cache disabled, on the first start with the cache enabled (which hashes the
+checkpoint and saves the artifact), and on a later start that reads the fused
+and dequantized parameters from the artifact.
+
+Example:
+    python benchmarks/bench_fused_weight_cache.py --num_layers 4 --num_experts 32
+"""
+
+from __future__ import annotations
+
+import sys
+import tempfile
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+import torch
+import ztensor
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+# pylint: disable=wrong-import-position
+from config.gptoss import GptOssArch
+from model.gptoss import GptOssForCausalLM, create_fusion_map
+from model.l4ma_torch import TorchL4maBackend
+from model_loader import load_model
+
+
+# Standard deviation of the random weights
+_WEIGHT_SCALE = 0.02
+
+
+def _create_model(model_info):
+    model = GptOssForCausalLM(model_info.architecture, backend=TorchL4maBackend())
+    return model, create_fusion_map(model)
+
+
+def _checkpoint_tensors(arch: GptOssArch) -> dict[str, torch.Tensor]:
+    """
+    Returns random checkpoint tensors, named as the fusion map expects.
+
+    The model is created with uninitialized parameters, so every floating-point
+    tensor is replaced by normal values of standard deviation `_WEIGHT_SCALE`,
+    and the norm weights by ones.
+    """
+    model, fusion_map = _create_model(SimpleNamespace(architecture=arch))
+    kv_size = arch.num_key_value_heads * arch.head_size
+    qkv_sizes = [arch.num_query_heads * arch.head_size, kv_size, kv_size]
+
+    tensors = {}
+    for name, tensor in model.state_dict().items():
+        if "norm" in name:
+            tensor = torch.ones_like(tensor)
+        elif tensor.is_floating_point():
+            tensor = (torch.randn(tensor.shape) * _WEIGHT_SCALE).to(tensor.dtype)
+        details = fusion_map.get(name)
+        if details is None:
+            tensors[name] = tensor
+        elif details["op"] == "fusion":
+            for source, part in zip(details["sources"], tensor.split(qkv_sizes)):
+                tensors[source] = part
+        else:
+            # Random MXFP4 blocks and scales with exponents around 2^-6
+            blocks, scales = details["sources"]
+            num_experts, rows, cols = tensor.shape
+            tensors[blocks] = torch.randint(
+                0, 256, (num_experts, rows, cols // 32, 16), dtype=torch.uint8
+            )
+            tensors[scales] = torch.randint(
+                118, 124, (num_experts, rows, cols // 32), dtype=torch.uint8
+            )
+    return tensors
+
+
+def main(
+    num_layers: int = 4,
+    hidden_size: int = 1024,
+    intermediate_size: int = 1024,
+    num_experts: int = 32,
+    vocab_size: int = 32000,
+    dtype: str = "bfloat16",
+):
+    """Runs the benchmark and prints the startup time of each configuration."""
+    arch = GptOssArch(
+        type="gptoss",
+        num_layers=num_layers,
+        num_query_heads=hidden_size // 64,
+        num_key_value_heads=hidden_size // 512,
+        head_size=64,
+        hidden_size=hidden_size,
+        intermediate_size=intermediate_size,
+        vocab_size=vocab_size,
+        use_qkv_bias=True,
+        rms_norm_eps=1e-5,
+        device="cpu",
+        dtype=getattr(torch, dtype),
+        num_experts=num_experts,
+        experts_per_token=4,
+        rope_theta=150000.0,
+        rope_scaling_factor=32.0,
+        rope_ntk_alpha=1.0,
+        rope_ntk_beta=32.0,
+        initial_context_length=4096,
+        sliding_window=128,
+        swiglu_limit=7.0,
+    )
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        weights_dir = Path(cache_dir) / "models" / "bench"
+        weights_dir.mkdir(parents=True)
+        with ztensor.Writer(str(weights_dir / "model.zt")) as writer:
+            for name, tensor in _checkpoint_tensors(arch).items():
+                writer.add_tensor(name, tensor)
+        model_info = SimpleNamespace(parameters=["model.zt"], architecture=arch)
+
+        def start(cache_fused_weights: bool) -> tuple[float, torch.nn.Module]:
+            config = {
+                "model": "bench",
+                "cache_dir": cache_dir,
+                "device": "cpu",
+                "cache_fused_weights": cache_fused_weights,
+            }
+            begin = time.perf_counter()
+            model = load_model(config, model_info, _create_model)  # type: ignore[arg-type]
+            return time.perf_counter() - begin, model
+
+        uncached_seconds, uncached = start(False)
+        cold_seconds, _ = start(True)
+        warm_seconds, warm = start(True)
+
+        warm_state = warm.state_dict()
+        max_err = max(
+            (tensor.float() - warm_state[name].float()).abs().max().item()
+            for name, tensor in uncached.state_dict().items()
+        )
+
+    print(
+        f"layers={num_layers} hidden={hidden_size} experts={num_experts} "
+        f"dtype={dtype}"
+    )
+    print(f"  cache disabled:     {uncached_seconds * 1000:9.1f} ms")
+    print(f"  cold start (save):  {cold_seconds * 1000:9.1f} ms")
+    print(f"  warm start (read):  {warm_seconds * 1000:9.1f} ms")
+    print(f"  max abs difference: {max_err:.2e}")
+
+
+if __name__ == "__main__":
+    import fire
+
+    fire.Fire(main)
@@ -0,0 +1,120 @@
+"""
+Benchmark the two execution paths of the GPT OSS experts layer.
+
+`gathered` copies the weights of every token's experts before two einsums,
+while `grouped` sorts the token-expert assignments by expert and runs one GEMM
+per active expert. `GptOssExperts.forward` picks between them by batch size.
+
+Example:
+    python benchmarks/bench_gptoss_moe.py --device cpu --batch_sizes 1,8,64,512
+"""
+
+from __future__ import annotations
+
+import statistics
+import sys
+import time
+from pathlib import Path
+
+import torch
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+# pylint: disable=wrong-import-position
+from config.gptoss import GptOssArch
+from model.gptoss import GptOssMlp
+
+
+def _time(fn, device: str, warmup: int, iters: int) -> float:
+    """Returns the median latency of `fn` in milliseconds."""
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(iters):
+        if device.startswith("cuda"):
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        fn()
+        if device.startswith("cuda"):
+            torch.cuda.synchronize()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+def main(
+    device: str = "cpu",
+    dtype: str = "float32",
+    batch_sizes: tuple[int, ...] = (1, 4, 16, 64, 256),
+    hidden_size: int = 512,
+    intermediate_size: int = 512,
+    num_experts: int = 32,
+    experts_per_token: int = 4,
+    warmup: int = 2,
+    iters: int = 10,
+):
+    """Runs the benchmark and prints the latency of both paths per batch size."""
+    if isinstance(batch_sizes, int):
+        batch_sizes = (batch_sizes,)
+    arch = GptOssArch(
+        type="gptoss",
+        num_layers=1,
+        num_query_heads=1,
+        num_key_value_heads=1,
+        head_size=64,
+        hidden_size=hidden_size,
+        intermediate_size=intermediate_size,
+        vocab_size=0,
+        use_qkv_bias=True,
+        rms_norm_eps=1e-5,
+        device=device,
+        dtype=getattr(torch, dtype),
+        num_experts=num_experts,
+        experts_per_token=experts_per_token,
+        rope_theta=150000.0,
+        rope_scaling_factor=32.0,
+        rope_ntk_alpha=1.0,
+        rope_ntk_beta=32.0,
+        initial_context_length=4096,
+        sliding_window=0,
+        swiglu_limit=7.0,
+    )
+    mlp = GptOssMlp(arch).eval()
+    for param in mlp.parameters():
+        torch.nn.init.normal_(param, std=0.02)
+    experts = mlp.experts
+
+    print(
+        f"hidden={hidden_size} intermediate={intermediate_size} "
+        f"experts={num_experts} top_k={experts_per_token} "
+        f"device={device} dtype={dtype}"
+    )
+    print(f"  {'tokens':>7} {'gathered ms':>12} {'grouped ms':>12} {'max err':>9}")
+    for batch_size in batch_sizes:
+        x = torch.randn(batch_size, hidden_size, dtype=arch.dtype, device=device)
+        with torch.inference_mode():
+            router_scores, router_indices = mlp.router(x)
+            expert_weights = torch.gather(router_scores, 1, router_indices)
+            args = (x, router_indices, expert_weights)
+
+            max_err = (
+                (experts._forward_gathered(*args) - experts._forward_grouped(*args))
+                .abs()
+                .max()
+                .item()
+            )
+            gathered_ms = _time(
+                lambda: experts._forward_gathered(*args), device, warmup, iters
+            )
+            grouped_ms = _time(
+                lambda: experts._forward_grouped(*args), device, warmup, iters
+            )
+        print(
+            f"  {batch_size:>7} {gathered_ms:>12.3f} {grouped_ms:>12.3f} "
+            f"{max_err:>9.1e}"
+        )
+
+
+if __name__ == "__main__":
+    import fire
+
+    fire.Fire(main)
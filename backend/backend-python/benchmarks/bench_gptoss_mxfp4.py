@@ -0,0 +1,184 @@
+"""
+Benchmark GPT OSS experts with MXFP4 weights kept packed versus dequantized.
+
+Builds one MoE layer from random MXFP4 blocks and scales, then compares the
+resident weight memory and the latency of the experts layer when the weights
+are dequantized at load time and when they stay packed with an LRU of
+`cache_sizes` dequantized experts per weight.
+
+Example:
+    python benchmarks/bench_gptoss_mxfp4.py --device cpu --batch_sizes 1,8,64
+"""
+
+from __future__ import annotations
+
+import dataclasses
+import statistics
+import sys
+import time
+from pathlib import Path
+
+import torch
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+# pylint: disable=wrong-import-position
+from config.gptoss import GptOssArch
+from model.gptoss import GptOssMlp
+from model_loader import _dequantize_from_mxfp4
+from mxfp4 import FP4_VALUES
+
+
+def _time(fn, device: str, warmup: int, iters: int) -> float:
+    """Returns the median latency of `fn` in milliseconds."""
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(iters):
+        if device.startswith("cuda"):
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        fn()
+        if device.startswith("cuda"):
+            torch.cuda.synchronize()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+def _expert_weight_bytes(mlp: GptOssMlp) -> int:
+    """Bytes of the expert projection weights (packed or dequantized)."""
+    experts = mlp.experts
+    names = (
+        ("gate_up_proj_blocks", "gate_up_proj_scales")
+        + ("down_proj_blocks", "down_proj_scales")
+        if experts.packed
+        else ("gate_up_proj", "down_proj")
+    )
+    return sum(
+        getattr(experts, name).numel() * getattr(experts, name).element_size()
+        for name in names
+    )
+
+
+def main(
+    device: str = "cpu",
+    dtype: str = "bfloat16",
+    batch_sizes: tuple[int, ...] = (1, 8, 64),
+    cache_sizes: tuple[int, ...] = (4, 32),
+    hidden_size: int = 1024,
+    intermediate_size: int = 1024,
+    num_experts: int = 32,
+    experts_per_token: int = 4,
+    warmup: int = 2,
+    iters: int = 10,
+):
+    """Runs the benchmark and prints memory and latency per configuration."""
+    if isinstance(batch_sizes, int):
+        batch_sizes = (batch_sizes,)
+    if isinstance(cache_sizes, int):
+        cache_sizes = (cache_sizes,)
+    arch = GptOssArch(
+        type="gptoss",
+        num_layers=1,
+        num_query_heads=1,
+        num_key_value_heads=1,
+        head_size=64,
+        hidden_size=hidden_size,
+        intermediate_size=intermediate_size,
+        vocab_size=0,
+        use_qkv_bias=True,
+        rms_norm_eps=1e-5,
+        device=device,
+        dtype=getattr(torch, dtype),
+        num_experts=num_experts,
+        experts_per_token=experts_per_token,
+        rope_theta=150000.0,
+        rope_scaling_factor=32.0,
+        rope_ntk_alpha=1.0,
+        rope_ntk_beta=32.0,
+        initial_context_length=4096,
+        sliding_window=0,
+        swiglu_limit=7.0,
+    )
+
+    # Random packed weights with exponents around 2^-6, as in trained models
+    packed = {}
+    for name, rows, cols in (
+        ("gate_up_proj", intermediate_size * 2, hidden_size),
+        ("down_proj", hidden_size, intermediate_size),
+    ):
+        packed[f"{name}_blocks"] = torch.randint(
+            0, 256, (num_experts, rows, cols // 32, 16), dtype=torch.uint8
+        )
+        packed[f"{name}_scales"] = torch.randint(
+            118, 124, (num_experts, rows, cols // 32), dtype=torch.uint8
+        )
+
+    dense_mlp = GptOssMlp(arch).eval()
+    for param in dense_mlp.parameters():
+        torch.nn.init.normal_(param, std=0.02)
+    with torch.no_grad():
+        for name in ("gate_up_proj", "down_proj"):
+            getattr(dense_mlp.experts, name).copy_(
+                _dequantize_from_mxfp4(
+                    packed[f"{name}_blocks"],
+                    packed[f"{name}_scales"],
+                    FP4_VALUES,
+                    device=device,
+                    dtype=arch.dtype,
+                )
+            )
+
+    mlps = {"dequantized": dense_mlp}
+    for cache_size in cache_sizes:
+        mlp = GptOssMlp(
+            dataclasses.replace(arch, mxfp4_expert_cache_size=cache_size)
+        ).eval()
+        state = {
+            k: v for k, v in dense_mlp.state_dict().items() if k in mlp.state_dict()
+        }
+        state.update({f"experts.{k}": v for k, v in packed.items()})
+        mlp.load_state_dict(state)
+        mlps[f"packed lru={cache_size}"] = mlp
+
+    print(
+        f"hidden={hidden_size} intermediate={intermediate_size} "
+        f"experts={num_experts} top_k={experts_per_token} "
+        f"device={device} dtype={dtype}"
+    )
+    for label, mlp in mlps.items():
+        print(f"  {label:<18} weights: {_expert_weight_bytes(mlp) / 2**20:8.1f} MiB")
+
+    print(f"  {'tokens':>7} {'mode':<18} {'ms':>9} {'max err':>9} {'hit rate':>9}")
+    for batch_size in batch_sizes:
+        # Decode-like traffic: a few batches drawn from the same hidden states
+        inputs = [
+            torch.randn(batch_size, hidden_size, dtype=arch.dtype, device=device)
+            for _ in range(4)
+        ]
+        with torch.inference_mode():
+            reference = dense_mlp(inputs[0]).float()
+            for label, mlp in mlps.items():
+                step = iter(range(10**9))
+                max_err = (mlp(inputs[0]).float() - reference).abs().max().item()
+                latency_ms = _time(
+                    lambda mlp=mlp, step=step: mlp(inputs[next(step) % len(inputs)]),
+                    device,
+                    warmup,
+                    iters,
+                )
+                hit_rate = ""
+                if mlp.experts.packed:
+                    cache = mlp.experts.gate_up_proj_cache
+                    hit_rate = f"{cache.hits / max(1, cache.hits + cache.misses):.2f}"
+                    cache.hits = cache.misses = 0
+                print(
+                    f"  {batch_size:>7} {label:<18} {latency_ms:>9.3f} "
+                    f"{max_err:>9.1e} {hit_rate:>9}"
+                )
+
+
+if __name__ == "__main__":
+    import fire
+
+    fire.Fire(main)
@@ -0,0 +1,178 @@
+"""
+Benchmark the prefill latency of a randomly initialized GPT OSS model.
+
+Reports the latency of a full `GptOssModel.forward` over one long prompt, and
+of the mask preparation on its own. The latter is compared with the per-query
+Python loop that used to build the sliding-window mask, which issued one
+device sync and one slice assignment per query token.
+
+Example:
+    python benchmarks/bench_gptoss_prefill.py --device cpu --prompt_len 4096
+"""
+
+from __future__ import annotations
+
+import statistics
+import sys
+import time
+from pathlib import Path
+
+import torch
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+# pylint: disable=wrong-import-position
+import torch_ops
+from config.gptoss import GptOssArch
+from model.gptoss import GptOssModel
+from model.l4ma_torch import TorchL4maBackend
+
+
+def _time(fn, device: str, warmup: int, iters: int) -> float:
+    """Returns the median latency of `fn` in milliseconds."""
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(iters):
+        if device.startswith("cuda"):
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        fn()
+        if device.startswith("cuda"):
+            torch.cuda.synchronize()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+def _legacy_window_mask(
+    custom_mask: torch.Tensor, position_ids: torch.Tensor, window: int
+) -> torch.Tensor:
+    """The per-query loop previously used for a single-request batch."""
+    query_len = position_ids.numel()
+    mask = custom_mask.clone().view(query_len, -1)
+    for q_idx in range(query_len):
+        mask[q_idx, : max(0, int(position_ids[q_idx]) - (window - 1))] = 0
+    return mask
+
+
+def main(
+    device: str = "cpu",
+    dtype: str = "float32",
+    prompt_len: int = 2048,
+    page_size: int = 16,
+    num_layers: int = 2,
+    hidden_size: int = 512,
+    num_query_heads: int = 8,
+    num_key_value_heads: int = 2,
+    head_size: int = 64,
+    num_experts: int = 8,
+    experts_per_token: int = 2,
+    sliding_window: int = 128,
+    warmup: int = 1,
+    iters: int = 5,
+):
+    """Runs the benchmark and prints the prefill and mask latencies."""
+    arch = GptOssArch(
+        type="gptoss",
+        num_layers=num_layers,
+        num_query_heads=num_query_heads,
+        num_key_value_heads=num_key_value_heads,
+        head_size=head_size,
+        hidden_size=hidden_size,
+        intermediate_size=hidden_size,
+        vocab_size=1024,
+        use_qkv_bias=True,
+        rms_norm_eps=1e-5,
+        device=device,
+        dtype=getattr(torch, dtype),
+        num_experts=num_experts,
+        experts_per_token=experts_per_token,
+        rope_theta=150000.0,
+        rope_scaling_factor=32.0,
+        rope_ntk_alpha=1.0,
+        rope_ntk_beta=32.0,
+        initial_context_length=4096,
+        sliding_window=sliding_window,
+        swiglu_limit=7.0,
+    )
+    model = GptOssModel(arch, TorchL4maBackend()).eval()
+    for param in model.parameters():
+        torch.nn.init.normal_(param, std=0.02)
+
+    num_pages = -(-prompt_len // page_size)
+    kv_cache_at_layer = [
+        torch.zeros(
+            num_pages,
+            2,
+            page_size,
+            num_key_value_heads,
+            head_size,
+            dtype=arch.dtype,
+            device=device,
+        )
+        for _ in range(num_layers)
+    ]
+    kv_page_indices = torch.arange(num_pages, dtype=torch.int32, device=device)
+    kv_page_indptr = torch.tensor([0, num_pages], dtype=torch.int32, device=device)
+    kv_last_page_lens = torch.tensor(
+        [prompt_len - (num_pages - 1) * page_size], dtype=torch.int32, device=device
+    )
+    qo_indptr = torch.tensor([0, prompt_len], dtype=torch.int32, device=device)
+    position_ids = torch.arange(prompt_len, dtype=torch.int32, device=device)
+    custom_mask = torch.tril(
+        torch.ones(prompt_len, prompt_len, dtype=torch.bool, device=device)
+    ).flatten()
+    input_embeds = torch.randn(prompt_len, hidden_size, dtype=arch.dtype, device=device)
+
+    def run_forward():
+        return model(
+            input_embeds,
+            position_ids,
+            qo_indptr,
+            kv_cache_at_layer,
+            kv_page_indices,
+            kv_page_indptr,
+            kv_last_page_lens,
+            custom_mask,
+            False,
+            None,
+        )
+
+    def run_window_plan():
+        return torch_ops.plan_online_attention(
+            qo_indptr=qo_indptr,
+            kv_indptr=kv_page_indptr,
+            kv_indices=kv_page_indices,
+            kv_last_page_len=kv_last_page_lens,
+            num_qo_heads=num_query_heads,
+            num_kv_heads=num_key_value_heads,
+            head_dim=head_size,
+            page_size=page_size,
+            custom_mask=custom_mask,
+            window=sliding_window,
+            query_positions=position_ids,
+            nnz=prompt_len,
+        )
+
+    def run_legacy_mask():
+        return _legacy_window_mask(custom_mask, position_ids, sliding_window)
+
+    with torch.inference_mode():
+        forward_ms = _time(run_forward, device, warmup, iters)
+        plan_ms = _time(run_window_plan, device, warmup, iters)
+        legacy_ms = _time(run_legacy_mask, device, warmup, iters)
+
+    print(
+        f"prompt={prompt_len} layers={num_layers} hidden={hidden_size} "
+        f"heads={num_query_heads}/{num_key_value_heads} window={sliding_window} "
+        f"device={device} dtype={dtype}"
+    )
+    print(f"  prefill forward:      {forward_ms:9.3f} ms")
+    print(f"  window plan:          {plan_ms:9.3f} ms")
+    print(f"  legacy window mask:   {legacy_ms:9.3f} ms")
+
+
+if __name__ == "__main__":
+    import fire
+
+    fire.Fire(main)
@@ -0,0 +1,199 @@
+"""
+Benchmark the PyTorch L4MA attention backend against the per-request reference.
+
+Compares `TorchL4maBackend` (one paged-KV gather and one SDPA call for the whole
+batch) with `attention_reference` from pie-metal, which loops over requests and
+pages on the host. Runs on any device PyTorch supports.
+
+Example:
+    python benchmarks/bench_l4ma_attention.py --device cpu --batch_size 16
+"""
+
+from __future__ import annotations
+
+import statistics
+import sys
+import time
+from pathlib import Path
+
+import torch
+
+BACKEND_DIR = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(BACKEND_DIR))
+sys.path.insert(0, str(BACKEND_DIR.parents[1] / "pie-metal" / "src"))
+
+# pylint: disable=wrong-import-position
+from config.l4ma import L4maArch
+from model.l4ma_runtime import AttentionSpec, Llama31Rope, RuntimeInputs
+from model.l4ma_torch import TorchL4maBackend
+from pie_metal._internal.pytorch_reference import attention_reference
+
+
+def _make_batch(
+    arch: L4maArch,
+    batch_size: int,
+    context_len: int,
+    num_new_tokens: int,
+    page_size: int,
+    device: str,
+):
+    """Builds a random paged KV cache and the runtime inputs of one batch."""
+    seq_len = context_len + num_new_tokens
+    pages_per_req = -(-seq_len // page_size)
+    last_page_len = seq_len - (pages_per_req - 1) * page_size
+    num_pages = batch_size * pages_per_req
+
+    kv_cache = torch.randn(
+        num_pages,
+        2,
+        page_size,
+        arch.num_key_value_heads,
+        arch.head_size,
+        dtype=arch.dtype,
+        device=device,
+    )
+    # Shuffle the pages so the gather is not a contiguous slice.
+    kv_page_indices = torch.randperm(num_pages, device=device).to(torch.int32)
+    kv_page_indptr = torch.arange(
+        0, num_pages + 1, pages_per_req, dtype=torch.int32, device=device
+    )
+    kv_last_page_lens = torch.full(
+        (batch_size,), last_page_len, dtype=torch.int32, device=device
+    )
+    qo_indptr = torch.arange(
+        0,
+        batch_size * num_new_tokens + 1,
+        num_new_tokens,
+        dtype=torch.int32,
+        device=device,
+    )
+
+    causal = torch.ones(num_new_tokens, seq_len, dtype=torch.bool, device=device)
+    causal = torch.tril(causal, diagonal=context_len)
+    custom_mask = causal.flatten().repeat(batch_size)
+
+    inputs = RuntimeInputs(
+        num_tokens=batch_size * num_new_tokens,
+        kv_cache_at_layer=[kv_cache],
+        kv_page_indices=kv_page_indices,
+        kv_page_indptr=kv_page_indptr,
+        kv_last_page_lens=kv_last_page_lens,
+        qo_indptr=qo_indptr,
+        custom_mask=custom_mask,
+        single_token_inference_mode=num_new_tokens == 1,
+    )
+    query = torch.randn(
+        batch_size * num_new_tokens,
+        arch.num_query_heads,
+        arch.head_size,
+        dtype=arch.dtype,
+        device=device,
+    )
+    return inputs, query
+
+
+def _time(fn, device: str, warmup: int, iters: int) -> float:
+    """Returns the median latency of `fn` in milliseconds."""
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(iters):
+        if device.startswith("cuda"):
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        fn()
+        if device.startswith("cuda"):
+            torch.cuda.synchronize()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+def main(
+    device: str = "cpu",
+    dtype: str = "float32",
+    batch_size: int = 8,
+    context_len: int = 512,
+    num_new_tokens: int = 1,
+    page_size: int = 16,
+    num_query_heads: int = 32,
+    num_key_value_heads: int = 8,
+    head_size: int = 128,
+    warmup: int = 3,
+    iters: int = 20,
+):
+    """Runs the benchmark and prints the latency of both implementations."""
+    arch = L4maArch(
+        type="l4ma",
+        num_layers=1,
+        num_query_heads=num_query_heads,
+        num_key_value_heads=num_key_value_heads,
+        head_size=head_size,
+        hidden_size=num_query_heads * head_size,
+        intermediate_size=0,
+        vocab_size=0,
+        use_qkv_bias=False,
+        rms_norm_eps=1e-5,
+        device=device,
+        dtype=getattr(torch, dtype),
+        rope_factor=8.0,
+        rope_high_frequency_factor=4.0,
+        rope_low_frequency_factor=1.0,
+        rope_theta=500000.0,
+    )
+    inputs, query = _make_batch(
+        arch, batch_size, context_len, num_new_tokens, page_size, device
+    )
+    kv_cache = inputs.kv_cache_at_layer[0]
+    backend = TorchL4maBackend()
+    spec = AttentionSpec.from_arch(
+        arch,
+        rope=Llama31Rope(
+            theta=arch.rope_theta,
+            factor=arch.rope_factor,
+            low_frequency_factor=arch.rope_low_frequency_factor,
+            high_frequency_factor=arch.rope_high_frequency_factor,
+        ),
+    )
+
+    def run_torch():
+        # Include the per-pass planning, which all layers of a pass share.
+        context = backend.create_forward_context(spec=spec, inputs=inputs)
+        return context.run_attention(0, query, kv_cache)
+
+    def run_reference():
+        # The reference only supports causal masking (its custom mask marks
+        # masked-out entries), which matches the benchmark's mask.
+        return attention_reference(
+            query,
+            kv_cache,
+            inputs.kv_page_indices,
+            inputs.kv_page_indptr,
+            inputs.kv_last_page_lens,
+            inputs.qo_indptr,
+        )
+
+    with torch.inference_mode():
+        max_err = (
+            (run_torch().float() - run_reference().reshape(query.shape[0], -1).float())
+            .abs()
+            .max()
+            .item()
+        )
+        torch_ms = _time(run_torch, device, warmup, iters)
+        reference_ms = _time(run_reference, device, warmup, iters)
+
+    print(
+        f"batch={batch_size} context={context_len} new_tokens={num_new_tokens} "
+        f"heads={num_query_heads}/{num_key_value_heads} head_size={head_size} "
+        f"device={device} dtype={dtype}"
+    )
+    print(f"  torch backend:  {torch_ms:8.3f} ms")
+    print(f"  reference loop: {reference_ms:8.3f} ms")
+    print(f"  speedup:        {reference_ms / torch_ms:8.2f}x")
+    print(f"  max abs error:  {max_err:.2e}")
+
+
+if __name__ == "__main__":
+    import fire
+
+    fire.Fire(main)
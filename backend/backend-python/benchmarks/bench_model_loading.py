@@ -0,0 +1,157 @@
+"""
+Benchmark loading model weights from ztensor files.
+
+Writes the weights of a randomly initialized L4MA model to `num_files` tensor
+files, split into the per-projection tensors that checkpoints store, then
+loads them back with `load_model` for each number of I/O threads. The files
+were just written, so they are read from the page cache: this measures the
+loader itself rather than the disk. `load_model` prints the read throughput
+of each run.
+
+With `--mmap_weights`, the parameters stored in the model dtype are mapped
+from the files instead of being read. With `--load_host_memory_mb`, the model
+is loaded layer by layer within that host memory budget; `load_model` prints
+the peak resident memory either way.
+
+Example:
+    python benchmarks/bench_model_loading.py --num_layers 16 --num_threads 1,4,8
+"""
+
+from __future__ import annotations
+
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+import torch
+import ztensor
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+# pylint: disable=wrong-import-position
+from config.l4ma import L4maArch
+from model.l4ma import L4maForCausalLM, create_fusion_map
+from model.l4ma_torch import TorchL4maBackend
+from model_loader import load_model
+
+
+def _create_model(model_info):
+    model = L4maForCausalLM(model_info.architecture, backend=TorchL4maBackend())
+    return model, create_fusion_map(model)
+
+
+def _split_sizes(arch: L4maArch, fused_name: str) -> list[int]:
+    """Sizes of the source tensors of a fused parameter along dim 0."""
+    if ".qkv_proj." in fused_name:
+        kv_size = arch.num_key_value_heads * arch.head_size
+        return [arch.num_query_heads * arch.head_size, kv_size, kv_size]
+    return [arch.intermediate_size, arch.intermediate_size]
+
+
+def _write_checkpoint(
+    model_info, weights_dir: Path, num_files: int
+) -> tuple[list[str], int]:
+    """Writes the model weights as checkpoint tensors and returns the files."""
+    model, fusion_map = _create_model(model_info)
+    tensors = {}
+    for name, tensor in model.state_dict().items():
+        if name in fusion_map:
+            sizes = _split_sizes(model_info.architecture, name)
+            for source, part in zip(fusion_map[name]["sources"], tensor.split(sizes)):
+                tensors[source] = part
+        elif name != "lm_head.weight":
+            tensors[name] = tensor
+
+    names = list(tensors)
+    files = [f"model-{i:05d}.zt" for i in range(num_files)]
+    per_file = -(-len(names) // num_files)
+    for i, param_file in enumerate(files):
+        with ztensor.Writer(str(weights_dir / param_file)) as writer:
+            for name in names[i * per_file : (i + 1) * per_file]:
+                writer.add_tensor(name, tensors[name])
+    return files, sum(t.numel() * t.element_size() for t in tensors.values())
+
+
+def main(
+    num_threads: tuple[int, ...] = (1, 2, 4, 8),
+    num_layers: int = 16,
+    hidden_size: int = 2048,
+    intermediate_size: int = 8192,
+    vocab_size: int = 32000,
+    num_files: int = 4,
+    dtype: str = "bfloat16",
+    mmap_weights: bool = False,
+    load_host_memory_mb: int = 0,
+    iters: int = 3,
+):
+    """Runs the benchmark and prints the load time per number of threads."""
+    if isinstance(num_threads, int):
+        num_threads = (num_threads,)
+    torch_dtype = getattr(torch, dtype)
+    arch = L4maArch(
+        type="l4ma",
+        num_layers=num_layers,
+        num_query_heads=hidden_size // 128,
+        num_key_value_heads=hidden_size // 512,
+        head_size=128,
+        hidden_size=hidden_size,
+        intermediate_size=intermediate_size,
+        vocab_size=vocab_size,
+        use_qkv_bias=False,
+        rms_norm_eps=1e-5,
+        device="cpu",
+        dtype=torch_dtype,
+        rope_factor=8.0,
+        rope_high_frequency_factor=4.0,
+        rope_low_frequency_factor=1.0,
+        rope_theta=500000.0,
+    )
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        weights_dir = Path(cache_dir) / "models" / "bench"
+        weights_dir.mkdir(parents=True)
+        torch.set_default_dtype(torch_dtype)
+        files, num_bytes = _write_checkpoint(
+            SimpleNamespace(architecture=arch), weights_dir, num_files
+        )
+        model_info = SimpleNamespace(parameters=files, architecture=arch)
+        print(
+            f"layers={num_layers} hidden={hidden_size} files={num_files} "
+            f"size={num_bytes / 2**30:.2f} GiB dtype={dtype} mmap={mmap_weights}"
+        )
+
+        # For reference: building the model eagerly, with random initialization,
+        # as `load_model` did before it deferred the allocation of the weights.
+        start = time.perf_counter()
+        _create_model(model_info)
+        construct_seconds = time.perf_counter() - start
+
+        results = []
+        for threads in num_threads:
+            config = {
+                "model": "bench",
+                "cache_dir": cache_dir,
+                "device": "cpu",
+                "num_load_threads": threads,
+                "mmap_weights": mmap_weights,
+                "load_host_memory_mb": load_host_memory_mb,
+            }
+            samples = []
+            for _ in range(iters):
+                start = time.perf_counter()
+                load_model(config, model_info, _create_model)  # type: ignore[arg-type]
+                samples.append(time.perf_counter() - start)
+            results.append((threads, statistics.median(samples)))
+
+    print(f"  eager model construction: {construct_seconds * 1000:9.1f} ms")
+    for threads, seconds in results:
+        print(f"  load_model, {threads:2d} threads: {seconds * 1000:9.1f} ms")
+
+
+if __name__ == "__main__":
+    import fire
+
+    fire.Fire(main)
@@ -0,0 +1,211 @@
+"""
+Benchmark weight-only int8/int4 quantization against the unquantized model.
+
+Samples `num_tokens` tokens from the unquantized model, then reports for each
+`weight_quantization` mode the size of the weights, the decode throughput of
+a single sequence and the perplexity of the sampled tokens. The perplexity of
+the unquantized model on its own samples is the baseline; the increase of a
+quantized model over it measures how far its predictions drifted.
+
+By default the model is a randomly initialized L4MA model, whose predictions
+are close to uniform. With `--model`, the weights of that model are loaded
+from `--cache_dir` instead, as the server would.
+
+Example:
+    python benchmarks/bench_weight_quantization.py --num_layers 8 --hidden_size 2048
+    python benchmarks/bench_weight_quantization.py --model llama-3.2-1b-instruct
+"""
+
+from __future__ import annotations
+
+import copy
+import math
+import os
+import sys
+import time
+from functools import partial
+from pathlib import Path
+
+import torch
+from platformdirs import user_cache_dir
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+# pylint: disable=wrong-import-position
+from config.l4ma import L4maArch
+from memory_planner import measure_weight_bytes
+from model.l4ma import L4maForCausalLM
+from model.l4ma_torch import TorchL4maBackend
+from model_factory import ModelOptions, create_model_and_fusion_map
+from model_loader import load_model, load_model_info
+from weight_quantization import quantize_linears
+
+
+def _random_model(
+    num_layers: int, hidden_size: int, vocab_size: int, dtype: torch.dtype
+) -> tuple[torch.nn.Module, L4maArch]:
+    arch = L4maArch(
+        type="l4ma",
+        num_layers=num_layers,
+        num_query_heads=hidden_size // 64,
+        num_key_value_heads=hidden_size // 256,
+        head_size=64,
+        hidden_size=hidden_size,
+        intermediate_size=4 * hidden_size,
+        vocab_size=vocab_size,
+        use_qkv_bias=False,
+        rms_norm_eps=1e-5,
+        device="cpu",
+        dtype=dtype,
+        rope_factor=8.0,
+        rope_high_frequency_factor=4.0,
+        rope_low_frequency_factor=1.0,
+        rope_theta=500000.0,
+    )
+    model = L4maForCausalLM(arch, backend=TorchL4maBackend())
+    for param in model.parameters():
+        torch.nn.init.normal_(param, std=0.02)
+    return model, arch
+
+
+def _loaded_model(
+    model_name: str, cache_dir: str | None, dtype: str
+) -> tuple[torch.nn.Module, object]:
+    config = {
+        "model": model_name,
+        # As resolved by the server
+        "cache_dir": cache_dir or os.environ.get("PIE_HOME") or user_cache_dir("pie"),
+        "device": "cpu",
+        "dtype": dtype,
+    }
+    model_info = load_model_info(config)
+    create_model = partial(
+        create_model_and_fusion_map, options=ModelOptions(attention_backend="torch")
+    )
+    return load_model(config, model_info, create_model), model_info.architecture
+
+
+class _Sequence:
+    """Runs a single sequence through the model, keeping its KV cache."""
+
+    def __init__(self, model, arch, max_len: int, page_size: int = 16):
+        self.model = model
+        self.page_size = page_size
+        self.length = 0
+        num_pages = -(-max_len // page_size)
+        self.kv_cache_at_layer = [
+            torch.zeros(
+                num_pages,
+                2,
+                page_size,
+                arch.num_key_value_heads,
+                arch.head_size,
+                dtype=arch.dtype,
+            )
+            for _ in range(arch.num_layers)
+        ]
+
+    def forward(self, token_ids: list[int]) -> torch.Tensor:
+        """Appends `token_ids` and returns their logits."""
+        start, n = self.length, len(token_ids)
+        self.length += n
+        num_pages = -(-self.length // self.page_size)
+        # Row i of the mask lets token `start + i` attend to itself and before.
+        mask = torch.ones(n, self.length, dtype=torch.bool).tril(diagonal=start)
+        hidden_states = self.model.model(
+            self.model.model.embed_tokens(torch.tensor(token_ids)),
+            torch.arange(start, self.length, dtype=torch.int32),
+            torch.tensor([0, n], dtype=torch.int32),
+            self.kv_cache_at_layer,
+            torch.arange(num_pages, dtype=torch.int32),
+            torch.tensor([0, num_pages], dtype=torch.int32),
+            torch.tensor(
+                [self.length - (num_pages - 1) * self.page_size], dtype=torch.int32
+            ),
+            mask.flatten(),
+            n == 1,
+            None,
+        )
+        return self.model.lm_head(hidden_states).float()
+
+
+def _decode(model, arch, num_tokens: int, sample: bool) -> tuple[list[int], float]:
+    """Decodes `num_tokens` tokens and returns them with the tokens/s."""
+    sequence = _Sequence(model, arch, num_tokens + 1)
+    tokens = [1]
+    start = time.perf_counter()
+    for _ in range(num_tokens):
+        logits = sequence.forward(tokens[-1:])[-1]
+        if sample:
+            probs = torch.softmax(logits, dim=-1)
+            tokens.append(int(torch.multinomial(probs, 1)))
+        else:
+            tokens.append(int(logits.argmax()))
+    return tokens, num_tokens / (time.perf_counter() - start)
+
+
+def _perplexity(model, arch, tokens: list[int]) -> float:
+    """Perplexity of `tokens[1:]` given the tokens before each of them."""
+    logits = _Sequence(model, arch, len(tokens)).forward(tokens[:-1])
+    nll = torch.nn.functional.cross_entropy(logits, torch.tensor(tokens[1:]))
+    return math.exp(nll.item())
+
+
+def main(
+    model: str | None = None,
+    cache_dir: str | None = None,
+    num_layers: int = 8,
+    hidden_size: int = 1024,
+    vocab_size: int = 32000,
+    dtype: str = "bfloat16",
+    modes: tuple[str, ...] = ("int8", "int4"),
+    group_size: int = 128,
+    lm_head: bool = False,
+    num_tokens: int = 128,
+    seed: int = 0,
+):
+    """Runs the benchmark and prints the size, throughput and perplexity."""
+    if isinstance(modes, str):
+        modes = (modes,)
+    torch.manual_seed(seed)
+    if model is None:
+        reference, arch = _random_model(
+            num_layers, hidden_size, vocab_size, getattr(torch, dtype)
+        )
+    else:
+        reference, arch = _loaded_model(model, cache_dir, dtype)
+
+    results = []
+    with torch.inference_mode():
+        tokens, _ = _decode(reference, arch, num_tokens, sample=True)
+        for mode in ("none", *modes):
+            quantized = reference
+            if mode != "none":
+                quantized = copy.deepcopy(reference)
+                quantize_linears(quantized, mode, group_size, lm_head=lm_head)
+            _, tokens_per_s = _decode(quantized, arch, num_tokens, sample=False)
+            results.append(
+                (
+                    mode,
+                    measure_weight_bytes(quantized),
+                    tokens_per_s,
+                    _perplexity(quantized, arch, tokens),
+                )
+            )
+
+    print(
+        f"model={model or 'random l4ma'} dtype={dtype} tokens={num_tokens} "
+        f"group_size={group_size} lm_head={lm_head} "
+        f"threads={torch.get_num_threads()}"
+    )
+    for mode, num_bytes, tokens_per_s, perplexity in results:
+        print(
+            f"  {mode:>5}: {num_bytes / 2**30:6.2f} GiB, "
+            f"{tokens_per_s:8.2f} tokens/s, perplexity {perplexity:10.4f}"
+        )
+
+
+if __name__ == "__main__":
+    import fire
+
+    fire.Fire(main)
@@ -0,0 +1,231 @@
+"""
+Chunked prefill: splits oversized forward-pass requests over several steps.
+
+A long prompt processed in one forward pass holds up every request queued
+behind it for the whole prefill. With a per-step token budget, the worker
+instead runs steps that take the queued requests that fit first (in practice
+the decode requests), and fills the rest of the budget with the next chunk of
+each oversized request. A message is only answered once all of its requests,
+including the last chunk of each oversized one, have completed.
+
+A chunk is an ordinary `ForwardPassRequest` covering a contiguous range of the
+request's input tokens:
+
+* its KV pages are the leading pages of the request that hold the tokens up to
+  the end of the chunk, and `kv_page_last_len` is set accordingly, so earlier
+  chunks have already written the KV the chunk attends to;
+* the BRLE mask of token `i` only depends on `i`, so the chunk keeps the mask
+  rows of its tokens;
+* output indices falling in the chunk are rebased to it, and their results are
+  put back in the order of the original request.
+"""
+
+from __future__ import annotations
+
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Callable, Hashable
+
+from message import ForwardPassRequest, ForwardPassResponse
+
+
+def make_chunk(
+    req: ForwardPassRequest, start: int, end: int, page_size: int
+) -> tuple[ForwardPassRequest, list[int]]:
+    """Returns the chunk of `req` for input tokens `[start, end)`.
+
+    Also returns the positions, in `req.output_token_indices`, of the outputs
+    that the chunk produces.
+    """
+    num_tokens = len(req.input_tokens)
+    seq_len = (len(req.kv_page_ptrs) - 1) * page_size + req.kv_page_last_len
+    chunk_seq_len = seq_len - num_tokens + end
+    num_pages = -(-chunk_seq_len // page_size)
+
+    output_positions = [
+        i for i, idx in enumerate(req.output_token_indices) if start <= idx < end
+    ]
+    embed_positions = [
+        i for i, idx in enumerate(req.output_embed_indices) if start <= idx < end
+    ]
+    input_embeds = [
+        i for i, pos in enumerate(req.input_embed_positions) if start <= pos < end
+    ]
+
+    chunk = ForwardPassRequest(
+        input_tokens=req.input_tokens[start:end],
+        input_token_positions=req.input_token_positions[start:end],
+        input_embed_ptrs=[req.input_embed_ptrs[i] for i in input_embeds],
+        input_embed_positions=[
+            req.input_embed_positions[i] - start for i in input_embeds
+        ],
+        adapter=req.adapter,
+        adapter_seed=req.adapter_seed,
+        mask=req.mask[start:end],
+        kv_page_ptrs=req.kv_page_ptrs[:num_pages],
+        kv_page_last_len=chunk_seq_len - (num_pages - 1) * page_size,
+        output_token_indices=[
+            req.output_token_indices[i] - start for i in output_positions
+        ],
+        output_token_samplers=[req.output_token_samplers[i] for i in output_positions],
+        output_embed_ptrs=[req.output_embed_ptrs[i] for i in embed_positions],
+        output_embed_indices=[
+            req.output_embed_indices[i] - start for i in embed_positions
+        ],
+    )
+    return chunk, output_positions
+
+
+@dataclass
+class _PendingRequest:
+    """A request of a message, with the progress of its chunks."""
+
+    message: "_PendingMessage"
+    index: int
+    req: ForwardPassRequest
+    next_token: int = 0
+    # Result of each output of the request, by position in its output list
+    outputs: dict[int, Any] = field(default_factory=dict)
+
+    @property
+    def remaining_tokens(self) -> int:
+        return len(self.req.input_tokens) - self.next_token
+
+
+@dataclass
+class _PendingMessage:
+    """A forward-pass message waiting for all of its requests."""
+
+    ticket: Hashable
+    responses: list[ForwardPassResponse | None]
+
+    @property
+    def done(self) -> bool:
+        return all(resp is not None for resp in self.responses)
+
+
+class ChunkedPrefillScheduler:
+    """Schedules forward-pass requests in steps of at most `token_budget` tokens.
+
+    Requests that fit into the budget are never split. A step takes the queued
+    requests that fit in submission order, then gives the rest of the budget
+    to the next chunk of each request larger than the budget. A step always
+    makes progress, even if its first request alone exceeds the budget.
+    """
+
+    def __init__(self, token_budget: int, page_size: int):
+        if token_budget <= 0:
+            raise ValueError("token_budget must be positive")
+        self.token_budget = token_budget
+        self.page_size = page_size
+        self._queue: deque[_PendingRequest] = deque()
+        self._messages: list[_PendingMessage] = []
+
+    def submit(self, ticket: Hashable, reqs: list[ForwardPassRequest]) -> None:
+        """Queues the requests of a message, answered under `ticket`."""
+        message = _PendingMessage(ticket=ticket, responses=[None] * len(reqs))
+        self._messages.append(message)
+        for index, req in enumerate(reqs):
+            self._queue.append(_PendingRequest(message=message, index=index, req=req))
+
+    def has_pending(self) -> bool:
+        """Returns whether any submitted request has not completed yet."""
+        return bool(self._queue)
+
+    def _select(self) -> list[tuple[_PendingRequest, int]]:
+        """Picks the requests of the next step and how many tokens each runs."""
+        selected: list[tuple[_PendingRequest, int]] = []
+        budget = self.token_budget
+
+        # Requests that fit whole, in submission order
+        for pending in self._queue:
+            oversized = len(pending.req.input_tokens) > self.token_budget
+            if not oversized and pending.remaining_tokens <= budget:
+                selected.append((pending, pending.remaining_tokens))
+                budget -= pending.remaining_tokens
+
+        # The next chunk of every oversized request, while budget remains
+        for pending in self._queue:
+            if budget <= 0:
+                break
+            if len(pending.req.input_tokens) > self.token_budget:
+                num_tokens = min(pending.remaining_tokens, budget)
+                selected.append((pending, num_tokens))
+                budget -= num_tokens
+
+        if not selected:
+            pending = self._queue[0]
+            selected.append((pending, pending.remaining_tokens))
+        return selected
+
+    def step(
+        self,
+        forward_pass: Callable[[list[ForwardPassRequest]], list[ForwardPassResponse]],
+    ) -> list[tuple[Hashable, list[ForwardPassResponse]]]:
+        """Runs one step and returns the messages it completed."""
+        selected = self._select()
+
+        batch: list[ForwardPassRequest] = []
+        output_positions: list[list[int] | None] = []
+        for pending, num_tokens in selected:
+            if pending.next_token == 0 and num_tokens == len(pending.req.input_tokens):
+                batch.append(pending.req)
+                output_positions.append(None)
+            else:
+                chunk, positions = make_chunk(
+                    pending.req,
+                    pending.next_token,
+                    pending.next_token + num_tokens,
+                    self.page_size,
+                )
+                batch.append(chunk)
+                output_positions.append(positions)
+
+        # Answered in the order of `batch`, so by position in `selected`
+        responses = forward_pass(batch)
+
+        for (pending, num_tokens), positions, resp in zip(
+            selected, output_positions, responses
+        ):
+            if resp.error:
+                # A refused chunk fails the request, with the reason.
+                pending.message.responses[pending.index] = resp
+                self._queue.remove(pending)
+                continue
+            pending.next_token += num_tokens
+            if positions is None:
+                pending.message.responses[pending.index] = resp
+            else:
+                self._collect(pending, positions, resp)
+            if pending.remaining_tokens == 0:
+                self._queue.remove(pending)
+
+        completed = [m for m in self._messages if m.done]
+        self._messages = [m for m in self._messages if not m.done]
+        return [(m.ticket, m.responses) for m in completed]  # type: ignore[misc]
+
+    @staticmethod
+    def _collect(
+        pending: _PendingRequest, positions: list[int], resp: ForwardPassResponse
+    ) -> None:
+        """Stores the outputs of a chunk, and builds the response after the last."""
+        # Distributions come from sampler 0, tokens from the other samplers.
+        samplers = pending.req.output_token_samplers
+        dists = iter(resp.dists)
+        tokens = iter(resp.tokens)
+        for position in positions:
+            is_dist = samplers[position]["sampler"] == 0
+            pending.outputs[position] = next(dists) if is_dist else next(tokens)
+
+        if pending.remaining_tokens > 0:
+            return
+
+        ordered = range(len(samplers))
+        pending.message.responses[pending.index] = ForwardPassResponse(
+            tokens=[pending.outputs[i] for i in ordered if samplers[i]["sampler"] != 0],
+            dists=[pending.outputs[i] for i in ordered if samplers[i]["sampler"] == 0],
+            window_unreachable_kv_pages=resp.window_unreachable_kv_pages,
+        )
+
+
+__all__ = ["ChunkedPrefillScheduler", "make_chunk"]
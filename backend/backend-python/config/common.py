@@ -8,8 +8,12 @@ import tomllib
 import base64
 from dataclasses import dataclass
 from typing import Any, Optional
+import msgspec
 import torch
 
+# Bump when the format of the cached merge tables changes.
+MERGE_TABLE_CACHE_VERSION = 1
+
 
 @dataclass
 class Tokenizer:
@@ -23,6 +27,15 @@ class Tokenizer:
     escape_non_printable: bool
 
 
+class MergeTableCache(msgspec.Struct, gc=False):
+    """Parsed merge table, cached along with the vocabulary file it was read from."""
+
+    version: int
+    source_size: int
+    source_mtime_ns: int
+    merge_table: dict[int, bytes]
+
+
 @dataclass
 class CommonArch:
     """Base architecture configuration with common fields."""
@@ -43,6 +56,10 @@ class CommonArch:
     device: str
     dtype: torch.dtype
 
+    def sliding_window_layers(self) -> list[int]:
+        """Returns the indices of the layers that use sliding-window attention."""
+        return []
+
 
 @dataclass
 class ModelInfo:
@@ -60,11 +77,16 @@ class ModelInfo:
 
     @staticmethod
     def load_from_file(
-        cfg_file_path: str, device: str, dtype: torch.dtype
+        cfg_file_path: str,
+        device: str,
+        dtype: torch.dtype,
+        cache_dir: Optional[str] = None,
     ) -> "ModelInfo":
         """
         Parses a dictionary (from loaded TOML data) into the ModelMetadata struct,
         with improved and informative error handling.
+
+        If `cache_dir` is given, the parsed tokenizer merge table is cached there.
         """
 
         # Load and parse TOML file
@@ -107,7 +129,7 @@ class ModelInfo:
                 raise ValueError(f"Unsupported architecture type: {arch_dict['type']}")
 
         # Get other common information
-        tokenizer = cfg.get_tokenizer()
+        tokenizer = cfg.get_tokenizer(cache_dir)
         metadata_dict = cfg.get_metadata_fields()
         template_dict = cfg.get_chat_template_dict()
 
@@ -212,8 +234,13 @@ class ModelConfig:
             "parameters": get_required_top_level_key("parameters"),
         }
 
-    def get_tokenizer(self) -> Tokenizer:
-        """Get the tokenizer from the configuration."""
+    def get_tokenizer(self, cache_dir: Optional[str] = None) -> Tokenizer:
+        """
+        Get the tokenizer from the configuration.
+
+        If `cache_dir` is given, the merge table is read from a binary copy in
+        `cache_dir/tokenizers` as long as the vocabulary file is unchanged.
+        """
         tokenizer_data = self.get_required_key(self.root, "tokenizer")
         architecture_data = self.get_required_key(self.root, "architecture")
 
@@ -230,7 +257,15 @@ class ModelConfig:
         vocab_file_path = os.path.join(metadata_dir, model_name, vocab_file_name)
 
         try:
-            merge_rules = ModelConfig._load_merge_rules(vocab_file_path)
+            if cache_dir is None:
+                merge_rules = ModelConfig._load_merge_rules(vocab_file_path)
+            else:
+                merge_rules = ModelConfig._load_cached_merge_rules(
+                    vocab_file_path,
+                    os.path.join(
+                        cache_dir, "tokenizers", model_name, f"{vocab_file_name}.bin"
+                    ),
+                )
         except Exception as e:
             raise RuntimeError(
                 f"Failed to load vocabulary file '{vocab_file_name}' "
@@ -263,6 +298,52 @@ class ModelConfig:
                     return result
         return None
 
+    @staticmethod
+    def _load_cached_merge_rules(
+        vocab_file_path: str, cache_path: str
+    ) -> dict[int, bytes]:
+        """
+        Loads merge rules from the msgpack cache at `cache_path`, parsing and
+        caching the vocabulary file if the cache is missing or out of date.
+
+        The cache is only used if it was built from a vocabulary file of the
+        same size and modification time. Failing to write it is not an error.
+        """
+        stat = os.stat(vocab_file_path)
+        try:
+            with open(cache_path, "rb") as f:
+                cached = msgspec.msgpack.decode(f.read(), type=MergeTableCache)
+            if (
+                cached.version == MERGE_TABLE_CACHE_VERSION
+                and cached.source_size == stat.st_size
+                and cached.source_mtime_ns == stat.st_mtime_ns
+            ):
+                return cached.merge_table
+        except (OSError, msgspec.DecodeError):
+            pass
+
+        merge_rules = ModelConfig._load_merge_rules(vocab_file_path)
+        tmp_path = f"{cache_path}.tmp{os.getpid()}"
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            with open(tmp_path, "wb") as f:
+                f.write(
+                    msgspec.msgpack.encode(
+                        MergeTableCache(
+                            version=MERGE_TABLE_CACHE_VERSION,
+                            source_size=stat.st_size,
+                            source_mtime_ns=stat.st_mtime_ns,
+                            merge_table=merge_rules,
+                        )
+                    )
+                )
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            print(f"Warning: Could not cache the merge table at {cache_path}: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return merge_rules
+
     @staticmethod
     def _load_merge_rules(vocab_file_path: str) -> dict[int, bytes]:
         """
@@ -29,6 +29,17 @@ class GptOssArch(CommonArch):
     sliding_window: int
     swiglu_limit: float
 
+    # Fields that will be set by the backend config file. With a positive
+    # cache size, the MXFP4 expert weights stay packed in memory and up to that
+    # many dequantized experts per weight and layer are cached.
+    mxfp4_expert_cache_size: int = 0
+
+    def sliding_window_layers(self) -> list[int]:
+        """GPT OSS alternates windowed (even) and full (odd) attention layers."""
+        if self.sliding_window <= 0:
+            return []
+        return list(range(0, self.num_layers, 2))
+
     @staticmethod
     def from_config(cfg: ModelConfig) -> "GptOssArch":
         """Parse GPT OSS-specific architecture configuration."""
@@ -0,0 +1,317 @@
+"""
+Offline conversion of model checkpoints to the ztensor files the server loads.
+
+Reads the tensors of the safetensors (or ztensor) shards in `source_dir` and
+writes them to `cache_dir/models/<model>/` as ztensor shards of at most
+`max_shard_size_mb`. If the metadata of the model is already in
+`cache_dir/models/<model>.toml`, the fusion map of its architecture is applied
+on the way: the q/k/v and gate/up projections are stored concatenated and the
+MXFP4 experts dequantized, so the loader reads them as they are. The
+`parameters` of the metadata file are then updated to list the new shards.
+
+Each output shard is built by a worker process, which reads the sources of
+one output tensor at a time, writes it and drops it, then hashes the finished
+shard. Memory use is bounded by `num_workers` times the largest output tensor
+with its sources, whatever the size of the model. The digests are recorded
+for the fused weight cache, so the first start does not hash the files again.
+
+The ztensor writer of the Python package stores tensors uncompressed, which
+is also the encoding the loader can read straight into the parameters.
+
+Example:
+    python convert_checkpoint.py --source_dir ~/hf/Llama-3.1-8B-Instruct \\
+        --model llama-3.1-8b-instruct --dtype bfloat16
+"""
+
+from __future__ import annotations
+
+import json
+import multiprocessing
+import os
+import re
+import time
+import tomllib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass
+from pathlib import Path
+
+import torch
+import ztensor
+from platformdirs import user_cache_dir
+from tqdm import tqdm
+
+from config.common import ModelInfo
+from model_factory import create_model_and_fusion_map
+from mxfp4 import dequantize_mxfp4
+from tensor_files import TensorEntry, TensorFiles
+from weight_cache import file_digest, record_file_digests
+
+_INDEX_FILE = "model.safetensors.index.json"
+_SHARD_PATTERN = re.compile(r"model-\d{5}-of-\d{5}\.zt")
+
+
+@dataclass(frozen=True)
+class _OutputTensor:
+    """A tensor of the converted checkpoint and the source tensors it is built from."""
+
+    name: str
+    sources: tuple[str, ...]
+    # Entry of the fusion map, or None to copy the single source as it is
+    fusion: dict | None
+    nbytes: int
+
+
+def _source_files(source_dir: Path) -> list[str]:
+    """Returns the tensor files of a checkpoint, relative to `source_dir`."""
+    index_path = source_dir / _INDEX_FILE
+    if index_path.exists():
+        weight_map = json.loads(index_path.read_text())["weight_map"]
+        return sorted(set(weight_map.values()))
+    for pattern in ("*.safetensors", "*.zt"):
+        files = sorted(path.name for path in source_dir.glob(pattern))
+        if files:
+            return files
+    raise FileNotFoundError(f"No safetensors or ztensor files found in {source_dir}")
+
+
+def _load_fusion_map(metadata_path: Path, cache_dir: str, dtype: torch.dtype) -> dict:
+    """Returns the fusion map of the model described by `metadata_path`."""
+    model_info = ModelInfo.load_from_file(
+        str(metadata_path), "meta", dtype, cache_dir=cache_dir
+    )
+    # Only the module structure is needed, so nothing is allocated.
+    with torch.device("meta"):
+        _, fusion_map = create_model_and_fusion_map(model_info)
+    return fusion_map
+
+
+def _output_dtype(source_dtype: torch.dtype, dtype: torch.dtype | None) -> torch.dtype:
+    if dtype is not None and source_dtype.is_floating_point:
+        return dtype
+    return source_dtype
+
+
+def _output_nbytes(entry: TensorEntry, dtype: torch.dtype | None) -> int:
+    """Size of a source tensor once converted to `dtype`."""
+    if entry.dtype is None:
+        return entry.nbytes
+    numel = entry.nbytes // entry.dtype.itemsize
+    return numel * _output_dtype(entry.dtype, dtype).itemsize
+
+
+def _plan(
+    tensor_files: TensorFiles, fusion_map: dict, dtype: torch.dtype | None
+) -> list[_OutputTensor]:
+    """Lists the output tensors, in the order of their first source."""
+    outputs = []
+    fused_sources = set()
+    for name, fusion in fusion_map.items():
+        sources = tuple(fusion["sources"])
+        if not all(source in tensor_files for source in sources):
+            continue
+        entries = [tensor_files.entries[source] for source in sources]
+        if fusion["op"] == "dequantize_mxfp4":
+            # Two FP4 values per byte of the blocks
+            nbytes = entries[0].nbytes * 2 * (dtype or torch.bfloat16).itemsize
+        else:
+            nbytes = sum(_output_nbytes(entry, dtype) for entry in entries)
+        outputs.append(_OutputTensor(name, sources, fusion, nbytes))
+        fused_sources.update(sources)
+
+    for name, entry in tensor_files.entries.items():
+        if name not in fused_sources:
+            outputs.append(
+                _OutputTensor(name, (name,), None, _output_nbytes(entry, dtype))
+            )
+
+    def source_order(output: _OutputTensor) -> tuple[str, int]:
+        entry = tensor_files.entries[output.sources[0]]
+        return entry.param_file, entry.position
+
+    return sorted(outputs, key=source_order)
+
+
+def _split_shards(
+    outputs: list[_OutputTensor], max_shard_bytes: int
+) -> list[list[_OutputTensor]]:
+    """Groups consecutive outputs into shards of at most `max_shard_bytes`."""
+    shards: list[list[_OutputTensor]] = [[]]
+    shard_bytes = 0
+    for output in outputs:
+        if shards[-1] and shard_bytes + output.nbytes > max_shard_bytes:
+            shards.append([])
+            shard_bytes = 0
+        shards[-1].append(output)
+        shard_bytes += output.nbytes
+    return shards
+
+
+# Source tensors of the worker process, set by `_init_worker`
+_worker_files: TensorFiles | None = None
+
+
+def _init_worker(source_dir: Path, source_files: list[str]) -> None:
+    global _worker_files  # pylint: disable=global-statement
+    # The workers already run in parallel.
+    torch.set_num_threads(1)
+    _worker_files = TensorFiles(source_dir)
+    for source_file in source_files:
+        _worker_files.scan(source_file)
+
+
+def _build_tensor(output: _OutputTensor, dtype: torch.dtype | None) -> torch.Tensor:
+    """Reads the sources of `output` and applies its fusion."""
+    assert _worker_files is not None
+    sources = [_worker_files.read(source) for source in output.sources]
+    if output.fusion is None:
+        return sources[0].to(_output_dtype(sources[0].dtype, dtype))
+    if output.fusion["op"] == "fusion":
+        fused = torch.cat(sources, dim=output.fusion["dim"])
+        return fused.to(_output_dtype(fused.dtype, dtype))
+    if output.fusion["op"] == "dequantize_mxfp4":
+        lut = torch.tensor(
+            list(output.fusion["fp4_values"]), dtype=dtype or torch.bfloat16
+        )
+        return dequantize_mxfp4(sources[0], sources[1], lut)
+    raise ValueError(f"Unknown fusion operation: {output.fusion['op']}")
+
+
+def _write_shard(
+    path: Path, outputs: list[_OutputTensor], dtype: torch.dtype | None
+) -> str:
+    """Writes the tensors of a shard to `path` and returns its SHA-256."""
+    tmp_path = path.with_suffix(f".tmp{os.getpid()}")
+    try:
+        with ztensor.Writer(str(tmp_path)) as writer:
+            for output in outputs:
+                # Written right away, so only one tensor is held at a time
+                writer.add_tensor(output.name, _build_tensor(output, dtype))
+        os.replace(tmp_path, path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+    return file_digest(path)
+
+
+def _update_parameters(metadata_path: Path, param_files: list[str]) -> bool:
+    """Replaces the `parameters` of a metadata file, returning whether it did."""
+    text = metadata_path.read_text()
+    parameters = ", ".join(json.dumps(param_file) for param_file in param_files)
+    # Top-level keys come before the tables, so the first match is the one.
+    text, count = re.subn(
+        r"^[ \t]*parameters\s*=\s*\[.*?\]",
+        lambda _: f"parameters = [{parameters}]",
+        text,
+        count=1,
+        flags=re.MULTILINE | re.DOTALL,
+    )
+    if not count or tomllib.loads(text).get("parameters") != param_files:
+        return False
+    metadata_path.write_text(text)
+    return True
+
+
+def convert(
+    source_dir: str,
+    model: str,
+    cache_dir: str | None = None,
+    dtype: str | None = None,
+    fuse: bool = True,
+    max_shard_size_mb: int = 4096,
+    num_workers: int = 4,
+) -> list[str]:
+    """
+    Converts the checkpoint in `source_dir` to the ztensor files of `model`.
+
+    Args:
+        source_dir: Directory of the safetensors (or ztensor) files to convert.
+        model: Name of the model, the directory of the files in `cache_dir/models`.
+        cache_dir: The PIE cache directory, resolved as the server does.
+        dtype: Type of the floating-point tensors (e.g. 'bfloat16'). The loader
+               reads tensors of the model dtype straight into the parameters.
+               If None, they keep their type, and MXFP4 experts are
+               dequantized to bfloat16.
+        fuse: Apply the fusion map of the model, if its metadata file exists.
+              GPT OSS experts are then stored dequantized, which the server
+              can only load with `mxfp4_expert_cache_size` of 0.
+        max_shard_size_mb: Maximum size of an output file.
+        num_workers: Number of processes building and hashing output files.
+
+    Returns:
+        The names of the output files.
+    """
+    start = time.perf_counter()
+    cache_dir = cache_dir or os.environ.get("PIE_HOME") or user_cache_dir("pie")
+    source_path = Path(source_dir).expanduser()
+    metadata_path = Path(cache_dir) / "models" / f"{model}.toml"
+    out_dir = Path(cache_dir) / "models" / model
+    torch_dtype = getattr(torch, dtype) if dtype is not None else None
+
+    source_files = _source_files(source_path)
+    tensor_files = TensorFiles(source_path)
+    for source_file in source_files:
+        tensor_files.scan(source_file)
+
+    fusion_map = {}
+    if fuse and metadata_path.exists():
+        fusion_map = _load_fusion_map(
+            metadata_path, cache_dir, torch_dtype or torch.bfloat16
+        )
+    elif fuse:
+        print(f"No metadata at {metadata_path}: tensors are not fused.")
+
+    outputs = _plan(tensor_files, fusion_map, torch_dtype)
+    shards = _split_shards(outputs, max_shard_size_mb * 2**20)
+    param_files = [
+        f"model-{i + 1:05d}-of-{len(shards):05d}.zt" for i in range(len(shards))
+    ]
+
+    out_dir.mkdir(parents=True, exist_ok=True)
+    digests = {}
+    with ProcessPoolExecutor(
+        max_workers=num_workers,
+        # Forking a process that has loaded PyTorch is not safe.
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker,
+        initargs=(source_path, source_files),
+    ) as pool:
+        futures = {
+            pool.submit(
+                _write_shard, out_dir / param_file, shard, torch_dtype
+            ): param_file
+            for param_file, shard in zip(param_files, shards)
+        }
+        for future in tqdm(
+            as_completed(futures),
+            total=len(futures),
+            desc="Converting checkpoint",
+            unit="files",
+        ):
+            digests[futures[future]] = future.result()
+
+    # Files of an earlier conversion that are not overwritten
+    for path in out_dir.glob("model-*-of-*.zt"):
+        if _SHARD_PATTERN.fullmatch(path.name) and path.name not in digests:
+            path.unlink()
+    record_file_digests(Path(cache_dir) / "fused" / model, out_dir, digests)
+
+    total_bytes = sum(output.nbytes for output in outputs)
+    num_fused = sum(output.fusion is not None for output in outputs)
+    print(
+        f"Converted {len(outputs)} tensors ({num_fused} fused) into "
+        f"{len(param_files)} files, {total_bytes / 2**30:.2f} GiB, in "
+        f"{time.perf_counter() - start:.1f} s"
+    )
+    if metadata_path.exists() and _update_parameters(metadata_path, param_files):
+        print(f"Updated the parameters of {metadata_path}")
+    else:
+        print(f"Parameters of the model: {param_files}")
+    return param_files
+
+
+__all__ = ["convert"]
+
+
+if __name__ == "__main__":
+    import fire
+
+    fire.Fire(convert)
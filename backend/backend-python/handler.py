@@ -2,57 +2,54 @@
 Python Backend Handler
 
 This module provides the backend handler for the Python backend.
-Directly imports operations from flashinfer or pie_metal based on platform.
-Both backends now provide identical APIs.
+Operations come from flashinfer or pie_metal based on platform, with the
+portable PyTorch ops as a fallback. All of them provide identical APIs.
 """
 
 from __future__ import annotations
 
+import json
+import sys
+import threading
 import time
 from contextlib import contextmanager, nullcontext
+from functools import partial
 
+import msgspec
 import numpy as np
 import torch
 
 import message
 
 # Safe import of adapter functionality
+from adapter import EsAdapter
+from adapter_store import AdapterStore, deserialize_adapter, serialize_adapter
 from adapter_utils import ensure_adapter_available
-from platform_detection import is_apple_silicon
+from backend_ops import BACKEND_NAME, NATIVE_BACKEND_NAME, NATIVE_OPS_AVAILABLE, ops
+from index_buffers import DeviceIndexBuffers
+from kv_pool import (
+    SlidingWindowKvPool,
+    min_window_kv_pages,
+    num_window_unreachable_pages,
+    window_ring_pages,
+)
+from memory_planner import MemoryPlan, describe_fixed_kv_cache, plan_kv_cache
 
 # Import profiler for performance analysis
 from profiler import start_profile
-
-# Direct import of backend operations based on platform
-# pie_metal now provides the same API structure as flashinfer
-if is_apple_silicon():
-    try:
-        import pie_metal.ops as ops  # type: ignore[import-not-found]
-
-        BACKEND_NAME = "pie-metal"
-        BACKEND_AVAILABLE = True
-    except ImportError:
-        ops = None  # type: ignore[assignment]
-        BACKEND_NAME = "pie-metal"
-        BACKEND_AVAILABLE = False
-else:
-    try:
-        import flashinfer as ops  # type: ignore[import-not-found]
-
-        BACKEND_NAME = "flashinfer"
-        BACKEND_AVAILABLE = True
-    except ImportError:
-        ops = None  # type: ignore[assignment]
-        BACKEND_NAME = "flashinfer"
-        BACKEND_AVAILABLE = False
+from shared_prefix import prepare_shared_prefix
+from warmup import WarmupTiming, format_timings, timings_to_dicts, warm_up
 
 
 class Handler:
     """Python backend handler using platform-appropriate operations."""
 
     max_num_kv_pages: int
+    max_num_window_kv_pages: int
+    memory_plan: MemoryPlan
     max_num_embeds: int
     max_num_adapters: int
+    max_num_host_adapters: int
     max_adapter_rank: int
 
     def __init__(
@@ -60,16 +57,16 @@ class Handler:
         config: dict,
     ):
         """Initialize handler with platform-appropriate backend operations."""
-        self.adapters = {}
-        self.ops = ops  # backend operations module (flashinfer or pie_metal.ops)
+        # backend operations module (flashinfer, pie_metal.ops or torch_ops)
+        self.ops = ops
 
         print(f"✅ Handler initialized with {BACKEND_NAME} backend")
-        print(f"   {BACKEND_NAME} available: {BACKEND_AVAILABLE}")
+        print(f"   {NATIVE_BACKEND_NAME} available: {NATIVE_OPS_AVAILABLE}")
 
         # Put imports here to avoid circular import
         # pylint: disable=import-outside-toplevel
         from model_loader import load_model, load_model_info
-        from model_factory import create_model_and_fusion_map
+        from model_factory import ModelOptions, create_model_and_fusion_map
 
         self.model_info = load_model_info(config)
         self.kv_page_size = config["kv_page_size"]
@@ -77,13 +74,64 @@ class Handler:
         self.max_num_embeds = config["max_num_embeds"]
         self.max_batch_tokens = config["max_batch_tokens"]
         self.max_num_adapters = config["max_num_adapters"]
+        # Adapters kept in host memory; only `max_num_adapters` fit on the device
+        self.max_num_host_adapters = (
+            config.get("max_num_host_adapters") or self.max_num_adapters
+        )
         self.max_adapter_rank = config["max_adapter_rank"]
+        self.adapter_encoding = config.get("adapter_encoding", "float16")
         self.dtype = getattr(torch, config["dtype"])
         self.device = config["device"]
         self.logits_dtype = getattr(torch, config["dtype"])
 
+        # Sliding-window layers only ever read the last `sliding_window` tokens.
+        # If `max_num_window_kv_pages` is set, they get their own, much smaller
+        # KV pool instead of mirroring every page of the full-attention layers.
+        arch = self.model_info.architecture
+        self.window_layers = set(arch.sliding_window_layers())
+        self.sliding_window = (
+            getattr(arch, "sliding_window", 0) if self.window_layers else 0
+        )
+        self.max_num_window_kv_pages = 0
+        self.window_kv_pool: SlidingWindowKvPool | None = None
+        if config.get("max_num_window_kv_pages"):
+            if not self.window_layers:
+                print(
+                    "'max_num_window_kv_pages' is ignored since the model "
+                    "has no sliding-window layers."
+                )
+            else:
+                self.max_num_window_kv_pages = config["max_num_window_kv_pages"]
+                # The pages of all the tokens of a pass are resident during it.
+                max_pass_tokens = self.max_batch_tokens
+                if config.get("prefill_token_budget", 0) > 0:
+                    max_pass_tokens = min(
+                        max_pass_tokens, config["prefill_token_budget"]
+                    )
+                min_pages = min_window_kv_pages(
+                    self.kv_page_size, self.sliding_window, max_pass_tokens
+                )
+                if self.max_num_window_kv_pages < min_pages:
+                    raise ValueError(
+                        f"'max_num_window_kv_pages' must be at least {min_pages} "
+                        f"to run a forward pass of {max_pass_tokens} tokens."
+                    )
+                num_idle_contexts = (
+                    self.max_num_window_kv_pages - min_pages
+                ) // window_ring_pages(self.kv_page_size, self.sliding_window)
+                print(
+                    f"The sliding-window KV pool holds the windows of "
+                    f"{num_idle_contexts} idle contexts besides a full pass."
+                )
+                self.window_kv_pool = SlidingWindowKvPool(
+                    num_slots=self.max_num_window_kv_pages,
+                    page_size=self.kv_page_size,
+                    window=self.sliding_window,
+                    device=self.device,
+                )
+
         # If `gpu_mem_headroom` is set by the user, then we will cap the KV
-        # cache size so that there is some percentage of GPU memory left over
+        # cache size so that there is some percentage of device memory left over
         # after loading the model and allocating the KV cache.
         if "gpu_mem_headroom" in config:
             adaptive_kv_cache_size = True
@@ -97,20 +145,10 @@ class Handler:
         # tensors are not allocated up front.
         if not adaptive_kv_cache_size:
             self.max_num_kv_pages = config["max_num_kv_pages"]
-            self.kv_cache_at_layer = [
-                torch.zeros(
-                    (
-                        self.max_num_kv_pages,
-                        2,
-                        self.kv_page_size,
-                        self.model_info.architecture.num_key_value_heads,
-                        self.model_info.architecture.head_size,
-                    ),
-                    dtype=self.dtype,
-                    device=self.device,
-                )
-                for _ in range(self.model_info.architecture.num_layers)
-            ]
+            self.kv_cache_at_layer = self._allocate_kv_cache(self.max_num_kv_pages)
+
+        # Index tensors of the forward passes, updated in place between steps
+        self.index_buffers = DeviceIndexBuffers(self.device)
 
         self.embeds = torch.empty(
             (self.max_num_embeds, self.model_info.architecture.hidden_size),
@@ -145,11 +183,22 @@ class Handler:
             )
             for _ in range(self.model_info.architecture.num_layers)
         ]
+        self.adapter_store = AdapterStore(
+            self.adapter_at_layer,
+            max_num_adapters=self.max_num_host_adapters,
+            pin_memory=str(self.device).startswith("cuda"),
+        )
 
         self.lm = load_model(
             config,
             self.model_info,
-            create_model_and_fusion_map,
+            partial(
+                create_model_and_fusion_map,
+                options=ModelOptions(
+                    attention_backend=config.get("attention_backend", "auto"),
+                    mxfp4_expert_cache_size=config.get("mxfp4_expert_cache_size", 0),
+                ),
+            ),
         )
 
         # Validate model structure has required attributes and they are callable
@@ -165,99 +214,110 @@ class Handler:
             raise TypeError("Model 'embed_tokens' attribute must be callable")
 
         # If `gpu_mem_headroom` is set by the user, then we have to allocate the KV
-        # cache at the end and dynamically calculate the number of KV pages based on
-        # the available GPU memory.
+        # cache at the end and size it from the memory that is left on the device
+        # (GPU, unified or system memory) after loading the model.
         if adaptive_kv_cache_size:
-            # Calculate the available GPU memory for the KV cache after accounting for
-            # the reserved GPU memory specified through `gpu_mem_headroom`.
-            free_gpu_mem_bytes, total_gpu_mem_bytes = torch.cuda.mem_get_info(
-                self.device
+            self.memory_plan = plan_kv_cache(
+                device=self.device,
+                model=self.lm,
+                arch=self.model_info.architecture,
+                kv_page_size=self.kv_page_size,
+                max_batch_tokens=self.max_batch_tokens,
+                dtype=self.dtype,
+                headroom_percent=config["gpu_mem_headroom"],
+                max_num_kv_pages=config.get("max_num_kv_pages"),
+                num_window_kv_pages=self.max_num_window_kv_pages,
             )
-            used_gpu_mem_bytes = total_gpu_mem_bytes - free_gpu_mem_bytes
-            reserved_gpu_mem_percentage = config["gpu_mem_headroom"]
-            useable_gpu_mem_bytes = total_gpu_mem_bytes * (
-                1 - (reserved_gpu_mem_percentage / 100)
+            self.max_num_kv_pages = self.memory_plan.num_kv_pages
+            self.kv_cache_at_layer = self._allocate_kv_cache(self.max_num_kv_pages)
+        else:
+            self.memory_plan = describe_fixed_kv_cache(
+                device=self.device,
+                model=self.lm,
+                arch=self.model_info.architecture,
+                kv_page_size=self.kv_page_size,
+                max_batch_tokens=self.max_batch_tokens,
+                dtype=self.dtype,
+                num_kv_pages=self.max_num_kv_pages,
+                num_window_kv_pages=self.max_num_window_kv_pages,
             )
-            available_kv_cache_bytes = useable_gpu_mem_bytes - used_gpu_mem_bytes
 
-            if available_kv_cache_bytes <= 0:
-                raise ValueError(
-                    "Not enough GPU memory available to allocate the KV cache. "
-                    "Please decrease 'gpu_mem_headroom'."
-                )
+        print(self.memory_plan.summary())
 
-            # Calculate the number of KV pages based on the available GPU memory.
-            self.max_num_kv_pages = int(
-                available_kv_cache_bytes
-                / (
-                    self.kv_page_size
-                    * 2
-                    * self.model_info.architecture.num_key_value_heads
-                    * self.model_info.architecture.head_size
-                    * self.model_info.architecture.num_layers
-                    * self.dtype.itemsize
-                )
-            )
+        self.inter_fill_time = time.time()
 
-            # If the user also specified "max_num_kv_pages", then we will use the
-            # smaller of the two values.
-            if "max_num_kv_pages" in config:
-                if self.max_num_kv_pages > config["max_num_kv_pages"]:
-                    self.max_num_kv_pages = config["max_num_kv_pages"]
-                elif self.max_num_kv_pages < config["max_num_kv_pages"]:
-                    print(
-                        f"'max_num_kv_pages' is reduced to {self.max_num_kv_pages} "
-                        "to respect 'gpu_mem_headroom'."
-                    )
+        # Set once `warm_up` has run; requests that use the model wait for it.
+        self.ready = threading.Event()
+        self.warmup_timings: list[WarmupTiming] = []
 
-            self.kv_cache_at_layer = [
-                torch.zeros(
-                    (
-                        self.max_num_kv_pages,
-                        2,
-                        self.kv_page_size,
-                        self.model_info.architecture.num_key_value_heads,
-                        self.model_info.architecture.head_size,
-                    ),
-                    dtype=self.dtype,
-                    device=self.device,
-                )
-                for _ in range(self.model_info.architecture.num_layers)
-            ]
+        # The handshake only depends on the model and the limits above. It is
+        # encoded once, instead of encoding the whole merge table every time.
+        self._handshake_response = msgspec.Raw(
+            msgspec.msgpack.encode(self._build_handshake_response())
+        )
 
-        self.inter_fill_time = time.time()
+    def _allocate_kv_cache(self, num_kv_pages: int) -> list[torch.Tensor]:
+        """Allocates the paged KV cache tensor of every layer.
 
-    def handshake(
-        self, reqs: list[message.HandshakeRequest]
-    ) -> list[message.HandshakeResponse]:
-        """Handle handshake requests."""
-        resps = []
-        for _ in reqs:
-            # Request details not currently used
-
-            resp = message.HandshakeResponse(
-                version=self.model_info.version,
-                model_name=self.model_info.name,
-                model_traits=["todo"],
-                model_description=self.model_info.description,
-                prompt_template=self.model_info.template_content,
-                prompt_template_type=self.model_info.template_type,
-                prompt_stop_tokens=self.model_info.stop_tokens,
-                kv_page_size=self.kv_page_size,
-                max_batch_tokens=self.max_batch_tokens,
-                resources={
-                    0: self.max_num_kv_pages,
-                    1: self.max_num_embeds,
-                    2: self.max_num_adapters,
-                },
-                tokenizer_num_vocab=self.model_info.tokenizer.num_vocab,
-                tokenizer_merge_table=self.model_info.tokenizer.merge_table,
-                tokenizer_special_tokens=self.model_info.tokenizer.special_tokens,
-                tokenizer_split_regex=self.model_info.tokenizer.split_regex,
-                tokenizer_escape_non_printable=self.model_info.tokenizer.escape_non_printable,
+        Sliding-window layers get `max_num_window_kv_pages` pages if they use
+        their own pool.
+        """
+        return [
+            torch.zeros(
+                (
+                    (
+                        self.max_num_window_kv_pages
+                        if self.window_kv_pool is not None
+                        and layer_idx in self.window_layers
+                        else num_kv_pages
+                    ),
+                    2,
+                    self.kv_page_size,
+                    self.model_info.architecture.num_key_value_heads,
+                    self.model_info.architecture.head_size,
+                ),
+                dtype=self.dtype,
+                device=self.device,
             )
-            resps.append(resp)
-        return resps
+            for layer_idx in range(self.model_info.architecture.num_layers)
+        ]
+
+    def warm_up(self, rounds: int) -> None:
+        """Runs synthetic forward passes `rounds` times, then becomes ready."""
+        if rounds > 0:
+            start = time.perf_counter()
+            self.warmup_timings = warm_up(self, rounds)
+            print(format_timings(self.warmup_timings))
+            print(f"Warm-up completed in {time.perf_counter() - start:.1f} s")
+        self.ready.set()
+
+    def handshake(self, reqs: list[message.HandshakeRequest]) -> list[msgspec.Raw]:
+        """Handle handshake requests with the pre-encoded response."""
+        # Request details not currently used
+        return [self._handshake_response for _ in reqs]
+
+    def _build_handshake_response(self) -> message.HandshakeResponse:
+        return message.HandshakeResponse(
+            version=self.model_info.version,
+            model_name=self.model_info.name,
+            model_traits=["todo"],
+            model_description=self.model_info.description,
+            prompt_template=self.model_info.template_content,
+            prompt_template_type=self.model_info.template_type,
+            prompt_stop_tokens=self.model_info.stop_tokens,
+            kv_page_size=self.kv_page_size,
+            max_batch_tokens=self.max_batch_tokens,
+            resources={
+                0: self.max_num_kv_pages,
+                1: self.max_num_embeds,
+                2: self.max_num_host_adapters,
+            },
+            tokenizer_num_vocab=self.model_info.tokenizer.num_vocab,
+            tokenizer_merge_table=self.model_info.tokenizer.merge_table,
+            tokenizer_special_tokens=self.model_info.tokenizer.special_tokens,
+            tokenizer_split_regex=self.model_info.tokenizer.split_regex,
+            tokenizer_escape_non_printable=self.model_info.tokenizer.escape_non_printable,
+        )
 
     def query(self, reqs: list[message.QueryRequest]) -> list[message.QueryResponse]:
         """Handle query requests."""
@@ -267,10 +327,29 @@ class Handler:
             match req.query:
                 case "ping":
                     value = "pong"
+                case "ready":
+                    value = json.dumps(self.ready.is_set())
+                case "warmup":
+                    value = json.dumps(timings_to_dicts(self.warmup_timings))
+                case "memory_plan":
+                    value = json.dumps(self.memory_plan.to_dict())
+                case "plan_cache":
+                    value = json.dumps(self.plan_cache_stats())
+                case "adapter_store":
+                    value = json.dumps(self.adapter_store.stats())
             resp = message.QueryResponse(value=value)
             resps.append(resp)
         return resps
 
+    def plan_cache_stats(self) -> dict[str, dict[str, int]]:
+        """Returns the counters of the attention plan cache and index buffers."""
+        backend = getattr(self.lm.model, "backend", None)  # type: ignore[attr-defined]
+        plan_cache = getattr(backend, "plan_cache", None)
+        return {
+            "plan_cache": plan_cache.stats() if plan_cache is not None else {},
+            "index_buffers": self.index_buffers.stats(),
+        }
+
     def embed_image(self, reqs: list[message.EmbedImageRequest]):
         """
         Embeds images into the specified embed pointers.
@@ -296,49 +375,158 @@ class Handler:
 
     @torch.inference_mode()
     def initialize_adapter(self, reqs: list[message.InitializeAdapterRequest]):
-        """Initialize adapter functionality."""
-        # cfg = self.lm.config  # Available if needed
+        """Creates evolution-strategy adapters in their slots."""
+        arch = self.model_info.architecture
+        out_features = [
+            arch.num_query_heads * arch.head_size,
+            arch.num_key_value_heads * arch.head_size,
+            arch.num_key_value_heads * arch.head_size,
+        ]
+        for req in reqs:
+            if not 0 < req.rank <= self.max_adapter_rank:
+                raise ValueError(
+                    f"Adapter rank {req.rank} out of range "
+                    f"[1, {self.max_adapter_rank}]."
+                )
 
-        for _ in reqs:
-            pass  # Request details not currently used
+            adapter = EsAdapter(
+                adapter_id=req.adapter_ptr,
+                rank=req.rank,
+                alpha=req.alpha,
+                out_features=out_features,
+                population_size=req.population_size,
+                mu_fraction=req.mu_fraction,
+                sigma=req.initial_sigma,
+            )
+            slot = self.adapter_store.create(req.adapter_ptr, adapter)
+            adapter.initialize(self.adapter_at_layer, slot)
 
     @torch.inference_mode()
     def update_adapter(self, reqs: list[message.UpdateAdapterRequest]):
-        """Update adapter functionality."""
+        """Updates evolution-strategy adapters from the scores of their seeds."""
         for req in reqs:
-            if req.adapter_ptr in self.adapters:
-                pass
+            adapter = self.adapter_store.get(req.adapter_ptr)
+            if not isinstance(adapter, EsAdapter):
+                raise ValueError(
+                    f"Adapter {req.adapter_ptr} is not an evolution-strategy adapter."
+                )
+            slot = self.adapter_store.acquire([req.adapter_ptr])[req.adapter_ptr]
+            adapter.update(
+                self.adapter_at_layer, slot, req.scores, req.seeds, req.max_sigma
+            )
+            self.adapter_store.mark_dirty(req.adapter_ptr)
 
     @torch.inference_mode()
     def forward_pass(self, reqs: list[message.ForwardPassRequest]):
         """
         Processes a batch of forward pass requests through the language model.
+
+        Returns the responses in the order of `reqs`. Requests the
+        sliding-window KV pool cannot serve are refused with an `error`. A
+        batch that uses more adapters than fit on the device runs as several
+        passes.
         """
+        responses: dict[int, message.ForwardPassResponse] = {}
         with start_profile("forward_pass_total"):
-            # Sort requests by adapter to optimize the adapter subpass.
-            with start_profile("request_sorting"):
-                reqs = sorted(reqs, key=lambda o: (o.adapter is None, o.adapter))
-
-            # 1. Consolidate and process all requests into a single batch.
-            with start_profile("batch_consolidation"):
-                batch = ForwardPassBatch(self)
-                for req in reqs:
-                    batch.add_request(req)
-
-            # 2. Finalize the batch to get model inputs as tensors.
-            with start_profile("batch_finalize"):
-                model_inputs = batch.finalize()
-
-            # 3. Run the forward pass through the model.
-            with start_profile("model_forward"):
-                with _device_context(self.device):
-                    output_embeds = self.lm.model.forward(  # type: ignore[attr-defined]
-                        kv_cache_at_layer=self.kv_cache_at_layer, **model_inputs
+            admitted = list(range(len(reqs)))
+            if self.window_kv_pool is not None:
+                with start_profile("window_kv_admission"):
+                    admitted = self._admit_window_kv(reqs, responses)
+
+            if admitted:
+                # Sort requests by adapter to optimize the adapter subpass.
+                with start_profile("request_sorting"):
+                    order = sorted(
+                        admitted,
+                        key=lambda i: (reqs[i].adapter is None, reqs[i].adapter),
                     )
+                for sub_batch in self._split_by_adapter_slots(reqs, order):
+                    batch_responses = self._run_batch([reqs[i] for i in sub_batch])
+                    responses.update(zip(sub_batch, batch_responses))
+
+        # Callers pair the responses with their requests by position.
+        return [responses[i] for i in range(len(reqs))]
 
-            # 4. Package the model outputs into response messages.
-            with start_profile("package_responses"):
-                responses = batch.package_responses(output_embeds)
+    def _admit_window_kv(
+        self,
+        reqs: list[message.ForwardPassRequest],
+        responses: dict[int, message.ForwardPassResponse],
+    ) -> list[int]:
+        """Returns the requests the sliding-window KV pool can serve.
+
+        The others are answered in `responses` with the reason of the refusal.
+        """
+        assert self.window_kv_pool is not None
+        errors = self.window_kv_pool.admit(
+            [req.kv_page_ptrs or [] for req in reqs],
+            [req.kv_page_last_len or 0 for req in reqs],
+            [len(req.input_tokens) for req in reqs],
+        )
+        for i, error in enumerate(errors):
+            if error is not None:
+                print(f"[!] Refused a forward pass: {error}", file=sys.stderr)
+                responses[i] = message.ForwardPassResponse(
+                    tokens=[], dists=[], error=error
+                )
+        return [i for i, error in enumerate(errors) if error is None]
+
+    def _split_by_adapter_slots(
+        self, reqs: list[message.ForwardPassRequest], order: list[int]
+    ) -> list[list[int]]:
+        """Splits requests sorted by adapter into batches whose adapters fit
+        in the device slots.
+
+        The controller may address up to `max_num_host_adapters` adapters, but
+        only `max_num_adapters` of them can be resident at once.
+        """
+        batches: list[list[int]] = [[]]
+        adapters: set[int] = set()
+        for i in order:
+            adapter = reqs[i].adapter
+            if (
+                adapter is not None
+                and adapter in self.adapter_store
+                and adapter not in adapters
+            ):
+                if len(adapters) == self.max_num_adapters:
+                    batches.append([])
+                    adapters = set()
+                adapters.add(adapter)
+            batches[-1].append(i)
+        return batches
+
+    def _run_batch(
+        self, reqs: list[message.ForwardPassRequest]
+    ) -> list[message.ForwardPassResponse]:
+        """Runs requests sorted by adapter as one batch, answering in their order."""
+        # Page the adapters of the batch into device slots.
+        with start_profile("adapter_paging"):
+            adapter_slots = self.adapter_store.acquire(
+                req.adapter
+                for req in reqs
+                if req.adapter is not None and req.adapter in self.adapter_store
+            )
+
+        # 1. Consolidate and process all requests into a single batch.
+        with start_profile("batch_consolidation"):
+            batch = ForwardPassBatch(self, adapter_slots)
+            for req in reqs:
+                batch.add_request(req)
+
+        # 2. Finalize the batch to get model inputs as tensors.
+        with start_profile("batch_finalize"):
+            model_inputs = batch.finalize()
+
+        # 3. Run the forward pass through the model.
+        with start_profile("model_forward"):
+            with _device_context(self.device):
+                output_embeds = self.lm.model.forward(  # type: ignore[attr-defined]
+                    kv_cache_at_layer=self.kv_cache_at_layer, **model_inputs
+                )
+
+        # 4. Package the model outputs into response messages.
+        with start_profile("package_responses"):
+            responses = batch.package_responses(output_embeds)
 
         return responses
 
@@ -351,17 +539,34 @@ class Handler:
             resps.append(message.HeartbeatResponse())
         return resps
 
+    @torch.inference_mode()
     def upload_handler(self, reqs: list[message.UploadAdapterRequest]):
-        """Handle adapter upload requests."""
-        _ = reqs  # Parameter not currently used
-        raise NotImplementedError("upload_handler not yet implemented")
+        """Stores uploaded adapters in host memory, to be paged in on use."""
+        for req in reqs:
+            adapter, down, up = deserialize_adapter(
+                req.adapter_data, adapter_id=req.adapter_ptr, dtype=self.dtype
+            )
+            self.adapter_store.add(req.adapter_ptr, adapter, down, up)
 
+    @torch.inference_mode()
     def download_handler(
         self, reqs: list[message.DownloadAdapterRequest]
     ) -> list[message.DownloadAdapterResponse]:
-        """Handle adapter download requests."""
-        _ = reqs  # Parameter not currently used
-        raise NotImplementedError("download_handler not yet implemented")
+        """Serializes adapters with the configured `adapter_encoding`."""
+        resps = []
+        for req in reqs:
+            adapter = self.adapter_store.get(req.adapter_ptr)
+            if adapter is None:
+                raise ValueError(f"Adapter {req.adapter_ptr} does not exist.")
+            down, up = self.adapter_store.host_weights(req.adapter_ptr)
+            resps.append(
+                message.DownloadAdapterResponse(
+                    adapter_data=serialize_adapter(
+                        adapter, down, up, encoding=self.adapter_encoding, name=req.name
+                    )
+                )
+            )
+        return resps
 
 
 @contextmanager
@@ -410,9 +615,13 @@ class ForwardPassBatch:
     # Static constant for the maximum top_k value for distributions.
     TOP_K_MAX_BOUND = 1024
 
-    def __init__(self, handler: Handler):
-        """Initializes the batch processor."""
+    def __init__(self, handler: Handler, adapter_slots: dict[int, int] | None = None):
+        """Initializes the batch processor.
+
+        `adapter_slots` maps the adapters of the batch to their device slots.
+        """
         self._handler = handler
+        self._adapter_slots = adapter_slots or {}
         self.logits_dtype = getattr(handler, "logits_dtype", handler.dtype)
         self._original_reqs: list[message.ForwardPassRequest] = []
 
@@ -446,10 +655,10 @@ class ForwardPassBatch:
         self._original_reqs.append(req)
 
         # Handle adapter information
-        if req.adapter is not None and req.adapter in self._handler.adapters:
+        if req.adapter is not None and req.adapter in self._adapter_slots:
             seed = req.adapter_seed if req.adapter_seed is not None else 0
             self.seeds.extend([seed] * len(req.input_tokens))
-            self.adapter_indices.append(req.adapter)
+            self.adapter_indices.append(self._adapter_slots[req.adapter])
             self.adapter_subpass_needed = True
 
         # Handle KV cache pages
@@ -563,23 +772,33 @@ class ForwardPassBatch:
             adapter_subpass = None
             if self.adapter_subpass_needed:
                 adapter_subpass_class = ensure_adapter_available()
-                seeds_tensor = torch.as_tensor(
-                    self.seeds, device=device, dtype=torch.long
-                )
                 adapter_subpass = adapter_subpass_class(
                     adapter_at_layer=self._handler.adapter_at_layer,
                     adapter_indices=self.adapter_indices,
-                    adapter_extras=self._handler.adapters,
-                    rand_seeds=seeds_tensor,
+                    adapter_extras={
+                        slot: self._handler.adapter_store.get(adapter_ptr)
+                        for adapter_ptr, slot in self._adapter_slots.items()
+                    },
+                    rand_seeds=self.seeds,
                     qo_indptr=self.qo_indptr,
                 )
 
         with start_profile("finalize_tensor_creation"):
-            batched_attention_mask = (
-                np.concatenate(self.attention_masks)
-                if self.attention_masks
-                else np.array([], dtype=np.bool_)
-            )
+            # A decode step whose tokens see all of their keys needs no mask,
+            # which saves uploading one that covers the whole KV length.
+            custom_mask = None
+            if not self.single_token_inference_mode or not all(
+                mask.all() for mask in self.attention_masks
+            ):
+                custom_mask = torch.as_tensor(
+                    (
+                        np.concatenate(self.attention_masks)
+                        if self.attention_masks
+                        else np.array([], dtype=np.bool_)
+                    ),
+                    device=device,
+                    dtype=torch.bool,
+                )
             token_ids_tensor = torch.as_tensor(
                 self.batch_token_ids, device=device, dtype=torch.int32
             )
@@ -589,32 +808,76 @@ class ForwardPassBatch:
             input_embeds = embed_tokens(token_ids_tensor)  # type: ignore[operator]
 
         with start_profile("finalize_create_input_dict"):
+            index_buffers = self._handler.index_buffers
             result = {
                 "input_embeds": input_embeds,
-                "position_ids": torch.as_tensor(
-                    self.batch_position_ids, device=device, dtype=torch.int32
-                ),
-                "qo_indptr": torch.as_tensor(
-                    self.qo_indptr, device=device, dtype=torch.int32
-                ),
-                "kv_page_indices": torch.as_tensor(
-                    self.kv_page_indices, device=device, dtype=torch.int32
+                # Decode steps of a stable batch advance positions and
+                # last-page lengths by one, which is done on the device.
+                "position_ids": index_buffers.get(
+                    "position_ids", self.batch_position_ids, advance=True
                 ),
-                "kv_page_indptr": torch.as_tensor(
-                    self.kv_page_indptr, device=device, dtype=torch.int32
+                "qo_indptr": index_buffers.get("qo_indptr", self.qo_indptr),
+                "kv_page_indices": index_buffers.get(
+                    "kv_page_indices", self.kv_page_indices
                 ),
-                "kv_last_page_lens": torch.as_tensor(
-                    self.kv_last_page_lengths, device=device, dtype=torch.int32
+                "kv_page_indptr": index_buffers.get(
+                    "kv_page_indptr", self.kv_page_indptr
                 ),
-                "custom_mask": torch.as_tensor(
-                    batched_attention_mask, device=device, dtype=torch.bool
+                "kv_last_page_lens": index_buffers.get(
+                    "kv_last_page_lens", self.kv_last_page_lengths, advance=True
                 ),
+                "custom_mask": custom_mask,
                 "single_token_inference_mode": self.single_token_inference_mode,
                 "adapter_subpass": adapter_subpass,
+                "plan_key": (
+                    self.single_token_inference_mode,
+                    tuple(self.qo_indptr),
+                    tuple(self.kv_page_indptr),
+                    # Changes whenever the pages do
+                    index_buffers.generation("kv_page_indices"),
+                ),
             }
 
+        backend = getattr(self._handler.lm.model, "backend", None)  # type: ignore[attr-defined]
+        if getattr(backend, "supports_shared_prefix", False):
+            with start_profile("finalize_shared_prefix"):
+                shared_prefix = prepare_shared_prefix(
+                    kv_page_ptrs=[
+                        req.kv_page_ptrs or [] for req in self._original_reqs
+                    ],
+                    qo_indptr=self.qo_indptr,
+                    masks=self.attention_masks,
+                    page_size=self._handler.kv_page_size,
+                    device=device,
+                )
+                if shared_prefix is not None:
+                    result["shared_prefix"] = shared_prefix
+
+        window_kv_pool = self._handler.window_kv_pool
+        if window_kv_pool is not None:
+            with start_profile("finalize_window_kv_pool"):
+                result["window_kv"] = window_kv_pool.prepare(
+                    kv_page_ptrs=[
+                        req.kv_page_ptrs or [] for req in self._original_reqs
+                    ],
+                    kv_last_page_lens=self.kv_last_page_lengths,
+                    num_input_tokens=[
+                        len(req.input_tokens) for req in self._original_reqs
+                    ],
+                    masks=self.attention_masks,
+                )
+
         return result
 
+    def _window_unreachable_kv_pages(self, req: message.ForwardPassRequest) -> int:
+        """Number of leading KV pages no sliding-window layer will read again."""
+        return num_window_unreachable_pages(
+            len(req.kv_page_ptrs or []),
+            req.kv_page_last_len or 0,
+            self._handler.kv_page_size,
+            self._handler.sliding_window,
+        )
+
     def package_responses(
         self, output_embeds: torch.Tensor
     ) -> list[message.ForwardPassResponse]:
@@ -629,8 +892,12 @@ class ForwardPassBatch:
 
         if not self.indices_for_logits:
             return [
-                message.ForwardPassResponse(dists=[], tokens=[])
-                for _ in self._original_reqs
+                message.ForwardPassResponse(
+                    dists=[],
+                    tokens=[],
+                    window_unreachable_kv_pages=self._window_unreachable_kv_pages(req),
+                )
+                for req in self._original_reqs
             ]
 
         # Calculate logits for all required tokens (both dists and samples)
@@ -772,7 +1039,11 @@ class ForwardPassBatch:
                     request_tokens.append(final_tokens_tensor[i].item())
 
             responses.append(
-                message.ForwardPassResponse(dists=request_dists, tokens=request_tokens)
+                message.ForwardPassResponse(
+                    dists=request_dists,
+                    tokens=request_tokens,
+                    window_unreachable_kv_pages=self._window_unreachable_kv_pages(req),
+                )
             )
             cursor += num_outputs
 
@@ -0,0 +1,91 @@
+"""
+Device-resident index tensors of the forward-pass batches.
+
+Consecutive decode steps of a stable batch send the same page tables, and the
+positions and last-page lengths of every request grow by exactly one. Instead
+of uploading all index lists for every pass, `DeviceIndexBuffers` keeps each
+of them in a preallocated device buffer together with its host copy:
+
+* an unchanged list reuses its buffer as is,
+* a list whose entries all grew by one is updated with an in-place add,
+* anything else is copied into the buffer (which grows when needed).
+
+So a steady-state decode step makes no host-to-device index upload, and the
+buffers keep their addresses, which lets attention kernels that captured them
+when they were planned read the updated values.
+"""
+
+from __future__ import annotations
+
+import torch
+
+
+class DeviceIndexBuffers:
+    """Named int32 device buffers that are updated incrementally."""
+
+    def __init__(self, device: str, initial_capacity: int = 256):
+        self.device = device
+        self.initial_capacity = initial_capacity
+        self._buffers: dict[str, torch.Tensor] = {}
+        self._host_values: dict[str, list[int]] = {}
+        self._views: dict[str, torch.Tensor] = {}
+        # Number of uploads of each buffer, which changes whenever its values
+        # do, except by an in-place advance
+        self._generations: dict[str, int] = {}
+
+        # Number of `get` calls served by each kind of update
+        self.reuses = 0
+        self.increments = 0
+        self.uploads = 0
+
+    def get(self, name: str, values: list[int], advance: bool = False) -> torch.Tensor:
+        """Returns a device tensor holding `values`.
+
+        With `advance`, a list whose entries are all one more than the previous
+        ones is updated on the device instead of being uploaded.
+        """
+        previous = self._host_values.get(name)
+        if previous is not None:
+            if previous == values:
+                self.reuses += 1
+                return self._views[name]
+            if (
+                advance
+                and len(previous) == len(values)
+                and all(v == p + 1 for v, p in zip(values, previous))
+            ):
+                self._views[name].add_(1)
+                self._host_values[name] = list(values)
+                self.increments += 1
+                return self._views[name]
+
+        buffer = self._buffers.get(name)
+        if buffer is None or buffer.numel() < len(values):
+            capacity = max(
+                self.initial_capacity, 1 << max(0, len(values) - 1).bit_length()
+            )
+            buffer = torch.empty(capacity, dtype=torch.int32, device=self.device)
+            self._buffers[name] = buffer
+
+        view = buffer[: len(values)]
+        view.copy_(torch.tensor(values, dtype=torch.int32))
+        self._host_values[name] = list(values)
+        self._views[name] = view
+        self._generations[name] = self._generations.get(name, 0) + 1
+        self.uploads += 1
+        return view
+
+    def generation(self, name: str) -> int:
+        """Returns how many times the buffer `name` was uploaded."""
+        return self._generations.get(name, 0)
+
+    def stats(self) -> dict[str, int]:
+        """Returns the number of reused, incremented and uploaded tensors."""
+        return {
+            "reuses": self.reuses,
+            "increments": self.increments,
+            "uploads": self.uploads,
+        }
+
+
+__all__ = ["DeviceIndexBuffers"]
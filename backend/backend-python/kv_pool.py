@@ -0,0 +1,308 @@
+"""
+Paged KV bookkeeping for sliding-window attention layers.
+
+Architectures such as GPT OSS alternate full-attention and sliding-window
+layers. A sliding-window layer never reads keys that are more than `window`
+tokens behind the query, so once a sequence grows past the window its leading
+KV pages are dead for those layers even though the full-attention layers still
+need them.
+
+This module provides two things:
+
+* `num_window_unreachable_pages`, which tells the controller how many leading
+  pages of a request can no longer be reached by any sliding-window layer.
+* `SlidingWindowKvPool`, an optional separate KV pool for the sliding-window
+  layers. The controller-visible page pointers are remapped to a much smaller
+  set of slots. Between forward passes, each sequence only keeps a ring of
+  `window_ring_pages` pages resident in those layers; during a pass, the
+  pages of all of its new tokens are resident as well, since a prefill
+  attends to them.
+"""
+
+from __future__ import annotations
+
+from collections import OrderedDict
+from dataclasses import dataclass
+
+import numpy as np
+import torch
+
+
+def num_window_unreachable_pages(
+    num_pages: int, last_page_len: int, page_size: int, window: int
+) -> int:
+    """
+    Returns how many leading pages no future query of the sequence can attend to
+    in a sliding-window layer.
+
+    The next token is appended at KV index `seq_len` and sees keys in
+    `[seq_len - window + 1, seq_len]`, so every page that ends before that
+    range is unreachable from now on.
+    """
+    if num_pages == 0 or window <= 0:
+        return 0
+    seq_len = (num_pages - 1) * page_size + last_page_len
+    return min(num_pages - 1, max(0, (seq_len - window + 1) // page_size))
+
+
+def window_ring_pages(page_size: int, window: int) -> int:
+    """Pages a sequence keeps resident in a sliding-window pool between passes."""
+    return -(-window // page_size) + 1
+
+
+def min_window_kv_pages(page_size: int, window: int, max_pass_tokens: int) -> int:
+    """
+    Size of the smallest sliding-window pool that can run a forward pass of
+    `max_pass_tokens` tokens for a single sequence.
+
+    Each other sequence whose context is kept while it is idle needs
+    `window_ring_pages` more slots.
+    """
+    return -(-max_pass_tokens // page_size) + window_ring_pages(page_size, window)
+
+
+@dataclass
+class WindowKvInputs:
+    """Batch inputs for the sliding-window layers when they use their own pool.
+
+    The page tables only cover the pages that are inside the window of at least
+    one query of the pass. `kv_offsets` holds, per request, the number of
+    leading KV positions that were cut off, so KV indices (for appends and mask
+    columns) have to be shifted by it.
+    """
+
+    kv_page_indices: torch.Tensor
+    kv_page_indptr: torch.Tensor
+    kv_offsets: torch.Tensor
+    custom_mask: torch.Tensor
+
+
+class SlidingWindowKvPool:
+    """
+    Maps controller page pointers to slots of the sliding-window KV pool.
+
+    Slots are handed out when a page first falls inside a window and returned
+    as soon as the page becomes unreachable for the request that owns it. The
+    controller does not report the pages it frees, so the pool cannot tell an
+    idle context from a finished one: the last window of every context stays
+    resident until its slots are needed. When a batch needs more slots than
+    are free, `admit` reclaims the pages that were used the longest ago and
+    that no request of the batch attends to.
+
+    `admit` picks the requests of a batch the pool can serve: a request is
+    refused, rather than failing the whole batch, if its new pages do not fit
+    in the free slots or if it attends to a page that is not resident (e.g. a
+    context that was idle while its window was reclaimed, or a fork lagging
+    more than a window behind its parent, whose pages were released), whose
+    keys and values cannot be restored.
+    """
+
+    def __init__(self, num_slots: int, page_size: int, window: int, device: str):
+        if num_slots <= 0:
+            raise ValueError("The sliding-window KV pool needs at least one slot.")
+        self.num_slots = num_slots
+        self.page_size = page_size
+        self.window = window
+        self.device = device
+
+        # page pointer -> slot, least recently used first
+        self._slots: OrderedDict[int, int] = OrderedDict()
+        self._free_slots: list[int] = list(range(num_slots - 1, -1, -1))
+
+        # Number of slots taken from idle pages by `admit`
+        self.reclaims = 0
+        # Pages that the requests admitted last still reach. They stay
+        # resident when the admitted requests run as several passes.
+        self._admitted_live_pages: set[int] = set()
+
+    @property
+    def num_free_slots(self) -> int:
+        """Number of slots that are currently unassigned."""
+        return len(self._free_slots)
+
+    def reset(self) -> None:
+        """Unassigns all slots, e.g. after the warm-up passes."""
+        self._slots.clear()
+        self._free_slots = list(range(self.num_slots - 1, -1, -1))
+        self.reclaims = 0
+        self._admitted_live_pages.clear()
+
+    def _window_pages(
+        self, page_ptrs: list[int], last_len: int, q_len: int
+    ) -> tuple[int, int]:
+        """Returns the first page in the window of a request and its old tokens."""
+        seq_len = max(0, (len(page_ptrs) - 1) * self.page_size + last_len)
+        # The first query of the pass sits at KV index `seq_len - q_len`.
+        first_key = max(0, seq_len - q_len - self.window + 1)
+        first_page = min(first_key // self.page_size, max(0, len(page_ptrs) - 1))
+        return first_page, seq_len - q_len
+
+    def admit(
+        self,
+        kv_page_ptrs: list[list[int]],
+        kv_last_page_lens: list[int],
+        num_input_tokens: list[int],
+    ) -> list[str | None]:
+        """
+        Checks, in order, which requests of a batch the pool can serve.
+
+        Returns, for each request, None if it is admitted or the reason it is
+        refused. Only the admitted requests may be passed to `prepare`. Slots
+        of pages outside the windows of the batch are reclaimed, least
+        recently used first, if the free ones do not suffice.
+        """
+        windows = [
+            self._window_pages(page_ptrs, last_len, q_len)
+            for page_ptrs, last_len, q_len in zip(
+                kv_page_ptrs, kv_last_page_lens, num_input_tokens
+            )
+        ]
+        batch_pages = set()
+        for page_ptrs, (first_page, _) in zip(kv_page_ptrs, windows):
+            batch_pages.update(page_ptrs[first_page:])
+
+        errors: list[str | None] = []
+        new_pages: set[int] = set()
+        self._admitted_live_pages = set()
+        for page_ptrs, last_len, (first_page, num_old_tokens) in zip(
+            kv_page_ptrs, kv_last_page_lens, windows
+        ):
+            error = None
+            request_pages = set()
+            for i, page_ptr in enumerate(page_ptrs[first_page:], start=first_page):
+                if page_ptr in self._slots or page_ptr in new_pages:
+                    continue
+                if i * self.page_size < num_old_tokens:
+                    error = (
+                        f"KV page {page_ptr} is inside the attention window but "
+                        "is not resident in the sliding-window KV pool."
+                    )
+                    break
+                request_pages.add(page_ptr)
+            if error is None:
+                self._reclaim(len(new_pages | request_pages), batch_pages)
+            if error is None and len(new_pages | request_pages) > len(self._free_slots):
+                error = (
+                    f"The sliding-window KV pool has {len(self._free_slots)} free "
+                    "slots, too few for the request. Increase "
+                    "'max_num_window_kv_pages' or reduce the number of live "
+                    "contexts."
+                )
+            if error is None:
+                new_pages |= request_pages
+                num_dead = num_window_unreachable_pages(
+                    len(page_ptrs), last_len, self.page_size, self.window
+                )
+                self._admitted_live_pages.update(page_ptrs[num_dead:])
+            errors.append(error)
+        return errors
+
+    def _reclaim(self, num_free_slots: int, keep: set[int]) -> None:
+        """Frees the least recently used slots, outside `keep`, up to a total."""
+        if len(self._free_slots) >= num_free_slots:
+            return
+        for page_ptr in [ptr for ptr in self._slots if ptr not in keep]:
+            self._free_slots.append(self._slots.pop(page_ptr))
+            self.reclaims += 1
+            if len(self._free_slots) >= num_free_slots:
+                return
+
+    def prepare(
+        self,
+        kv_page_ptrs: list[list[int]],
+        kv_last_page_lens: list[int],
+        num_input_tokens: list[int],
+        masks: list[np.ndarray],
+    ) -> WindowKvInputs:
+        """
+        Assigns slots for one forward pass and builds the remapped batch inputs.
+
+        Args:
+            kv_page_ptrs: Page pointers of every request in the batch.
+            kv_last_page_lens: Number of valid tokens in each request's last page.
+            num_input_tokens: Number of new tokens each request appends.
+            masks: Flattened `(num_input_tokens, seq_len)` boolean masks.
+
+        The requests must have been admitted by `admit`, possibly as a part
+        of the admitted batch.
+        """
+        first_pages = [
+            self._window_pages(page_ptrs, last_len, q_len)[0]
+            for page_ptrs, last_len, q_len in zip(
+                kv_page_ptrs, kv_last_page_lens, num_input_tokens
+            )
+        ]
+
+        slot_indices: list[int] = []
+        slot_indptr = [0]
+        kv_offsets = []
+        window_masks = []
+        for page_ptrs, last_len, q_len, mask, first_page in zip(
+            kv_page_ptrs, kv_last_page_lens, num_input_tokens, masks, first_pages
+        ):
+            seq_len = max(0, (len(page_ptrs) - 1) * self.page_size + last_len)
+            # Pages that only receive new tokens get a free slot (`admit`
+            # checked that there are enough); the others are resident.
+            for page_ptr in page_ptrs[first_page:]:
+                slot = self._slots.get(page_ptr)
+                if slot is None:
+                    slot = self._free_slots.pop()
+                    self._slots[page_ptr] = slot
+                else:
+                    self._slots.move_to_end(page_ptr)
+                slot_indices.append(slot)
+            slot_indptr.append(len(slot_indices))
+
+            offset = first_page * self.page_size
+            kv_offsets.append(offset)
+            window_masks.append(mask.reshape(q_len, seq_len)[:, offset:].reshape(-1))
+
+        # Release the pages that fell out of the window for good, once the pass
+        # has read them. A page can be shared with another request of the batch
+        # (e.g. a fork), in which case it stays resident as long as that
+        # request, in this pass or a later part of the admitted batch, can
+        # still reach it.
+        num_dead_pages = [
+            num_window_unreachable_pages(
+                len(page_ptrs), last_len, self.page_size, self.window
+            )
+            for page_ptrs, last_len in zip(kv_page_ptrs, kv_last_page_lens)
+        ]
+        live_pages = set(self._admitted_live_pages)
+        for page_ptrs, num_dead in zip(kv_page_ptrs, num_dead_pages):
+            live_pages.update(page_ptrs[num_dead:])
+        for page_ptrs, num_dead in zip(kv_page_ptrs, num_dead_pages):
+            for page_ptr in page_ptrs[:num_dead]:
+                if page_ptr in live_pages or page_ptr not in self._slots:
+                    continue
+                self._free_slots.append(self._slots.pop(page_ptr))
+
+        return WindowKvInputs(
+            kv_page_indices=torch.as_tensor(
+                slot_indices, device=self.device, dtype=torch.int32
+            ),
+            kv_page_indptr=torch.as_tensor(
+                slot_indptr, device=self.device, dtype=torch.int32
+            ),
+            kv_offsets=torch.as_tensor(
+                kv_offsets, device=self.device, dtype=torch.int32
+            ),
+            custom_mask=torch.as_tensor(
+                (
+                    np.concatenate(window_masks)
+                    if window_masks
+                    else np.array([], dtype=np.bool_)
+                ),
+                device=self.device,
+                dtype=torch.bool,
+            ),
+        )
+
+
+__all__ = [
+    "SlidingWindowKvPool",
+    "WindowKvInputs",
+    "min_window_kv_pages",
+    "num_window_unreachable_pages",
+    "window_ring_pages",
+]
@@ -0,0 +1,397 @@
+"""
+Device-agnostic memory planning for the KV cache.
+
+The planner sizes the paged KV cache from what is actually left on the device
+after the model has been loaded. It works the same way on CUDA, MPS (unified
+memory) and CPU hosts, so `gpu_mem_headroom` no longer has to be paired with a
+CUDA device and `max_num_kv_pages` no longer has to be hand-tuned per machine.
+"""
+
+from __future__ import annotations
+
+import os
+import sys
+from dataclasses import asdict, dataclass
+from typing import Any
+
+import torch
+from torch import nn
+
+# Size of the attention workspace buffer allocated by the FlashInfer wrappers.
+ATTENTION_WORKSPACE_BYTES = 128 * 1024 * 1024
+
+
+@dataclass
+class MemoryPlan:
+    """Describes how device memory is split between weights, activations and KV."""
+
+    device: str
+    mode: str  # "adaptive" (sized from free memory) or "fixed" (from config)
+    total_memory_bytes: int
+    available_memory_bytes: int
+    weight_bytes: int
+    activation_bytes: int
+    headroom_percent: float
+    kv_page_bytes: int
+    num_kv_pages: int
+    # Separate pool of the sliding-window layers, if any (see `kv_pool`)
+    window_kv_page_bytes: int = 0
+    num_window_kv_pages: int = 0
+    # Bytes of weights that tied parameters share instead of each holding a copy
+    shared_weight_bytes: int = 0
+
+    @property
+    def kv_cache_bytes(self) -> int:
+        """Total number of bytes held by the KV cache."""
+        return (
+            self.kv_page_bytes * self.num_kv_pages
+            + self.window_kv_page_bytes * self.num_window_kv_pages
+        )
+
+    def to_dict(self) -> dict[str, Any]:
+        """Converts the plan to a JSON-serializable dictionary."""
+        result = asdict(self)
+        result["kv_cache_bytes"] = self.kv_cache_bytes
+        return result
+
+    def summary(self) -> str:
+        """Returns a human readable, multi-line description of the plan."""
+        lines = [
+            "--- Memory Plan ---",
+            f"device: {self.device} ({self.mode})",
+            f"total memory: {_format_bytes(self.total_memory_bytes)}",
+            f"available after load: {_format_bytes(self.available_memory_bytes)}",
+            f"model weights: {_format_bytes(self.weight_bytes)}"
+            + (
+                f" ({_format_bytes(self.shared_weight_bytes)} shared by tied "
+                "parameters)"
+                if self.shared_weight_bytes
+                else ""
+            ),
+            f"activation workspace: {_format_bytes(self.activation_bytes)}",
+            f"headroom: {self.headroom_percent:.1f}%",
+            f"kv cache: {self.num_kv_pages} pages x "
+            f"{_format_bytes(self.kv_page_bytes)}",
+        ]
+        if self.num_window_kv_pages:
+            lines.append(
+                f"window kv cache: {self.num_window_kv_pages} pages x "
+                f"{_format_bytes(self.window_kv_page_bytes)}"
+            )
+        lines += [
+            f"kv cache total: {_format_bytes(self.kv_cache_bytes)}",
+            "-------------------",
+        ]
+        return "\n".join(lines)
+
+
+def get_device_memory_info(device: str) -> tuple[int, int]:
+    """
+    Returns the (free, total) memory in bytes for the given device.
+
+    CUDA devices report their own memory. MPS devices share unified memory with
+    the host, so the Metal working-set limit is used as the total and the
+    result is further capped by the memory the OS reports as available. CPU
+    devices use the system memory.
+    """
+    if device.startswith("cuda"):
+        free_bytes, total_bytes = torch.cuda.mem_get_info(device)
+        return int(free_bytes), int(total_bytes)
+
+    sys_free_bytes, sys_total_bytes = get_system_memory_info()
+
+    if device.startswith("mps"):
+        total_bytes = sys_total_bytes
+        free_bytes = sys_free_bytes
+        if hasattr(torch.mps, "recommended_max_memory"):
+            total_bytes = min(total_bytes, int(torch.mps.recommended_max_memory()))
+            used_bytes = int(torch.mps.driver_allocated_memory())
+            free_bytes = min(free_bytes, max(0, total_bytes - used_bytes))
+        return free_bytes, total_bytes
+
+    return sys_free_bytes, sys_total_bytes
+
+
+def get_system_memory_info() -> tuple[int, int]:
+    """Returns the (available, total) system memory in bytes."""
+    try:
+        import psutil  # pylint: disable=import-outside-toplevel
+
+        vm = psutil.virtual_memory()
+        return int(vm.available), int(vm.total)
+    except ImportError:
+        pass
+
+    # Linux: `MemAvailable` accounts for reclaimable page cache, which is what
+    # we want since weights loaded through the page cache can be evicted.
+    try:
+        meminfo = {}
+        with open("/proc/meminfo", "r", encoding="utf-8") as f:
+            for line in f:
+                key, value = line.split(":", 1)
+                meminfo[key] = int(value.split()[0]) * 1024
+        return meminfo["MemAvailable"], meminfo["MemTotal"]
+    except (OSError, KeyError, ValueError):
+        pass
+
+    page_size = os.sysconf("SC_PAGE_SIZE")
+    total_bytes = os.sysconf("SC_PHYS_PAGES") * page_size
+    try:
+        free_bytes = os.sysconf("SC_AVPHYS_PAGES") * page_size
+    except (ValueError, OSError):
+        # macOS does not expose SC_AVPHYS_PAGES. Assume half of the memory
+        # is usable rather than over-committing unified memory.
+        free_bytes = total_bytes // 2
+    return free_bytes, total_bytes
+
+
+def _proc_status_bytes(key: str) -> int | None:
+    """Reads a memory field (e.g. `VmRSS`) of `/proc/self/status` in bytes."""
+    try:
+        with open("/proc/self/status", "r", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith(f"{key}:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def reset_peak_rss() -> None:
+    """Restarts the peak of `get_peak_rss_bytes` from the current RSS (Linux)."""
+    try:
+        with open("/proc/self/clear_refs", "w", encoding="utf-8") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def get_peak_rss_bytes() -> int:
+    """Returns the peak resident set size of the process in bytes."""
+    peak = _proc_status_bytes("VmHWM")
+    if peak is not None:
+        return peak
+    import resource  # pylint: disable=import-outside-toplevel
+
+    # `ru_maxrss` is in bytes on macOS and in KiB elsewhere.
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+def get_rss_bytes() -> int | None:
+    """Returns the current resident set size of the process in bytes, if known."""
+    return _proc_status_bytes("VmRSS")
+
+
+def _weight_storages(model: nn.Module) -> dict[tuple[str, int], tuple[int, int]]:
+    """Maps each storage of the model's tensors to its size and tensor count."""
+    storages: dict[tuple[str, int], tuple[int, int]] = {}
+    tensors = [
+        *model.named_parameters(remove_duplicate=False),
+        *model.named_buffers(remove_duplicate=False),
+    ]
+    for _, tensor in tensors:
+        storage = tensor.untyped_storage()
+        key = (str(tensor.device), storage.data_ptr())
+        _, count = storages.get(key, (0, 0))
+        storages[key] = (storage.nbytes(), count + 1)
+    return storages
+
+
+def measure_weight_bytes(model: nn.Module) -> int:
+    """Returns the number of bytes held by the model's parameters and buffers.
+
+    Tensors that share storage (e.g. tied weights) are only counted once.
+    """
+    return sum(nbytes for nbytes, _ in _weight_storages(model).values())
+
+
+def measure_shared_weight_bytes(model: nn.Module) -> int:
+    """Returns the bytes saved by tensors sharing a storage instead of copying it."""
+    return sum(
+        nbytes * (count - 1) for nbytes, count in _weight_storages(model).values()
+    )
+
+
+def kv_page_bytes(
+    arch: Any, kv_page_size: int, dtype: torch.dtype, num_layers: int | None = None
+) -> int:
+    """Returns the number of bytes one KV page occupies across `num_layers` layers.
+
+    All layers of the model are counted if `num_layers` is not given.
+    """
+    if num_layers is None:
+        num_layers = arch.num_layers
+    return (
+        kv_page_size
+        * 2
+        * arch.num_key_value_heads
+        * arch.head_size
+        * num_layers
+        * dtype.itemsize
+    )
+
+
+def estimate_activation_bytes(
+    arch: Any, max_batch_tokens: int, dtype: torch.dtype
+) -> int:
+    """
+    Estimates the transient memory needed to run a batch of `max_batch_tokens`.
+
+    Only one decoder layer is live at a time, so the estimate covers the
+    per-token tensors of a single layer (residual, normalized hidden states,
+    fused QKV, attention output and the gated MLP intermediates), plus the
+    attention workspace.
+    """
+    qkv_size = arch.head_size * (arch.num_query_heads + 2 * arch.num_key_value_heads)
+    intermediate_size = arch.intermediate_size * getattr(arch, "experts_per_token", 1)
+    per_token_elems = 4 * arch.hidden_size + 2 * qkv_size + 3 * intermediate_size
+    return max_batch_tokens * per_token_elems * dtype.itemsize + (
+        ATTENTION_WORKSPACE_BYTES
+    )
+
+
+def plan_kv_cache(
+    *,
+    device: str,
+    model: nn.Module,
+    arch: Any,
+    kv_page_size: int,
+    max_batch_tokens: int,
+    dtype: torch.dtype,
+    headroom_percent: float,
+    max_num_kv_pages: int | None = None,
+    num_window_kv_pages: int = 0,
+) -> MemoryPlan:
+    """
+    Sizes the KV cache so that `headroom_percent` of the device memory stays free
+    after the weights, the activation workspace and the KV cache are allocated.
+
+    Must be called after the model has been loaded and before the KV cache is
+    allocated. If `max_num_kv_pages` is given, it caps the number of pages.
+    If `num_window_kv_pages` is non-zero, the sliding-window layers of `arch`
+    use a pool of that fixed size, and only the remaining layers are sized
+    from the free memory.
+
+    Raises:
+        ValueError: If there is not enough memory left for a single KV page.
+    """
+    free_bytes, total_bytes = get_device_memory_info(device)
+    weight_bytes = measure_weight_bytes(model)
+    activation_bytes = estimate_activation_bytes(arch, max_batch_tokens, dtype)
+    page_bytes, window_page_bytes = _split_kv_page_bytes(
+        arch, kv_page_size, dtype, num_window_kv_pages
+    )
+
+    # Memory in use by anything (our weights, other processes) is implied by
+    # `total - free`, so the budget is whatever remains below the headroom line.
+    reserved_bytes = total_bytes * (headroom_percent / 100)
+    available_kv_cache_bytes = (
+        free_bytes
+        - reserved_bytes
+        - activation_bytes
+        - window_page_bytes * num_window_kv_pages
+    )
+
+    num_kv_pages = int(available_kv_cache_bytes // page_bytes)
+    if num_kv_pages <= 0:
+        raise ValueError(
+            "Not enough device memory available to allocate the KV cache. "
+            "Please decrease 'gpu_mem_headroom' or 'max_batch_tokens'."
+        )
+
+    if max_num_kv_pages is not None:
+        if num_kv_pages > max_num_kv_pages:
+            num_kv_pages = max_num_kv_pages
+        elif num_kv_pages < max_num_kv_pages:
+            print(
+                f"'max_num_kv_pages' is reduced to {num_kv_pages} "
+                "to respect 'gpu_mem_headroom'."
+            )
+
+    return MemoryPlan(
+        device=device,
+        mode="adaptive",
+        total_memory_bytes=total_bytes,
+        available_memory_bytes=free_bytes,
+        weight_bytes=weight_bytes,
+        activation_bytes=activation_bytes,
+        headroom_percent=headroom_percent,
+        kv_page_bytes=page_bytes,
+        num_kv_pages=num_kv_pages,
+        window_kv_page_bytes=window_page_bytes,
+        num_window_kv_pages=num_window_kv_pages,
+        shared_weight_bytes=measure_shared_weight_bytes(model),
+    )
+
+
+def describe_fixed_kv_cache(
+    *,
+    device: str,
+    model: nn.Module,
+    arch: Any,
+    kv_page_size: int,
+    max_batch_tokens: int,
+    dtype: torch.dtype,
+    num_kv_pages: int,
+    num_window_kv_pages: int = 0,
+) -> MemoryPlan:
+    """Builds a plan describing a KV cache whose size was fixed by the config."""
+    free_bytes, total_bytes = get_device_memory_info(device)
+    page_bytes, window_page_bytes = _split_kv_page_bytes(
+        arch, kv_page_size, dtype, num_window_kv_pages
+    )
+    activation_bytes = estimate_activation_bytes(arch, max_batch_tokens, dtype)
+    # The KV cache is already allocated at this point, so the headroom is
+    # whatever is left once the activation workspace is accounted for.
+    headroom_bytes = max(0, free_bytes - activation_bytes)
+    return MemoryPlan(
+        device=device,
+        mode="fixed",
+        total_memory_bytes=total_bytes,
+        available_memory_bytes=free_bytes,
+        weight_bytes=measure_weight_bytes(model),
+        activation_bytes=activation_bytes,
+        headroom_percent=100 * headroom_bytes / total_bytes if total_bytes else 0.0,
+        kv_page_bytes=page_bytes,
+        num_kv_pages=num_kv_pages,
+        window_kv_page_bytes=window_page_bytes,
+        num_window_kv_pages=num_window_kv_pages,
+        shared_weight_bytes=measure_shared_weight_bytes(model),
+    )
+
+
+def _split_kv_page_bytes(
+    arch: Any, kv_page_size: int, dtype: torch.dtype, num_window_kv_pages: int
+) -> tuple[int, int]:
+    """Returns the page size in bytes of the full and the sliding-window pool."""
+    if not num_window_kv_pages:
+        return kv_page_bytes(arch, kv_page_size, dtype), 0
+    num_window_layers = len(arch.sliding_window_layers())
+    return (
+        kv_page_bytes(arch, kv_page_size, dtype, arch.num_layers - num_window_layers),
+        kv_page_bytes(arch, kv_page_size, dtype, num_window_layers),
+    )
+
+
+def _format_bytes(num_bytes: float) -> str:
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if abs(num_bytes) < 1024:
+            return f"{num_bytes:.1f} {unit}"
+        num_bytes /= 1024
+    return f"{num_bytes:.1f} TiB"
+
+
+__all__ = [
+    "MemoryPlan",
+    "describe_fixed_kv_cache",
+    "estimate_activation_bytes",
+    "get_device_memory_info",
+    "get_peak_rss_bytes",
+    "get_rss_bytes",
+    "kv_page_bytes",
+    "measure_shared_weight_bytes",
+    "measure_weight_bytes",
+    "plan_kv_cache",
+    "reset_peak_rss",
+]
@@ -84,6 +84,10 @@ class ForwardPassResponse(msgspec.Struct, gc=False):
 
     tokens: list[int]
     dists: list[tuple[list[int], list[float]]]
+    # Leading KV pages that no sliding-window layer can attend to anymore
+    window_unreachable_kv_pages: int = 0
+    # Why the request was refused without running, if it was
+    error: str = ""
 
 
 class EmbedImageRequest(msgspec.Struct, gc=False):
@@ -3,68 +3,25 @@
 from __future__ import annotations
 
 import math
-from itertools import islice
+from typing import Hashable, Sequence
 
 import torch
 from torch import nn
-import flashinfer as ops
 from adapter import AdapterSubpass
 from config.gptoss import GptOssArch
-from einops import einsum, rearrange
-
-
-VERSION = "0.1.0"
-
-# Reference:
-# https://github.com/openai/gpt-oss/blob/9ffdd14b89b9dbc1/gpt_oss/torch/weights.py
-FP4_VALUES = (
-    +0.0,
-    +0.5,
-    +1.0,
-    +1.5,
-    +2.0,
-    +3.0,
-    +4.0,
-    +6.0,
-    -0.0,
-    -0.5,
-    -1.0,
-    -1.5,
-    -2.0,
-    -3.0,
-    -4.0,
-    -6.0,
+from kv_pool import WindowKvInputs
+from model.l4ma_runtime import (
+    AttentionSpec,
+    CachedRope,
+    L4maBackend,
+    L4maForwardContext,
+    RuntimeInputs,
 )
+from mxfp4 import FP4_VALUES, ExpertDequantCache
+from shared_prefix import SharedPrefixInputs
 
 
-def chunked_enumerate(iterable, chunk_size):
-    """
-    Enumerate an iterable in chunks, yielding both indices and items.
-
-    This function takes an iterable and processes it in chunks of the specified size,
-    yielding tuples of (indices, items) for each chunk. The indices correspond to
-    the original positions in the iterable.
-
-    Args:
-        iterable: The iterable to process in chunks
-        chunk_size: The maximum size of each chunk
-
-    Yields:
-        tuple[list[int], list]: A tuple containing:
-            - A list of indices from the original iterable
-            - A list of corresponding items from the iterable
-
-    Example:
-        >>> list(chunked_enumerate(['a', 'b', 'c', 'd', 'e'], 2))
-        [([0, 1], ['a', 'b']), ([2, 3], ['c', 'd']), ([4], ['e'])]
-    """
-    it = iter(enumerate(iterable))
-    while True:
-        chunk = list(islice(it, chunk_size))
-        if not chunk:
-            break
-        idxs, items = zip(*chunk)
-        yield list(idxs), list(items)
+VERSION = "0.1.0"
 
 
 def create_fusion_map(model: nn.Module):
@@ -107,7 +64,8 @@ def create_fusion_map(model: nn.Module):
                 }
 
         # --- Rule for GptOssExperts MXFP4 Weights ---
-        elif isinstance(module, GptOssExperts):
+        # Packed experts load their blocks and scales as regular buffers.
+        elif isinstance(module, GptOssExperts) and not module.packed:
             # Handle gate_up_proj weights (MXFP4 format)
             target_gate_up = f"{name}.gate_up_proj"
             blocks_gate_up = f"{name}.gate_up_proj_blocks"
@@ -246,30 +204,16 @@ class GptOssRotaryEmbedding(nn.Module):
         # Ensure float32 precision for numerical accuracy
         return cos_sin_cache.to(torch.float32)
 
-    def forward(
-        self,
-        query: torch.Tensor,
-        key: torch.Tensor,
-        position_ids: torch.Tensor,
-    ) -> tuple[torch.Tensor, torch.Tensor]:
-        """Apply rotary embedding to query and key tensors using position IDs."""
-        # Use FlashInfer's optimized RoPE function with pre-computed cache
-        ops.apply_rope_with_cos_sin_cache_inplace(
-            positions=position_ids.to(torch.int32),
-            query=query,
-            key=key,
-            head_size=self.head_dim,
-            cos_sin_cache=self._cos_sin_cache,
-            is_neox=True,  # GPT-OSS uses Neox-style RoPE
-        )
-
-        return query, key
+    @property
+    def cos_sin_cache(self) -> torch.Tensor:
+        """The `[max_position_id, head_dim]` cache in the FlashInfer layout."""
+        return self._cos_sin_cache
 
 
 class GptOssAttention(nn.Module):
     """GPT OSS attention module with attention sink."""
 
-    def __init__(self, config: GptOssArch, layer_idx: int, rope: GptOssRotaryEmbedding):
+    def __init__(self, config: GptOssArch, layer_idx: int):
         """Initialize the GPT OSS attention module."""
         super().__init__()
         self.config = config
@@ -280,7 +224,9 @@ class GptOssAttention(nn.Module):
         self.num_key_value_groups = self.num_attention_heads // self.num_key_value_heads
         # Apply sliding window to even layers and full attention to odd layers
         # This follows the GPT-OSS alternating attention pattern
-        self.sliding_window = config.sliding_window if layer_idx % 2 == 0 else 0
+        self.sliding_window = (
+            config.sliding_window if layer_idx in config.sliding_window_layers() else 0
+        )
 
         # Define the output sizes for Q, K, and V for clarity
         self.q_size = config.num_query_heads * config.head_size
@@ -313,218 +259,12 @@ class GptOssAttention(nn.Module):
             dtype=config.dtype,
         )
 
-        self.scaling = self.head_dim**-0.5
-
-        self.rope = rope
-
-    def _ceil_div(self, a: int, b: int) -> int:
-        return -(-a // b)
-
-    def _attend_one_page(
-        self,
-        query: torch.Tensor,
-        paged_keys: torch.Tensor,
-        paged_mask: torch.Tensor,
-        paged_values: torch.Tensor,
-        sum_exp: torch.Tensor,
-        sum_val: torch.Tensor,
-        max_score: torch.Tensor,
-    ):
-        page_attn_scores = einsum(query, paged_keys, "q h d, s h d -> h q s")
-        page_attn_scores = (page_attn_scores + paged_mask).to(torch.float32)
-        page_max_score = torch.max(page_attn_scores, dim=-1, keepdim=False).values
-
-        # Convert -inf elements to 0.0 in page_max_score
-        page_max_score = torch.where(
-            torch.isinf(page_max_score) & (page_max_score < 0),
-            torch.tensor(0.0, dtype=page_max_score.dtype, device=page_max_score.device),
-            page_max_score,
-        )
-
-        page_attn_scores = torch.exp(page_attn_scores - page_max_score.unsqueeze(-1))
-
-        page_sum_exp = torch.sum(page_attn_scores, dim=-1, keepdim=False)
-        page_sum_val = einsum(
-            page_attn_scores, paged_values.to(torch.float32), "h q s, s h d -> h q d"
-        )
-
-        new_max_score = torch.max(max_score, page_max_score)
-        alpha = torch.exp(max_score - new_max_score)
-        beta = torch.exp(page_max_score - new_max_score)
-
-        sum_exp = sum_exp * alpha + page_sum_exp * beta
-        sum_val = sum_val * alpha.unsqueeze(-1) + page_sum_val * beta.unsqueeze(-1)
-        max_score = new_max_score
-
-        return sum_val, sum_exp, max_score
-
-    def _paged_attention(
-        self,
-        queries: torch.Tensor,
-        qo_indptr: torch.IntTensor,
-        kv_page_indptr: torch.IntTensor,
-        kv_last_page_lens: torch.IntTensor,
-        kv_page_indices: torch.IntTensor,
-        attention_mask: torch.Tensor,
-        kv_cache_at_layer: torch.Tensor,
-    ):
-        output_embeds = torch.empty(
-            queries.shape[0],
-            self.config.hidden_size,
-            dtype=queries.dtype,
-            device=queries.device,
-        )
-        kv_page_size = kv_cache_at_layer.shape[2]
-        mask_offset = 0
-        batch_num = len(qo_indptr) - 1
-
-        for batch_idx in range(batch_num):
-            q_start = qo_indptr[batch_idx]
-            q_end = qo_indptr[batch_idx + 1]
-            query_len = int(q_end - q_start)
-
-            kv_page_start = int(kv_page_indptr[batch_idx])
-            kv_page_end = int(kv_page_indptr[batch_idx + 1])
-            kv_last_page_len = int(kv_last_page_lens[batch_idx])
-
-            seq_len = int(
-                (kv_page_end - kv_page_start - 1) * kv_page_size + kv_last_page_len
-            )
-
-            mask_len = seq_len * query_len
-            mask = attention_mask[mask_offset : mask_offset + mask_len].view(
-                query_len, seq_len
-            )
-            mask_offset += mask_len
-
-            # If this attention layer uses a sliding window, we keep only the last
-            # few pages of the KV cache and the corresponding mask.
-            if self.sliding_window != 0:
-                attn_page_cnt = 1 + self._ceil_div(
-                    self.sliding_window - kv_last_page_len, kv_page_size
-                )
-                kv_page_start = max(kv_page_start, kv_page_end - attn_page_cnt)
-
-                seq_len = int(
-                    (kv_page_end - kv_page_start - 1) * kv_page_size + kv_last_page_len
-                )
-
-                mask = mask[:, -seq_len:]
-
-            query = queries[q_start:q_end, :] * self.scaling
-
-            sum_exp = torch.zeros(
-                self.num_attention_heads,
-                query_len,
-                device=query.device,
-                dtype=torch.float32,
-            )
-            sum_val = torch.zeros(
-                self.num_attention_heads,
-                query_len,
-                self.head_dim,
-                device=query.device,
-                dtype=torch.float32,
-            )
-            max_score = torch.zeros(
-                self.num_attention_heads,
-                query_len,
-                device=query.device,
-                dtype=torch.float32,
-            )
-
-            # Attend to all but the last page, processing 32 pages at a time
-            for page_cnts, kv_page_idx_idxs in chunked_enumerate(
-                range(kv_page_start, kv_page_end - 1), 32
-            ):
-                chunk_kv_page_indices = kv_page_indices[kv_page_idx_idxs]
-
-                # Gather keys and values for all pages in the chunk at once
-                # Shape: [chunk_size, page_size, num_kv_heads, head_dim]
-                chunk_keys = kv_cache_at_layer[chunk_kv_page_indices, 0]
-                chunk_values = kv_cache_at_layer[chunk_kv_page_indices, 1]
-
-                # Reshape to concatenate pages as one page:
-                # [chunk_size * page_size, num_kv_heads, head_dim]
-                paged_keys = chunk_keys.view(
-                    -1, chunk_keys.shape[-2], chunk_keys.shape[-1]
-                )
-                paged_values = chunk_values.view(
-                    -1, chunk_values.shape[-2], chunk_values.shape[-1]
-                )
-
-                paged_keys = torch.repeat_interleave(
-                    paged_keys, self.num_key_value_groups, dim=1
-                )
-                paged_values = torch.repeat_interleave(
-                    paged_values, self.num_key_value_groups, dim=1
-                )
-
-                chunk_size = len(page_cnts)
-                mask_start = page_cnts[0] * kv_page_size
-                mask_end = mask_start + chunk_size * kv_page_size
-                paged_mask = mask[:, mask_start:mask_end].unsqueeze(0)
-
-                sum_val, sum_exp, max_score = self._attend_one_page(
-                    query,
-                    paged_keys,
-                    paged_mask,
-                    paged_values,
-                    sum_exp,
-                    sum_val,
-                    max_score,
-                )
-
-            # Attend to the last page
-            page_cnt = kv_page_end - kv_page_start - 1
-            kv_page_idx_idx = kv_page_end - 1
-
-            kv_page_idx = kv_page_indices[kv_page_idx_idx]
-            paged_keys = kv_cache_at_layer[kv_page_idx, 0][:kv_last_page_len]
-            paged_values = kv_cache_at_layer[kv_page_idx, 1][:kv_last_page_len]
-
-            paged_keys = torch.repeat_interleave(
-                paged_keys, self.num_key_value_groups, dim=1
-            )
-            paged_values = torch.repeat_interleave(
-                paged_values, self.num_key_value_groups, dim=1
-            )
-
-            paged_mask_offset = page_cnt * kv_page_size
-            paged_mask = mask[:, paged_mask_offset : paged_mask_offset + kv_page_size][
-                ..., :kv_last_page_len
-            ]
-            paged_mask = paged_mask.unsqueeze(0)
-
-            sum_val, sum_exp, max_score = self._attend_one_page(
-                query, paged_keys, paged_mask, paged_values, sum_exp, sum_val, max_score
-            )
-
-            adjusted_sinks = self.sinks.unsqueeze(-1) - max_score
-            adjusted_sinks = torch.exp(adjusted_sinks)
-            sum_exp += adjusted_sinks
-
-            attn_output = sum_val / sum_exp.unsqueeze(-1)
-            attn_output = rearrange(attn_output, "h q d -> q (h d)")
-
-            attn_output = self.o_proj(attn_output.to(queries.dtype))
-
-            output_embeds[q_start:q_end, :] = attn_output
-
-        return output_embeds
-
     def forward(
         self,
+        runtime: L4maForwardContext,
         hidden_states: torch.Tensor,
-        position_ids: torch.IntTensor,
-        qo_indptr: torch.IntTensor,
-        kv_cache_at_layer: torch.Tensor,
-        kv_page_indices: torch.IntTensor,
-        kv_page_indptr: torch.IntTensor,
-        kv_last_page_lens: torch.IntTensor,
-        batch_indices: torch.IntTensor,
-        batch_positions: torch.IntTensor,
-        attention_mask: torch.Tensor,
+        position_ids: torch.Tensor,
+        kv_cache_at_layer: Sequence[torch.Tensor],
         adapter_subpass: AdapterSubpass | None,
     ) -> torch.Tensor:
         """Forward pass through the attention module."""
@@ -541,9 +281,7 @@ class GptOssAttention(nn.Module):
             adapter_subpass.execute(
                 self.layer_idx,
                 hidden_states,
-                q_state=query_states,
-                k_state=key_states,
-                v_state=value_states,
+                qkv_state=qkv_states,
             )
 
         # Reshape for multi-head attention
@@ -551,33 +289,34 @@ class GptOssAttention(nn.Module):
         key_states = key_states.view(n, self.num_key_value_heads, self.head_dim)
         value_states = value_states.view(n, self.num_key_value_heads, self.head_dim)
 
-        # Apply rotary embedding
-        query_states, key_states = self.rope(query_states, key_states, position_ids)
-
-        # Store current KV states in FlashInfer cache for future use
-        ops.append_paged_kv_cache(
-            append_key=key_states,
-            append_value=value_states,
-            batch_indices=batch_indices,
-            positions=batch_positions,
-            paged_kv_cache=kv_cache_at_layer[self.layer_idx],
-            kv_indices=kv_page_indices,
-            kv_indptr=kv_page_indptr,
-            kv_last_page_len=kv_last_page_lens,
-            kv_layout="NHD",
+        runtime.apply_rope(query_states, key_states, position_ids)
+
+        runtime.append_kv_cache(
+            layer_idx=self.layer_idx,
+            key_states=key_states,
+            value_states=value_states,
+            kv_cache_layer=kv_cache_at_layer[self.layer_idx],
         )
 
-        new_attn_output = self._paged_attention(
-            query_states,
-            qo_indptr,
-            kv_page_indptr,
-            kv_last_page_lens,
-            kv_page_indices,
-            attention_mask,
-            kv_cache_at_layer[self.layer_idx],
+        # The runtime applies the sliding window of the even layers.
+        attn_output = runtime.run_attention(
+            layer_idx=self.layer_idx,
+            query_states=query_states,
+            kv_cache_layer=kv_cache_at_layer[self.layer_idx],
+            sinks=self.sinks,
         )
 
-        return new_attn_output
+        return self.o_proj(attn_output)
+
+
+# On accelerators, batches up to this many tokens gather the weights of their
+# experts per token, which avoids the host sync of the grouped path. Larger
+# batches, and all batches on CPU (where the sync is free and the copy is not),
+# are grouped by expert so each expert's weights are read once.
+_GATHERED_MOE_MAX_TOKENS = 4
+
+# Number of weights that share one exponent in the MXFP4 format.
+_MXFP4_BLOCK_SIZE = 32
 
 
 class GptOssRouter(nn.Module):
@@ -634,17 +373,6 @@ class GptOssExperts(nn.Module):
         self.num_experts = config.num_experts
         self.swiglu_limit = config.swiglu_limit
 
-        self.gate_up_proj = nn.Parameter(
-            torch.empty(
-                (
-                    config.num_experts,
-                    config.intermediate_size * 2,
-                    config.hidden_size,
-                ),
-                device=torch.device(config.device),
-                dtype=config.dtype,
-            )
-        )
         self.gate_up_proj_bias = nn.Parameter(
             torch.empty(
                 (config.num_experts, config.intermediate_size * 2),
@@ -652,17 +380,6 @@ class GptOssExperts(nn.Module):
                 dtype=config.dtype,
             )
         )
-        self.down_proj = nn.Parameter(
-            torch.empty(
-                (
-                    config.num_experts,
-                    config.hidden_size,
-                    config.intermediate_size,
-                ),
-                device=torch.device(config.device),
-                dtype=config.dtype,
-            )
-        )
         self.down_proj_bias = nn.Parameter(
             torch.empty(
                 (config.num_experts, config.hidden_size),
@@ -671,16 +388,87 @@ class GptOssExperts(nn.Module):
             )
         )
 
-    def forward(self, t: torch.Tensor, expert_indices: torch.Tensor) -> torch.Tensor:
-        """Forward pass through the experts."""
+        # With an expert cache, the MXFP4 weights stay packed and only the
+        # experts selected by a batch are dequantized, into a few reusable slots.
+        self.packed = config.mxfp4_expert_cache_size > 0
+        if self.packed:
+            self._register_packed_weight(
+                "gate_up_proj", config.intermediate_size * 2, config.hidden_size
+            )
+            self._register_packed_weight(
+                "down_proj", config.hidden_size, config.intermediate_size
+            )
+            self.register_buffer(
+                "fp4_lut",
+                torch.tensor(
+                    FP4_VALUES, device=torch.device(config.device), dtype=config.dtype
+                ),
+                persistent=False,
+            )
+            self.gate_up_proj_cache = ExpertDequantCache(config.mxfp4_expert_cache_size)
+            self.down_proj_cache = ExpertDequantCache(config.mxfp4_expert_cache_size)
+        else:
+            self.gate_up_proj = nn.Parameter(
+                torch.empty(
+                    (
+                        config.num_experts,
+                        config.intermediate_size * 2,
+                        config.hidden_size,
+                    ),
+                    device=torch.device(config.device),
+                    dtype=config.dtype,
+                )
+            )
+            self.down_proj = nn.Parameter(
+                torch.empty(
+                    (
+                        config.num_experts,
+                        config.hidden_size,
+                        config.intermediate_size,
+                    ),
+                    device=torch.device(config.device),
+                    dtype=config.dtype,
+                )
+            )
 
-        # Gate and Up projection
-        gate_up_proj = self.gate_up_proj[expert_indices, ...]
-        gate_up_proj_bias = self.gate_up_proj_bias[expert_indices, ...]
+    def _register_packed_weight(self, name: str, rows: int, cols: int) -> None:
+        """Registers the MXFP4 blocks and scales of an `[experts, rows, cols]` weight."""
+        num_blocks = cols // _MXFP4_BLOCK_SIZE
+        self.register_buffer(
+            f"{name}_blocks",
+            torch.empty(
+                (self.num_experts, rows, num_blocks, _MXFP4_BLOCK_SIZE // 2),
+                device=torch.device(self.config.device),
+                dtype=torch.uint8,
+            ),
+        )
+        self.register_buffer(
+            f"{name}_scales",
+            torch.empty(
+                (self.num_experts, rows, num_blocks),
+                device=torch.device(self.config.device),
+                dtype=torch.uint8,
+            ),
+        )
 
-        t = torch.einsum("beck,bk->bec", gate_up_proj, t) + gate_up_proj_bias
+    def _expert_weights(self, expert_idx: int) -> tuple[torch.Tensor, torch.Tensor]:
+        """Returns the gate/up and down projection weights of one expert."""
+        if not self.packed:
+            return self.gate_up_proj[expert_idx], self.down_proj[expert_idx]
+        return (
+            self.gate_up_proj_cache.get(
+                expert_idx,
+                self.gate_up_proj_blocks,
+                self.gate_up_proj_scales,
+                self.fp4_lut,
+            ),
+            self.down_proj_cache.get(
+                expert_idx, self.down_proj_blocks, self.down_proj_scales, self.fp4_lut
+            ),
+        )
 
-        # Inline swiglu function
+    def _swiglu(self, t: torch.Tensor) -> torch.Tensor:
+        """Clamped SwiGLU over interleaved gate and linear projections."""
         x_glu, x_linear = t[..., ::2], t[..., 1::2]
 
         # Clamp the input values
@@ -689,7 +477,36 @@ class GptOssExperts(nn.Module):
         out_glu = x_glu * torch.sigmoid(1.702 * x_glu)
 
         # Add an extra bias of 1 to the linear layer
-        t = out_glu * (x_linear + 1)
+        return out_glu * (x_linear + 1)
+
+    def forward(
+        self,
+        t: torch.Tensor,
+        expert_indices: torch.Tensor,
+        expert_weights: torch.Tensor,
+    ) -> torch.Tensor:
+        """Forward pass through the experts, returning the weighted sum."""
+        if (
+            not self.packed
+            and t.device.type != "cpu"
+            and t.shape[0] <= _GATHERED_MOE_MAX_TOKENS
+        ):
+            return self._forward_gathered(t, expert_indices, expert_weights)
+        return self._forward_grouped(t, expert_indices, expert_weights)
+
+    def _forward_gathered(
+        self,
+        t: torch.Tensor,
+        expert_indices: torch.Tensor,
+        expert_weights: torch.Tensor,
+    ) -> torch.Tensor:
+        """Gathers the weights of every token's experts (small decode batches)."""
+        # Gate and Up projection
+        gate_up_proj = self.gate_up_proj[expert_indices, ...]
+        gate_up_proj_bias = self.gate_up_proj_bias[expert_indices, ...]
+
+        t = torch.einsum("beck,bk->bec", gate_up_proj, t) + gate_up_proj_bias
+        t = self._swiglu(t)
 
         # Down projection
         down_proj = self.down_proj[expert_indices, ...]
@@ -697,7 +514,49 @@ class GptOssExperts(nn.Module):
 
         t = torch.einsum("beck,bek->bec", down_proj, t) + down_proj_bias
 
-        return t
+        # Weighted sum of experts
+        return torch.einsum("bec,be->bc", t, expert_weights)
+
+    def _forward_grouped(
+        self,
+        t: torch.Tensor,
+        expert_indices: torch.Tensor,
+        expert_weights: torch.Tensor,
+    ) -> torch.Tensor:
+        """Runs one GEMM per active expert over the tokens routed to it."""
+        experts_per_token = expert_indices.shape[1]
+        flat_experts = expert_indices.reshape(-1)
+
+        # Sort the token-expert assignments so each expert's tokens are contiguous
+        order = torch.argsort(flat_experts, stable=True)
+        token_ids = order // experts_per_token
+        counts = torch.bincount(flat_experts, minlength=self.num_experts).tolist()
+
+        sorted_inputs = t[token_ids]
+        sorted_outputs = torch.empty_like(sorted_inputs)
+        start = 0
+        for expert_idx, count in enumerate(counts):
+            if count == 0:
+                continue
+            end = start + count
+            gate_up_proj, down_proj = self._expert_weights(expert_idx)
+            # pylint: disable=not-callable
+            h = torch.nn.functional.linear(
+                sorted_inputs[start:end],
+                gate_up_proj,
+                self.gate_up_proj_bias[expert_idx],
+            )
+            sorted_outputs[start:end] = torch.nn.functional.linear(
+                self._swiglu(h), down_proj, self.down_proj_bias[expert_idx]
+            )
+            start = end
+
+        weights = expert_weights.reshape(-1)[order].to(torch.float32)
+        output = torch.zeros(t.shape, dtype=torch.float32, device=t.device)
+        output.index_add_(
+            0, token_ids, sorted_outputs.to(torch.float32) * weights[:, None]
+        )
+        return output.to(t.dtype)
 
 
 class GptOssMlp(nn.Module):
@@ -718,13 +577,8 @@ class GptOssMlp(nn.Module):
         # Extract the weights for selected experts
         expert_weights = torch.gather(router_scores, 1, router_indices)
 
-        # Forward through experts
-        t = self.experts(x, router_indices)
-
-        # Weighted sum of experts
-        t = torch.einsum("bec,be->bc", t, expert_weights)
-
-        return t
+        # Forward through experts and take their weighted sum
+        return self.experts(x, router_indices, expert_weights)
 
 
 class GptOssDecoderLayer(nn.Module):
@@ -735,18 +589,7 @@ class GptOssDecoderLayer(nn.Module):
         super().__init__()
         self.layer_idx = layer_idx
         self.input_layernorm = GptOssRMSNorm(config.hidden_size, device=config.device)
-        self.rope = GptOssRotaryEmbedding(
-            config.head_size,
-            int(config.rope_theta),
-            torch.float32,
-            initial_context_length=config.initial_context_length,
-            scaling_factor=config.rope_scaling_factor,
-            ntk_alpha=config.rope_ntk_alpha,
-            ntk_beta=config.rope_ntk_beta,
-            device=torch.device(config.device),
-            max_position_id=131072,
-        )
-        self.self_attn = GptOssAttention(config, layer_idx, self.rope)
+        self.self_attn = GptOssAttention(config, layer_idx)
         self.mlp = GptOssMlp(config)
         self.post_attention_layernorm = GptOssRMSNorm(
             config.hidden_size, device=config.device
@@ -754,17 +597,10 @@ class GptOssDecoderLayer(nn.Module):
 
     def forward(
         self,
+        runtime: L4maForwardContext,
         hidden_states: torch.Tensor,
         position_ids: torch.Tensor,
-        qo_indptr: torch.Tensor,
-        kv_cache_at_layer: torch.Tensor,
-        kv_page_indices: torch.Tensor,
-        kv_page_indptr: torch.Tensor,
-        kv_last_page_lens: torch.Tensor,
-        batch_indices: torch.Tensor,
-        batch_positions: torch.Tensor,
-        full_mask: torch.Tensor,
-        window_mask: torch.Tensor,
+        kv_cache_at_layer: Sequence[torch.Tensor],
         adapter_subpass: AdapterSubpass | None,
     ) -> torch.Tensor:
         """Forward pass through the decoder layer."""
@@ -774,16 +610,10 @@ class GptOssDecoderLayer(nn.Module):
 
         # Self Attention
         hidden_states = self.self_attn(
+            runtime=runtime,
             hidden_states=hidden_states,
             position_ids=position_ids,
-            qo_indptr=qo_indptr,
             kv_cache_at_layer=kv_cache_at_layer,
-            kv_page_indices=kv_page_indices,
-            kv_page_indptr=kv_page_indptr,
-            kv_last_page_lens=kv_last_page_lens,
-            batch_indices=batch_indices,
-            batch_positions=batch_positions,
-            attention_mask=window_mask if self.layer_idx % 2 == 0 else full_mask,
             adapter_subpass=adapter_subpass,
         )
 
@@ -800,12 +630,31 @@ class GptOssDecoderLayer(nn.Module):
 
 
 class GptOssModel(nn.Module):
-    """GPT OSS model with FlashInfer support."""
+    """GPT OSS model running on an injected runtime backend."""
 
-    def __init__(self, config: GptOssArch):
+    def __init__(self, config: GptOssArch, backend: L4maBackend):
         """Initialize the GPT OSS model."""
         super().__init__()
         self.config = config
+        self.backend = backend
+
+        # All layers share one YaRN cos/sin cache.
+        self.rope = GptOssRotaryEmbedding(
+            config.head_size,
+            int(config.rope_theta),
+            torch.float32,
+            initial_context_length=config.initial_context_length,
+            scaling_factor=config.rope_scaling_factor,
+            ntk_alpha=config.rope_ntk_alpha,
+            ntk_beta=config.rope_ntk_beta,
+            device=torch.device(config.device),
+            max_position_id=131072,
+        )
+        self.attention_spec = AttentionSpec.from_arch(
+            config,
+            rope=CachedRope(cos_sin_cache=self.rope.cos_sin_cache, is_neox=True),
+            sliding_window=config.sliding_window,
+        )
 
         self.embed_tokens = nn.Embedding(
             config.vocab_size,
@@ -824,105 +673,59 @@ class GptOssModel(nn.Module):
             config.hidden_size,
             device=config.device,
         )
-        self.sliding_window = config.sliding_window
 
     def forward(
         self,
         input_embeds: torch.Tensor,
         position_ids: torch.Tensor,
         qo_indptr: torch.Tensor,
-        kv_cache_at_layer: torch.Tensor,
+        kv_cache_at_layer: Sequence[torch.Tensor],
         kv_page_indices: torch.Tensor,
         kv_page_indptr: torch.Tensor,
         kv_last_page_lens: torch.Tensor,
-        custom_mask: torch.Tensor,
+        custom_mask: torch.Tensor | None,
         single_token_inference_mode: bool,
         adapter_subpass: AdapterSubpass | None,
+        window_kv: WindowKvInputs | None = None,
+        plan_key: Hashable | None = None,
+        shared_prefix: SharedPrefixInputs | None = None,
     ) -> torch.Tensor:
-        """Forward pass through the GPT OSS model."""
-
-        # The current naive implementation does not distinguish between
-        # single-token inference mode and batch inference mode
-        _ = single_token_inference_mode
+        """Forward pass through the GPT OSS model.
 
+        If `window_kv` is given, the sliding-window layers read and write their
+        own KV pool through its remapped page table instead of `kv_page_indices`.
+        With `shared_prefix`, the full-attention layers run cascade attention.
+        """
         hidden_states = input_embeds
         n, _ = hidden_states.size()
 
-        page_size = kv_cache_at_layer[0].shape[2]
-
-        batch_indices, batch_positions = ops.get_batch_indices_positions(
-            append_indptr=qo_indptr,
-            seq_lens=ops.get_seq_lens(kv_page_indptr, kv_last_page_lens, page_size),
-            nnz=n,
-        )
-
-        batch_num = len(qo_indptr) - 1
-
-        full_mask = custom_mask
-        window_mask = custom_mask.clone()
-
-        # For window attention layers, set the mask to 0 for positions that are
-        # outside the sliding window.
-        mask_offset = 0
-        for batch_idx in range(batch_num):
-            q_start = qo_indptr[batch_idx]
-            q_end = qo_indptr[batch_idx + 1]
-
-            kv_page_start = kv_page_indptr[batch_idx]
-            kv_page_end = kv_page_indptr[batch_idx + 1]
-
-            query_len = int(q_end - q_start)
-            seq_len = int(
-                (kv_page_end - kv_page_start - 1) * page_size
-                + kv_last_page_lens[batch_idx]
-            )
-            mask_len = seq_len * query_len
-
-            mask = window_mask[mask_offset : mask_offset + mask_len]
-            mask_offset += mask_len
-
-            mask = mask.view(query_len, seq_len)
-
-            pos_id = position_ids[q_start:q_end]
-            for q_idx in range(query_len):
-                mask[
-                    q_idx, : max(0, int(pos_id[q_idx]) - (self.sliding_window - 1))
-                ] = 0
-
-        full_mask = torch.where(
-            full_mask,
-            torch.tensor(0.0, dtype=input_embeds.dtype, device=input_embeds.device),
-            torch.tensor(
-                float("-inf"), dtype=input_embeds.dtype, device=input_embeds.device
-            ),
-        )
-        window_mask = torch.where(
-            window_mask,
-            torch.tensor(0.0, dtype=input_embeds.dtype, device=input_embeds.device),
-            torch.tensor(
-                float("-inf"), dtype=input_embeds.dtype, device=input_embeds.device
+        runtime = self.backend.create_forward_context(
+            spec=self.attention_spec,
+            inputs=RuntimeInputs(
+                num_tokens=n,
+                kv_cache_at_layer=kv_cache_at_layer,
+                kv_page_indices=kv_page_indices,
+                kv_page_indptr=kv_page_indptr,
+                kv_last_page_lens=kv_last_page_lens,
+                qo_indptr=qo_indptr,
+                custom_mask=custom_mask,
+                single_token_inference_mode=single_token_inference_mode,
+                position_ids=position_ids,
+                window_kv=window_kv,
+                plan_key=plan_key,
+                shared_prefix=shared_prefix,
             ),
         )
 
         for decoder_layer in self.layers:
-
-            layer_outputs = decoder_layer(
+            hidden_states = decoder_layer(
+                runtime=runtime,
                 hidden_states=hidden_states,
                 position_ids=position_ids,
-                qo_indptr=qo_indptr,
                 kv_cache_at_layer=kv_cache_at_layer,
-                kv_page_indices=kv_page_indices,
-                kv_page_indptr=kv_page_indptr,
-                kv_last_page_lens=kv_last_page_lens,
-                batch_indices=batch_indices,
-                batch_positions=batch_positions,
-                full_mask=full_mask,
-                window_mask=window_mask,
                 adapter_subpass=adapter_subpass,
             )
 
-            hidden_states = layer_outputs
-
         hidden_states = self.norm(hidden_states)
 
         return hidden_states
@@ -931,11 +734,11 @@ class GptOssModel(nn.Module):
 class GptOssForCausalLM(nn.Module):
     """GPT OSS model for causal language modeling."""
 
-    def __init__(self, config: GptOssArch):
+    def __init__(self, config: GptOssArch, backend: L4maBackend):
         """Initialize the GPT OSS causal LM model."""
         super().__init__()
         self.config = config
-        self.model = GptOssModel(config)
+        self.model = GptOssModel(config, backend)
         self.lm_head = nn.Linear(
             config.hidden_size,
             config.vocab_size,
@@ -5,7 +5,7 @@ runtime backend for kernel-specific behaviour (e.g. FlashInfer or Metal).
 """
 
 from __future__ import annotations
-from typing import Sequence, Optional
+from typing import Hashable, Optional, Sequence
 
 import torch
 from torch import nn
@@ -13,8 +13,15 @@ from torch import nn
 # Safe import of adapter functionality
 from adapter_utils import AdapterSubpass
 from config.l4ma import L4maArch
-from model.l4ma_runtime import L4maBackend, L4maForwardContext, RuntimeInputs
+from model.l4ma_runtime import (
+    AttentionSpec,
+    L4maBackend,
+    L4maForwardContext,
+    Llama31Rope,
+    RuntimeInputs,
+)
 from profiler import start_profile
+from shared_prefix import SharedPrefixInputs
 
 VERSION = "0.1.0"
 
@@ -153,9 +160,7 @@ class L4maAttention(nn.Module):
             adapter_subpass.execute(
                 self.layer_idx,
                 hidden_states,
-                q_state=query_states,
-                k_state=key_states,
-                v_state=value_states,
+                qkv_state=qkv_states,
             )
 
         # Reshape for multi-head attention
@@ -268,6 +273,15 @@ class L4maModel(nn.Module):
         super().__init__()
         self.config = config
         self.backend = backend
+        self.attention_spec = AttentionSpec.from_arch(
+            config,
+            rope=Llama31Rope(
+                theta=config.rope_theta,
+                factor=config.rope_factor,
+                low_frequency_factor=config.rope_low_frequency_factor,
+                high_frequency_factor=config.rope_high_frequency_factor,
+            ),
+        )
         self.embed_tokens = nn.Embedding(
             config.vocab_size,
             config.hidden_size,
@@ -304,6 +318,10 @@ class L4maModel(nn.Module):
         single_token_inference_mode: bool,
         # subpasses
         adapter_subpass: Optional[AdapterSubpass],
+        # batch structure, for the backend's plan cache
+        plan_key: Optional[Hashable] = None,
+        # leading KV pages shared by requests, for cascade attention
+        shared_prefix: Optional[SharedPrefixInputs] = None,
     ) -> torch.Tensor:
         """Forward pass through all decoder layers using the injected backend."""
 
@@ -320,10 +338,13 @@ class L4maModel(nn.Module):
                 qo_indptr=qo_indptr,
                 custom_mask=custom_mask,
                 single_token_inference_mode=single_token_inference_mode,
+                position_ids=position_ids,
+                plan_key=plan_key,
+                shared_prefix=shared_prefix,
             )
 
             runtime = self.backend.create_forward_context(
-                config=self.config,
+                spec=self.attention_spec,
                 inputs=runtime_inputs,
             )
 
@@ -359,6 +380,10 @@ class L4maForCausalLM(nn.Module):
             dtype=config.dtype,
         )
 
+    def tie_weights(self):
+        """Makes the LM head use the token embedding matrix as its weight."""
+        self.lm_head.weight = self.model.embed_tokens.weight
+
     def forward(self):  # pragma: no cover - interface parity placeholder
         """The handler uses dedicated methods rather than Module.forward."""
         raise NotImplementedError("Should not be called")
@@ -1,4 +1,4 @@
-"""FlashInfer-backed runtime implementation for the L4MA architecture.
+"""FlashInfer-backed runtime implementation shared by all architectures.
 
 Supports both FlashInfer and pie-metal backends:
 - pie-metal: Metal-accelerated operations for macOS with Apple Silicon
@@ -7,124 +7,51 @@ Supports both FlashInfer and pie-metal backends:
 
 from __future__ import annotations
 
-from dataclasses import dataclass
 from typing import Optional
 
 import torch
 
-from config.l4ma import L4maArch
-from model.l4ma_runtime import L4maBackend, L4maForwardContext, RuntimeInputs
-from platform_detection import is_apple_silicon
-
-# Direct import of backend operations based on platform
-if is_apple_silicon():
-    try:
-        import pie_metal.ops as ops  # type: ignore[import-not-found]
-    except ImportError:
-        ops = None  # type: ignore[assignment]
-else:
-    try:
-        import flashinfer as ops  # type: ignore[import-not-found,no-redef]
-    except ImportError:
-        ops = None  # type: ignore[assignment]
+from backend_ops import native_ops as ops
+from model.l4ma_runtime import (
+    AttentionSpec,
+    L4maBackend,
+    L4maForwardContext,
+    PagedForwardContext,
+    PlanCache,
+    RuntimeInputs,
+    infer_page_size,
+)
 
 FlashInferWrapper = object  # type: ignore[misc]
 
-
-def _infer_page_size(kv_cache_at_layer) -> int:
-    if not kv_cache_at_layer:
-        raise ValueError("kv_cache_at_layer must contain at least one tensor")
-    first_layer = kv_cache_at_layer[0]
-    if first_layer.ndim < 3:
-        raise ValueError("Unexpected KV cache tensor shape; expected >= 3 dimensions")
-    return int(first_layer.shape[2])
-
-
-@dataclass(frozen=True)
-class FlashInferRuntimeMetadata:
-    """Metadata describing the prepared FlashInfer execution state."""
-
-    page_size: int
-    batch_indices: torch.Tensor
-    batch_positions: torch.Tensor
+# Query/KV head ratios the FlashInfer decode wrapper handles. Others, such as
+# the 5:1 ratio of Qwen 2 14B (40 query heads, 8 KV heads), make it fail, so
+# those models decode with the prefill wrapper.
+_DECODE_GROUP_SIZES = (1, 2, 4, 8)
 
 
-class _FlashInferForwardContext(L4maForwardContext):
+class _FlashInferForwardContext(PagedForwardContext):
     """FlashInfer-backed forward context implementation."""
 
     def __init__(
         self,
         *,
-        config: L4maArch,
+        spec: AttentionSpec,
         inputs: RuntimeInputs,
         wrapper: FlashInferWrapper,  # type: ignore[name-defined]
         kv_layout: str,
-        batch_indices: torch.Tensor,
-        batch_positions: torch.Tensor,
-        metadata: FlashInferRuntimeMetadata,
-    ) -> None:
-        self._config = config
-        self._inputs = inputs
-        self.wrapper = wrapper
-        self._kv_layout = kv_layout
-        self._batch_indices = batch_indices
-        self._batch_positions = batch_positions
-        self._metadata = metadata
-
-    @property
-    def batch_indices(self) -> torch.Tensor:
-        """Get the batch indices tensor."""
-        return self._batch_indices
-
-    @property
-    def batch_positions(self) -> torch.Tensor:
-        """Get the batch positions tensor."""
-        return self._batch_positions
-
-    @property
-    def metadata(self) -> FlashInferRuntimeMetadata:
-        """Get the runtime metadata."""
-        return self._metadata
-
-    def apply_rope(
-        self,
-        query_states: torch.Tensor,
-        key_states: torch.Tensor,
-        position_ids: torch.Tensor,
-    ) -> None:
-        """Apply RoPE encoding to query and key states."""
-        ops.apply_llama31_rope_pos_ids_inplace(  # type: ignore
-            q=query_states,
-            k=key_states,
-            pos_ids=position_ids,
-            rope_scale=self._config.rope_factor,
-            rope_theta=self._config.rope_theta,
-            low_freq_factor=self._config.rope_low_frequency_factor,
-            high_freq_factor=self._config.rope_high_frequency_factor,
-        )
-
-    def append_kv_cache(
-        self,
-        layer_idx: int,
-        key_states: torch.Tensor,
-        value_states: torch.Tensor,
-        kv_cache_layer: torch.Tensor,
+        page_size: int,
     ) -> None:
-        """Append key and value states to the KV cache."""
-        _ = layer_idx  # Parameter not currently used
-        ops.append_paged_kv_cache(  # type: ignore
-            append_key=key_states,
-            append_value=value_states,
-            batch_indices=self._batch_indices,
-            positions=self._batch_positions,
-            paged_kv_cache=kv_cache_layer,
-            kv_indices=self._inputs.kv_page_indices,
-            kv_indptr=self._inputs.kv_page_indptr,
-            kv_last_page_len=self._inputs.kv_last_page_lens,
-            kv_layout=self._kv_layout,
+        super().__init__(
+            ops=ops,  # type: ignore[arg-type]
+            spec=spec,
+            inputs=inputs,
+            page_size=page_size,
+            kv_layout=kv_layout,
         )
+        self.wrapper = wrapper
 
-    def run_attention(
+    def _run_full_attention(
         self,
         layer_idx: int,
         query_states: torch.Tensor,
@@ -132,12 +59,11 @@ class _FlashInferForwardContext(L4maForwardContext):
     ) -> torch.Tensor:
         """Run attention computation using FlashInfer."""
         _ = layer_idx  # Parameter not currently used
-        attn_output = self.wrapper.run(query_states, kv_cache_layer)  # type: ignore[attr-defined]
-        return attn_output.reshape(attn_output.size(0), -1)
+        return self.wrapper.run(query_states, kv_cache_layer)  # type: ignore[attr-defined]
 
 
 class FlashInferL4maBackend(L4maBackend):
-    """Default FlashInfer implementation of the L4MA runtime backend."""
+    """Default FlashInfer implementation of the runtime backend."""
 
     @staticmethod
     def is_available() -> bool:
@@ -155,6 +81,7 @@ class FlashInferL4maBackend(L4maBackend):
 
         self.workspace_size_bytes = workspace_size_bytes
         self.kv_layout = kv_layout
+        self.plan_cache = PlanCache()
 
         self._workspace_buffer: Optional[torch.Tensor] = None
         # Type ignore: FlashInfer types are optional dependencies not available in CI
@@ -188,41 +115,43 @@ class FlashInferL4maBackend(L4maBackend):
     def create_forward_context(
         self,
         *,
-        config: L4maArch,
+        spec: AttentionSpec,
         inputs: RuntimeInputs,
     ) -> L4maForwardContext:
         """Create a forward context for FlashInfer execution."""
-        self._ensure_workspace(config.device)
-
-        page_size = _infer_page_size(inputs.kv_cache_at_layer)
+        self._ensure_workspace(spec.device)
 
-        seq_lens = ops.get_seq_lens(  # type: ignore[union-attr]
-            inputs.kv_page_indptr,
-            inputs.kv_last_page_lens,
-            page_size,
-        )
+        page_size = infer_page_size(inputs.kv_cache_at_layer)
+        group_size = spec.num_query_heads // spec.num_key_value_heads
 
-        get_positions = ops.get_batch_indices_positions  # type: ignore
-        batch_indices, batch_positions = get_positions(
-            append_indptr=inputs.qo_indptr,
-            seq_lens=seq_lens,
-            nnz=inputs.num_tokens,
-        )
-
-        if inputs.single_token_inference_mode:
+        if inputs.single_token_inference_mode and group_size in _DECODE_GROUP_SIZES:
             wrapper = self._decode_wrapper
             assert wrapper is not None
-            wrapper.plan(
-                indptr=inputs.kv_page_indptr,
-                indices=inputs.kv_page_indices,
-                last_page_len=inputs.kv_last_page_lens,
-                num_qo_heads=config.num_query_heads,
-                num_kv_heads=config.num_key_value_heads,
-                head_dim=config.head_size,
-                page_size=page_size,
-                pos_encoding_mode="NONE",
-                q_data_type=config.dtype,
-            )
+            # The decode plan only depends on the page counts. The wrapper reads
+            # the page table and last-page lengths from the given buffers when
+            # it runs, so they may be updated in place between steps.
+            signature = None
+            if inputs.plan_key is not None:
+                signature = (
+                    inputs.plan_key,
+                    id(spec),
+                    inputs.kv_page_indptr.data_ptr(),
+                    inputs.kv_page_indices.data_ptr(),
+                    inputs.kv_last_page_lens.data_ptr(),
+                )
+            if self.plan_cache.lookup("decode", signature) is None:
+                wrapper.plan(
+                    indptr=inputs.kv_page_indptr,
+                    indices=inputs.kv_page_indices,
+                    last_page_len=inputs.kv_last_page_lens,
+                    num_qo_heads=spec.num_query_heads,
+                    num_kv_heads=spec.num_key_value_heads,
+                    head_dim=spec.head_size,
+                    page_size=page_size,
+                    pos_encoding_mode="NONE",
+                    q_data_type=spec.dtype,
+                )
+                self.plan_cache.store("decode", signature, True)
         else:
             wrapper = self._prefill_wrapper
             assert wrapper is not None
@@ -231,32 +160,23 @@ class FlashInferL4maBackend(L4maBackend):
                 paged_kv_indptr=inputs.kv_page_indptr,
                 paged_kv_indices=inputs.kv_page_indices,
                 paged_kv_last_page_len=inputs.kv_last_page_lens,
-                num_qo_heads=config.num_query_heads,
-                num_kv_heads=config.num_key_value_heads,
-                head_dim_qk=config.head_size,
+                num_qo_heads=spec.num_query_heads,
+                num_kv_heads=spec.num_key_value_heads,
+                head_dim_qk=spec.head_size,
                 page_size=page_size,
                 custom_mask=inputs.custom_mask,
-                q_data_type=config.dtype,
+                q_data_type=spec.dtype,
             )
 
-        metadata = FlashInferRuntimeMetadata(
-            page_size=page_size,
-            batch_indices=batch_indices,
-            batch_positions=batch_positions,
-        )
-
         return _FlashInferForwardContext(
-            config=config,
+            spec=spec,
             inputs=inputs,
             wrapper=wrapper,
             kv_layout=self.kv_layout,
-            batch_indices=batch_indices,
-            batch_positions=batch_positions,
-            metadata=metadata,
+            page_size=page_size,
         )
 
 
 __all__ = [
     "FlashInferL4maBackend",
-    "FlashInferRuntimeMetadata",
 ]
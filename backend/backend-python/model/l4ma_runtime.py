@@ -1,14 +1,92 @@
-"""Shared interfaces for L4MA runtime backends."""
+"""Shared interfaces for the runtime backends of all architectures.
+
+The runtime was first written for L4MA; the other architectures describe the
+few ways they differ from it with an `AttentionSpec` (RoPE variant, sliding
+window, attention sinks) and run on the same `L4maBackend` implementations.
+Architecture-specific math that precedes RoPE, such as QK normalization, stays
+in the models.
+"""
 
 from __future__ import annotations
 
 from abc import ABC, abstractmethod
-from dataclasses import dataclass
-from typing import Optional, Sequence
+from dataclasses import dataclass, field
+from types import ModuleType
+from typing import Any, Hashable, Optional, Sequence
 
 import torch
 
-from config.l4ma import L4maArch
+import torch_ops
+from config.common import CommonArch
+from kv_pool import WindowKvInputs
+from shared_prefix import SharedPrefixInputs
+
+
+@dataclass(frozen=True)
+class DefaultRope:
+    """Standard RoPE, as used by Qwen 2 and Qwen 3."""
+
+    theta: float
+
+
+@dataclass(frozen=True)
+class Llama31Rope:
+    """RoPE with the Llama 3.1 frequency scaling."""
+
+    theta: float
+    factor: float
+    low_frequency_factor: float
+    high_frequency_factor: float
+
+
+@dataclass(frozen=True, eq=False)
+class CachedRope:
+    """RoPE read from a precomputed `[max_position, head_size]` cos/sin cache.
+
+    This covers variants whose frequencies are not a closed form of the
+    position, such as the YaRN scaling of GPT OSS.
+    """
+
+    cos_sin_cache: torch.Tensor
+    is_neox: bool = True
+
+
+RopeSpec = DefaultRope | Llama31Rope | CachedRope
+
+
+@dataclass(frozen=True, eq=False)
+class AttentionSpec:
+    """What a backend needs to know about the attention of an architecture."""
+
+    num_query_heads: int
+    num_key_value_heads: int
+    head_size: int
+    dtype: torch.dtype
+    device: str
+    rope: RopeSpec
+    # Number of keys seen by the queries of the layers in `window_layers`
+    sliding_window: int = 0
+    window_layers: frozenset[int] = field(default_factory=frozenset)
+
+    @classmethod
+    def from_arch(
+        cls, config: CommonArch, rope: RopeSpec, sliding_window: int = 0
+    ) -> "AttentionSpec":
+        """Build the spec of `config`, whose windowed layers use `sliding_window`."""
+        return cls(
+            num_query_heads=config.num_query_heads,
+            num_key_value_heads=config.num_key_value_heads,
+            head_size=config.head_size,
+            dtype=config.dtype,
+            device=config.device,
+            rope=rope,
+            sliding_window=sliding_window,
+            window_layers=(
+                frozenset(config.sliding_window_layers())
+                if sliding_window > 0
+                else frozenset()
+            ),
+        )
 
 
 @dataclass(frozen=True)
@@ -23,6 +101,17 @@ class RuntimeInputs:
     qo_indptr: torch.Tensor
     custom_mask: Optional[torch.Tensor]
     single_token_inference_mode: bool
+    # Positions of the tokens, which the sliding window is measured in
+    position_ids: Optional[torch.Tensor] = None
+    # Page table of the separate KV pool of the sliding-window layers, if any
+    window_kv: Optional[WindowKvInputs] = None
+    # Host-side description of the batch structure. Passes with equal keys
+    # have identical `qo_indptr`, `kv_page_indptr`, `kv_page_indices` and
+    # decode mode.
+    plan_key: Optional[Hashable] = None
+    # Leading KV pages shared by groups of requests, for cascade attention.
+    # Only given to backends with `supports_shared_prefix`.
+    shared_prefix: Optional[SharedPrefixInputs] = None
 
 
 class L4maForwardContext(ABC):
@@ -63,21 +152,306 @@ class L4maForwardContext(ABC):
         layer_idx: int,
         query_states: torch.Tensor,
         kv_cache_layer: torch.Tensor,
+        sinks: Optional[torch.Tensor] = None,
     ) -> torch.Tensor:
-        """Execute the attention kernel for the given layer."""
+        """Execute the attention kernel for the given layer.
+
+        `sinks` holds one learned logit per query head that joins the softmax
+        as an extra key with a zero value.
+        """
 
 
 class L4maBackend(ABC):
     """Factory interface that produces backend-specific forward contexts."""
 
+    # Whether the contexts run cascade attention over `RuntimeInputs.shared_prefix`
+    supports_shared_prefix: bool = False
+
     @abstractmethod
     def create_forward_context(
         self,
         *,
-        config: L4maArch,
+        spec: AttentionSpec,
         inputs: RuntimeInputs,
     ) -> L4maForwardContext:
         """Create a context object to drive a single forward pass."""
 
 
-__all__ = ["L4maBackend", "L4maForwardContext", "RuntimeInputs"]
+class PlanCache:
+    """Remembers what each kernel of a backend was last planned for.
+
+    A kernel whose plan only depends on the batch structure can skip planning
+    when the next pass has the same signature, e.g. for the decode steps of a
+    stable batch, which only advance the last-page lengths.
+    """
+
+    def __init__(self) -> None:
+        self.hits = 0
+        self.misses = 0
+        self._entries: dict[str, tuple[Hashable, Any]] = {}
+
+    def lookup(self, kernel: str, signature: Optional[Hashable]) -> Any:
+        """Returns what was stored for `kernel` under `signature`, or None."""
+        entry = self._entries.get(kernel)
+        if signature is not None and entry is not None and entry[0] == signature:
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        return None
+
+    def store(self, kernel: str, signature: Optional[Hashable], value: Any) -> None:
+        """Records that `kernel` was planned for `signature`."""
+        if signature is None:
+            self._entries.pop(kernel, None)
+        else:
+            self._entries[kernel] = (signature, value)
+
+    def stats(self) -> dict[str, int]:
+        """Returns the hit and miss counters."""
+        return {"hits": self.hits, "misses": self.misses}
+
+
+def infer_page_size(kv_cache_at_layer: Sequence[torch.Tensor]) -> int:
+    """Return the page size of a `[pages, 2, page_size, ...]` KV cache."""
+    if not kv_cache_at_layer:
+        raise ValueError("kv_cache_at_layer must contain at least one tensor")
+    first_layer = kv_cache_at_layer[0]
+    if first_layer.ndim < 3:
+        raise ValueError("Unexpected KV cache tensor shape; expected >= 3 dimensions")
+    return int(first_layer.shape[2])
+
+
+class PagedForwardContext(L4maForwardContext):
+    """Forward context logic shared by the backends over a paged KV cache.
+
+    Subclasses only provide the kernel of the plain (full, sink-free) layers.
+    RoPE goes through the backend's `ops` module, while the layers with a
+    sliding window or sinks run the portable online-softmax kernel of
+    `torch_ops`, which works on any device. Sliding-window layers that keep
+    their KV in a separate pool use its page table for appends and reads.
+    When the inputs describe shared prefixes, all other layers run the cascade
+    kernel of `torch_ops`.
+    """
+
+    def __init__(
+        self,
+        *,
+        ops: ModuleType,
+        spec: AttentionSpec,
+        inputs: RuntimeInputs,
+        page_size: int,
+        kv_layout: str = "NHD",
+    ) -> None:
+        self._ops = ops
+        self._spec = spec
+        self._inputs = inputs
+        self._page_size = page_size
+        self._kv_layout = kv_layout
+
+        seq_lens = ops.get_seq_lens(
+            inputs.kv_page_indptr, inputs.kv_last_page_lens, page_size
+        )
+        self._batch_indices, self._batch_positions = ops.get_batch_indices_positions(
+            append_indptr=inputs.qo_indptr,
+            seq_lens=seq_lens,
+            nnz=inputs.num_tokens,
+        )
+
+        # KV indices in the window pool are shifted by the positions cut off.
+        self._window_batch_positions = self._batch_positions
+        if inputs.window_kv is not None and spec.window_layers:
+            self._window_batch_positions = (
+                self._batch_positions - inputs.window_kv.kv_offsets[self._batch_indices]
+            )
+
+        self._online_plans: dict[bool, torch_ops.OnlineAttentionPlan] = {}
+        self._cascade_plan: torch_ops.CascadeAttentionPlan | None = None
+
+    @property
+    def batch_indices(self) -> torch.Tensor:
+        """Get the batch indices tensor."""
+        return self._batch_indices
+
+    @property
+    def batch_positions(self) -> torch.Tensor:
+        """Get the batch positions tensor."""
+        return self._batch_positions
+
+    def apply_rope(
+        self,
+        query_states: torch.Tensor,
+        key_states: torch.Tensor,
+        position_ids: torch.Tensor,
+    ) -> None:
+        """Apply the architecture's RoPE variant to query and key states."""
+        rope = self._spec.rope
+        if isinstance(rope, Llama31Rope):
+            self._ops.apply_llama31_rope_pos_ids_inplace(
+                q=query_states,
+                k=key_states,
+                pos_ids=position_ids,
+                rope_scale=rope.factor,
+                rope_theta=rope.theta,
+                low_freq_factor=rope.low_frequency_factor,
+                high_freq_factor=rope.high_frequency_factor,
+            )
+        elif isinstance(rope, DefaultRope):
+            self._ops.apply_rope_pos_ids_inplace(
+                q=query_states,
+                k=key_states,
+                pos_ids=position_ids,
+                rope_theta=rope.theta,
+            )
+        else:
+            self._ops.apply_rope_with_cos_sin_cache_inplace(
+                positions=position_ids.to(torch.int32),
+                query=query_states,
+                key=key_states,
+                head_size=self._spec.head_size,
+                cos_sin_cache=rope.cos_sin_cache,
+                is_neox=rope.is_neox,
+            )
+
+    def _uses_window_pool(self, layer_idx: int) -> bool:
+        return (
+            self._inputs.window_kv is not None and layer_idx in self._spec.window_layers
+        )
+
+    def append_kv_cache(
+        self,
+        layer_idx: int,
+        key_states: torch.Tensor,
+        value_states: torch.Tensor,
+        kv_cache_layer: torch.Tensor,
+    ) -> None:
+        """Append key and value states to the KV cache."""
+        kv_indices = self._inputs.kv_page_indices
+        kv_indptr = self._inputs.kv_page_indptr
+        positions = self._batch_positions
+        if self._uses_window_pool(layer_idx):
+            assert self._inputs.window_kv is not None
+            kv_indices = self._inputs.window_kv.kv_page_indices
+            kv_indptr = self._inputs.window_kv.kv_page_indptr
+            positions = self._window_batch_positions
+
+        self._ops.append_paged_kv_cache(
+            append_key=key_states,
+            append_value=value_states,
+            batch_indices=self._batch_indices,
+            positions=positions,
+            paged_kv_cache=kv_cache_layer,
+            kv_indices=kv_indices,
+            kv_indptr=kv_indptr,
+            kv_last_page_len=self._inputs.kv_last_page_lens,
+            kv_layout=self._kv_layout,
+        )
+
+    def run_attention(
+        self,
+        layer_idx: int,
+        query_states: torch.Tensor,
+        kv_cache_layer: torch.Tensor,
+        sinks: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
+        """Run attention, with the online-softmax kernel for sinks and windows."""
+        windowed = layer_idx in self._spec.window_layers
+        if self._inputs.shared_prefix is not None and not windowed:
+            attn_output = torch_ops.run_cascade_attention(
+                self.cascade_plan, query_states, kv_cache_layer, sinks
+            )
+        elif sinks is None and not windowed:
+            attn_output = self._run_full_attention(
+                layer_idx, query_states, kv_cache_layer
+            )
+        else:
+            attn_output = torch_ops.run_online_attention(
+                self._online_plan(windowed), query_states, kv_cache_layer, sinks
+            )
+        return attn_output.reshape(attn_output.size(0), -1)
+
+    @property
+    def cascade_plan(self) -> torch_ops.CascadeAttentionPlan:
+        """Plan of the cascade kernel, built on first use."""
+        if self._cascade_plan is None:
+            inputs = self._inputs
+            shared_prefix = inputs.shared_prefix
+            assert shared_prefix is not None
+            self._cascade_plan = torch_ops.plan_cascade_attention(
+                qo_indptr=inputs.qo_indptr,
+                kv_indptr=inputs.kv_page_indptr,
+                kv_indices=inputs.kv_page_indices,
+                kv_last_page_len=inputs.kv_last_page_lens,
+                prefix_qo_indptr=shared_prefix.qo_indptr,
+                prefix_token_indices=shared_prefix.token_indices,
+                prefix_kv_indptr=shared_prefix.kv_page_indptr,
+                prefix_kv_indices=shared_prefix.kv_page_indices,
+                prefix_pages=shared_prefix.prefix_pages,
+                num_qo_heads=self._spec.num_query_heads,
+                num_kv_heads=self._spec.num_key_value_heads,
+                head_dim=self._spec.head_size,
+                page_size=self._page_size,
+                custom_mask=inputs.custom_mask,
+                nnz=inputs.num_tokens,
+            )
+        return self._cascade_plan
+
+    def _online_plan(self, windowed: bool) -> torch_ops.OnlineAttentionPlan:
+        """Plan the online-softmax kernel once per pass and kind of layer."""
+        plan = self._online_plans.get(windowed)
+        if plan is not None:
+            return plan
+
+        inputs = self._inputs
+        kv_indices = inputs.kv_page_indices
+        kv_indptr = inputs.kv_page_indptr
+        custom_mask = inputs.custom_mask
+        query_positions = inputs.position_ids
+        if windowed and inputs.window_kv is not None:
+            kv_indices = inputs.window_kv.kv_page_indices
+            kv_indptr = inputs.window_kv.kv_page_indptr
+            custom_mask = inputs.window_kv.custom_mask
+            if query_positions is not None:
+                query_positions = (
+                    query_positions - inputs.window_kv.kv_offsets[self._batch_indices]
+                )
+
+        plan = torch_ops.plan_online_attention(
+            qo_indptr=inputs.qo_indptr,
+            kv_indptr=kv_indptr,
+            kv_indices=kv_indices,
+            kv_last_page_len=inputs.kv_last_page_lens,
+            num_qo_heads=self._spec.num_query_heads,
+            num_kv_heads=self._spec.num_key_value_heads,
+            head_dim=self._spec.head_size,
+            page_size=self._page_size,
+            custom_mask=custom_mask,
+            window=self._spec.sliding_window if windowed else 0,
+            query_positions=query_positions,
+            nnz=inputs.num_tokens,
+        )
+        self._online_plans[windowed] = plan
+        return plan
+
+    @abstractmethod
+    def _run_full_attention(
+        self,
+        layer_idx: int,
+        query_states: torch.Tensor,
+        kv_cache_layer: torch.Tensor,
+    ) -> torch.Tensor:
+        """Attend a layer without sinks or window; returns `[n, heads, head]`."""
+
+
+__all__ = [
+    "AttentionSpec",
+    "CachedRope",
+    "DefaultRope",
+    "L4maBackend",
+    "L4maForwardContext",
+    "Llama31Rope",
+    "PagedForwardContext",
+    "PlanCache",
+    "RopeSpec",
+    "RuntimeInputs",
+    "infer_page_size",
+]
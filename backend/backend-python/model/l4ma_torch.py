@@ -0,0 +1,126 @@
+"""Pure PyTorch runtime implementation shared by all architectures.
+
+This backend only depends on PyTorch, so it runs on any device PyTorch supports
+(including CPU-only hosts). It drives the portable kernels of `torch_ops`:
+
+- The paged KV cache of all requests is gathered with a single indexing op.
+- Grouped-query attention is handled by folding the query heads of each KV
+  head into the query length, so the KV heads are broadcast instead of copied.
+- The flattened custom mask is scattered into a padded boolean mask once per
+  forward pass and shared by all layers. Decode steps of a stable batch
+  without a custom mask reuse the plan of the previous step, of which only
+  the key lengths are updated.
+- Batches whose requests share leading KV pages run cascade attention, which
+  reads those pages once per group of requests.
+"""
+
+from __future__ import annotations
+
+import torch
+
+import torch_ops
+from model.l4ma_runtime import (
+    AttentionSpec,
+    L4maBackend,
+    L4maForwardContext,
+    PagedForwardContext,
+    PlanCache,
+    RuntimeInputs,
+    infer_page_size,
+)
+
+
+class _TorchForwardContext(PagedForwardContext):
+    """PyTorch forward context implementation."""
+
+    def __init__(
+        self,
+        *,
+        spec: AttentionSpec,
+        inputs: RuntimeInputs,
+        page_size: int,
+        plan_cache: PlanCache,
+    ) -> None:
+        super().__init__(ops=torch_ops, spec=spec, inputs=inputs, page_size=page_size)
+        self._plan: torch_ops.PagedAttentionPlan | None = None
+        self._plan_cache = plan_cache
+
+    @property
+    def plan(self) -> torch_ops.PagedAttentionPlan:
+        """Padded batch layout of the full-attention layers, built on first use."""
+        if self._plan is None:
+            inputs = self._inputs
+            # Batches with the same structure share the padded shape, so only
+            # the first of them waits for the device to compute it.
+            reusable = inputs.single_token_inference_mode and inputs.custom_mask is None
+            signature = None
+            if inputs.plan_key is not None:
+                signature = (inputs.plan_key, reusable)
+            cached = self._plan_cache.lookup("paged", signature)
+            if cached is not None and reusable:
+                self._plan = torch_ops.advance_decode_plan(
+                    cached,
+                    inputs.kv_page_indptr,
+                    inputs.kv_last_page_lens,
+                    self._page_size,
+                )
+                return self._plan
+            self._plan = torch_ops.plan_paged_attention(
+                qo_indptr=inputs.qo_indptr,
+                kv_indptr=inputs.kv_page_indptr,
+                kv_indices=inputs.kv_page_indices,
+                kv_last_page_len=inputs.kv_last_page_lens,
+                num_qo_heads=self._spec.num_query_heads,
+                num_kv_heads=self._spec.num_key_value_heads,
+                head_dim=self._spec.head_size,
+                page_size=self._page_size,
+                custom_mask=inputs.custom_mask,
+                causal=True,
+                padded_shape=cached.padded_shape if cached is not None else None,
+            )
+            if cached is None:
+                self._plan_cache.store("paged", signature, self._plan)
+        return self._plan
+
+    def _run_full_attention(
+        self,
+        layer_idx: int,
+        query_states: torch.Tensor,
+        kv_cache_layer: torch.Tensor,
+    ) -> torch.Tensor:
+        """Run attention for all requests with a single SDPA call."""
+        _ = layer_idx  # Parameter not currently used
+        return torch_ops.run_paged_attention(self.plan, query_states, kv_cache_layer)
+
+
+class TorchL4maBackend(L4maBackend):
+    """Device-agnostic runtime backend built on PyTorch SDPA."""
+
+    supports_shared_prefix = True
+
+    def __init__(self) -> None:
+        self.plan_cache = PlanCache()
+
+    @staticmethod
+    def is_available() -> bool:
+        """The PyTorch backend has no optional dependencies."""
+        return True
+
+    def create_forward_context(
+        self,
+        *,
+        spec: AttentionSpec,
+        inputs: RuntimeInputs,
+    ) -> L4maForwardContext:
+        """Create a forward context for PyTorch execution."""
+        return _TorchForwardContext(
+            spec=spec,
+            inputs=inputs,
+            page_size=infer_page_size(inputs.kv_cache_at_layer),
+            plan_cache=self.plan_cache,
+        )
+
+
+__all__ = [
+    "TorchL4maBackend",
+]
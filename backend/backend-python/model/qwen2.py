@@ -1,14 +1,21 @@
 """Qwen 2 Large Language Model Architecture (Qwen2)"""
 
 from __future__ import annotations
-from typing import Optional
+from typing import Hashable, Optional, Sequence
 
 import torch
 from torch import nn
 
 from adapter_utils import AdapterSubpass
 from config.qwen2 import Qwen2Arch
-import flashinfer as ops
+from model.l4ma_runtime import (
+    AttentionSpec,
+    DefaultRope,
+    L4maBackend,
+    L4maForwardContext,
+    RuntimeInputs,
+)
+from shared_prefix import SharedPrefixInputs
 
 VERSION = "0.1.0"
 
@@ -94,7 +101,7 @@ class Qwen2Mlp(nn.Module):
 
 
 class Qwen2Attention(nn.Module):
-    """Qwen2 attention module with FlashInfer support and Grouped Query Attention."""
+    """Qwen2 attention module with Grouped Query Attention."""
 
     def __init__(self, config: Qwen2Arch, layer_idx: int):
         """Initialize the Qwen2 attention module."""
@@ -125,15 +132,10 @@ class Qwen2Attention(nn.Module):
 
     def forward(
         self,
-        wrapper,
+        runtime: L4maForwardContext,
         hidden_states: torch.Tensor,
         position_ids: torch.Tensor,
-        kv_cache_at_layer: torch.Tensor,
-        kv_page_indices: torch.Tensor,
-        kv_page_indptr: torch.Tensor,
-        kv_last_page_lens: torch.Tensor,
-        batch_indices: torch.Tensor,
-        batch_positions: torch.Tensor,
+        kv_cache_at_layer: Sequence[torch.Tensor],
         adapter_subpass: Optional[AdapterSubpass],
     ) -> torch.Tensor:
         """Forward pass through the attention module."""
@@ -150,9 +152,7 @@ class Qwen2Attention(nn.Module):
             adapter_subpass.execute(
                 self.layer_idx,
                 hidden_states,
-                q_state=query_states,
-                k_state=key_states,
-                v_state=value_states,
+                qkv_state=qkv_states,
             )
 
         query_states = query_states.view(
@@ -165,27 +165,20 @@ class Qwen2Attention(nn.Module):
             n, self.config.num_key_value_heads, self.config.head_size
         )
 
-        ops.apply_rope_pos_ids_inplace(
-            q=query_states,
-            k=key_states,
-            pos_ids=position_ids,
-            rope_theta=self.config.rope_theta,
-        )
+        runtime.apply_rope(query_states, key_states, position_ids)
 
-        ops.append_paged_kv_cache(
-            append_key=key_states,
-            append_value=value_states,
-            batch_indices=batch_indices,
-            positions=batch_positions,
-            paged_kv_cache=kv_cache_at_layer[self.layer_idx],
-            kv_indices=kv_page_indices,
-            kv_indptr=kv_page_indptr,
-            kv_last_page_len=kv_last_page_lens,
-            kv_layout="NHD",
+        runtime.append_kv_cache(
+            layer_idx=self.layer_idx,
+            key_states=key_states,
+            value_states=value_states,
+            kv_cache_layer=kv_cache_at_layer[self.layer_idx],
         )
 
-        attn_output = wrapper.run(query_states, kv_cache_at_layer[self.layer_idx])
-        attn_output = attn_output.reshape(n, -1)
+        attn_output = runtime.run_attention(
+            layer_idx=self.layer_idx,
+            query_states=query_states,
+            kv_cache_layer=kv_cache_at_layer[self.layer_idx],
+        )
 
         attn_output = self.o_proj(attn_output)
 
@@ -219,15 +212,10 @@ class Qwen2DecoderLayer(nn.Module):
 
     def forward(
         self,
-        wrapper,
+        runtime: L4maForwardContext,
         hidden_states: torch.Tensor,
         position_ids: torch.Tensor,
-        kv_cache_at_layer: torch.Tensor,
-        kv_page_indices: torch.Tensor,
-        kv_page_indptr: torch.Tensor,
-        kv_last_page_lens: torch.Tensor,
-        batch_indices: torch.Tensor,
-        batch_positions: torch.Tensor,
+        kv_cache_at_layer: Sequence[torch.Tensor],
         adapter_subpass: Optional[AdapterSubpass],
     ) -> torch.Tensor:
         """Forward pass through the decoder layer."""
@@ -237,15 +225,10 @@ class Qwen2DecoderLayer(nn.Module):
 
         # Self Attention
         hidden_states = self.self_attn(
-            wrapper=wrapper,
+            runtime=runtime,
             hidden_states=hidden_states,
             position_ids=position_ids,
             kv_cache_at_layer=kv_cache_at_layer,
-            kv_page_indices=kv_page_indices,
-            kv_page_indptr=kv_page_indptr,
-            kv_last_page_lens=kv_last_page_lens,
-            batch_indices=batch_indices,
-            batch_positions=batch_positions,
             adapter_subpass=adapter_subpass,
         )
 
@@ -263,12 +246,16 @@ class Qwen2DecoderLayer(nn.Module):
 
 
 class Qwen2Model(nn.Module):
-    """Qwen2 model with FlashInfer support."""
+    """Qwen2 model running on an injected runtime backend."""
 
-    def __init__(self, config: Qwen2Arch):
+    def __init__(self, config: Qwen2Arch, backend: L4maBackend):
         """Initialize the Qwen2 model."""
         super().__init__()
         self.config = config
+        self.backend = backend
+        self.attention_spec = AttentionSpec.from_arch(
+            config, rope=DefaultRope(theta=config.rope_theta)
+        )
 
         self.embed_tokens = nn.Embedding(
             config.vocab_size,
@@ -290,76 +277,49 @@ class Qwen2Model(nn.Module):
             dtype=config.dtype,
         )
 
-        self.workspace_buffer = torch.empty(
-            128 * 1024 * 1024, dtype=torch.uint8, device=config.device
-        )
-        self.wrapper_decode = ops.BatchDecodeWithPagedKVCacheWrapper(
-            self.workspace_buffer, "NHD"
-        )
-        self.wrapper_append = ops.BatchPrefillWithPagedKVCacheWrapper(
-            self.workspace_buffer, "NHD"
-        )
-
     def forward(
         self,
         input_embeds: torch.Tensor,
         position_ids: torch.Tensor,
         qo_indptr: torch.Tensor,
-        kv_cache_at_layer: torch.Tensor,
+        kv_cache_at_layer: Sequence[torch.Tensor],
         kv_page_indices: torch.Tensor,
         kv_page_indptr: torch.Tensor,
         kv_last_page_lens: torch.Tensor,
-        custom_mask: torch.Tensor,
+        custom_mask: Optional[torch.Tensor],
         single_token_inference_mode: bool,
         adapter_subpass: Optional[AdapterSubpass],
+        plan_key: Optional[Hashable] = None,
+        # leading KV pages shared by requests, for cascade attention
+        shared_prefix: Optional[SharedPrefixInputs] = None,
     ) -> torch.Tensor:
         """Forward pass through the Qwen2 model."""
         hidden_states = input_embeds
         n, _ = hidden_states.size()
 
-        page_size = kv_cache_at_layer[0].shape[2]
-
-        batch_indices, batch_positions = ops.get_batch_indices_positions(
-            append_indptr=qo_indptr,
-            seq_lens=ops.get_seq_lens(kv_page_indptr, kv_last_page_lens, page_size),
-            nnz=n,
-        )
-
-        # Theoretically, we should check if it's single-token inference mode and use
-        # `self.wrapper_decode` instead of `self.wrapper_append`.
-        # However, the current FlashInfer implementation of the decode wrapper does not support
-        # does not support arbitrary ratio between the number of query and key-value heads.
-        # For example, it returns errors when running the Qwen 2 14B model, where there are
-        # 40 query heads and 8 key-value heads (5:1 ratio).
-        #
-        # For now, we just always use the append wrapper.
-        _ = single_token_inference_mode
-
-        self.wrapper_append.plan(
-            qo_indptr=qo_indptr,
-            paged_kv_indptr=kv_page_indptr,
-            paged_kv_indices=kv_page_indices,
-            paged_kv_last_page_len=kv_last_page_lens,
-            num_qo_heads=self.config.num_query_heads,
-            num_kv_heads=self.config.num_key_value_heads,
-            head_dim_qk=self.config.head_size,
-            page_size=page_size,
-            custom_mask=custom_mask,
-            q_data_type=self.config.dtype,
+        runtime = self.backend.create_forward_context(
+            spec=self.attention_spec,
+            inputs=RuntimeInputs(
+                num_tokens=n,
+                kv_cache_at_layer=kv_cache_at_layer,
+                kv_page_indices=kv_page_indices,
+                kv_page_indptr=kv_page_indptr,
+                kv_last_page_lens=kv_last_page_lens,
+                qo_indptr=qo_indptr,
+                custom_mask=custom_mask,
+                single_token_inference_mode=single_token_inference_mode,
+                position_ids=position_ids,
+                plan_key=plan_key,
+                shared_prefix=shared_prefix,
+            ),
         )
-        wrapper = self.wrapper_append
 
         for decoder_layer in self.layers:
             layer_outputs = decoder_layer(
-                wrapper=wrapper,
+                runtime=runtime,
                 hidden_states=hidden_states,
                 position_ids=position_ids,
                 kv_cache_at_layer=kv_cache_at_layer,
-                kv_page_indices=kv_page_indices,
-                kv_page_indptr=kv_page_indptr,
-                kv_last_page_lens=kv_last_page_lens,
-                batch_indices=batch_indices,
-                batch_positions=batch_positions,
                 adapter_subpass=adapter_subpass,
             )
 
@@ -373,11 +333,11 @@ class Qwen2Model(nn.Module):
 class Qwen2ForCausalLM(nn.Module):
     """Qwen2 model for causal language modeling."""
 
-    def __init__(self, config: Qwen2Arch):
+    def __init__(self, config: Qwen2Arch, backend: L4maBackend):
         """Initialize the Qwen2 causal LM model."""
         super().__init__()
         self.config = config
-        self.model = Qwen2Model(config)
+        self.model = Qwen2Model(config, backend)
         self.lm_head = nn.Linear(
             config.hidden_size,
             config.vocab_size,
@@ -386,6 +346,10 @@ class Qwen2ForCausalLM(nn.Module):
             dtype=config.dtype,
         )
 
+    def tie_weights(self):
+        """Makes the LM head use the token embedding matrix as its weight."""
+        self.lm_head.weight = self.model.embed_tokens.weight
+
     def forward(self):
         """
         Should not be called. Method 'forward' is abstract in class
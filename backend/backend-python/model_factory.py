@@ -13,20 +13,55 @@ from config.common import ModelInfo
 from platform_detection import is_apple_silicon
 
 
+class ModelOptions(NamedTuple):
+    """Backend options that change how a model is built, but not its weights."""
+
+    # Attention implementation, one of `ATTENTION_BACKENDS`
+    attention_backend: str = "auto"
+    # Number of dequantized MXFP4 experts to cache per layer (0 dequantizes
+    # every expert at load time)
+    mxfp4_expert_cache_size: int = 0
+
+
 class ArchitectureSpec(NamedTuple):
     """Specification for creating a model architecture."""
 
-    create_model: Callable[[ModelInfo], tuple]
+    create_model: Callable[[ModelInfo, ModelOptions], tuple]
     description: str
 
 
-def _create_l4ma_model(model_info: ModelInfo):
+# Attention backends that can be selected with the `attention_backend` option.
+# "auto" picks FlashInfer (or pie-metal) when installed and PyTorch otherwise.
+ATTENTION_BACKENDS = ("auto", "flashinfer", "torch")
+
+
+def _create_backend(attention_backend: str):
+    """Create the runtime backend, shared by all architectures, selected by
+    `attention_backend`."""
+    from model.l4ma_flashinfer import FlashInferL4maBackend
+    from model.l4ma_torch import TorchL4maBackend
+
+    if attention_backend == "auto":
+        attention_backend = (
+            "flashinfer" if FlashInferL4maBackend.is_available() else "torch"
+        )
+
+    if attention_backend == "flashinfer":
+        return FlashInferL4maBackend()
+    if attention_backend == "torch":
+        return TorchL4maBackend()
+    raise RuntimeError(
+        f"Unknown attention backend '{attention_backend}'. "
+        f"Supported backends: {list(ATTENTION_BACKENDS)}"
+    )
+
+
+def _create_l4ma_model(model_info: ModelInfo, options: ModelOptions):
     """Create L4MA model and fusion map."""
     from config.l4ma import L4maArch
     from model.l4ma import L4maForCausalLM, create_fusion_map
-    from model.l4ma_flashinfer import FlashInferL4maBackend
 
-    backend = FlashInferL4maBackend()
+    backend = _create_backend(options.attention_backend)
     arch = L4maArch(**model_info.architecture.__dict__)
     model = L4maForCausalLM(arch, backend=backend)
     fusion_map = create_fusion_map(model)
@@ -38,39 +73,48 @@ ARCHITECTURE_REGISTRY: dict[str, ArchitectureSpec | None] = {
     # L4MA is always available (works with both flashinfer and pie-metal)
     "l4ma": ArchitectureSpec(
         create_model=_create_l4ma_model,
-        description="Llama-like architecture with FlashInfer/pie-metal backend",
+        description="Llama-like architecture with FlashInfer/pie-metal/PyTorch backend",
     ),
 }
 
-# Add FlashInfer-only architectures if not on Apple Silicon
+# Add architectures that need ops pie-metal does not provide (the RoPE variants
+# of Qwen and GPT OSS). Elsewhere they run on FlashInfer or on `torch_ops`.
 IS_APPLE_SILICON = is_apple_silicon()
 
 if not IS_APPLE_SILICON:
 
-    def _create_qwen2_model(model_info: ModelInfo):
+    def _create_qwen2_model(model_info: ModelInfo, options: ModelOptions):
         from config.qwen2 import Qwen2Arch
         from model.qwen2 import Qwen2ForCausalLM, create_fusion_map
 
+        backend = _create_backend(options.attention_backend)
         arch = Qwen2Arch(**model_info.architecture.__dict__)
-        model = Qwen2ForCausalLM(arch)
+        model = Qwen2ForCausalLM(arch, backend=backend)
         fusion_map = create_fusion_map(model)
         return model, fusion_map
 
-    def _create_qwen3_model(model_info: ModelInfo):
+    def _create_qwen3_model(model_info: ModelInfo, options: ModelOptions):
         from config.qwen3 import Qwen3Arch
         from model.qwen3 import Qwen3ForCausalLM, create_fusion_map
 
+        backend = _create_backend(options.attention_backend)
         arch = Qwen3Arch(**model_info.architecture.__dict__)
-        model = Qwen3ForCausalLM(arch)
+        model = Qwen3ForCausalLM(arch, backend=backend)
         fusion_map = create_fusion_map(model)
         return model, fusion_map
 
-    def _create_gptoss_model(model_info: ModelInfo):
+    def _create_gptoss_model(model_info: ModelInfo, options: ModelOptions):
         from config.gptoss import GptOssArch
         from model.gptoss import GptOssForCausalLM, create_fusion_map
 
-        arch = GptOssArch(**model_info.architecture.__dict__)
-        model = GptOssForCausalLM(arch)
+        backend = _create_backend(options.attention_backend)
+        arch = GptOssArch(
+            **{
+                **model_info.architecture.__dict__,
+                "mxfp4_expert_cache_size": options.mxfp4_expert_cache_size,
+            }
+        )
+        model = GptOssForCausalLM(arch, backend=backend)
         fusion_map = create_fusion_map(model)
         return model, fusion_map
 
@@ -78,25 +122,29 @@ if not IS_APPLE_SILICON:
         {
             "qwen2": ArchitectureSpec(
                 create_model=_create_qwen2_model,
-                description="Qwen2 architecture (requires FlashInfer)",
+                description="Qwen2 architecture with FlashInfer/PyTorch backend",
             ),
             "qwen3": ArchitectureSpec(
                 create_model=_create_qwen3_model,
-                description="Qwen3 architecture (requires FlashInfer)",
+                description="Qwen3 architecture with FlashInfer/PyTorch backend",
             ),
             "gptoss": ArchitectureSpec(
                 create_model=_create_gptoss_model,
-                description="GPT OSS architecture (requires FlashInfer)",
+                description="GPT OSS architecture with FlashInfer/PyTorch backend",
             ),
         }
     )
 
 
-def create_model_and_fusion_map(model_info: ModelInfo):
+def create_model_and_fusion_map(
+    model_info: ModelInfo, options: ModelOptions | None = None
+):
     """Create a model and fusion map based on architecture type.
 
     Args:
         model_info: Model information containing architecture details
+        options: Backend options; options an architecture does not support
+            are ignored
 
     Returns:
         Tuple of (model, fusion_map)
@@ -114,4 +162,4 @@ def create_model_and_fusion_map(model_info: ModelInfo):
             f"Supported architectures: {supported}"
         )
 
-    return spec.create_model(model_info)
+    return spec.create_model(model_info, options or ModelOptions())
@@ -2,20 +2,37 @@
 
 from __future__ import annotations
 
+import re
 import sys
-import math
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
 from pathlib import Path
-from typing import Callable, Iterable, Tuple
+from typing import Callable, Iterable, Iterator, Tuple
 
 import torch
 import ztensor
+from torch.overrides import TorchFunctionMode
 from tqdm import tqdm
 
 from config.common import ModelInfo
+from memory_planner import get_peak_rss_bytes, get_rss_bytes, reset_peak_rss
+from mxfp4 import dequantize_mxfp4
+from tensor_files import TensorFiles
+from weight_cache import fused_artifact_path, write_fused_artifact
+from weight_quantization import quantize_linears
 
 
 CreateModelFn = Callable[[ModelInfo], Tuple[torch.nn.Module, dict]]
 
+# Threads reading tensor files, and tensors each may read ahead of the copies
+DEFAULT_NUM_LOAD_THREADS = 4
+READ_AHEAD_PER_THREAD = 2
+
+_LAYER_PATTERN = re.compile(r"\.layers\.(\d+)\.")
+
 
 def load_model_info(config: dict) -> ModelInfo:
     """Load the model information from the metadata file."""
@@ -32,7 +49,9 @@ def load_model_info(config: dict) -> ModelInfo:
     # Load the model information from the metadata file.
     model_device = config["device"]
     model_dtype = getattr(torch, config["dtype"])
-    model_info = ModelInfo.load_from_file(str(metadata_path), model_device, model_dtype)
+    model_info = ModelInfo.load_from_file(
+        str(metadata_path), model_device, model_dtype, cache_dir=str(cache_dir)
+    )
 
     return model_info
 
@@ -47,63 +66,176 @@ def load_model(
     # Use blocking copy for MPS device to avoid race conditions
     # MPS async operations may not complete before function returns
     use_non_blocking = config["device"] != "mps"
-    # Instantiate the model and its fusion map.
+    # Instantiate the model and its fusion map. The weights are allocated
+    # after the checkpoint is scanned, so they are not initialized twice.
     try:
-        model, fusion_map = create_model_fn(model_info)
+        with _DeferredInit():
+            model, fusion_map = create_model_fn(model_info)
     except RuntimeError as exc:
         raise RuntimeError(
             f"Failed to instantiate model for architecture {model_info.architecture.type}: {exc}"
         ) from exc
 
-    tensor_to_file_map = {}
-    file_readers = {}
+    num_threads = config.get("num_load_threads", DEFAULT_NUM_LOAD_THREADS)
+    # Map CPU weights from the files instead of reading them into new memory
+    map_weights = config.get("mmap_weights", False) and config["device"] == "cpu"
+    cache_fused_weights = config.get("cache_fused_weights", False)
+    # Host memory that tensors read ahead of their copy may take (0: no limit).
+    # With a budget, the model is also loaded layer by layer.
+    host_budget = config.get("load_host_memory_mb", 0) * 2**20
+
+    tensor_files = TensorFiles(model_path / model_name)
 
     try:
         # Scan the tensor files and build the mapping of tensor names to the corresponding files.
         for param_file in tqdm(
             model_info.parameters, desc="Scanning tensor files", unit="files"
         ):
-            weights_path = model_path / model_name / param_file
-            reader = ztensor.Reader(str(weights_path))
-            file_readers[param_file] = reader
+            tensor_files.scan(param_file)
 
-            tensor_names = reader.get_tensor_names()
-            for name in tensor_names:
-                tensor_to_file_map[name] = param_file
+        # Parameters stored already fused (see `convert_checkpoint`) are read
+        # as they are.
+        fusion_map = {
+            name: details
+            for name, details in fusion_map.items()
+            if name not in tensor_files
+        }
 
         model_state_keys = set(model.state_dict().keys())
         loaded_keys = set()
         model_state = model.state_dict()
 
-        # Load the parameters from the files to the model.
-        for param_name in tqdm(
-            model_state_keys, desc="Loading model parameters", unit="tensors"
+        # Read the fused parameters from the cached artifact of this
+        # checkpoint if there is one, and otherwise save them after loading.
+        artifact_path = None
+        save_artifact = False
+        fused_names = sorted(fusion_map.keys() & model_state_keys)
+        if cache_fused_weights and fused_names:
+            artifact_path = fused_artifact_path(
+                Path(cache_dir) / "fused" / model_name,
+                model_path / model_name,
+                model_info.parameters,
+                {name: fusion_map[name] for name in fused_names},
+                model_state[fused_names[0]].dtype,
+                num_threads,
+            )
+            if artifact_path.exists():
+                tensor_files.scan(str(artifact_path))
+                fusion_map = {
+                    name: details
+                    for name, details in fusion_map.items()
+                    if name not in tensor_files
+                }
+                print(f"Reading fused parameters from {artifact_path}")
+            else:
+                save_artifact = True
+
+        # Checkpoints of tied models store no LM head: it shares the storage
+        # of the embedding matrix rather than holding a copy of it.
+        tie_lm_head = (
+            "lm_head.weight" in model_state_keys
+            and "lm_head.weight" not in tensor_files
+            and hasattr(model, "tie_weights")
+        )
+
+        # Collect the tensors to read for each parameter, in file order so
+        # that the reads of each file are mostly sequential.
+        tasks = []
+        for param_name in model_state_keys:
+            if tie_lm_head and param_name == "lm_head.weight":
+                continue
+            task = _make_load_task(param_name, fusion_map, tensor_files)
+            if task is not None:
+                tasks.append(task)
+        tasks.sort(
+            key=lambda task: (
+                _layer_index(task.param_name) if host_budget else 0,
+                tensor_files.entries[task.sources[0]].param_file,
+                tensor_files.entries[task.sources[0]].position,
+            )
+        )
+
+        # Parameters stored as is become views of the file pages.
+        if map_weights:
+            mapped_bytes = 0
+            unmapped_tasks = []
+            for task in tasks:
+                if _map_parameter(model, task, tensor_files):
+                    loaded_keys.add(task.param_name)
+                    mapped_bytes += tensor_files.entries[task.param_name].nbytes
+                else:
+                    unmapped_tasks.append(task)
+            tasks = unmapped_tasks
+            print(f"Mapped {mapped_bytes / 2**30:.2f} GiB of weights from the files")
+
+        # Tied after mapping, which replaces the embedding parameter
+        if tie_lm_head:
+            model.tie_weights()  # type: ignore[operator]
+
+        # Allocate the other weights, left uninitialized for the loader.
+        _materialize(model, config["device"])
+        model_state = model.state_dict()
+
+        # Load the parameters from the files to the model: the I/O threads
+        # read the tensors ahead while this thread copies them to the device.
+        stats = _ReadStats()
+        start = time.perf_counter()
+        reset_peak_rss()
+        for task, source_tensors in tqdm(
+            _read_ahead(
+                tasks, model_state, tensor_files, stats, num_threads, host_budget
+            ),
+            total=len(tasks),
+            desc="Loading model parameters",
+            unit="tensors",
         ):
-            param = model_state[param_name]
+            param = model_state[task.param_name]
 
-            if param_name in fusion_map:
+            if source_tensors is None:
+                # Already read into the parameter by an I/O thread
+                success = True
+            elif task.fusion is not None:
                 success = _load_fused_parameter(
-                    param_name,
+                    task.param_name,
                     param,
-                    fusion_map[param_name],
-                    tensor_to_file_map,
-                    file_readers,
+                    task.fusion,
+                    source_tensors,
                     use_non_blocking,
                 )
             else:
                 success = _load_regular_parameter(
-                    param_name,
+                    task.param_name,
                     param,
-                    tensor_to_file_map,
-                    file_readers,
+                    source_tensors[0],
                     use_non_blocking,
                 )
 
             if success:
-                loaded_keys.add(param_name)
+                loaded_keys.add(task.param_name)
+            # Release the host tensors before the next ones are read.
+            del source_tensors
+
+        _synchronize(config["device"])
+        stats.report(time.perf_counter() - start, num_threads)
+        _report_rss(host_budget)
+
+        if save_artifact and artifact_path is not None:
+            _save_fused_artifact(
+                artifact_path,
+                [
+                    (name, model_state[name])
+                    for name in fused_names
+                    if name in loaded_keys
+                ],
+            )
 
         # Handle weight tying for the LM head.
-        if "lm_head.weight" in model_state_keys and "lm_head.weight" not in loaded_keys:
+        if tie_lm_head:
+            if "model.embed_tokens.weight" in loaded_keys:
+                loaded_keys.add("lm_head.weight")
+        elif (
+            "lm_head.weight" in model_state_keys and "lm_head.weight" not in loaded_keys
+        ):
             if hasattr(model, "model") and hasattr(model.model, "embed_tokens"):
                 embed_tokens = getattr(model.model, "embed_tokens")
                 if hasattr(embed_tokens, "weight"):
@@ -123,6 +255,22 @@ def load_model(
         else:
             print("\nSuccessfully loaded all expected model weights.")
 
+        # Quantized layers replace the loaded projections, whose weights are
+        # freed once nothing refers to them anymore.
+        weight_quantization = config.get("weight_quantization", "none")
+        if weight_quantization != "none":
+            del model_state
+            original_bytes, quantized_bytes = quantize_linears(
+                model,
+                weight_quantization,
+                config.get("weight_quantization_group_size", 128),
+                lm_head=config.get("quantize_lm_head", False),
+            )
+            print(
+                f"Quantized {original_bytes / 2**30:.2f} GiB of projection weights "
+                f"to {quantized_bytes / 2**30:.2f} GiB of {weight_quantization}"
+            )
+
         model.eval()
         return model
 
@@ -138,36 +286,303 @@ def load_model(
             file=sys.stderr,
         )
         raise SystemExit(1) from exc
+    finally:
+        tensor_files.close()
+
+
+@dataclass
+class _LoadTask:
+    """A model parameter and the tensors it is loaded from."""
+
+    param_name: str
+    sources: list[str]
+    # Fusion details of fused parameters, None for regular ones
+    fusion: dict | None = None
+
+
+def _make_load_task(
+    param_name: str, fusion_map: dict, tensor_files: TensorFiles
+) -> _LoadTask | None:
+    """Returns the load task of a parameter, or None if a source is missing."""
+    if param_name not in fusion_map:
+        if param_name not in tensor_files:
+            print(f"    Warning: Could not read tensor '{param_name}'. Skipping.")
+            return None
+        return _LoadTask(param_name=param_name, sources=[param_name])
+
+    fusion_details = fusion_map[param_name]
+    for source_name in fusion_details["sources"]:
+        if source_name not in tensor_files:
+            print(
+                f"    Warning: Could not load fusion source tensor '{source_name}'. "
+                f"Skipping fusion for '{param_name}'."
+            )
+            return None
+    return _LoadTask(
+        param_name=param_name,
+        sources=list(fusion_details["sources"]),
+        fusion=fusion_details,
+    )
+
+
+class _ReadStats:
+    """Bytes read per file and the time span of the reads, shared by threads."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._bytes: dict[str, int] = {}
+        self._spans: dict[str, tuple[float, float]] = {}
+
+    def record(self, param_file: str, num_bytes: int, start: float, end: float):
+        """Records one read of `num_bytes` from `param_file`."""
+        with self._lock:
+            self._bytes[param_file] = self._bytes.get(param_file, 0) + num_bytes
+            first, last = self._spans.get(param_file, (start, end))
+            self._spans[param_file] = (min(first, start), max(last, end))
+
+    def report(self, elapsed: float, num_threads: int) -> None:
+        """Prints the read throughput per file and overall."""
+        total_bytes = sum(self._bytes.values())
+        print(
+            f"Read {total_bytes / 2**30:.2f} GiB in {elapsed:.2f} s "
+            f"({_format_rate(total_bytes, elapsed)}) with {num_threads} I/O threads"
+        )
+        for param_file, num_bytes in self._bytes.items():
+            first, last = self._spans[param_file]
+            print(
+                f"  {param_file}: {num_bytes / 2**30:.2f} GiB, "
+                f"{_format_rate(num_bytes, last - first)}"
+            )
+
+
+def _format_rate(num_bytes: int, seconds: float) -> str:
+    return f"{num_bytes / max(seconds, 1e-9) / 1e9:.2f} GB/s"
+
+
+class _DeferredInit(TorchFunctionMode):
+    """
+    Creates the tensors of `torch.empty` on the meta device.
+
+    Modules allocate their parameters with `torch.empty` and then initialize
+    them randomly, which is wasted work for weights the loader overwrites. In
+    this mode both steps are free, and `_materialize` allocates the storage
+    later. Tensors created with values (`torch.tensor`, `torch.ones`, ...),
+    such as lookup tables, are created as usual.
+    """
+
+    def __torch_function__(self, func, types, args=(), kwargs=None):
+        kwargs = kwargs or {}
+        if func is torch.empty:
+            kwargs = {**kwargs, "device": "meta"}
+        elif re.fullmatch(r"[a-z]\w*_", getattr(func, "__name__", "")):
+            # In-place initialization (`normal_`, `uniform_`, ...) of a meta
+            # tensor has nothing to compute, but would still be traced.
+            target = next(iter([*args, *kwargs.values()]), None)
+            if isinstance(target, torch.Tensor) and target.is_meta:
+                return target
+        return func(*args, **kwargs)
+
+
+def _materialize(model: torch.nn.Module, device: str) -> None:
+    """Allocates the meta parameters and buffers of `model` on `device`."""
+    # Tied parameters stay tied.
+    allocated: dict[int, torch.Tensor] = {}
+    for module in model.modules():
+        tensors = [
+            *module.named_parameters(recurse=False),
+            *module.named_buffers(recurse=False),
+        ]
+        for name, tensor in tensors:
+            if not tensor.is_meta:
+                continue
+            new_tensor = allocated.get(id(tensor))
+            if new_tensor is None:
+                new_tensor = torch.empty(
+                    tensor.shape, dtype=tensor.dtype, device=device
+                )
+                if isinstance(tensor, torch.nn.Parameter):
+                    new_tensor = torch.nn.Parameter(
+                        new_tensor, requires_grad=tensor.requires_grad
+                    )
+                allocated[id(tensor)] = new_tensor
+            setattr(module, name, new_tensor)
+
+
+def _map_parameter(
+    model: torch.nn.Module, task: _LoadTask, tensor_files: TensorFiles
+) -> bool:
+    """Replaces a regular CPU parameter by a view of its file, if possible."""
+    if task.fusion is not None:
+        return False
+    try:
+        param = model.get_parameter(task.param_name)
+    except AttributeError:
+        return False
+    entry = tensor_files.entries[task.param_name]
+    if entry.dtype != param.dtype or entry.shape != tuple(param.shape):
+        return False
+    module_name, _, attr = task.param_name.rpartition(".")
+    setattr(
+        model.get_submodule(module_name),
+        attr,
+        torch.nn.Parameter(
+            tensor_files.map(task.param_name), requires_grad=param.requires_grad
+        ),
+    )
+    return True
+
+
+def _read_targets(
+    param: torch.Tensor, task: _LoadTask, tensor_files: TensorFiles
+) -> list[torch.Tensor] | None:
+    """
+    Returns the parts of `param` that the sources of `task` can be read into.
+
+    These are the whole parameter for a regular one, and consecutive rows for
+    one fused along dim 0. Returns None if the sources need a conversion.
+    """
+    if task.fusion is None:
+        targets = [param]
+    elif task.fusion["op"] == "fusion" and task.fusion["dim"] == 0:
+        targets = []
+        offset = 0
+        for source_name in task.sources:
+            rows = tensor_files.entries[source_name].shape[:1] or (0,)
+            targets.append(param[offset : offset + rows[0]])
+            offset += rows[0]
+        if offset != param.shape[0]:
+            return None
+    else:
+        return None
+
+    if not all(
+        tensor_files.can_read_into(source_name, target)
+        for source_name, target in zip(task.sources, targets)
+    ):
+        return None
+    return targets
+
+
+def _layer_index(param_name: str) -> int:
+    """Index of the decoder layer of a parameter, -1 outside of the layers."""
+    match = _LAYER_PATTERN.search(param_name)
+    return int(match.group(1)) if match else -1
+
+
+def _read_ahead(
+    tasks: list[_LoadTask],
+    model_state: dict[str, torch.Tensor],
+    tensor_files: TensorFiles,
+    stats: _ReadStats,
+    num_threads: int,
+    host_budget: int = 0,
+) -> Iterator[tuple[_LoadTask, list[torch.Tensor] | None]]:
+    """
+    Reads the source tensors of `tasks` on `num_threads` threads.
+
+    Yields the tasks in order with their tensors. Sources that are stored with
+    the dtype and shape of their CPU parameter are read straight into it, in
+    which case the tensors are None. At most `READ_AHEAD_PER_THREAD *
+    num_threads` tasks are read ahead of the consumer and, with a positive
+    `host_budget`, only as long as their tensors fit in that many bytes
+    together. A task is always read once nothing else is pending, even if it
+    exceeds the budget alone. The consumer must drop the tensors it receives
+    before asking for the next ones.
+    """
+
+    def read(task: _LoadTask) -> tuple[_LoadTask, list[torch.Tensor] | None]:
+        targets = _read_targets(model_state[task.param_name], task, tensor_files)
+        tensors = []
+        for i, source_name in enumerate(task.sources):
+            param_file = tensor_files.entries[source_name].param_file
+            start = time.perf_counter()
+            if targets is not None:
+                tensor_files.read_into(source_name, targets[i])
+                num_bytes = targets[i].nbytes
+            else:
+                tensor = tensor_files.read(source_name)
+                tensors.append(tensor)
+                num_bytes = tensor.nbytes
+            stats.record(param_file, num_bytes, start, time.perf_counter())
+        return task, None if targets is not None else tensors
+
+    def host_bytes(task: _LoadTask) -> int:
+        """Host memory taken by the tensors of a task until they are copied."""
+        if _read_targets(model_state[task.param_name], task, tensor_files) is not None:
+            return 0
+        return sum(tensor_files.entries[name].nbytes for name in task.sources)
+
+    max_pending = READ_AHEAD_PER_THREAD * num_threads
+    with ThreadPoolExecutor(
+        max_workers=num_threads, thread_name_prefix="model-loader"
+    ) as pool:
+        pending: deque[tuple[Future, int]] = deque()
+        pending_bytes = 0
+        remaining = deque(tasks)
+        try:
+            while remaining or pending:
+                while remaining and len(pending) < max_pending:
+                    num_bytes = host_bytes(remaining[0])
+                    if (
+                        pending
+                        and host_budget
+                        and pending_bytes + num_bytes > host_budget
+                    ):
+                        break
+                    pending.append((pool.submit(read, remaining.popleft()), num_bytes))
+                    pending_bytes += num_bytes
+
+                future, num_bytes = pending.popleft()
+                result = future.result()
+                yield result
+                # The consumer is done with the tensors of `result`.
+                del result
+                pending_bytes -= num_bytes
+        finally:
+            for future, _ in pending:
+                future.cancel()
+
+
+def _report_rss(host_budget: int) -> None:
+    """Prints the peak and current resident memory of the process."""
+    rss = get_rss_bytes()
+    budget = f", budget {host_budget / 2**20:.0f} MiB" if host_budget else ""
+    current = f", now {rss / 2**30:.2f} GiB" if rss is not None else ""
+    print(
+        f"Peak RSS while loading: {get_peak_rss_bytes() / 2**30:.2f} GiB"
+        f"{current}{budget}"
+    )
+
+
+def _save_fused_artifact(path: Path, tensors: list[tuple[str, torch.Tensor]]) -> None:
+    """Saves the fused parameters; a failure only costs the next start."""
+    try:
+        num_bytes = write_fused_artifact(path, tensors)
+    except (OSError, ztensor.ZTensorError) as exc:
+        print(f"    Warning: Could not save fused parameters to {path}: {exc}")
+        return
+    print(f"Saved {num_bytes / 2**30:.2f} GiB of fused parameters to {path}")
+
+
+def _synchronize(device: str) -> None:
+    """Waits for the pending copies to `device`."""
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+    elif device.startswith("mps"):
+        torch.mps.synchronize()
 
 
 def _load_fused_parameter(
     param_name: str,
     param: torch.Tensor,
     fusion_details: dict,
-    tensor_to_file_map: dict,
-    file_readers: dict,
+    source_tensors: list[torch.Tensor],
     non_blocking: bool = True,
 ) -> bool:
     """Load and process a fusion parameter (concatenation or dequantization).
 
     Returns True if successful, False if the parameter loading is skipped due to errors.
     """
-    source_names = fusion_details["sources"]
-
-    source_tensors = []
-    for source_name in source_names:
-        if source_name not in tensor_to_file_map:
-            print(
-                f"    Warning: Could not load fusion source tensor '{source_name}'. "
-                f"Skipping fusion for '{param_name}'."
-            )
-            return False
-
-        param_file = tensor_to_file_map[source_name]
-        reader = file_readers[param_file]
-        tensor_data = reader.read_tensor(source_name, to="torch")
-        source_tensors.append(tensor_data)
-
     with torch.no_grad():
         if fusion_details["op"] == "fusion":
             dim = fusion_details["dim"]
@@ -219,22 +634,13 @@ def _load_fused_parameter(
 def _load_regular_parameter(
     param_name: str,
     param: torch.Tensor,
-    tensor_to_file_map: dict,
-    file_readers: dict,
+    tensor_data: torch.Tensor,
     non_blocking: bool = True,
 ) -> bool:
     """Load and process a regular (non-fused) parameter.
 
     Returns True if successful, False if the parameter loading is skipped due to errors.
     """
-    if param_name not in tensor_to_file_map:
-        print(f"    Warning: Could not read tensor '{param_name}'. Skipping.")
-        return False
-
-    param_file = tensor_to_file_map[param_name]
-    reader = file_readers[param_file]
-    tensor_data = reader.read_tensor(param_name, to="torch")
-
     if tensor_data.shape != param.shape:
         print(f"    Warning: Shape mismatch for tensor '{param_name}'. Skipping.")
         return False
@@ -263,32 +669,8 @@ def _dequantize_from_mxfp4(
     Returns:
         Converted tensor in the target dtype
     """
-    scales = scales.to(torch.int32) - 127
-
-    assert (
-        blocks.shape[:-1] == scales.shape
-    ), f"{blocks.shape=} does not match {scales.shape=}"
-
-    lut = torch.tensor(fp4_values, dtype=dtype, device=device)
-
-    *prefix_shape, g, b = blocks.shape
-    rows_total = math.prod(prefix_shape) * g
-
-    blocks = blocks.reshape(rows_total, b).to(device)
-    scales = scales.reshape(rows_total, 1).to(device)
-
-    # Extract low and high 4-bit indices
-    idx_lo = (blocks & 0x0F).to(torch.long)
-    idx_hi = (blocks >> 4).to(torch.long)
-
-    # Create output tensor and populate
-    out = torch.empty(rows_total, b * 2, dtype=dtype, device=device)
-    out[:, 0::2] = lut[idx_lo]  # Low 4-bit values at even indices
-    out[:, 1::2] = lut[idx_hi]  # High 4-bit values at odd indices
-
-    torch.ldexp(out, scales, out=out)
-
-    return out.reshape(*prefix_shape, g, b * 2).view(*prefix_shape, g * b * 2)
+    lut = torch.tensor(list(fp4_values), dtype=dtype, device=device)
+    return dequantize_mxfp4(blocks.to(device), scales.to(device), lut)
 
 
 __all__ = ["load_model", "load_model_info"]
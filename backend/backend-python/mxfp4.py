@@ -0,0 +1,150 @@
+"""
+MXFP4 decoding helpers.
+
+MXFP4 tensors store 32-value blocks as 16 bytes of packed 4-bit codes (two
+codes per byte, low nibble first) plus one uint8 power-of-two exponent per
+block, biased by 127. They are kept as two tensors:
+
+* `blocks`: `[..., num_blocks, 16]` uint8
+* `scales`: `[..., num_blocks]` uint8
+
+`ExpertDequantCache` keeps a few dequantized experts of a packed MoE layer in
+a fixed scratch buffer, so only the experts a batch selects are expanded.
+"""
+
+from __future__ import annotations
+
+import math
+from collections import OrderedDict
+
+import torch
+
+# Values of the 16 FP4 (E2M1) codes.
+# Reference:
+# https://github.com/openai/gpt-oss/blob/9ffdd14b89b9dbc1/gpt_oss/torch/weights.py
+FP4_VALUES = (
+    +0.0,
+    +0.5,
+    +1.0,
+    +1.5,
+    +2.0,
+    +3.0,
+    +4.0,
+    +6.0,
+    -0.0,
+    -0.5,
+    -1.0,
+    -1.5,
+    -2.0,
+    -3.0,
+    -4.0,
+    -6.0,
+)
+
+
+def dequantize_mxfp4(
+    blocks: torch.Tensor,
+    scales: torch.Tensor,
+    lut: torch.Tensor,
+    out: torch.Tensor | None = None,
+) -> torch.Tensor:
+    """
+    Expands MXFP4 `blocks` and `scales` into a `[..., num_blocks * 32]` tensor.
+
+    Args:
+        blocks: Packed FP4 codes, on the same device as `lut`.
+        scales: Biased block exponents, on the same device as `lut`.
+        lut: The 16 FP4 values in the output dtype.
+        out: Optional contiguous output with `blocks.numel() * 2` elements.
+    """
+    assert (
+        blocks.shape[:-1] == scales.shape
+    ), f"{blocks.shape=} does not match {scales.shape=}"
+
+    *prefix_shape, num_blocks, block_bytes = blocks.shape
+    rows_total = math.prod(prefix_shape) * num_blocks
+
+    if out is None:
+        out = torch.empty(
+            *prefix_shape,
+            num_blocks * block_bytes * 2,
+            dtype=lut.dtype,
+            device=lut.device,
+        )
+
+    # Decode both nibbles of a byte with a single lookup: the low nibble goes
+    # to the even index and the high nibble to the odd index.
+    byte_lut = torch.stack((lut.repeat(16), lut.repeat_interleave(16)), dim=-1)
+    torch.index_select(
+        byte_lut, 0, blocks.reshape(-1).to(torch.int32), out=out.view(-1, 2)
+    )
+
+    # Scaling by a power of two is exact, so multiplying matches `ldexp`
+    scale = torch.exp2(scales.reshape(rows_total, 1).to(torch.float32) - 127)
+    out.view(rows_total, block_bytes * 2).mul_(scale.to(out.dtype))
+
+    return out.view(*prefix_shape, num_blocks * block_bytes * 2)
+
+
+class ExpertDequantCache:
+    """
+    LRU of dequantized experts of one packed weight, backed by a scratch buffer.
+
+    `get` returns a view into the scratch buffer that stays valid until
+    `capacity` other experts have been requested, so callers must consume it
+    before asking for that many more.
+    """
+
+    def __init__(self, capacity: int):
+        if capacity <= 0:
+            raise ValueError("The expert cache needs at least one slot.")
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+
+        # expert index -> slot, ordered from least to most recently used
+        self._slots: OrderedDict[int, int] = OrderedDict()
+        self._scratch: torch.Tensor | None = None
+
+    def get(
+        self,
+        expert_idx: int,
+        blocks: torch.Tensor,
+        scales: torch.Tensor,
+        lut: torch.Tensor,
+    ) -> torch.Tensor:
+        """Returns expert `expert_idx` of `blocks`/`scales`, dequantized."""
+        slot = self._slots.get(expert_idx)
+        if slot is not None:
+            self._slots.move_to_end(expert_idx)
+            self.hits += 1
+            return self._scratch[slot]  # type: ignore[index]
+
+        self.misses += 1
+        if self._scratch is None:
+            *_, num_blocks, block_bytes = blocks.shape
+            self._scratch = torch.empty(
+                self.capacity,
+                *blocks.shape[1:-2],
+                num_blocks * block_bytes * 2,
+                dtype=lut.dtype,
+                device=lut.device,
+            )
+
+        if len(self._slots) < self.capacity:
+            slot = len(self._slots)
+        else:
+            _, slot = self._slots.popitem(last=False)
+        self._slots[expert_idx] = slot
+
+        return dequantize_mxfp4(
+            blocks[expert_idx], scales[expert_idx], lut, out=self._scratch[slot]
+        )
+
+    def clear(self) -> None:
+        """Drops the cached experts and releases the scratch buffer."""
+        self._slots.clear()
+        self._scratch = None
+
+
+__all__ = ["ExpertDequantCache", "FP4_VALUES", "dequantize_mxfp4"]
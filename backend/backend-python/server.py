@@ -30,6 +30,8 @@ from websockets.sync.client import connect
 
 # Note: profiler.save_profiling_json is imported at shutdown time (line 188)
 
+from adapter_store import ADAPTER_ENCODINGS
+from chunked_prefill import ChunkedPrefillScheduler
 from message import (
     DownloadAdapterRequest,
     EmbedImageRequest,
@@ -41,6 +43,8 @@ from message import (
     UpdateAdapterRequest,
     UploadAdapterRequest,
 )
+from model_factory import ATTENTION_BACKENDS
+from weight_quantization import INT4_GROUP_SIZES, WEIGHT_QUANTIZATIONS
 
 
 class HandlerId(enum.Enum):
@@ -57,6 +61,18 @@ class HandlerId(enum.Enum):
     DOWNLOAD_HANDLER = 8
 
 
+# Messages that change the embeddings or adapters forward passes read. With
+# chunked prefill, they wait for the forward passes that arrived before them.
+ORDERED_HANDLER_IDS = frozenset(
+    {
+        HandlerId.EMBED_IMAGE.value,
+        HandlerId.INITIALIZE_ADAPTER.value,
+        HandlerId.UPDATE_ADAPTER.value,
+        HandlerId.UPLOAD_HANDLER.value,
+    }
+)
+
+
 def resolve_cache_dir(cache_dir: str | None) -> str:
     """Resolve the cache directory using CLI arg > env var > default."""
 
@@ -76,12 +92,60 @@ def build_config(**kwargs: Any) -> Dict[str, Any]:
             "Config must contain either 'max_num_kv_pages' or 'gpu_mem_headroom'."
         )
 
-    # Check that if `gpu_mem_headroom` is set, then CUDA must be available
+    # `gpu_mem_headroom` is a percentage of the device memory (GPU, unified or
+    # system memory) that is kept free when sizing the KV cache.
     if "gpu_mem_headroom" in config:
-        if not torch.cuda.is_available():
+        if not 0 <= config["gpu_mem_headroom"] < 100:
+            terminate("'gpu_mem_headroom' must be a percentage in [0, 100).")
+        if "cuda" in config["device"] and not torch.cuda.is_available():
             terminate("'gpu_mem_headroom' is set but CUDA is not available.")
-        if "cuda" not in config["device"]:
-            terminate("'gpu_mem_headroom' is set but device is not a CUDA device.")
+
+    if config.get("attention_backend", "auto") not in ATTENTION_BACKENDS:
+        terminate(
+            f"'attention_backend' must be one of {list(ATTENTION_BACKENDS)}, "
+            f"got '{config['attention_backend']}'."
+        )
+
+    if config.get("max_num_window_kv_pages", 1) <= 0:
+        terminate("'max_num_window_kv_pages' must be a positive number of pages.")
+
+    if config.get("mxfp4_expert_cache_size", 0) < 0:
+        terminate("'mxfp4_expert_cache_size' must be a non-negative number.")
+
+    if config.get("prefill_token_budget", 0) < 0:
+        terminate("'prefill_token_budget' must be a non-negative number.")
+
+    if config.get("num_load_threads", 1) <= 0:
+        terminate("'num_load_threads' must be a positive number.")
+
+    if config.get("load_host_memory_mb", 0) < 0:
+        terminate("'load_host_memory_mb' must be a non-negative number.")
+
+    weight_quantization = config.get("weight_quantization", "none")
+    if weight_quantization not in WEIGHT_QUANTIZATIONS:
+        terminate(
+            f"'weight_quantization' must be one of {list(WEIGHT_QUANTIZATIONS)}, "
+            f"got '{weight_quantization}'."
+        )
+    if weight_quantization != "none" and config["device"] != "cpu":
+        terminate("'weight_quantization' is only supported on the 'cpu' device.")
+    if config.get("weight_quantization_group_size", 128) not in INT4_GROUP_SIZES:
+        terminate(
+            "'weight_quantization_group_size' must be one of "
+            f"{list(INT4_GROUP_SIZES)}."
+        )
+
+    if config.get("warmup_rounds", 0) < 0:
+        terminate("'warmup_rounds' must be a non-negative number.")
+
+    if config.get("max_num_host_adapters", 1) <= 0:
+        terminate("'max_num_host_adapters' must be a positive number.")
+
+    if config.get("adapter_encoding", "float16") not in ADAPTER_ENCODINGS:
+        terminate(
+            f"'adapter_encoding' must be one of {list(ADAPTER_ENCODINGS)}, "
+            f"got '{config['adapter_encoding']}'."
+        )
 
     return config
 
@@ -132,8 +196,8 @@ def start_service(
     #   | (heartbeat req queue)   | (work req queue)
     #   v                         v
     # +------------------+    +---------------+
-    # | heartbeat_thread |    | worker_thread |
-    # +------------------+    +---------------+
+    # | heartbeat_thread |    | worker_thread |  <-- Waits for warmup_thread
+    # +------------------+    +---------------+      before using the model
     #           |                |
     #           +-------+--------+
     #                   | (response queue)
@@ -149,12 +213,22 @@ def start_service(
     ).start()
     threading.Thread(
         target=worker_thread,
-        args=(work_request_queue, response_queue, handler),
+        args=(
+            work_request_queue,
+            response_queue,
+            handler,
+            config.get("prefill_token_budget", 0),
+        ),
         daemon=True,
     ).start()
     threading.Thread(
         target=zmq_response_thread, args=(response_queue, socket), daemon=True
     ).start()
+    threading.Thread(
+        target=warmup_thread,
+        args=(handler, config.get("warmup_rounds", 0)),
+        daemon=True,
+    ).start()
     threading.Thread(
         target=zmq_listen_thread,
         args=(heartbeat_request_queue, work_request_queue, socket),
@@ -164,7 +238,7 @@ def start_service(
     if register_with_controller:
         threading.Thread(
             target=register_thread,
-            args=(config, endpoint),
+            args=(config, endpoint, handler.ready),
             daemon=True,
         ).start()
 
@@ -198,8 +272,22 @@ def start_service(
         print("Server shutdown complete.")
 
 
-def register_thread(config: Dict[str, Any], endpoint: str) -> None:
-    """Register this service with the controller."""
+def warmup_thread(handler: Any, rounds: int) -> None:
+    """Warms up the model, after which the handler is ready."""
+
+    try:
+        handler.warm_up(rounds)
+    except Exception as exc:  # pylint: disable=broad-exception-caught
+        terminate(f"Unhandled error occurred during the warm-up: {exc}")
+
+
+def register_thread(
+    config: Dict[str, Any], endpoint: str, ready: threading.Event | None = None
+) -> None:
+    """Register this service with the controller, once `ready` is set."""
+
+    if ready is not None:
+        ready.wait()
 
     controller_addr = f"ws://{config['controller_host']}:{config['controller_port']}"
     try:
@@ -265,6 +353,11 @@ def heartbeat_thread(
         while True:
             time.sleep(1)
 
+            # The controller only sends heartbeats once the service registered,
+            # after the warm-up.
+            if not handler.ready.is_set():
+                last_heartbeat_time = time.monotonic()
+
             if time.monotonic() - last_heartbeat_time > heartbeat_timeout:
                 print(
                     f"[!] Heartbeat timeout after {heartbeat_timeout}s, exiting",
@@ -290,15 +383,48 @@ def heartbeat_thread(
 
 
 def worker_thread(
-    work_request_queue: queue.Queue, response_queue: queue.Queue, handler: Any
+    work_request_queue: queue.Queue,
+    response_queue: queue.Queue,
+    handler: Any,
+    prefill_token_budget: int = 0,
 ) -> None:
-    """Worker thread that processes incoming requests from the controller."""
+    """Worker thread that processes incoming requests from the controller.
+
+    With a positive `prefill_token_budget`, forward passes go through a
+    `ChunkedPrefillScheduler`: they run in steps of at most that many tokens,
+    between which the worker picks up newly arrived requests, and a message is
+    answered once all of its requests have completed. Messages that change the
+    embeddings or adapters (`ORDERED_HANDLER_IDS`) first let the pending steps
+    complete, so they never apply in the middle of an earlier prefill.
+    """
+
+    scheduler = None
+    if prefill_token_budget > 0:
+        scheduler = ChunkedPrefillScheduler(prefill_token_budget, handler.kv_page_size)
 
     try:
         while True:
-            client_identity, corr_id_bytes, handler_id_bytes, handler_id, reqs = (
-                work_request_queue.get()
-            )
+            if scheduler is not None and scheduler.has_pending():
+                try:
+                    work = work_request_queue.get_nowait()
+                except queue.Empty:
+                    for ticket, resps in scheduler.step(handler.forward_pass):
+                        response_queue.put((*ticket, resps))
+                    continue
+            else:
+                work = work_request_queue.get()
+
+            client_identity, corr_id_bytes, handler_id_bytes, handler_id, reqs = work
+
+            # Handshakes and queries (e.g. "ready") are answered during the
+            # warm-up; the other requests wait for it to complete.
+            if handler_id not in (HandlerId.HANDSHAKE.value, HandlerId.QUERY.value):
+                handler.ready.wait()
+
+            if scheduler is not None and handler_id in ORDERED_HANDLER_IDS:
+                while scheduler.has_pending():
+                    for ticket, resps in scheduler.step(handler.forward_pass):
+                        response_queue.put((*ticket, resps))
 
             resps = []
             match handler_id:
@@ -307,7 +433,12 @@ def worker_thread(
                 case HandlerId.QUERY.value:
                     resps = handler.query(reqs)
                 case HandlerId.FORWARD_PASS.value:
-                    resps = handler.forward_pass(reqs)
+                    if scheduler is not None:
+                        scheduler.submit(
+                            (client_identity, corr_id_bytes, handler_id_bytes), reqs
+                        )
+                    else:
+                        resps = handler.forward_pass(reqs)
                 case HandlerId.EMBED_IMAGE.value:
                     handler.embed_image(reqs)
                 case HandlerId.INITIALIZE_ADAPTER.value:
@@ -448,8 +579,22 @@ def main(
     max_batch_tokens: int = 10240,
     max_num_adapters: int = 48,
     max_adapter_rank: int = 8,
+    max_num_host_adapters: int | None = None,
+    adapter_encoding: str = "float16",
     max_num_kv_pages: int | None = None,
     gpu_mem_headroom: float | None = None,
+    max_num_window_kv_pages: int | None = None,
+    attention_backend: str = "auto",
+    mxfp4_expert_cache_size: int = 0,
+    prefill_token_budget: int = 0,
+    num_load_threads: int = 4,
+    mmap_weights: bool = False,
+    cache_fused_weights: bool = False,
+    load_host_memory_mb: int = 0,
+    weight_quantization: str = "none",
+    weight_quantization_group_size: int = 128,
+    quantize_lm_head: bool = False,
+    warmup_rounds: int = 0,
     device: str | None = None,
     dtype: str = "bfloat16",
 ):
@@ -472,6 +617,65 @@ def main(
         max_batch_tokens: Maximum number of tokens in a batch.
         max_num_adapters: Maximum number of adapters that can be loaded.
         max_adapter_rank: Maximum rank for any loaded adapter.
+        max_num_host_adapters: Maximum number of adapters kept in host memory.
+                               Only `max_num_adapters` of them are on the
+                               device at a time; the others are swapped in
+                               when a batch uses them. Defaults to
+                               `max_num_adapters`.
+        adapter_encoding: Weight encoding of downloaded adapters ('float32',
+                          'float16', 'bfloat16' or 'int8').
+        gpu_mem_headroom: Percentage of device memory to keep free when sizing
+                          the KV cache from the memory left after loading the
+                          model. Works on CUDA, MPS and CPU devices.
+        max_num_window_kv_pages: Size of a separate KV pool for sliding-window
+                                 layers (e.g. GPT OSS). If unset, those layers
+                                 share the page layout of the full KV cache.
+                                 It must hold the pages of the tokens of a
+                                 forward pass, plus about `window / page size`
+                                 pages per context kept while it is idle. The
+                                 windows of the contexts idle the longest are
+                                 dropped when a pass needs their slots, and
+                                 requests that still do not fit are refused.
+        attention_backend: Attention implementation ('auto', 'flashinfer' or
+                           'torch'). 'auto' uses FlashInfer/pie-metal when
+                           installed and falls back to pure PyTorch.
+        mxfp4_expert_cache_size: If positive, MXFP4 expert weights (GPT OSS)
+                                 stay packed in memory (about 4x smaller) and
+                                 only the experts a batch selects are
+                                 dequantized, caching up to this many per
+                                 layer. If 0, they are dequantized at load time.
+        prefill_token_budget: If positive, the maximum number of tokens of a
+                              forward-pass step. Longer prefills are split into
+                              chunks that run interleaved with the other
+                              requests. If 0, requests run unsplit.
+        num_load_threads: Number of threads reading the model weight files.
+                          Reads overlap with the copies to the device.
+        mmap_weights: On CPU, use the pages of the weight files as the model
+                      parameters when they are stored in the model dtype,
+                      instead of reading them into new memory. Processes
+                      serving the same model then share its weights.
+        cache_fused_weights: Save the fused (q/k/v, gate/up) and dequantized
+                             (MXFP4) parameters to `cache_dir` on the first
+                             start, and read them from there on later starts
+                             of the same checkpoint and dtype.
+        load_host_memory_mb: If positive, load the model layer by layer and
+                             hold at most this many MiB of weights read from
+                             the files but not yet copied to the device. If
+                             0, reads are only bounded by their count.
+        weight_quantization: On CPU, store the weights of the attention and MLP
+                             projections as 'int8' (one scale per output
+                             channel) or 'int4' (a scale and zero point per
+                             group of input channels), or 'none'.
+        weight_quantization_group_size: Input channels per group of 'int4'
+                                        weights: 32, 64, 128 or 256.
+        quantize_lm_head: Also quantize the LM head, which is not tied to the
+                          embeddings anymore.
+        warmup_rounds: Number of times synthetic decode and prefill batches of
+                       several sizes (up to a 2048-token prefill) are run
+                       before registering with the controller, so that the
+                       first requests do not pay for kernel initialization.
+                       The "ready" query reports whether it has completed.
+                       Defaults to 0, i.e. no warm-up.
         device: The device to run the model on (e.g., 'mps', 'cuda:0', 'cpu').
                 Auto-detects to 'mps' on Apple Silicon, 'cuda:0' otherwise.
         dtype: The data type for model weights (e.g., 'bfloat16', 'float16').
@@ -500,8 +704,22 @@ def main(
         max_batch_tokens=max_batch_tokens,
         max_num_adapters=max_num_adapters,
         max_adapter_rank=max_adapter_rank,
+        max_num_host_adapters=max_num_host_adapters,
+        adapter_encoding=adapter_encoding,
         max_num_kv_pages=max_num_kv_pages,
         gpu_mem_headroom=gpu_mem_headroom,
+        max_num_window_kv_pages=max_num_window_kv_pages,
+        attention_backend=attention_backend,
+        mxfp4_expert_cache_size=mxfp4_expert_cache_size,
+        prefill_token_budget=prefill_token_budget,
+        num_load_threads=num_load_threads,
+        mmap_weights=mmap_weights,
+        cache_fused_weights=cache_fused_weights,
+        load_host_memory_mb=load_host_memory_mb,
+        weight_quantization=weight_quantization,
+        weight_quantization_group_size=weight_quantization_group_size,
+        quantize_lm_head=quantize_lm_head,
+        warmup_rounds=warmup_rounds,
         device=device,
         dtype=dtype,
     )
@@ -0,0 +1,141 @@
+"""
+Detection of KV pages shared by the requests of a batch.
+
+Contexts forked from the same system prompt keep pointing at the same leading
+KV pages. Attending to those pages once per request reads them again for
+every request of the batch. Cascade attention reads them once per group
+instead: the queries of all requests of a group attend to the shared prefix
+together, each request attends to the rest of its pages on its own, and the
+two partial results are merged with their log-sum-exp.
+
+This is only exact if every query of the group can see every key of the
+prefix, so the prefix of a group is cut at the first key masked out for any of
+its queries. It also never includes the last page of a request, which may
+still be partially filled.
+"""
+
+from __future__ import annotations
+
+from dataclasses import dataclass
+
+import numpy as np
+import torch
+
+
+@dataclass
+class SharedPrefixInputs:
+    """Batch inputs of cascade attention.
+
+    Group `g` shares the pages `kv_page_indices[kv_page_indptr[g]:
+    kv_page_indptr[g + 1]]`, and its queries are the batch tokens
+    `token_indices[qo_indptr[g]:qo_indptr[g + 1]]`. `prefix_pages` holds, per
+    request, the number of leading pages its group covers (0 if it has none).
+    """
+
+    kv_page_indices: torch.Tensor
+    kv_page_indptr: torch.Tensor
+    token_indices: torch.Tensor
+    qo_indptr: torch.Tensor
+    prefix_pages: torch.Tensor
+
+
+def _num_visible_pages(mask: np.ndarray, num_tokens: int, page_size: int) -> int:
+    """Number of leading pages that all queries of a request attend to."""
+    rows = mask.reshape(num_tokens, -1)
+    masked_out = np.flatnonzero(~rows.all(axis=0))
+    num_keys = masked_out[0] if masked_out.size else rows.shape[1]
+    return int(num_keys) // page_size
+
+
+def find_shared_prefixes(
+    kv_page_ptrs: list[list[int]],
+    num_input_tokens: list[int],
+    masks: list[np.ndarray],
+    page_size: int,
+    min_shared_pages: int = 1,
+) -> list[tuple[list[int], int]]:
+    """
+    Groups the requests of a batch by shared leading pages.
+
+    Returns `(requests, num_pages)` per group of at least two requests whose
+    first `num_pages >= min_shared_pages` pages are the same and fully visible
+    to all of their queries. `masks` are the flattened `[num_tokens, seq_len]`
+    masks of the requests.
+    """
+    by_first_page: dict[int, list[int]] = {}
+    for i, ptrs in enumerate(kv_page_ptrs):
+        # The last page is never shared, so a prefix needs at least two pages.
+        if len(ptrs) > 1:
+            by_first_page.setdefault(ptrs[0], []).append(i)
+
+    groups = []
+    for candidates in by_first_page.values():
+        if len(candidates) < 2:
+            continue
+
+        # Requests that mask out part of the first pages stay out of the group.
+        members = []
+        num_pages = min(len(kv_page_ptrs[i]) - 1 for i in candidates)
+        for i in candidates:
+            visible = _num_visible_pages(masks[i], num_input_tokens[i], page_size)
+            if visible >= min_shared_pages:
+                members.append(i)
+                num_pages = min(num_pages, visible)
+        if len(members) < 2:
+            continue
+
+        first = kv_page_ptrs[members[0]]
+        for i in members[1:]:
+            ptrs = kv_page_ptrs[i]
+            shared = 0
+            while shared < num_pages and ptrs[shared] == first[shared]:
+                shared += 1
+            num_pages = shared
+
+        if num_pages >= min_shared_pages:
+            groups.append((members, num_pages))
+    return groups
+
+
+def prepare_shared_prefix(
+    kv_page_ptrs: list[list[int]],
+    qo_indptr: list[int],
+    masks: list[np.ndarray],
+    page_size: int,
+    device: str,
+    min_shared_pages: int = 1,
+) -> SharedPrefixInputs | None:
+    """Returns the cascade inputs of a batch, or None if nothing is shared."""
+    num_input_tokens = [end - start for start, end in zip(qo_indptr, qo_indptr[1:])]
+    groups = find_shared_prefixes(
+        kv_page_ptrs, num_input_tokens, masks, page_size, min_shared_pages
+    )
+    if not groups:
+        return None
+
+    kv_page_indices: list[int] = []
+    kv_page_indptr = [0]
+    token_indices: list[int] = []
+    group_qo_indptr = [0]
+    prefix_pages = [0] * len(kv_page_ptrs)
+    for members, num_pages in groups:
+        kv_page_indices.extend(kv_page_ptrs[members[0]][:num_pages])
+        kv_page_indptr.append(len(kv_page_indices))
+        for i in members:
+            token_indices.extend(range(qo_indptr[i], qo_indptr[i + 1]))
+            prefix_pages[i] = num_pages
+        group_qo_indptr.append(len(token_indices))
+
+    def as_tensor(values: list[int]) -> torch.Tensor:
+        return torch.as_tensor(values, device=device, dtype=torch.int32)
+
+    return SharedPrefixInputs(
+        kv_page_indices=as_tensor(kv_page_indices),
+        kv_page_indptr=as_tensor(kv_page_indptr),
+        token_indices=as_tensor(token_indices),
+        qo_indptr=as_tensor(group_qo_indptr),
+        prefix_pages=as_tensor(prefix_pages),
+    )
+
+
+__all__ = ["SharedPrefixInputs", "find_shared_prefixes", "prepare_shared_prefix"]
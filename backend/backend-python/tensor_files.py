@@ -0,0 +1,234 @@
+"""
+Direct access to the tensors stored in ztensor files.
+
+`ztensor.Reader.read_tensor` returns every tensor in a buffer of its own, which
+the loader then copies into the model parameter. Uncompressed tensors are
+stored as plain bytes at a known offset of the file, so `TensorFiles` can skip
+that intermediate buffer: `read_into` reads a tensor straight into the memory
+of a CPU parameter, and `map` returns a tensor backed by the pages of the file
+itself. Mapped tensors use copy-on-write pages, so processes that map the same
+files share a single copy of the weights in the page cache.
+
+Compressed tensors, and tensors with a dtype PyTorch cannot view, are read
+with `ztensor` as before.
+
+Safetensors files are scanned from their JSON header. They only store raw
+tensors, so all of them can be read or mapped directly.
+"""
+
+from __future__ import annotations
+
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+from dataclasses import dataclass
+from pathlib import Path
+
+import torch
+import ztensor
+
+_TORCH_DTYPES = {
+    "float64": torch.float64,
+    "float32": torch.float32,
+    "float16": torch.float16,
+    "bfloat16": torch.bfloat16,
+    "int64": torch.int64,
+    "int32": torch.int32,
+    "int16": torch.int16,
+    "int8": torch.int8,
+    "uint8": torch.uint8,
+    "bool": torch.bool,
+}
+
+_SAFETENSORS_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "F8_E4M3": torch.float8_e4m3fn,
+    "F8_E5M2": torch.float8_e5m2,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+
+
+@dataclass(frozen=True)
+class TensorEntry:
+    """Location of a tensor in its file.
+
+    `dtype` is None unless the tensor is stored as raw bytes that can be
+    viewed as a PyTorch tensor, in which case it takes `nbytes` bytes at
+    `offset`.
+    """
+
+    param_file: str
+    position: int
+    offset: int
+    nbytes: int
+    shape: tuple[int, ...]
+    dtype: torch.dtype | None
+
+
+def _raw_dtype(metadata: ztensor.TensorMetadata) -> torch.dtype | None:
+    """Returns the dtype of a tensor stored as raw bytes, or None."""
+    dtype = _TORCH_DTYPES.get(metadata.dtype_str)
+    if (
+        dtype is None
+        or metadata.layout != "dense"
+        or metadata.encoding != "raw"
+        or (metadata.endianness or sys.byteorder) != sys.byteorder
+    ):
+        return None
+    numel = 1
+    for dim in metadata.shape:
+        numel *= dim
+    if metadata.size != numel * dtype.itemsize:
+        return None
+    return dtype
+
+
+class TensorFiles:
+    """The tensors of a set of ztensor files, by name."""
+
+    def __init__(self, weights_dir: Path):
+        self.weights_dir = weights_dir
+        self.entries: dict[str, TensorEntry] = {}
+        self._fds: dict[str, int] = {}
+        self._maps: dict[str, mmap.mmap] = {}
+        self._lock = threading.Lock()
+        # `ztensor` readers are opened per thread instead of being shared.
+        self._local = threading.local()
+
+    def scan(self, param_file: str) -> None:
+        """Adds the tensors of `param_file` (relative to `weights_dir`)."""
+        if param_file.endswith(".safetensors"):
+            self._scan_safetensors(param_file)
+            return
+        reader = ztensor.Reader(str(self.weights_dir / param_file))
+        for position, metadata in enumerate(reader):
+            self.entries[metadata.name] = TensorEntry(
+                param_file=param_file,
+                position=position,
+                offset=metadata.offset,
+                nbytes=metadata.size,
+                shape=tuple(metadata.shape),
+                dtype=_raw_dtype(metadata),
+            )
+
+    def _scan_safetensors(self, param_file: str) -> None:
+        with open(self.weights_dir / param_file, "rb") as file:
+            (header_size,) = struct.unpack("<Q", file.read(8))
+            header = json.loads(file.read(header_size))
+        header.pop("__metadata__", None)
+        # Data offsets are relative to the end of the header.
+        items = sorted(header.items(), key=lambda item: item[1]["data_offsets"][0])
+        for position, (name, info) in enumerate(items):
+            dtype = _SAFETENSORS_DTYPES.get(info["dtype"])
+            if dtype is None:
+                raise ztensor.ZTensorError(
+                    f"Unsupported dtype {info['dtype']} of '{name}' in {param_file}."
+                )
+            begin, end = info["data_offsets"]
+            self.entries[name] = TensorEntry(
+                param_file=param_file,
+                position=position,
+                offset=8 + header_size + begin,
+                nbytes=end - begin,
+                shape=tuple(info["shape"]),
+                dtype=dtype,
+            )
+
+    def __contains__(self, name: object) -> bool:
+        return name in self.entries
+
+    def read(self, name: str) -> torch.Tensor:
+        """Reads a tensor into a new buffer."""
+        entry = self.entries[name]
+        if entry.param_file.endswith(".safetensors"):
+            assert entry.dtype is not None
+            tensor = torch.empty(entry.shape, dtype=entry.dtype)
+            self.read_into(name, tensor)
+            return tensor
+        readers = getattr(self._local, "readers", None)
+        if readers is None:
+            readers = self._local.readers = {}
+        reader = readers.get(entry.param_file)
+        if reader is None:
+            reader = readers[entry.param_file] = ztensor.Reader(
+                str(self.weights_dir / entry.param_file)
+            )
+        return reader.read_tensor(name, to="torch")
+
+    def can_read_into(self, name: str, out: torch.Tensor) -> bool:
+        """Returns whether `read_into(name, out)` is possible."""
+        entry = self.entries[name]
+        return (
+            hasattr(os, "preadv")
+            and entry.dtype == out.dtype
+            and entry.shape == tuple(out.shape)
+            and out.device.type == "cpu"
+            and out.is_contiguous()
+        )
+
+    def read_into(self, name: str, out: torch.Tensor) -> None:
+        """Reads a raw tensor into the memory of the contiguous CPU tensor `out`."""
+        entry = self.entries[name]
+        fd = self._fd(entry.param_file)
+        buffer = memoryview(out.view(-1).view(torch.uint8).numpy())
+        done = 0
+        while done < entry.nbytes:
+            # A single read may return fewer bytes than asked for.
+            num_read = os.preadv(fd, [buffer[done:]], entry.offset + done)
+            if num_read <= 0:
+                raise ztensor.ZTensorError(
+                    f"Unexpected end of file reading '{name}' from {entry.param_file}."
+                )
+            done += num_read
+
+    def map(self, name: str) -> torch.Tensor:
+        """Returns a raw tensor backed by the copy-on-write pages of its file."""
+        entry = self.entries[name]
+        assert entry.dtype is not None, f"Tensor '{name}' is not stored raw."
+        file_map = self._map(entry.param_file)
+        numel = entry.nbytes // entry.dtype.itemsize
+        tensor = torch.frombuffer(
+            file_map, dtype=entry.dtype, count=numel, offset=entry.offset
+        )
+        return tensor.view(entry.shape)
+
+    def _fd(self, param_file: str) -> int:
+        with self._lock:
+            fd = self._fds.get(param_file)
+            if fd is None:
+                fd = self._fds[param_file] = os.open(
+                    self.weights_dir / param_file, os.O_RDONLY
+                )
+            return fd
+
+    def _map(self, param_file: str) -> mmap.mmap:
+        with self._lock:
+            file_map = self._maps.get(param_file)
+            if file_map is None:
+                with open(self.weights_dir / param_file, "rb") as file:
+                    file_map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_COPY)
+                self._maps[param_file] = file_map
+            return file_map
+
+    def close(self) -> None:
+        """Closes the files. Mapped tensors stay valid."""
+        with self._lock:
+            for fd in self._fds.values():
+                os.close(fd)
+            self._fds.clear()
+            # The maps are released with the last tensor that uses them.
+            self._maps.clear()
+
+
+__all__ = ["TensorEntry", "TensorFiles"]
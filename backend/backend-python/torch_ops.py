@@ -0,0 +1,1085 @@
+"""
+Portable PyTorch implementation of the FlashInfer operations used by the backend.
+
+This module mirrors the subset of the `flashinfer` API that the handler and the
+models call (paged KV appends, RoPE variants, batch index helpers, the paged
+attention wrappers and the sampling functions), so it can be used as a drop-in
+`ops` module on hosts without FlashInfer, including CPU-only machines. Every
+operation is vectorized over the batch; the only host synchronization is the
+padded batch shape computed once when an attention wrapper is planned.
+"""
+
+from __future__ import annotations
+
+import math
+from dataclasses import dataclass, replace
+
+import torch
+import torch.nn.functional as F
+
+# --------------------------------------------------------------------------
+# Batch layout helpers
+# --------------------------------------------------------------------------
+
+
+def get_seq_lens(
+    kv_indptr: torch.Tensor, kv_last_page_len: torch.Tensor, page_size: int
+) -> torch.Tensor:
+    """Returns the KV length of every request from its paging metadata."""
+    num_pages = kv_indptr[1:] - kv_indptr[:-1]
+    seq_lens = (num_pages - 1) * page_size + kv_last_page_len
+    return torch.clamp(seq_lens, min=0).to(torch.int32)
+
+
+def get_batch_indices_positions(
+    append_indptr: torch.Tensor, seq_lens: torch.Tensor, nnz: int
+) -> tuple[torch.Tensor, torch.Tensor]:
+    """
+    Returns the request index and the KV position of each appended token.
+
+    `seq_lens` already include the appended tokens, so the tokens of request `i`
+    occupy positions `[seq_lens[i] - num_new_tokens, seq_lens[i])`.
+    """
+    device = append_indptr.device
+    append_indptr = append_indptr.long()
+    append_lens = append_indptr[1:] - append_indptr[:-1]
+    batch_indices = torch.repeat_interleave(
+        torch.arange(append_lens.numel(), device=device),
+        append_lens,
+        output_size=nnz,
+    )
+    token_offsets = torch.arange(nnz, device=device) - append_indptr[batch_indices]
+    positions = (
+        seq_lens.long()[batch_indices] - append_lens[batch_indices] + token_offsets
+    )
+    return batch_indices.to(torch.int32), positions.to(torch.int32)
+
+
+# --------------------------------------------------------------------------
+# Paged KV cache
+# --------------------------------------------------------------------------
+
+
+def _split_kv_cache(
+    paged_kv_cache: torch.Tensor | tuple[torch.Tensor, torch.Tensor],
+) -> tuple[torch.Tensor, torch.Tensor]:
+    """Returns (keys, values) views of a combined or split paged KV cache."""
+    if isinstance(paged_kv_cache, tuple):
+        return paged_kv_cache
+    return paged_kv_cache[:, 0], paged_kv_cache[:, 1]
+
+
+def append_paged_kv_cache(
+    append_key: torch.Tensor,
+    append_value: torch.Tensor,
+    batch_indices: torch.Tensor,
+    positions: torch.Tensor,
+    paged_kv_cache: torch.Tensor | tuple[torch.Tensor, torch.Tensor],
+    kv_indices: torch.Tensor,
+    kv_indptr: torch.Tensor,
+    kv_last_page_len: torch.Tensor,
+    kv_layout: str = "NHD",
+) -> None:
+    """Scatters the appended keys and values into their pages in place."""
+    _ = kv_last_page_len  # Implied by `positions`
+    k_cache, v_cache = _split_kv_cache(paged_kv_cache)
+    page_size = k_cache.shape[1] if kv_layout == "NHD" else k_cache.shape[2]
+
+    positions = positions.long()
+    page_ids = kv_indices.long()[
+        kv_indptr.long()[batch_indices.long()] + positions // page_size
+    ]
+    offsets = positions % page_size
+
+    if kv_layout == "NHD":
+        k_cache[page_ids, offsets] = append_key.to(k_cache.dtype)
+        v_cache[page_ids, offsets] = append_value.to(v_cache.dtype)
+    elif kv_layout == "HND":
+        k_cache[page_ids, :, offsets] = append_key.to(k_cache.dtype)
+        v_cache[page_ids, :, offsets] = append_value.to(v_cache.dtype)
+    else:
+        raise ValueError(f"Unsupported KV layout: {kv_layout}")
+
+
+# --------------------------------------------------------------------------
+# Rotary position embeddings
+# --------------------------------------------------------------------------
+
+
+def _rotate_inplace(
+    x: torch.Tensor,
+    cos: torch.Tensor,
+    sin: torch.Tensor,
+    rotary_dim: int,
+    interleave: bool,
+) -> None:
+    """Rotates the first `rotary_dim` features of `x` ([nnz, heads, dim]) in place."""
+    x_rot = x[..., :rotary_dim].float()
+    if interleave:
+        x1, x2 = x_rot[..., 0::2], x_rot[..., 1::2]
+        rotated = torch.stack((x1 * cos - x2 * sin, x2 * cos + x1 * sin), dim=-1)
+        rotated = rotated.flatten(-2)
+    else:
+        x1, x2 = x_rot.chunk(2, dim=-1)
+        rotated = torch.cat((x1 * cos - x2 * sin, x2 * cos + x1 * sin), dim=-1)
+    x[..., :rotary_dim] = rotated.to(x.dtype)
+
+
+def _apply_rope_inplace(
+    q: torch.Tensor,
+    k: torch.Tensor,
+    pos_ids: torch.Tensor,
+    inv_freq: torch.Tensor,
+    rotary_dim: int,
+    interleave: bool,
+) -> None:
+    freqs = torch.outer(pos_ids.float(), inv_freq).unsqueeze(1)
+    cos, sin = freqs.cos(), freqs.sin()
+    _rotate_inplace(q, cos, sin, rotary_dim, interleave)
+    _rotate_inplace(k, cos, sin, rotary_dim, interleave)
+
+
+def _rope_inv_freq(
+    rotary_dim: int, rope_scale: float, rope_theta: float, device: torch.device
+) -> torch.Tensor:
+    dims = torch.arange(0, rotary_dim, 2, dtype=torch.float32, device=device)
+    return 1.0 / (rope_scale * rope_theta ** (dims / rotary_dim))
+
+
+def apply_rope_pos_ids_inplace(
+    q: torch.Tensor,
+    k: torch.Tensor,
+    pos_ids: torch.Tensor,
+    rotary_dim: int | None = None,
+    interleave: bool = False,
+    rope_scale: float = 1.0,
+    rope_theta: float = 1e4,
+) -> None:
+    """Applies standard RoPE to `q` and `k` ([nnz, heads, head_dim]) in place."""
+    rotary_dim = rotary_dim or q.shape[-1]
+    inv_freq = _rope_inv_freq(rotary_dim, rope_scale, rope_theta, q.device)
+    _apply_rope_inplace(q, k, pos_ids, inv_freq, rotary_dim, interleave)
+
+
+def apply_llama31_rope_pos_ids_inplace(
+    q: torch.Tensor,
+    k: torch.Tensor,
+    pos_ids: torch.Tensor,
+    rotary_dim: int | None = None,
+    interleave: bool = False,
+    rope_scale: float = 8.0,
+    rope_theta: float = 5e5,
+    low_freq_factor: float = 1.0,
+    high_freq_factor: float = 4.0,
+    old_context_len: int = 8192,
+) -> None:
+    """Applies Llama 3.1 frequency-scaled RoPE to `q` and `k` in place."""
+    rotary_dim = rotary_dim or q.shape[-1]
+    inv_freq = _rope_inv_freq(rotary_dim, 1.0, rope_theta, q.device)
+
+    wavelen = 2 * math.pi / inv_freq
+    low_freq_wavelen = old_context_len / low_freq_factor
+    high_freq_wavelen = old_context_len / high_freq_factor
+
+    scaled = torch.where(wavelen > low_freq_wavelen, inv_freq / rope_scale, inv_freq)
+    smooth = (old_context_len / wavelen - low_freq_factor) / (
+        high_freq_factor - low_freq_factor
+    )
+    smoothed = (1 - smooth) * scaled / rope_scale + smooth * scaled
+    is_medium = (wavelen >= high_freq_wavelen) & (wavelen <= low_freq_wavelen)
+    inv_freq = torch.where(is_medium, smoothed, scaled)
+
+    _apply_rope_inplace(q, k, pos_ids, inv_freq, rotary_dim, interleave)
+
+
+def apply_rope_with_cos_sin_cache_inplace(
+    positions: torch.Tensor,
+    query: torch.Tensor,
+    key: torch.Tensor,
+    head_size: int,
+    cos_sin_cache: torch.Tensor,
+    is_neox: bool = True,
+) -> None:
+    """
+    Applies RoPE from a precomputed `[max_pos, rotary_dim]` cache in place.
+
+    Each cache row holds the cosines followed by the sines. `query` and `key`
+    may be `[nnz, heads * head_size]` or `[nnz, heads, head_size]`.
+    """
+    rotary_dim = cos_sin_cache.shape[-1]
+    cos, sin = cos_sin_cache[positions.long()].float().chunk(2, dim=-1)
+    for x in (query, key):
+        _rotate_inplace(
+            x.view(x.shape[0], -1, head_size),
+            cos.unsqueeze(1),
+            sin.unsqueeze(1),
+            rotary_dim,
+            interleave=not is_neox,
+        )
+
+
+# --------------------------------------------------------------------------
+# Paged attention
+# --------------------------------------------------------------------------
+
+
+@dataclass(frozen=True)
+class PagedAttentionPlan:
+    """Padded batch layout shared by every layer of a forward pass."""
+
+    num_qo_heads: int
+    num_kv_heads: int
+    head_dim: int
+    kv_layout: str
+    sm_scale: float
+    batch_size: int
+    max_qo_len: int
+    # Padded page table, [batch_size, max_num_pages]
+    page_table: torch.Tensor
+    # Position of every query token in the padded layout, [nnz]
+    padded_token_indices: torch.Tensor
+    # Mask in the folded GQA layout,
+    # [batch_size, 1, max_qo_len * group_size, max_num_pages * page_size]
+    attention_mask: torch.Tensor
+
+    @property
+    def padded_shape(self) -> tuple[int, int, int]:
+        """`(nnz, max_qo_len, max_num_pages)`, as taken by `plan_paged_attention`."""
+        return (
+            self.padded_token_indices.numel(),
+            self.max_qo_len,
+            self.page_table.shape[1],
+        )
+
+
+def plan_paged_attention(
+    *,
+    qo_indptr: torch.Tensor,
+    kv_indptr: torch.Tensor,
+    kv_indices: torch.Tensor,
+    kv_last_page_len: torch.Tensor,
+    num_qo_heads: int,
+    num_kv_heads: int,
+    head_dim: int,
+    page_size: int,
+    kv_layout: str = "NHD",
+    custom_mask: torch.Tensor | None = None,
+    causal: bool = True,
+    sm_scale: float | None = None,
+    padded_shape: tuple[int, int, int] | None = None,
+) -> PagedAttentionPlan:
+    """
+    Builds the padded page table and attention mask of a batch.
+
+    `custom_mask` is the concatenation of the row-major `[qo_len, kv_len]`
+    boolean masks of all requests (True means attend). Without it, queries
+    attend to every key up to their own position if `causal`, else to all keys.
+    The `padded_shape` of an earlier plan of a batch with the same `qo_indptr`
+    and `kv_indptr` can be passed to skip the host sync.
+    """
+    device = qo_indptr.device
+    qo_indptr = qo_indptr.long()
+    kv_indptr = kv_indptr.long()
+    batch_size = qo_indptr.numel() - 1
+
+    qo_lens = qo_indptr[1:] - qo_indptr[:-1]
+    num_pages = kv_indptr[1:] - kv_indptr[:-1]
+    seq_lens = get_seq_lens(kv_indptr, kv_last_page_len.long(), page_size).long()
+
+    # The only host synchronization: the padded shape of the batch.
+    if padded_shape is None:
+        nnz, max_qo_len, max_num_pages = (
+            torch.stack([qo_indptr[-1], qo_lens.max(), num_pages.max()]).tolist()
+            if batch_size > 0
+            else (0, 0, 0)
+        )
+        max_num_pages = max(1, max_num_pages)
+    else:
+        nnz, max_qo_len, max_num_pages = padded_shape
+    max_kv_len = max_num_pages * page_size
+
+    batch_indices, positions = get_batch_indices_positions(qo_indptr, seq_lens, nnz)
+    batch_indices = batch_indices.long()
+    positions = positions.long()
+    token_offsets = torch.arange(nnz, device=device) - qo_indptr[batch_indices]
+
+    # Padding slots point at the first page of the cache and are masked out.
+    page_slots = torch.arange(max_num_pages, device=device)
+    page_table = kv_indices.long()[
+        torch.clamp(
+            kv_indptr[:-1, None] + page_slots, max=max(0, kv_indices.numel() - 1)
+        )
+    ]
+    page_table = torch.where(
+        page_slots < num_pages[:, None], page_table, torch.zeros_like(page_table)
+    )
+
+    kv_ids = torch.arange(max_kv_len, device=device)
+    token_seq_lens = seq_lens[batch_indices]
+    token_mask = kv_ids < token_seq_lens[:, None]
+    if custom_mask is not None and custom_mask.numel() > 0:
+        mask_indptr = torch.zeros(batch_size + 1, dtype=torch.long, device=device)
+        mask_indptr[1:] = torch.cumsum(qo_lens * seq_lens, dim=0)
+        src = (
+            mask_indptr[batch_indices, None]
+            + token_offsets[:, None] * token_seq_lens[:, None]
+            + kv_ids
+        )
+        src = torch.clamp(src, max=custom_mask.numel() - 1)
+        token_mask &= custom_mask.bool()[src]
+    elif causal:
+        token_mask &= kv_ids <= positions[:, None]
+
+    # Padding rows attend to everything so SDPA never sees an empty row.
+    padded_token_indices = batch_indices * max_qo_len + token_offsets
+    padded_mask = torch.ones(
+        batch_size * max_qo_len, max_kv_len, dtype=torch.bool, device=device
+    )
+    padded_mask[padded_token_indices] = token_mask
+
+    # Fold the query heads that share a KV head into the query length, so
+    # the KV heads are broadcast by SDPA instead of being repeated.
+    group_size = num_qo_heads // num_kv_heads
+    attention_mask = (
+        padded_mask.view(batch_size, 1, max_qo_len, 1, max_kv_len)
+        .expand(-1, -1, -1, group_size, -1)
+        .reshape(batch_size, 1, max_qo_len * group_size, max_kv_len)
+    )
+
+    return PagedAttentionPlan(
+        num_qo_heads=num_qo_heads,
+        num_kv_heads=num_kv_heads,
+        head_dim=head_dim,
+        kv_layout=kv_layout,
+        sm_scale=sm_scale if sm_scale is not None else head_dim**-0.5,
+        batch_size=batch_size,
+        max_qo_len=max_qo_len,
+        page_table=page_table,
+        padded_token_indices=padded_token_indices,
+        attention_mask=attention_mask,
+    )
+
+
+def advance_decode_plan(
+    plan: PagedAttentionPlan,
+    kv_indptr: torch.Tensor,
+    kv_last_page_len: torch.Tensor,
+    page_size: int,
+) -> PagedAttentionPlan:
+    """
+    Returns `plan` with the mask of new last-page lengths.
+
+    `plan` must come from `plan_paged_attention` for a batch of one query per
+    request without a custom mask, whose pages are the ones of this batch.
+    Only the number of keys of each request is recomputed, on the device.
+    """
+    seq_lens = get_seq_lens(kv_indptr.long(), kv_last_page_len.long(), page_size)
+    kv_ids = torch.arange(plan.attention_mask.shape[-1], device=seq_lens.device)
+    visible = kv_ids < seq_lens.long()[:, None]
+    return replace(
+        plan,
+        attention_mask=visible[:, None, None, :].expand_as(plan.attention_mask),
+    )
+
+
+def run_paged_attention(
+    plan: PagedAttentionPlan,
+    q: torch.Tensor,
+    paged_kv_cache: torch.Tensor | tuple[torch.Tensor, torch.Tensor],
+) -> torch.Tensor:
+    """Runs attention for all requests of `plan` with a single SDPA call.
+
+    Returns the output as `[nnz, num_qo_heads, head_dim]`.
+    """
+    batch_size, max_qo_len = plan.batch_size, plan.max_qo_len
+    num_kv_heads, head_dim = plan.num_kv_heads, plan.head_dim
+    group_size = plan.num_qo_heads // num_kv_heads
+
+    # One gather per K/V for the whole batch: [batch, kv_heads, kv_len, head_dim]
+    k_cache, v_cache = _split_kv_cache(paged_kv_cache)
+    page_ids = plan.page_table.view(-1)
+    keys = k_cache.index_select(0, page_ids)
+    values = v_cache.index_select(0, page_ids)
+    if plan.kv_layout == "HND":
+        keys = keys.transpose(1, 2)
+        values = values.transpose(1, 2)
+    keys = keys.reshape(batch_size, -1, num_kv_heads, head_dim).transpose(1, 2)
+    values = values.reshape(batch_size, -1, num_kv_heads, head_dim).transpose(1, 2)
+
+    # [nnz, qo_heads, head_dim] -> [batch, kv_heads, max_qo_len * group, head_dim]
+    padded_q = q.new_zeros(batch_size * max_qo_len, num_kv_heads, group_size, head_dim)
+    padded_q[plan.padded_token_indices] = q.view(-1, num_kv_heads, group_size, head_dim)
+    padded_q = (
+        padded_q.view(batch_size, max_qo_len, num_kv_heads, group_size, head_dim)
+        .permute(0, 2, 1, 3, 4)
+        .reshape(batch_size, num_kv_heads, -1, head_dim)
+    )
+
+    out = F.scaled_dot_product_attention(
+        padded_q,
+        keys.to(q.dtype),
+        values.to(q.dtype),
+        attn_mask=plan.attention_mask,
+        scale=plan.sm_scale,
+    )
+
+    out = (
+        out.view(batch_size, num_kv_heads, max_qo_len, group_size, head_dim)
+        .permute(0, 2, 1, 3, 4)
+        .reshape(batch_size * max_qo_len, plan.num_qo_heads, head_dim)
+    )
+    return out[plan.padded_token_indices]
+
+
+# --------------------------------------------------------------------------
+# Paged attention with sinks and sliding windows
+# --------------------------------------------------------------------------
+
+# Number of KV pages attended per step of the online softmax.
+_ONLINE_KV_BLOCK_PAGES = 32
+
+
+@dataclass(frozen=True)
+class OnlineAttentionPlan:
+    """Padded layout of a batch for `run_online_attention`.
+
+    Request `b` attends to the pages `page_table[b]`, i.e. to KV positions
+    starting at `kv_starts[b]`. For each padded query row, keys outside
+    `[key_starts[row], key_ends[row])` are never attended to, and, with a
+    custom mask, the mask of the `j`-th key of the table is
+    `custom_mask[mask_offsets[row] + j]`. Padding rows have an empty range.
+    """
+
+    num_qo_heads: int
+    num_kv_heads: int
+    head_dim: int
+    sm_scale: float
+    batch_size: int
+    max_qo_len: int
+    page_table: torch.Tensor
+    kv_starts: torch.Tensor
+    token_rows: torch.Tensor
+    custom_mask: torch.Tensor | None
+    mask_offsets: torch.Tensor
+    key_starts: torch.Tensor
+    key_ends: torch.Tensor
+
+    def block_mask(self, key_start: int, block_len: int) -> torch.Tensor:
+        """Returns the `[batch, max_qo_len, block_len]` mask of a key block."""
+        keys = key_start + torch.arange(block_len, device=self.key_starts.device)
+        mask = (keys >= self.key_starts[..., None]) & (keys < self.key_ends[..., None])
+        if self.custom_mask is None:
+            return mask
+        src = torch.clamp(
+            self.mask_offsets[..., None] + keys, 0, max(0, self.custom_mask.numel() - 1)
+        )
+        return mask & self.custom_mask[src]
+
+
+def plan_online_attention(
+    *,
+    qo_indptr: torch.Tensor,
+    kv_indptr: torch.Tensor,
+    kv_indices: torch.Tensor,
+    kv_last_page_len: torch.Tensor,
+    num_qo_heads: int,
+    num_kv_heads: int,
+    head_dim: int,
+    page_size: int,
+    custom_mask: torch.Tensor | None = None,
+    window: int = 0,
+    query_positions: torch.Tensor | None = None,
+    sm_scale: float | None = None,
+    nnz: int | None = None,
+    causal: bool = True,
+    skip_pages: torch.Tensor | None = None,
+) -> OnlineAttentionPlan:
+    """
+    Builds the padded page table of a batch with one host sync.
+
+    `custom_mask` is laid out as in `plan_paged_attention`; without it, the
+    attention is causal if `causal`, else every query sees all keys of its
+    request. With a `window`, each query only attends to the keys
+    whose KV index is at least `query_positions - window + 1`, and the pages
+    before the window of a request's earliest query are left out of its page
+    table. The mask itself is derived per KV block while attending. Passing
+    the number of query tokens `nnz` saves a host sync. `skip_pages` leaves
+    out the given number of leading pages of each request, whose keys are
+    attended elsewhere (see `run_cascade_attention`).
+    """
+    device = qo_indptr.device
+    qo_indptr = qo_indptr.long()
+    kv_indptr = kv_indptr.long()
+    batch_size = qo_indptr.numel() - 1
+
+    qo_lens = qo_indptr[1:] - qo_indptr[:-1]
+    num_pages = kv_indptr[1:] - kv_indptr[:-1]
+    seq_lens = get_seq_lens(kv_indptr, kv_last_page_len.long(), page_size).long()
+
+    if nnz is None:
+        nnz = int(qo_indptr[-1]) if batch_size > 0 else 0
+    batch_indices, positions = get_batch_indices_positions(qo_indptr, seq_lens, nnz)
+    batch_indices = batch_indices.long()
+    token_seq_lens = seq_lens[batch_indices]
+
+    token_key_starts = torch.zeros_like(batch_indices)
+    first_pages = torch.zeros_like(num_pages)
+    if window > 0:
+        if query_positions is None:
+            query_positions = positions
+        token_key_starts = torch.clamp(query_positions.long() - window + 1, min=0)
+        first_keys = torch.full_like(seq_lens, torch.iinfo(torch.long).max)
+        first_keys.scatter_reduce_(0, batch_indices, token_key_starts, "amin")
+        first_pages = torch.clamp(
+            torch.minimum(first_keys // page_size, num_pages - 1), min=0
+        )
+    if skip_pages is not None:
+        first_pages = torch.maximum(first_pages, skip_pages.long())
+    num_pages = num_pages - first_pages
+    kv_starts = first_pages * page_size
+
+    max_qo_len, max_num_pages = (
+        torch.stack([qo_lens.max(), num_pages.max()]).tolist()
+        if batch_size > 0
+        else (0, 0)
+    )
+    max_num_pages = max(1, max_num_pages)
+
+    # Padding slots point at the first page of the cache and are masked out.
+    page_slots = torch.arange(max_num_pages, device=device)
+    page_table = kv_indices.long()[
+        torch.clamp(
+            (kv_indptr[:-1] + first_pages)[:, None] + page_slots,
+            max=max(0, kv_indices.numel() - 1),
+        )
+    ]
+    page_table = torch.where(
+        page_slots < num_pages[:, None], page_table, torch.zeros_like(page_table)
+    )
+
+    # Per padded row, everything is relative to the first key of the table.
+    token_offsets = torch.arange(nnz, device=device) - qo_indptr[batch_indices]
+    token_kv_starts = kv_starts[batch_indices]
+    token_key_ends = token_seq_lens
+    if custom_mask is None and causal:
+        token_key_ends = positions.long() + 1
+
+    token_rows = batch_indices * max_qo_len + token_offsets
+    num_rows = batch_size * max_qo_len
+    mask_offsets = torch.zeros(num_rows, dtype=torch.long, device=device)
+    key_starts = torch.zeros(num_rows, dtype=torch.long, device=device)
+    key_ends = torch.zeros(num_rows, dtype=torch.long, device=device)
+    if custom_mask is not None:
+        mask_indptr = torch.zeros(batch_size + 1, dtype=torch.long, device=device)
+        mask_indptr[1:] = torch.cumsum(qo_lens * seq_lens, dim=0)
+        mask_offsets[token_rows] = (
+            mask_indptr[batch_indices]
+            + token_offsets * token_seq_lens
+            + token_kv_starts
+        )
+        custom_mask = custom_mask.bool()
+    key_starts[token_rows] = token_key_starts - token_kv_starts
+    key_ends[token_rows] = token_key_ends - token_kv_starts
+
+    return OnlineAttentionPlan(
+        num_qo_heads=num_qo_heads,
+        num_kv_heads=num_kv_heads,
+        head_dim=head_dim,
+        sm_scale=sm_scale if sm_scale is not None else head_dim**-0.5,
+        batch_size=batch_size,
+        max_qo_len=max_qo_len,
+        page_table=page_table,
+        kv_starts=kv_starts,
+        token_rows=token_rows,
+        custom_mask=custom_mask,
+        mask_offsets=mask_offsets.view(batch_size, max_qo_len),
+        key_starts=key_starts.view(batch_size, max_qo_len),
+        key_ends=key_ends.view(batch_size, max_qo_len),
+    )
+
+
+def run_online_attention(
+    plan: OnlineAttentionPlan,
+    q: torch.Tensor,
+    paged_kv_cache: torch.Tensor | tuple[torch.Tensor, torch.Tensor],
+    sinks: torch.Tensor | None = None,
+    return_lse: bool = False,
+) -> torch.Tensor | tuple[torch.Tensor, torch.Tensor]:
+    """Attends all requests of `plan` with an online softmax over KV blocks.
+
+    Queries are laid out as `[batch, kv_heads, max_qo_len * group, head]`, and
+    the keys of a few pages of every request are gathered per step, so long
+    windowed sequences never materialize their full mask. If given, the
+    per-head `sinks` logits act as an extra key whose value is zero: the
+    running maximum and denominator start at them. The NHD layout is assumed.
+
+    Returns the output as `[nnz, num_qo_heads, head_dim]`, and with
+    `return_lse` also the float32 log-sum-exp of the scaled scores of every
+    query and head, `[nnz, num_qo_heads]`.
+    """
+    num_kv_heads, head_dim = plan.num_kv_heads, plan.head_dim
+    group_size = plan.num_qo_heads // num_kv_heads
+    batch_size, max_qo_len = plan.batch_size, plan.max_qo_len
+    num_rows = max_qo_len * group_size
+    k_cache, v_cache = _split_kv_cache(paged_kv_cache)
+    page_size = k_cache.shape[1]
+
+    padded_q = q.new_zeros(batch_size * max_qo_len, num_kv_heads, group_size, head_dim)
+    padded_q[plan.token_rows] = (q * plan.sm_scale).view(
+        -1, num_kv_heads, group_size, head_dim
+    )
+    padded_q = (
+        padded_q.view(batch_size, max_qo_len, num_kv_heads, group_size, head_dim)
+        .permute(0, 2, 1, 3, 4)
+        .reshape(batch_size, num_kv_heads, num_rows, head_dim)
+    )
+
+    if sinks is not None:
+        max_score = (
+            sinks.to(torch.float32)
+            .view(1, num_kv_heads, 1, group_size)
+            .expand(batch_size, -1, max_qo_len, -1)
+            .reshape(batch_size, num_kv_heads, num_rows)
+        )
+        sum_exp = torch.ones_like(max_score)
+    else:
+        # A finite floor keeps fully masked blocks from producing NaNs.
+        max_score = torch.full(
+            (batch_size, num_kv_heads, num_rows),
+            torch.finfo(torch.float32).min,
+            device=q.device,
+        )
+        sum_exp = torch.zeros_like(max_score)
+    sum_val = torch.zeros(
+        *max_score.shape, head_dim, dtype=torch.float32, device=q.device
+    )
+
+    num_pages = plan.page_table.shape[1]
+    for page_start in range(0, num_pages, _ONLINE_KV_BLOCK_PAGES):
+        pages = plan.page_table[:, page_start : page_start + _ONLINE_KV_BLOCK_PAGES]
+        block_len = pages.shape[1] * page_size
+
+        # [batch, block, kv_heads, head] -> [batch, kv_heads, block, head]
+        keys = (
+            k_cache.index_select(0, pages.reshape(-1))
+            .view(batch_size, block_len, num_kv_heads, head_dim)
+            .transpose(1, 2)
+        )
+        values = (
+            v_cache.index_select(0, pages.reshape(-1))
+            .view(batch_size, block_len, num_kv_heads, head_dim)
+            .transpose(1, 2)
+        )
+
+        mask = plan.block_mask(page_start * page_size, block_len)
+        mask = (
+            mask.view(batch_size, 1, max_qo_len, 1, block_len)
+            .expand(-1, -1, -1, group_size, -1)
+            .reshape(batch_size, 1, num_rows, block_len)
+        )
+
+        scores = torch.matmul(padded_q, keys.to(q.dtype).transpose(-1, -2))
+        scores = scores.to(torch.float32).masked_fill(~mask, float("-inf"))
+
+        new_max_score = torch.maximum(max_score, scores.amax(dim=-1))
+        alpha = torch.exp(max_score - new_max_score)
+        probs = torch.exp(scores - new_max_score.unsqueeze(-1))
+
+        sum_exp = sum_exp * alpha + probs.sum(dim=-1)
+        sum_val = sum_val * alpha.unsqueeze(-1) + torch.matmul(
+            probs, values.to(torch.float32)
+        )
+        max_score = new_max_score
+
+    # [batch, kv_heads, max_qo_len * group, head] -> [nnz, qo_heads, head]
+    out = (
+        (sum_val / sum_exp.clamp_min(torch.finfo(torch.float32).tiny).unsqueeze(-1))
+        .view(batch_size, num_kv_heads, max_qo_len, group_size, head_dim)
+        .permute(0, 2, 1, 3, 4)
+        .reshape(batch_size * max_qo_len, plan.num_qo_heads, head_dim)
+    )
+    out = out[plan.token_rows].to(q.dtype)
+    if not return_lse:
+        return out
+
+    lse = (
+        (max_score + torch.log(sum_exp))
+        .view(batch_size, num_kv_heads, max_qo_len, group_size)
+        .permute(0, 2, 1, 3)
+        .reshape(batch_size * max_qo_len, plan.num_qo_heads)
+    )
+    return out, lse[plan.token_rows]
+
+
+def merge_attention_states(
+    v_a: torch.Tensor, s_a: torch.Tensor, v_b: torch.Tensor, s_b: torch.Tensor
+) -> tuple[torch.Tensor, torch.Tensor]:
+    """Merges the attention of the same queries over two disjoint key sets.
+
+    `v_*` are the `[n, heads, head_dim]` outputs and `s_*` the `[n, heads]`
+    natural-log LSE of the scores, as returned by `run_online_attention`.
+    Returns the output and LSE over the union of the keys, like
+    `flashinfer.merge_state` (which uses base-2 LSE).
+    """
+    s = torch.logaddexp(s_a, s_b)
+    w_a = torch.exp(s_a - s).unsqueeze(-1)
+    w_b = torch.exp(s_b - s).unsqueeze(-1)
+    v = v_a.to(torch.float32) * w_a + v_b.to(torch.float32) * w_b
+    return v.to(v_a.dtype), s
+
+
+# --------------------------------------------------------------------------
+# Cascade attention over shared prefixes
+# --------------------------------------------------------------------------
+
+
+@dataclass(frozen=True)
+class CascadeAttentionPlan:
+    """Plans of the shared-prefix and per-request passes of cascade attention.
+
+    `prefix` has one request per group, whose queries are the batch tokens
+    `token_indices` of its members, and `suffix` covers every request of the
+    batch minus the pages of its group's prefix.
+    """
+
+    prefix: OnlineAttentionPlan
+    suffix: OnlineAttentionPlan
+    token_indices: torch.Tensor
+
+
+def plan_cascade_attention(
+    *,
+    qo_indptr: torch.Tensor,
+    kv_indptr: torch.Tensor,
+    kv_indices: torch.Tensor,
+    kv_last_page_len: torch.Tensor,
+    prefix_qo_indptr: torch.Tensor,
+    prefix_token_indices: torch.Tensor,
+    prefix_kv_indptr: torch.Tensor,
+    prefix_kv_indices: torch.Tensor,
+    prefix_pages: torch.Tensor,
+    num_qo_heads: int,
+    num_kv_heads: int,
+    head_dim: int,
+    page_size: int,
+    custom_mask: torch.Tensor | None = None,
+    sm_scale: float | None = None,
+    nnz: int | None = None,
+) -> CascadeAttentionPlan:
+    """
+    Builds the plans of cascade attention.
+
+    The batch is described as in `plan_online_attention`. Group `g` of the
+    prefix arguments shares the pages `prefix_kv_indices[prefix_kv_indptr[g]:
+    prefix_kv_indptr[g + 1]]`, which must be full and visible to all of the
+    group's queries `prefix_token_indices[prefix_qo_indptr[g]:
+    prefix_qo_indptr[g + 1]]`. `prefix_pages` holds the number of shared
+    leading pages of each request.
+    """
+    num_groups = prefix_kv_indptr.numel() - 1
+    prefix = plan_online_attention(
+        qo_indptr=prefix_qo_indptr,
+        kv_indptr=prefix_kv_indptr,
+        kv_indices=prefix_kv_indices,
+        kv_last_page_len=torch.full(
+            (num_groups,), page_size, dtype=torch.int32, device=qo_indptr.device
+        ),
+        num_qo_heads=num_qo_heads,
+        num_kv_heads=num_kv_heads,
+        head_dim=head_dim,
+        page_size=page_size,
+        sm_scale=sm_scale,
+        nnz=prefix_token_indices.numel(),
+        causal=False,
+    )
+    suffix = plan_online_attention(
+        qo_indptr=qo_indptr,
+        kv_indptr=kv_indptr,
+        kv_indices=kv_indices,
+        kv_last_page_len=kv_last_page_len,
+        num_qo_heads=num_qo_heads,
+        num_kv_heads=num_kv_heads,
+        head_dim=head_dim,
+        page_size=page_size,
+        custom_mask=custom_mask,
+        sm_scale=sm_scale,
+        nnz=nnz,
+        skip_pages=prefix_pages,
+    )
+    return CascadeAttentionPlan(
+        prefix=prefix, suffix=suffix, token_indices=prefix_token_indices.long()
+    )
+
+
+def run_cascade_attention(
+    plan: CascadeAttentionPlan,
+    q: torch.Tensor,
+    paged_kv_cache: torch.Tensor | tuple[torch.Tensor, torch.Tensor],
+    sinks: torch.Tensor | None = None,
+) -> torch.Tensor:
+    """Attends all requests of `plan`, reading each shared prefix once.
+
+    The `sinks`, if any, join the per-request pass only, so they are counted
+    once. Returns the output as `[nnz, num_qo_heads, head_dim]`.
+    """
+    out, lse = run_online_attention(
+        plan.suffix, q, paged_kv_cache, sinks, return_lse=True
+    )
+    prefix_out, prefix_lse = run_online_attention(
+        plan.prefix, q[plan.token_indices], paged_kv_cache, return_lse=True
+    )
+    merged, _ = merge_attention_states(
+        out[plan.token_indices], lse[plan.token_indices], prefix_out, prefix_lse
+    )
+    return out.index_copy(0, plan.token_indices, merged)
+
+
+class BatchPrefillWithPagedKVCacheWrapper:
+    """Drop-in replacement for `flashinfer.BatchPrefillWithPagedKVCacheWrapper`."""
+
+    def __init__(self, float_workspace_buffer: torch.Tensor, kv_layout: str = "NHD"):
+        # The workspace is only kept for API compatibility.
+        self.workspace_buffer = float_workspace_buffer
+        self.kv_layout = kv_layout
+        self._plan: PagedAttentionPlan | None = None
+
+    def plan(
+        self,
+        qo_indptr: torch.Tensor,
+        paged_kv_indptr: torch.Tensor,
+        paged_kv_indices: torch.Tensor,
+        paged_kv_last_page_len: torch.Tensor,
+        num_qo_heads: int,
+        num_kv_heads: int,
+        head_dim_qk: int,
+        page_size: int,
+        custom_mask: torch.Tensor | None = None,
+        causal: bool = False,
+        pos_encoding_mode: str = "NONE",
+        sm_scale: float | None = None,
+        q_data_type: torch.dtype | str = torch.float16,
+        kv_data_type: torch.dtype | str | None = None,
+    ) -> None:
+        """Plans attention for a batch of requests with any number of queries."""
+        _ = pos_encoding_mode, q_data_type, kv_data_type  # RoPE is applied by callers
+        self._plan = plan_paged_attention(
+            qo_indptr=qo_indptr,
+            kv_indptr=paged_kv_indptr,
+            kv_indices=paged_kv_indices,
+            kv_last_page_len=paged_kv_last_page_len,
+            num_qo_heads=num_qo_heads,
+            num_kv_heads=num_kv_heads,
+            head_dim=head_dim_qk,
+            page_size=page_size,
+            kv_layout=self.kv_layout,
+            custom_mask=custom_mask,
+            causal=causal,
+            sm_scale=sm_scale,
+        )
+
+    def run(
+        self,
+        q: torch.Tensor,
+        paged_kv_cache: torch.Tensor | tuple[torch.Tensor, torch.Tensor],
+    ) -> torch.Tensor:
+        """Computes attention; returns `[nnz, num_qo_heads, head_dim]`."""
+        if self._plan is None:
+            raise RuntimeError("plan() must be called before run()")
+        return run_paged_attention(self._plan, q, paged_kv_cache)
+
+
+class BatchDecodeWithPagedKVCacheWrapper:
+    """Drop-in replacement for `flashinfer.BatchDecodeWithPagedKVCacheWrapper`."""
+
+    def __init__(self, float_workspace_buffer: torch.Tensor, kv_layout: str = "NHD"):
+        # The workspace is only kept for API compatibility.
+        self.workspace_buffer = float_workspace_buffer
+        self.kv_layout = kv_layout
+        self._plan: PagedAttentionPlan | None = None
+
+    def plan(
+        self,
+        indptr: torch.Tensor,
+        indices: torch.Tensor,
+        last_page_len: torch.Tensor,
+        num_qo_heads: int,
+        num_kv_heads: int,
+        head_dim: int,
+        page_size: int,
+        pos_encoding_mode: str = "NONE",
+        sm_scale: float | None = None,
+        q_data_type: torch.dtype | str = torch.float16,
+        kv_data_type: torch.dtype | str | None = None,
+    ) -> None:
+        """Plans attention for a batch with one query per request."""
+        _ = pos_encoding_mode, q_data_type, kv_data_type  # RoPE is applied by callers
+        batch_size = indptr.numel() - 1
+        self._plan = plan_paged_attention(
+            qo_indptr=torch.arange(batch_size + 1, device=indptr.device),
+            kv_indptr=indptr,
+            kv_indices=indices,
+            kv_last_page_len=last_page_len,
+            num_qo_heads=num_qo_heads,
+            num_kv_heads=num_kv_heads,
+            head_dim=head_dim,
+            page_size=page_size,
+            kv_layout=self.kv_layout,
+            causal=False,
+            sm_scale=sm_scale,
+        )
+
+    def run(
+        self,
+        q: torch.Tensor,
+        paged_kv_cache: torch.Tensor | tuple[torch.Tensor, torch.Tensor],
+    ) -> torch.Tensor:
+        """Computes attention; returns `[batch_size, num_qo_heads, head_dim]`."""
+        if self._plan is None:
+            raise RuntimeError("plan() must be called before run()")
+        return run_paged_attention(self._plan, q, paged_kv_cache)
+
+
+# --------------------------------------------------------------------------
+# Sampling
+# --------------------------------------------------------------------------
+
+
+def _per_row(
+    value: torch.Tensor | float | int, probs: torch.Tensor, dtype: torch.dtype
+) -> torch.Tensor:
+    """Broadcasts a scalar or per-row parameter to a `[batch, 1]` tensor."""
+    if isinstance(value, torch.Tensor):
+        return value.to(device=probs.device, dtype=dtype).view(-1, 1)
+    return torch.full((probs.shape[0], 1), value, device=probs.device, dtype=dtype)
+
+
+def _sample(
+    probs: torch.Tensor, generator: torch.Generator | None = None
+) -> torch.Tensor:
+    """Draws one token per row of (possibly unnormalized) probabilities.
+
+    Uses the exponential race `argmax(p / E)` with `E ~ Exp(1)`, which is
+    equivalent to categorical sampling and needs no normalization.
+    """
+    noise = torch.empty_like(probs, dtype=torch.float32).exponential_(
+        generator=generator
+    )
+    return torch.argmax(probs.float() / noise, dim=-1).to(torch.int32)
+
+
+def _filter_sorted(
+    sorted_probs: torch.Tensor,
+    top_k: torch.Tensor | None,
+    top_p: torch.Tensor | None,
+) -> torch.Tensor:
+    """Zeroes the tail of descending-sorted probabilities by top-k then top-p."""
+    vocab_size = sorted_probs.shape[-1]
+    if top_k is not None:
+        k = torch.where((top_k <= 0) | (top_k > vocab_size), vocab_size, top_k)
+        ranks = torch.arange(vocab_size, device=sorted_probs.device)
+        sorted_probs = sorted_probs.masked_fill(ranks >= k, 0.0)
+    if top_p is not None:
+        # Keep the smallest prefix whose mass reaches `top_p` of the remaining mass.
+        cumsum = torch.cumsum(sorted_probs, dim=-1)
+        threshold = top_p * cumsum[:, -1:]
+        sorted_probs = sorted_probs.masked_fill(cumsum - sorted_probs >= threshold, 0.0)
+    return sorted_probs
+
+
+class sampling:  # pylint: disable=invalid-name
+    """Sampling operations namespace (mirrors `flashinfer.sampling`)."""
+
+    @staticmethod
+    def sampling_from_probs(
+        probs: torch.Tensor, generator: torch.Generator | None = None
+    ) -> torch.Tensor:
+        """Samples one token per row from the full distribution."""
+        return _sample(probs, generator)
+
+    @staticmethod
+    def top_p_sampling_from_probs(
+        probs: torch.Tensor,
+        top_p: torch.Tensor | float,
+        generator: torch.Generator | None = None,
+    ) -> torch.Tensor:
+        """Nucleus sampling with a per-row or shared `top_p`."""
+        return sampling.top_k_top_p_sampling_from_probs(
+            probs, top_k=0, top_p=top_p, generator=generator
+        )
+
+    @staticmethod
+    def top_k_sampling_from_probs(
+        probs: torch.Tensor,
+        top_k: torch.Tensor | int,
+        generator: torch.Generator | None = None,
+    ) -> torch.Tensor:
+        """Samples among the `top_k` most likely tokens of each row."""
+        return sampling.top_k_top_p_sampling_from_probs(
+            probs, top_k=top_k, top_p=1.0, generator=generator
+        )
+
+    @staticmethod
+    def min_p_sampling_from_probs(
+        probs: torch.Tensor,
+        min_p: torch.Tensor | float,
+        generator: torch.Generator | None = None,
+    ) -> torch.Tensor:
+        """Samples among tokens whose probability is at least `min_p * max(p)`."""
+        threshold = _per_row(min_p, probs, probs.dtype) * probs.amax(
+            dim=-1, keepdim=True
+        )
+        return _sample(probs.masked_fill(probs < threshold, 0.0), generator)
+
+    @staticmethod
+    def top_k_top_p_sampling_from_probs(
+        probs: torch.Tensor,
+        top_k: torch.Tensor | int,
+        top_p: torch.Tensor | float,
+        generator: torch.Generator | None = None,
+    ) -> torch.Tensor:
+        """Applies top-k, then top-p on the renormalized remainder, then samples."""
+        sorted_probs, sorted_ids = torch.sort(probs, dim=-1, descending=True)
+        sorted_probs = _filter_sorted(
+            sorted_probs,
+            _per_row(top_k, probs, torch.long),
+            _per_row(top_p, probs, sorted_probs.dtype),
+        )
+        choice = _sample(sorted_probs, generator).long()
+        return sorted_ids.gather(-1, choice.unsqueeze(-1)).squeeze(-1).to(torch.int32)
+
+
+class image:  # pylint: disable=invalid-name
+    """Image operations namespace (API compatibility with pie-metal)."""
+
+    @staticmethod
+    def decode_image(
+        image_blob: bytes, dtype: torch.dtype, device: str
+    ) -> torch.Tensor:
+        """Image decoding is not available in the portable ops."""
+        _ = image_blob, dtype, device
+        raise NotImplementedError("Image decoding is not supported by torch_ops.")
+
+
+__all__ = [
+    "BatchDecodeWithPagedKVCacheWrapper",
+    "BatchPrefillWithPagedKVCacheWrapper",
+    "CascadeAttentionPlan",
+    "OnlineAttentionPlan",
+    "PagedAttentionPlan",
+    "advance_decode_plan",
+    "append_paged_kv_cache",
+    "apply_llama31_rope_pos_ids_inplace",
+    "apply_rope_pos_ids_inplace",
+    "apply_rope_with_cos_sin_cache_inplace",
+    "get_batch_indices_positions",
+    "get_seq_lens",
+    "image",
+    "merge_attention_states",
+    "plan_cascade_attention",
+    "plan_online_attention",
+    "plan_paged_attention",
+    "run_cascade_attention",
+    "run_online_attention",
+    "run_paged_attention",
+    "sampling",
+]
@@ -0,0 +1,194 @@
+"""
+Warm-up of the forward pass before the service registers with the controller.
+
+The first forward passes of a process pay for lazy kernel initialization, the
+workspaces and plans of the attention backend, the growth of the allocators
+and other first-call overheads, which add up to seconds. `warm_up` runs
+synthetic decode and prefill batches of representative shapes through
+`Handler.forward_pass` instead, so that the first requests of the controller
+do not.
+
+The synthetic sequences write their keys and values to the leading pages of
+the KV cache, which the controller allocates later. That is harmless: a page
+is always written before being attended to. The sampler of each decode
+request cycles through the sampling methods, so all of them are initialized.
+"""
+
+from __future__ import annotations
+
+import sys
+import time
+from dataclasses import asdict, dataclass
+from typing import Any
+
+import torch
+
+from message import ForwardPassRequest
+
+# Number of sequences of the warm-up decode batches
+WARMUP_DECODE_BATCH_SIZES = (1, 4, 16, 64)
+
+# Number of tokens of the warm-up prefills
+WARMUP_PREFILL_LENGTHS = (16, 256, 2048)
+
+# Samplers of `ForwardPassBatch.package_responses`, other than distributions
+_SAMPLERS = (
+    {"sampler": 1},
+    {"sampler": 2, "top_p": 0.9},
+    {"sampler": 3, "top_k": 50},
+    {"sampler": 4, "min_p": 0.1},
+    {"sampler": 5, "top_k": 50, "top_p": 0.9},
+)
+
+
+@dataclass
+class WarmupTiming:
+    """Duration of each round of one warm-up batch shape."""
+
+    kind: str
+    batch_size: int
+    num_tokens: int
+    round_ms: list[float]
+
+
+def _decode_requests(batch_size: int) -> list[ForwardPassRequest]:
+    """The first token of each of `batch_size` sequences, one KV page each."""
+    # Sequences without earlier tokens, whose pages the sliding-window KV pool
+    # can assign on the spot
+    return [
+        ForwardPassRequest(
+            input_tokens=[0],
+            input_token_positions=[0],
+            input_embed_ptrs=[],
+            input_embed_positions=[],
+            adapter=None,
+            adapter_seed=None,
+            mask=[[1]],
+            kv_page_ptrs=[i],
+            kv_page_last_len=1,
+            output_token_indices=[0],
+            output_token_samplers=[
+                {**_SAMPLERS[i % len(_SAMPLERS)], "temperature": 1.0}
+            ],
+        )
+        for i in range(batch_size)
+    ]
+
+
+def _prefill_request(num_tokens: int, page_size: int) -> ForwardPassRequest:
+    """A causal prefill of `num_tokens` tokens, sampling after the last one."""
+    num_pages = -(-num_tokens // page_size)
+    return ForwardPassRequest(
+        input_tokens=[0] * num_tokens,
+        input_token_positions=list(range(num_tokens)),
+        input_embed_ptrs=[],
+        input_embed_positions=[],
+        adapter=None,
+        adapter_seed=None,
+        # BRLE runs starting with "attend": token `i` attends to tokens 0..i.
+        mask=[[i + 1] for i in range(num_tokens)],
+        kv_page_ptrs=list(range(num_pages)),
+        kv_page_last_len=num_tokens - (num_pages - 1) * page_size,
+        output_token_indices=[num_tokens - 1],
+        output_token_samplers=[{**_SAMPLERS[0], "temperature": 1.0}],
+    )
+
+
+def warmup_batches(
+    page_size: int, max_batch_tokens: int, max_num_pages: int
+) -> list[tuple[str, int, int, list[ForwardPassRequest]]]:
+    """
+    Lists the warm-up batches that fit the limits of the handler.
+
+    Each is given as its kind ('decode' or 'prefill'), number of sequences,
+    number of tokens and requests. A batch must fit in `max_batch_tokens`
+    tokens and `max_num_pages` KV pages.
+    """
+    batches = []
+    for batch_size in WARMUP_DECODE_BATCH_SIZES:
+        if batch_size <= min(max_batch_tokens, max_num_pages):
+            requests = _decode_requests(batch_size)
+            batches.append(("decode", batch_size, batch_size, requests))
+    for num_tokens in WARMUP_PREFILL_LENGTHS:
+        num_pages = -(-num_tokens // page_size)
+        if num_tokens <= max_batch_tokens and num_pages <= max_num_pages:
+            requests = [_prefill_request(num_tokens, page_size)]
+            batches.append(("prefill", 1, num_tokens, requests))
+    return batches
+
+
+def warm_up(handler: Any, rounds: int) -> list[WarmupTiming]:
+    """
+    Runs each warm-up batch `rounds` times through `handler.forward_pass`.
+
+    Returns the duration of every round, the first of which includes the
+    initialization the warm-up is meant to absorb. A batch shape whose passes
+    are refused (e.g. by a small sliding-window KV pool) is skipped, since
+    its rounds did not run the model.
+    """
+    max_num_pages = handler.max_num_kv_pages
+    if handler.window_kv_pool is not None:
+        # Every page of a warm-up batch is inside the sliding window.
+        max_num_pages = min(max_num_pages, handler.window_kv_pool.num_slots)
+
+    timings = []
+    batches = warmup_batches(
+        handler.kv_page_size, handler.max_batch_tokens, max_num_pages
+    )
+    for kind, batch_size, num_tokens, requests in batches:
+        round_ms = []
+        for _ in range(rounds):
+            start = time.perf_counter()
+            responses = handler.forward_pass(requests)
+            _synchronize(handler.device)
+            errors = [response.error for response in responses if response.error]
+            if errors:
+                print(
+                    f"[!] Skipped the warm-up {kind} batch of {batch_size} "
+                    f"sequences and {num_tokens} tokens: {errors[0]}",
+                    file=sys.stderr,
+                )
+                break
+            round_ms.append((time.perf_counter() - start) * 1000)
+        else:
+            timings.append(WarmupTiming(kind, batch_size, num_tokens, round_ms))
+
+    # Forget the pages of the synthetic sequences.
+    if handler.window_kv_pool is not None:
+        handler.window_kv_pool.reset()
+    return timings
+
+
+def _synchronize(device: str) -> None:
+    if device.startswith("cuda") and torch.cuda.is_available():
+        torch.cuda.synchronize(device)
+    elif device.startswith("mps") and torch.backends.mps.is_available():
+        torch.mps.synchronize()
+
+
+def format_timings(timings: list[WarmupTiming]) -> str:
+    """Formats warm-up timings as one line per batch shape."""
+    lines = ["--- Warm-up ---"]
+    for timing in timings:
+        rounds = ", ".join(f"{ms:.1f}" for ms in timing.round_ms)
+        lines.append(
+            f"{timing.kind:>7} batch={timing.batch_size:<3d} "
+            f"tokens={timing.num_tokens:<5d} {rounds} ms"
+        )
+    return "\n".join(lines)
+
+
+def timings_to_dicts(timings: list[WarmupTiming]) -> list[dict]:
+    """Converts warm-up timings to JSON-serializable dictionaries."""
+    return [asdict(timing) for timing in timings]
+
+
+__all__ = [
+    "WARMUP_DECODE_BATCH_SIZES",
+    "WARMUP_PREFILL_LENGTHS",
+    "WarmupTiming",
+    "format_timings",
+    "timings_to_dicts",
+    "warm_up",
+    "warmup_batches",
+]
@@ -0,0 +1,163 @@
+"""
+Cache of the fused and dequantized model parameters.
+
+Parameters listed in the fusion map of a model are built at load time: the
+q/k/v and gate/up projections are concatenated, and the MXFP4 experts of GPT
+OSS are dequantized. The loader can save the result to a ztensor artifact in
+`cache_dir`, and later starts read those parameters from it as they are.
+
+An artifact is only valid for the checkpoint it was built from. Its name is a
+hash of the contents of the checkpoint files, the parameter dtype, the fusion
+map and `FUSED_WEIGHTS_VERSION`. Hashing a checkpoint reads all of it, so the
+hash of each file is stored next to the artifacts and reused as long as the
+size and modification time of the file do not change.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Iterable
+
+import torch
+import ztensor
+
+# Bump when the way fused parameters are built changes.
+FUSED_WEIGHTS_VERSION = 1
+
+_HASH_CHUNK_SIZE = 8 << 20
+_DIGESTS_FILE = "digests.json"
+
+
+def file_digest(path: Path) -> str:
+    """Returns the SHA-256 of the contents of `path`."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        while chunk := file.read(_HASH_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_digests(
+    cache_dir: Path, weights_dir: Path, param_files: list[str], num_threads: int = 4
+) -> dict[str, str]:
+    """Returns the SHA-256 of each parameter file, hashing only changed files."""
+    digests_path = cache_dir / _DIGESTS_FILE
+    try:
+        known = json.loads(digests_path.read_text())
+    except (OSError, ValueError):
+        known = {}
+
+    digests = {}
+    stale = []
+    for param_file in param_files:
+        stat = (weights_dir / param_file).stat()
+        entry = known.get(param_file)
+        if (
+            entry
+            and entry["size"] == stat.st_size
+            and entry["mtime"] == stat.st_mtime_ns
+        ):
+            digests[param_file] = entry["sha256"]
+        else:
+            stale.append(param_file)
+
+    if stale:
+        # hashlib releases the GIL on large updates, so files hash in parallel.
+        with ThreadPoolExecutor(max_workers=num_threads) as pool:
+            hashed = pool.map(file_digest, (weights_dir / f for f in stale))
+            for param_file, digest in zip(stale, hashed):
+                stat = (weights_dir / param_file).stat()
+                digests[param_file] = digest
+                known[param_file] = {
+                    "size": stat.st_size,
+                    "mtime": stat.st_mtime_ns,
+                    "sha256": digest,
+                }
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        digests_path.write_text(json.dumps(known, indent=2))
+    return digests
+
+
+def record_file_digests(
+    cache_dir: Path, weights_dir: Path, digests: dict[str, str]
+) -> None:
+    """Stores digests computed elsewhere, so `file_digests` does not rehash."""
+    digests_path = cache_dir / _DIGESTS_FILE
+    try:
+        known = json.loads(digests_path.read_text())
+    except (OSError, ValueError):
+        known = {}
+    for param_file, digest in digests.items():
+        stat = (weights_dir / param_file).stat()
+        known[param_file] = {
+            "size": stat.st_size,
+            "mtime": stat.st_mtime_ns,
+            "sha256": digest,
+        }
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    digests_path.write_text(json.dumps(known, indent=2))
+
+
+def fused_artifact_path(
+    cache_dir: Path,
+    weights_dir: Path,
+    param_files: list[str],
+    fusion_map: dict,
+    dtype: torch.dtype,
+    num_threads: int = 4,
+) -> Path:
+    """Returns the path of the artifact of a checkpoint, which may not exist."""
+    digests = file_digests(cache_dir, weights_dir, param_files, num_threads)
+    key = json.dumps(
+        {
+            "version": FUSED_WEIGHTS_VERSION,
+            "files": [digests[param_file] for param_file in sorted(param_files)],
+            "dtype": str(dtype),
+            "fusion_map": fusion_map,
+        },
+        sort_keys=True,
+        default=str,
+    )
+    return cache_dir / f"fused-{hashlib.sha256(key.encode()).hexdigest()[:32]}.zt"
+
+
+def write_fused_artifact(
+    path: Path, tensors: Iterable[tuple[str, torch.Tensor]]
+) -> int:
+    """
+    Writes the fused parameters to `path` and returns the number of bytes.
+
+    The artifact is written to a temporary file that replaces `path` once
+    complete, and the artifacts of other checkpoint versions are removed.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(f".tmp{os.getpid()}")
+    num_bytes = 0
+    try:
+        with ztensor.Writer(str(tmp_path)) as writer:
+            for name, tensor in tensors:
+                tensor = tensor.detach().to("cpu").contiguous()
+                writer.add_tensor(name, tensor)
+                num_bytes += tensor.nbytes
+        os.replace(tmp_path, path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+    for stale in path.parent.glob("fused-*.zt"):
+        if stale != path:
+            stale.unlink(missing_ok=True)
+    return num_bytes
+
+
+__all__ = [
+    "FUSED_WEIGHTS_VERSION",
+    "file_digest",
+    "file_digests",
+    "fused_artifact_path",
+    "record_file_digests",
+    "write_fused_artifact",
+]
@@ -0,0 +1,204 @@
+"""
+Weight-only quantization of the linear projections for CPU serving.
+
+Decoding a few tokens at a time is bound by the memory bandwidth spent
+reading the weights, so storing them in fewer bits speeds it up about as much
+as it shrinks them. `QuantizedLinear` keeps the weight of a linear layer as
+integers with scales and runs its matmuls with the PyTorch CPU kernels that
+dequantize the weight on the fly, tile by tile:
+
+* "int8": symmetric int8 codes with one scale per output channel
+  (`torch._weight_int8pack_mm`);
+* "int4": asymmetric 4-bit codes with a scale and a zero point per group of
+  `group_size` input channels (`torch._weight_int4pack_mm_for_cpu`).
+
+The kernel for int8 only takes one scale per channel: scales per group would
+need a dequantized copy of the weight, which is slower than not quantizing.
+
+`quantize_linears` is applied by the loader once the weights are loaded, so
+the targets of the fusion map (q/k/v and gate/up) are quantized as the single
+matrices the model multiplies by.
+"""
+
+from __future__ import annotations
+
+import torch
+from torch import nn
+
+# The quantized matmul kernels are only exposed as private ops.
+# pylint: disable=protected-access
+
+# Values of the `weight_quantization` option
+WEIGHT_QUANTIZATIONS = ("none", "int8", "int4")
+
+# Group sizes supported by the int4 kernel
+INT4_GROUP_SIZES = (32, 64, 128, 256)
+
+# Projections of the decoder layers that are quantized
+QUANTIZED_PROJECTIONS = ("qkv_proj", "o_proj", "gate_up_proj", "down_proj")
+
+# Output channels quantized at a time, which bounds the float32 scratch memory.
+# A multiple of the 64-row blocks of the int4 layout, so chunks pack alike.
+_ROWS_PER_CHUNK = 4096
+
+
+class QuantizedLinear(nn.Module):
+    """A CPU linear layer with an int8 or int4 weight."""
+
+    def __init__(
+        self,
+        in_features: int,
+        out_features: int,
+        mode: str,
+        group_size: int,
+        bias: torch.Tensor | None,
+        dtype: torch.dtype,
+    ):
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.mode = mode
+        self.group_size = group_size if mode == "int4" else in_features
+        self.bias = (
+            nn.Parameter(bias, requires_grad=False) if bias is not None else None
+        )
+
+        if mode == "int8":
+            self.register_buffer(
+                "qweight", torch.empty(out_features, in_features, dtype=torch.int8)
+            )
+            self.register_buffer("scales", torch.empty(out_features, dtype=dtype))
+        elif mode == "int4":
+            # The layout of the int4 kernel packs two codes per byte.
+            self.register_buffer(
+                "qweight",
+                torch.empty(out_features, in_features // 2, dtype=torch.uint8),
+            )
+            self.register_buffer(
+                "scales_and_zeros",
+                torch.empty(in_features // group_size, out_features, 2, dtype=dtype),
+            )
+        else:
+            raise ValueError(f"Unknown weight quantization '{mode}'")
+
+    @staticmethod
+    def supports(linear: nn.Linear, mode: str, group_size: int) -> bool:
+        """Returns whether the weight of `linear` can be quantized to `mode`."""
+        if linear.weight.device.type != "cpu":
+            return False
+        if mode == "int4":
+            return (
+                group_size in INT4_GROUP_SIZES
+                and linear.in_features % group_size == 0
+                and linear.out_features % 16 == 0
+            )
+        return mode == "int8"
+
+    @classmethod
+    def from_linear(
+        cls, linear: nn.Linear, mode: str, group_size: int
+    ) -> QuantizedLinear:
+        """Quantizes the weight of `linear`, which must be `supports`ed."""
+        weight = linear.weight.detach()
+        module = cls(
+            linear.in_features,
+            linear.out_features,
+            mode,
+            group_size,
+            linear.bias.detach() if linear.bias is not None else None,
+            weight.dtype,
+        )
+        if mode == "int8":
+            for start in range(0, linear.out_features, _ROWS_PER_CHUNK):
+                rows = weight[start : start + _ROWS_PER_CHUNK].float()
+                scales = rows.abs().amax(dim=1).clamp(min=1e-12) / 127
+                module.qweight[start : start + _ROWS_PER_CHUNK] = (
+                    (rows / scales[:, None]).round().clamp(-127, 127)
+                )
+                module.scales[start : start + _ROWS_PER_CHUNK] = scales
+        else:
+            num_groups = linear.in_features // group_size
+            for start in range(0, linear.out_features, _ROWS_PER_CHUNK):
+                rows = weight[start : start + _ROWS_PER_CHUNK].float()
+                end = start + rows.shape[0]
+                groups = rows.view(rows.shape[0], num_groups, group_size)
+                low = groups.amin(dim=-1)
+                scales = ((groups.amax(dim=-1) - low) / 15).clamp(min=1e-12)
+                codes = (
+                    ((groups - low[..., None]) / scales[..., None])
+                    .round()
+                    .clamp(0, 15)
+                    .to(torch.int32)
+                    .view_as(rows)
+                )
+                # Chunks of rows are packed independently of each other.
+                module.qweight[start:end] = torch._convert_weight_to_int4pack_for_cpu(
+                    codes, 1
+                )
+                # The kernel computes (code - 8) * scale + zero.
+                module.scales_and_zeros[:, start:end, 0] = scales.t()
+                module.scales_and_zeros[:, start:end, 1] = (low + 8 * scales).t()
+        return module
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        """Multiplies `x` by the transposed weight and adds the bias."""
+        x_2d = x.reshape(-1, self.in_features).contiguous()
+        if self.mode == "int8":
+            out = torch._weight_int8pack_mm(x_2d, self.qweight, self.scales)
+        else:
+            out = torch._weight_int4pack_mm_for_cpu(
+                x_2d, self.qweight, self.group_size, self.scales_and_zeros
+            )
+        if self.bias is not None:
+            out = out + self.bias
+        return out.view(*x.shape[:-1], self.out_features)
+
+    def extra_repr(self) -> str:
+        return (
+            f"in_features={self.in_features}, out_features={self.out_features}, "
+            f"mode={self.mode}, group_size={self.group_size}, "
+            f"bias={self.bias is not None}"
+        )
+
+
+def quantize_linears(
+    model: nn.Module, mode: str, group_size: int = 128, lm_head: bool = False
+) -> tuple[int, int]:
+    """
+    Replaces the projections of `model` (and `lm_head` if asked) by quantized
+    layers, freeing their original weights.
+
+    Layers whose shape the kernel does not support are left as they are.
+    Returns the number of bytes of the replaced weights and of their
+    quantized versions.
+    """
+    targets = [
+        name
+        for name, module in model.named_modules()
+        if isinstance(module, nn.Linear)
+        and (
+            name.rpartition(".")[2] in QUANTIZED_PROJECTIONS
+            or (lm_head and name == "lm_head")
+        )
+        and QuantizedLinear.supports(module, mode, group_size)
+    ]
+
+    original_bytes = quantized_bytes = 0
+    for name in targets:
+        parent_name, _, attr = name.rpartition(".")
+        parent = model.get_submodule(parent_name)
+        linear = getattr(parent, attr)
+        quantized = QuantizedLinear.from_linear(linear, mode, group_size)
+        original_bytes += linear.weight.nbytes
+        quantized_bytes += sum(buffer.nbytes for buffer in quantized.buffers())
+        setattr(parent, attr, quantized)
+    return original_bytes, quantized_bytes
+
+
+__all__ = [
+    "INT4_GROUP_SIZES",
+    "QUANTIZED_PROJECTIONS",
+    "QuantizedLinear",
+    "WEIGHT_QUANTIZATIONS",
+    "quantize_linears",
+]
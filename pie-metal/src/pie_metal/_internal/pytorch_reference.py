@@ -6,6 +6,7 @@ They use only PyTorch native operations and are designed to match the exact sema
 of the Metal kernels.
 """
 
+import os
 import torch
 from typing import Optional
 import torch.nn.functional as F
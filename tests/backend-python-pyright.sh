@@ -7,7 +7,7 @@ ROOT="$(dirname "$(dirname "${BASH_SOURCE[0]}")")"
 # Run pyright check.
 # See `pyrightconfig.json` for the configuration of the check.
 
-PYTHONPATH=${ROOT}:${ROOT}/backend/backend-python uv run \
+PYTHONPATH=${ROOT}:${ROOT}/backend/backend-python:${ROOT}/pie-metal/src uv run \
     --project ${ROOT}/backend/backend-python \
     --with pyright \
     --with torch \
@@ -15,13 +15,28 @@ PYTHONPATH=${ROOT}:${ROOT}/backend/backend-python uv run \
     ${ROOT}/backend/backend-python/__init__.py \
     ${ROOT}/backend/backend-python/adapter.py \
     ${ROOT}/backend/backend-python/adapter_utils.py \
+    ${ROOT}/backend/backend-python/backend_ops.py \
     ${ROOT}/backend/backend-python/debug_utils.py \
     ${ROOT}/backend/backend-python/handler.py \
+    ${ROOT}/backend/backend-python/adapter_store.py \
+    ${ROOT}/backend/backend-python/tensor_files.py \
+    ${ROOT}/backend/backend-python/weight_cache.py \
+    ${ROOT}/backend/backend-python/weight_quantization.py \
+    ${ROOT}/backend/backend-python/convert_checkpoint.py \
+    ${ROOT}/backend/backend-python/warmup.py \
+    ${ROOT}/backend/backend-python/index_buffers.py \
+    ${ROOT}/backend/backend-python/chunked_prefill.py \
+    ${ROOT}/backend/backend-python/shared_prefix.py \
+    ${ROOT}/backend/backend-python/kv_pool.py \
+    ${ROOT}/backend/backend-python/memory_planner.py \
     ${ROOT}/backend/backend-python/message.py \
     ${ROOT}/backend/backend-python/model_factory.py \
     ${ROOT}/backend/backend-python/model_loader.py \
+    ${ROOT}/backend/backend-python/mxfp4.py \
     ${ROOT}/backend/backend-python/platform_detection.py \
     ${ROOT}/backend/backend-python/profiler.py \
     ${ROOT}/backend/backend-python/server.py \
+    ${ROOT}/backend/backend-python/torch_ops.py \
+    ${ROOT}/backend/backend-python/benchmarks/*.py \
     ${ROOT}/backend/backend-python/config/*.py \
     ${ROOT}/backend/backend-python/model/*.py
@@ -0,0 +1,162 @@
+"""Shared fixtures for the tests of the Python backend."""
+
+from __future__ import annotations
+
+import sys
+from pathlib import Path
+
+import pytest
+
+BACKEND_DIR = Path(__file__).resolve().parents[1] / "backend" / "backend-python"
+sys.path.insert(0, str(BACKEND_DIR))
+
+# pylint: disable=wrong-import-position
+import torch
+import ztensor
+
+_L4MA_METADATA = """\
+name = "tiny-l4ma"
+description = "A randomly initialized L4MA model for tests"
+version = "0.1"
+parameters = ["model.zt"]
+
+[architecture]
+type = "l4ma"
+num_layers = 2
+num_query_heads = 4
+num_key_value_heads = 2
+head_size = 16
+hidden_size = 64
+intermediate_size = 128
+vocab_size = 100
+use_qkv_bias = false
+rms_norm_eps = 1e-5
+
+[architecture.rope]
+factor = 8.0
+high_frequency_factor = 4.0
+low_frequency_factor = 1.0
+theta = 500000.0
+
+[tokenizer]
+type = "bpe"
+vocabulary_file = "vocab.txt"
+split_regex = "x"
+special_tokens = {}
+escape_non_printable = false
+
+[template]
+type = "minijinja"
+content = ""
+stop_tokens = []
+"""
+
+
+_GPTOSS_METADATA = """\
+name = "tiny-gptoss"
+description = "A randomly initialized GPT OSS model for tests"
+version = "0.1"
+parameters = ["model.zt"]
+
+[architecture]
+type = "gptoss"
+num_layers = 2
+num_query_heads = 4
+num_key_value_heads = 2
+head_size = 16
+hidden_size = 64
+intermediate_size = 64
+vocab_size = 100
+use_qkv_bias = true
+rms_norm_eps = 1e-5
+initial_context_length = 4096
+sliding_window = 32
+swiglu_limit = 7.0
+
+[architecture.moe]
+num_experts = 4
+experts_per_token = 2
+
+[architecture.rope]
+theta = 150000.0
+scaling_factor = 32.0
+ntk_alpha = 1.0
+ntk_beta = 32.0
+
+[tokenizer]
+type = "bpe"
+vocabulary_file = "vocab.txt"
+split_regex = "x"
+special_tokens = {}
+escape_non_printable = false
+
+[template]
+type = "minijinja"
+content = ""
+stop_tokens = []
+"""
+
+_METADATA = {"tiny-l4ma": _L4MA_METADATA, "tiny-gptoss": _GPTOSS_METADATA}
+
+
+def _write_tiny_model(cache_dir: Path, model_name: str) -> None:
+    """Writes the metadata and random weights of a tiny model to `cache_dir`."""
+    # pylint: disable=import-outside-toplevel
+    from config.common import ModelInfo
+    from model_factory import ModelOptions, create_model_and_fusion_map
+
+    weights_dir = cache_dir / "models" / model_name
+    weights_dir.mkdir(parents=True)
+    metadata_path = cache_dir / "models" / f"{model_name}.toml"
+    metadata_path.write_text(_METADATA[model_name])
+    (weights_dir / "vocab.txt").write_text("YQ== 0\nYg== 1\n")
+
+    model_info = ModelInfo.load_from_file(str(metadata_path), "cpu", torch.float32)
+    model, _ = create_model_and_fusion_map(
+        model_info, options=ModelOptions(attention_backend="torch")
+    )
+    generator = torch.Generator().manual_seed(0)
+    with ztensor.Writer(str(weights_dir / "model.zt")) as writer:
+        for name, tensor in model.state_dict().items():
+            if name == "lm_head.weight" and hasattr(model, "tie_weights"):
+                continue
+            # Fused parameters (e.g. q/k/v) are stored as they are.
+            writer.add_tensor(
+                name, torch.randn(tensor.shape, generator=generator) * 0.1
+            )
+
+
+@pytest.fixture(name="make_handler")
+def fixture_make_handler(tmp_path):
+    """Builds CPU `Handler`s of a tiny model with the PyTorch attention."""
+    # pylint: disable=import-outside-toplevel
+    from handler import Handler
+
+    def make_handler(model_name: str = "tiny-l4ma", **config):
+        if not (tmp_path / "models" / model_name).exists():
+            _write_tiny_model(tmp_path, model_name)
+        return Handler(
+            config={
+                "model": model_name,
+                "cache_dir": str(tmp_path),
+                "device": "cpu",
+                "dtype": "float32",
+                "attention_backend": "torch",
+                "kv_page_size": 16,
+                "max_dist_size": 8,
+                "max_num_embeds": 8,
+                "max_batch_tokens": 256,
+                "max_num_adapters": 2,
+                "max_adapter_rank": 4,
+                "max_num_kv_pages": 64,
+                **config,
+            }
+        )
+
+    return make_handler
+
+
+@pytest.fixture(name="tiny_handler")
+def fixture_tiny_handler(make_handler):
+    """A CPU `Handler` serving `tiny-l4ma`."""
+    return make_handler()
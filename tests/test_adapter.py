@@ -0,0 +1,54 @@
+"""Tests of the batched adapter subpass."""
+
+from __future__ import annotations
+
+import torch
+
+from adapter import Adapter, AdapterSubpass, EsAdapter
+
+HIDDEN_SIZE = 16
+MAX_RANK = 4
+OUT_FEATURES = [16, 8, 8]
+
+
+def _subpass_output(layers, extras, adapters, lens, seeds, xs):
+    qo_indptr = [0]
+    for num_tokens in lens:
+        qo_indptr.append(qo_indptr[-1] + num_tokens)
+    rand_seeds = [seed for seed, n in zip(seeds, lens) for _ in range(n)]
+    qkv = torch.zeros(qo_indptr[-1], sum(OUT_FEATURES))
+    AdapterSubpass(layers, adapters, extras, rand_seeds, qo_indptr).execute(0, xs, qkv)
+    return qkv
+
+
+def test_segments_of_mixed_lengths_match_separate_passes():
+    torch.manual_seed(0)
+    num_adapters = 4
+    layers = [
+        (
+            torch.randn(num_adapters, 3 * MAX_RANK, HIDDEN_SIZE),
+            torch.randn(num_adapters, sum(OUT_FEATURES), MAX_RANK),
+        )
+    ]
+    extras = {
+        0: Adapter(0, 2, 2.0, OUT_FEATURES),
+        1: EsAdapter(1, 4, 1.0, OUT_FEATURES, 2, 0.5, 0.3),
+        2: Adapter(2, 3, 4.0, OUT_FEATURES),
+        3: EsAdapter(3, 1, 2.0, OUT_FEATURES, 2, 0.5, 0.3),
+    }
+    # A long prefill, decodes and short prefills, several of which share an
+    # adapter but not a seed
+    adapters = [1, 0, 1, 1, 2, 3, 0]
+    lens = [37, 1, 1, 5, 2, 20, 1]
+    seeds = [7, 0, 7, 9, 0, 3, 0]
+    xs = torch.randn(sum(lens), HIDDEN_SIZE)
+
+    batched = _subpass_output(layers, extras, adapters, lens, seeds, xs)
+
+    begin = 0
+    for adapter, num_tokens, seed in zip(adapters, lens, seeds):
+        alone = _subpass_output(
+            layers, extras, [adapter], [num_tokens], [seed], xs[begin:][:num_tokens]
+        )
+        torch.testing.assert_close(batched[begin:][:num_tokens], alone)
+        begin += num_tokens
@@ -0,0 +1,88 @@
+"""Tests of adapter paging between host memory and the device slots."""
+
+from __future__ import annotations
+
+import pytest
+
+import message
+
+from .test_forward_pass import _initialize_adapter, _prefill
+
+
+def _assert_same_dists(response, reference):
+    ids, probs = response.dists[0]
+    assert ids == reference.dists[0][0]
+    assert probs == pytest.approx(reference.dists[0][1], abs=1e-5)
+
+
+@pytest.fixture(name="paging_handler")
+def fixture_paging_handler(make_handler):
+    """A handler with two device slots for up to six adapters."""
+    return make_handler(
+        max_num_adapters=2, max_num_host_adapters=6, adapter_encoding="float32"
+    )
+
+
+def test_batch_with_more_adapters_than_device_slots(paging_handler):
+    for adapter_ptr in range(3):
+        _initialize_adapter(paging_handler, adapter_ptr)
+    reqs = [
+        _prefill([1, 2, 3], kv_page=0, adapter=2),
+        _prefill([4, 5, 6, 7], kv_page=1),
+        _prefill([8, 9], kv_page=2, adapter=0),
+        _prefill([10, 11, 12], kv_page=3, adapter=1),
+        _prefill([13, 14], kv_page=4, adapter=2),
+    ]
+
+    expected = [paging_handler.forward_pass([req])[0] for req in reqs]
+    responses = paging_handler.forward_pass(reqs)
+
+    for response, reference in zip(responses, expected):
+        assert not response.error
+        _assert_same_dists(response, reference)
+    stats = paging_handler.adapter_store.stats()
+    assert stats["resident"] == 2
+    assert stats["evictions"] > 0
+
+
+def test_evicted_adapters_are_reloaded_with_their_weights(paging_handler):
+    _initialize_adapter(paging_handler, 0)
+    req = _prefill([1, 2, 3, 4, 5], kv_page=0, adapter=0)
+    (before,) = paging_handler.forward_pass([req])
+
+    # Two other adapters take both slots, and adapter 0 is written back.
+    for adapter_ptr in (1, 2):
+        _initialize_adapter(paging_handler, adapter_ptr)
+        paging_handler.forward_pass([_prefill([6], kv_page=1, adapter=adapter_ptr)])
+    loads = paging_handler.adapter_store.loads
+
+    (after,) = paging_handler.forward_pass([req])
+    assert paging_handler.adapter_store.loads == loads + 1
+    _assert_same_dists(after, before)
+
+
+def test_download_and_upload_round_trip(paging_handler):
+    _initialize_adapter(paging_handler, 0)
+    (data,) = paging_handler.download_handler(
+        [message.DownloadAdapterRequest(adapter_ptr=0, name="es")]
+    )
+    paging_handler.upload_handler(
+        [
+            message.UploadAdapterRequest(
+                adapter_ptr=3, name="es", adapter_data=data.adapter_data
+            )
+        ]
+    )
+
+    (copy,) = paging_handler.download_handler(
+        [message.DownloadAdapterRequest(adapter_ptr=3, name="es")]
+    )
+    assert copy.adapter_data == data.adapter_data
+
+    original, uploaded = paging_handler.forward_pass(
+        [
+            _prefill([1, 2, 3, 4, 5], kv_page=0, adapter=0),
+            _prefill([1, 2, 3, 4, 5], kv_page=1, adapter=3),
+        ]
+    )
+    _assert_same_dists(uploaded, original)
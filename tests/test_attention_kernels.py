@@ -0,0 +1,154 @@
+"""Tests of the portable attention kernels against a dense reference."""
+
+from __future__ import annotations
+
+import numpy as np
+import pytest
+import torch
+
+import torch_ops
+
+PAGE_SIZE = 4
+NUM_QO_HEADS = 4
+NUM_KV_HEADS = 2
+HEAD_DIM = 8
+
+# `(num_new_tokens, seq_len)` of the requests: prefills, decodes, a fresh
+# prompt and a request on a single partially filled page
+REQUESTS = [(5, 23), (1, 40), (3, 3), (1, 17), (2, 2)]
+
+
+def _make_batch(seed: int = 0):
+    """Random queries, KV cache, masks with holes and shuffled page tables."""
+    generator = np.random.default_rng(seed)
+    torch.manual_seed(seed)
+    num_pages = [-(-seq_len // PAGE_SIZE) for _, seq_len in REQUESTS]
+    page_ids = generator.permutation(sum(num_pages) + 3)
+    kv_cache = torch.randn(len(page_ids), 2, PAGE_SIZE, NUM_KV_HEADS, HEAD_DIM)
+    q = torch.randn(sum(n for n, _ in REQUESTS), NUM_QO_HEADS, HEAD_DIM)
+
+    masks = []
+    for num_new, seq_len in REQUESTS:
+        positions = np.arange(seq_len - num_new, seq_len)
+        causal = np.arange(seq_len)[None, :] <= positions[:, None]
+        holes = generator.random((num_new, seq_len)) < 0.3
+        # Every query still attends to its own key.
+        holes[np.arange(num_new), positions] = False
+        masks.append(causal & ~holes)
+
+    batch = {
+        "qo_indptr": torch.tensor(np.cumsum([0] + [n for n, _ in REQUESTS])),
+        "kv_indptr": torch.tensor(np.cumsum([0] + num_pages)),
+        "kv_indices": torch.tensor(page_ids[: sum(num_pages)]),
+        "kv_last_page_len": torch.tensor(
+            [s - (n - 1) * PAGE_SIZE for (_, s), n in zip(REQUESTS, num_pages)]
+        ),
+        "num_qo_heads": NUM_QO_HEADS,
+        "num_kv_heads": NUM_KV_HEADS,
+        "head_dim": HEAD_DIM,
+        "page_size": PAGE_SIZE,
+    }
+    return batch, q, kv_cache, masks
+
+
+def _dense_attention(batch, q, kv_cache, masks, window=0, sinks=None):
+    """Attends each query with a plain softmax; returns the outputs and LSE."""
+    group_size = NUM_QO_HEADS // NUM_KV_HEADS
+    outputs, lses = [], []
+    for i, mask in enumerate(masks):
+        pages = batch["kv_indices"][batch["kv_indptr"][i] : batch["kv_indptr"][i + 1]]
+        num_new, seq_len = mask.shape
+        keys = kv_cache[pages, 0].reshape(-1, NUM_KV_HEADS, HEAD_DIM)[:seq_len]
+        values = kv_cache[pages, 1].reshape(-1, NUM_KV_HEADS, HEAD_DIM)[:seq_len]
+        keys = keys.repeat_interleave(group_size, dim=1)
+        values = values.repeat_interleave(group_size, dim=1)
+
+        visible = torch.as_tensor(mask)
+        if window > 0:
+            positions = torch.arange(seq_len - num_new, seq_len)
+            visible &= torch.arange(seq_len)[None, :] > positions[:, None] - window
+
+        queries = q[batch["qo_indptr"][i] : batch["qo_indptr"][i + 1]]
+        scores = torch.einsum("qhd,khd->hqk", queries, keys) * HEAD_DIM**-0.5
+        scores = scores.masked_fill(~visible, float("-inf"))
+        if sinks is not None:
+            sink_scores = sinks[:, None, None].expand(-1, num_new, 1)
+            scores = torch.cat([scores, sink_scores], dim=-1)
+            values = torch.cat([values, torch.zeros_like(values[:1])])
+        probs = torch.softmax(scores, dim=-1)
+        outputs.append(torch.einsum("hqk,khd->qhd", probs, values))
+        lses.append(torch.logsumexp(scores, dim=-1).T)
+    return torch.cat(outputs), torch.cat(lses)
+
+
+@pytest.mark.parametrize("block_pages", [2, 32])
+@pytest.mark.parametrize("window", [0, 7])
+@pytest.mark.parametrize("with_sinks", [False, True])
+def test_online_attention_matches_dense_softmax(
+    monkeypatch, block_pages, window, with_sinks
+):
+    # Small blocks make long requests span several steps of the online softmax.
+    monkeypatch.setattr(torch_ops, "_ONLINE_KV_BLOCK_PAGES", block_pages)
+    batch, q, kv_cache, masks = _make_batch()
+    sinks = torch.randn(NUM_QO_HEADS) if with_sinks else None
+
+    plan = torch_ops.plan_online_attention(
+        **batch,
+        custom_mask=torch.as_tensor(np.concatenate([m.reshape(-1) for m in masks])),
+        window=window,
+    )
+    out, lse = torch_ops.run_online_attention(plan, q, kv_cache, sinks, return_lse=True)
+
+    expected_out, expected_lse = _dense_attention(
+        batch, q, kv_cache, masks, window, sinks
+    )
+    torch.testing.assert_close(out, expected_out)
+    torch.testing.assert_close(lse, expected_lse)
+
+
+@pytest.mark.parametrize("with_mask", [False, True])
+def test_paged_attention_matches_dense_softmax(with_mask):
+    batch, q, kv_cache, masks = _make_batch(seed=1)
+    if not with_mask:
+        # Without a mask, the attention is causal.
+        masks = [
+            np.arange(s)[None, :] <= np.arange(s - n, s)[:, None] for n, s in REQUESTS
+        ]
+
+    plan = torch_ops.plan_paged_attention(
+        **batch,
+        custom_mask=(
+            torch.as_tensor(np.concatenate([m.reshape(-1) for m in masks]))
+            if with_mask
+            else None
+        ),
+    )
+    out = torch_ops.run_paged_attention(plan, q, kv_cache)
+
+    expected_out, _ = _dense_attention(batch, q, kv_cache, masks)
+    torch.testing.assert_close(out, expected_out)
+
+
+def test_advanced_decode_plan_matches_a_new_plan():
+    num_pages = [3, 5, 1]
+    batch = {
+        "qo_indptr": torch.arange(4),
+        "kv_indptr": torch.tensor(np.cumsum([0] + num_pages)),
+        "kv_indices": torch.randperm(sum(num_pages)),
+        "num_qo_heads": NUM_QO_HEADS,
+        "num_kv_heads": NUM_KV_HEADS,
+        "head_dim": HEAD_DIM,
+        "page_size": PAGE_SIZE,
+    }
+    plan = torch_ops.plan_paged_attention(
+        **batch, kv_last_page_len=torch.tensor([1, 2, 1])
+    )
+    last_page_len = torch.tensor([3, 4, 2])
+
+    advanced = torch_ops.advance_decode_plan(
+        plan, batch["kv_indptr"], last_page_len, PAGE_SIZE
+    )
+
+    expected = torch_ops.plan_paged_attention(**batch, kv_last_page_len=last_page_len)
+    assert torch.equal(advanced.attention_mask, expected.attention_mask)
+    assert torch.equal(advanced.page_table, expected.page_table)
@@ -0,0 +1,114 @@
+"""Tests of cascade attention over shared KV prefixes."""
+
+from __future__ import annotations
+
+import numpy as np
+import pytest
+import torch
+
+from shared_prefix import prepare_shared_prefix
+from torch_ops import (
+    plan_cascade_attention,
+    plan_online_attention,
+    run_cascade_attention,
+    run_online_attention,
+)
+
+PAGE_SIZE = 4
+NUM_QO_HEADS = 4
+NUM_KV_HEADS = 2
+HEAD_DIM = 8
+
+
+def _causal_mask(seq_len: int, num_tokens: int) -> np.ndarray:
+    """Flattened mask of `num_tokens` queries appended at the end of the sequence."""
+    positions = np.arange(seq_len - num_tokens, seq_len)
+    return (np.arange(seq_len)[None, :] <= positions[:, None]).reshape(-1)
+
+
+def _attend(kv_page_ptrs, seq_lens, num_tokens, num_pages_in_cache):
+    """Returns the outputs of cascade and per-request attention and the groups."""
+    torch.manual_seed(0)
+    kv_cache = torch.randn(num_pages_in_cache, 2, PAGE_SIZE, NUM_KV_HEADS, HEAD_DIM)
+    q = torch.randn(sum(num_tokens), NUM_QO_HEADS, HEAD_DIM)
+    sinks = torch.randn(NUM_QO_HEADS)
+
+    qo_indptr = np.cumsum([0] + num_tokens).tolist()
+    masks = [_causal_mask(s, n) for s, n in zip(seq_lens, num_tokens)]
+    kv_page_indptr = np.cumsum([0] + [len(ptrs) for ptrs in kv_page_ptrs]).tolist()
+    batch = {
+        "qo_indptr": torch.as_tensor(qo_indptr, dtype=torch.int32),
+        "kv_indptr": torch.as_tensor(kv_page_indptr, dtype=torch.int32),
+        "kv_indices": torch.as_tensor(sum(kv_page_ptrs, []), dtype=torch.int32),
+        "kv_last_page_len": torch.as_tensor(
+            [s - (len(p) - 1) * PAGE_SIZE for s, p in zip(seq_lens, kv_page_ptrs)],
+            dtype=torch.int32,
+        ),
+        "num_qo_heads": NUM_QO_HEADS,
+        "num_kv_heads": NUM_KV_HEADS,
+        "head_dim": HEAD_DIM,
+        "page_size": PAGE_SIZE,
+        "custom_mask": torch.as_tensor(np.concatenate(masks)),
+        "nnz": q.shape[0],
+    }
+
+    shared = prepare_shared_prefix(kv_page_ptrs, qo_indptr, masks, PAGE_SIZE, "cpu")
+    assert shared is not None
+    cascade = run_cascade_attention(
+        plan_cascade_attention(
+            **batch,
+            prefix_qo_indptr=shared.qo_indptr,
+            prefix_token_indices=shared.token_indices,
+            prefix_kv_indptr=shared.kv_page_indptr,
+            prefix_kv_indices=shared.kv_page_indices,
+            prefix_pages=shared.prefix_pages,
+        ),
+        q,
+        kv_cache,
+        sinks,
+    )
+    reference = run_online_attention(plan_online_attention(**batch), q, kv_cache, sinks)
+    return cascade, reference, shared.prefix_pages.tolist()
+
+
+def test_forks_of_a_prompt_match_per_request_attention():
+    # A 10-token prompt on pages 0-2, forked by three decodes, one of which
+    # has diverged after the first page, and a prefill of a fork, next to an
+    # unrelated decode.
+    kv_page_ptrs = [
+        [0, 1, 2, 3],
+        [0, 1, 2, 4, 5],
+        [0, 6, 7],
+        [0, 1, 2, 8],
+        [9, 10],
+    ]
+    seq_lens = [13, 18, 11, 15, 6]
+    num_tokens = [1, 1, 1, 5, 1]
+
+    cascade, reference, prefix_pages = _attend(kv_page_ptrs, seq_lens, num_tokens, 11)
+
+    # The fork that diverged after page 0 limits the group to that page.
+    assert prefix_pages == [1, 1, 1, 1, 0]
+    torch.testing.assert_close(cascade, reference)
+
+
+@pytest.mark.parametrize("num_suffix_tokens", [0, 1, PAGE_SIZE])
+def test_prefix_ending_on_a_page_boundary(num_suffix_tokens):
+    # A prompt of exactly three pages, each fork decoding its first tokens
+    # from a fresh page, or, with no suffix, writing the last prompt token.
+    prompt_len = 3 * PAGE_SIZE
+    if num_suffix_tokens == 0:
+        kv_page_ptrs = [[0, 1, 2], [0, 1, 2]]
+        seq_lens = [prompt_len, prompt_len]
+        # The last page of a request is never shared.
+        expected_prefix = [2, 2]
+    else:
+        kv_page_ptrs = [[0, 1, 2, 3], [0, 1, 2, 4], [0, 1, 2, 5]]
+        seq_lens = [prompt_len + num_suffix_tokens] * 3
+        expected_prefix = [3, 3, 3]
+    num_tokens = [1] * len(kv_page_ptrs)
+
+    cascade, reference, prefix_pages = _attend(kv_page_ptrs, seq_lens, num_tokens, 6)
+
+    assert prefix_pages == expected_prefix
+    torch.testing.assert_close(cascade, reference)
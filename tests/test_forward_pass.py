@@ -0,0 +1,142 @@
+"""Tests of `Handler.forward_pass`."""
+
+from __future__ import annotations
+
+import pytest
+
+import message
+import torch_ops
+from chunked_prefill import ChunkedPrefillScheduler
+
+PAGE_SIZE = 16
+
+
+def _prefill(tokens: list[int], kv_page: int, adapter: int | None = None):
+    """A prefill of `tokens` from KV page `kv_page` on, with the last distribution."""
+    num_pages = -(-len(tokens) // PAGE_SIZE)
+    return message.ForwardPassRequest(
+        input_tokens=tokens,
+        input_token_positions=list(range(len(tokens))),
+        input_embed_ptrs=[],
+        input_embed_positions=[],
+        adapter=adapter,
+        adapter_seed=0 if adapter is not None else None,
+        mask=[[i + 1] for i in range(len(tokens))],
+        kv_page_ptrs=list(range(kv_page, kv_page + num_pages)),
+        kv_page_last_len=len(tokens) - (num_pages - 1) * PAGE_SIZE,
+        output_token_indices=[len(tokens) - 1],
+        output_token_samplers=[{"sampler": 0, "top_k": 8}],
+    )
+
+
+def _initialize_adapter(handler, adapter_ptr: int) -> None:
+    handler.initialize_adapter(
+        [
+            message.InitializeAdapterRequest(
+                adapter_ptr=adapter_ptr,
+                rank=2,
+                alpha=1.0,
+                population_size=4,
+                mu_fraction=0.5,
+                initial_sigma=0.1,
+            )
+        ]
+    )
+
+
+def _top_tokens(response: message.ForwardPassResponse) -> list[int]:
+    ids, _probs = response.dists[0]
+    return ids
+
+
+def test_responses_follow_request_order_with_adapters(tiny_handler):
+    """Requests are sorted by adapter internally, but answered in order."""
+    _initialize_adapter(tiny_handler, 1)
+    plain = _prefill([1, 2, 3], kv_page=0)
+    adapted = _prefill([40, 50, 60, 70, 80], kv_page=1, adapter=1)
+
+    (plain_alone,) = tiny_handler.forward_pass([plain])
+    (adapted_alone,) = tiny_handler.forward_pass([adapted])
+    plain_mixed, adapted_mixed = tiny_handler.forward_pass([plain, adapted])
+    assert _top_tokens(plain_mixed) == _top_tokens(plain_alone)
+    assert _top_tokens(adapted_mixed) == _top_tokens(adapted_alone)
+    assert _top_tokens(plain_mixed) != _top_tokens(adapted_mixed)
+
+
+def test_chunked_prefill_with_adapter_requests(tiny_handler):
+    """Chunks of a plain prompt batched with adapter requests get their outputs."""
+    _initialize_adapter(tiny_handler, 1)
+    long_prompt = _prefill([(7 * i) % 100 for i in range(40)], kv_page=0)
+    adapted = _prefill([40, 50, 60, 70, 80], kv_page=4, adapter=1)
+
+    expected = tiny_handler.forward_pass([long_prompt, adapted])
+
+    scheduler = ChunkedPrefillScheduler(token_budget=24, page_size=PAGE_SIZE)
+    scheduler.submit("message", [long_prompt, adapted])
+    completed = []
+    while scheduler.has_pending():
+        completed.extend(scheduler.step(tiny_handler.forward_pass))
+
+    ((ticket, responses),) = completed
+    assert ticket == "message"
+    for response, reference in zip(responses, expected):
+        assert _top_tokens(response) == _top_tokens(reference)
+        assert response.dists[0][1] == pytest.approx(reference.dists[0][1], abs=1e-4)
+
+
+def _decode(token: int, position: int, kv_page: int):
+    """The decode step of a sequence of `position + 1` tokens on one KV page."""
+    return message.ForwardPassRequest(
+        input_tokens=[token],
+        input_token_positions=[position],
+        input_embed_ptrs=[],
+        input_embed_positions=[],
+        adapter=None,
+        adapter_seed=None,
+        mask=[[position + 1]],
+        kv_page_ptrs=[kv_page],
+        kv_page_last_len=position + 1,
+        output_token_indices=[0],
+        output_token_samplers=[{"sampler": 0, "top_k": 8}],
+    )
+
+
+def test_steady_decode_steps_reuse_index_buffers_and_plans(make_handler, monkeypatch):
+    prompts = [[1, 2, 3], [4, 5, 6, 7, 8]]
+    handler = make_handler()
+    plans = []
+    plan_paged_attention = torch_ops.plan_paged_attention
+
+    def count_plans(**kwargs):
+        plans.append(kwargs["custom_mask"])
+        return plan_paged_attention(**kwargs)
+
+    monkeypatch.setattr(torch_ops, "plan_paged_attention", count_plans)
+    handler.forward_pass([_prefill(p, kv_page=i) for i, p in enumerate(prompts)])
+
+    sequences = [list(p) for p in prompts]
+    stats = []
+    for step in range(6):
+        reqs = [
+            _decode(10 + step, len(seq), kv_page=i) for i, seq in enumerate(sequences)
+        ]
+        responses = handler.forward_pass(reqs)
+        for seq, req in zip(sequences, reqs):
+            seq.extend(req.input_tokens)
+        stats.append(handler.plan_cache_stats())
+
+    uploads = [s["index_buffers"]["uploads"] for s in stats]
+    hits = [s["plan_cache"]["hits"] for s in stats]
+    assert uploads[1:] == [uploads[0]] * 5
+    assert all(b > a for a, b in zip(hits[1:], hits[2:]))
+    # Only the prefill and the first decode step are planned, the latter
+    # without a mask.
+    assert len(plans) == 2 and plans[1] is None
+
+    # The reused plans give the outputs of a prefill of the whole sequences.
+    reference = make_handler().forward_pass(
+        [_prefill(seq, kv_page=i) for i, seq in enumerate(sequences)]
+    )
+    for response, expected in zip(responses, reference):
+        assert _top_tokens(response) == _top_tokens(expected)
+        assert response.dists[0][1] == pytest.approx(expected.dists[0][1], abs=1e-4)
@@ -0,0 +1,210 @@
+"""Tests of the sliding-window KV pool."""
+
+from __future__ import annotations
+
+import numpy as np
+import pytest
+
+import message
+from kv_pool import SlidingWindowKvPool, min_window_kv_pages, window_ring_pages
+
+PAGE_SIZE = 16
+WINDOW = 32
+
+
+class _Sequence:
+    """A sequence with its own KV pages, as the controller would allocate them."""
+
+    def __init__(self, first_page: int):
+        self.next_page = first_page
+        self.pages: list[int] = []
+        self.length = 0
+
+    def append(self, num_tokens: int) -> tuple[list[int], int, int]:
+        """Grows the sequence and returns the pool inputs of the pass."""
+        self.length += num_tokens
+        while len(self.pages) * PAGE_SIZE < self.length:
+            self.pages.append(self.next_page)
+            self.next_page += 1
+        last_len = self.length - (len(self.pages) - 1) * PAGE_SIZE
+        return list(self.pages), last_len, num_tokens
+
+
+def _run(pool: SlidingWindowKvPool, passes: list[tuple[list[int], int, int]]):
+    """Admits a batch and prepares the admitted requests; returns the errors."""
+    errors = pool.admit(*map(list, zip(*passes)))
+    admitted = [p for p, error in zip(passes, errors) if error is None]
+    if admitted:
+        page_ptrs, last_lens, num_tokens = map(list, zip(*admitted))
+        masks = [
+            np.ones(q_len * ((len(pages) - 1) * PAGE_SIZE + last_len), dtype=bool)
+            for pages, last_len, q_len in admitted
+        ]
+        pool.prepare(page_ptrs, last_lens, num_tokens, masks)
+    return errors
+
+
+def test_prompt_longer_than_the_window():
+    pool = SlidingWindowKvPool(
+        min_window_kv_pages(PAGE_SIZE, WINDOW, max_pass_tokens=256),
+        PAGE_SIZE,
+        WINDOW,
+        "cpu",
+    )
+    sequence = _Sequence(first_page=0)
+    assert _run(pool, [sequence.append(200)]) == [None]
+    # Only the pages of the last window stay resident after the prefill.
+    assert pool.num_slots - pool.num_free_slots <= window_ring_pages(PAGE_SIZE, WINDOW)
+    assert _run(pool, [sequence.append(1)]) == [None]
+
+
+def test_idle_contexts_keep_their_windows():
+    ring = window_ring_pages(PAGE_SIZE, WINDOW)
+    pool = SlidingWindowKvPool(4 * ring, PAGE_SIZE, WINDOW, "cpu")
+    sequences = [_Sequence(first_page=100 * i) for i in range(4)]
+    for sequence in sequences:
+        assert _run(pool, [sequence.append(40)]) == [None]
+
+    # The first context was idle the longest, and is still resident.
+    assert _run(pool, [sequences[0].append(1)]) == [None]
+    assert _run(pool, [s.append(1) for s in sequences]) == [None] * 4
+
+
+def test_requests_that_do_not_fit_are_refused():
+    ring = window_ring_pages(PAGE_SIZE, WINDOW)
+    pool = SlidingWindowKvPool(2 * ring, PAGE_SIZE, WINDOW, "cpu")
+    live = [_Sequence(first_page=0), _Sequence(first_page=100)]
+    assert _run(pool, [s.append(40) for s in live]) == [None, None]
+
+    newcomer = _Sequence(first_page=200)
+    errors = _run(pool, [live[0].append(1), newcomer.append(40), live[1].append(1)])
+    assert errors[0] is None and errors[2] is None
+    assert "free slots" in errors[1]
+
+    # The live contexts were not disturbed by the refusal.
+    assert _run(pool, [s.append(1) for s in live]) == [None, None]
+
+
+def test_released_pages_cannot_be_attended_to():
+    pool = SlidingWindowKvPool(8, PAGE_SIZE, WINDOW, "cpu")
+    parent = _Sequence(first_page=0)
+    assert _run(pool, [parent.append(48)]) == [None]
+    fork_pages, fork_last_len, _ = list(parent.pages), 16, 1
+
+    # The parent moves on, and its first page leaves every window.
+    assert _run(pool, [parent.append(16)]) == [None]
+
+    # A fork from before attends to the released page.
+    (error,) = _run(pool, [(fork_pages[:2], fork_last_len, 1)])
+    assert "not resident" in error
+
+
+def test_admitted_batch_prepared_in_parts():
+    pool = SlidingWindowKvPool(8, PAGE_SIZE, WINDOW, "cpu")
+    parent = _Sequence(first_page=0)
+    prompt_pages, prompt_last_len, q_len = parent.append(32)
+    prefill = pool.prepare(
+        [prompt_pages],
+        [prompt_last_len],
+        [q_len],
+        [np.ones(q_len * 32, dtype=bool)],
+    )
+    first_slot = int(prefill.kv_page_indices[0])
+
+    # The parent leaves its first page behind, but a fork still attends to it.
+    parent_pass = parent.append(32)
+    fork_pass = ([0, 1, 50], 1, 1)
+    assert pool.admit(*map(list, zip(parent_pass, fork_pass))) == [None, None]
+    for page_ptrs, last_len, q_len in (parent_pass, fork_pass):
+        seq_len = (len(page_ptrs) - 1) * PAGE_SIZE + last_len
+        inputs = pool.prepare(
+            [page_ptrs], [last_len], [q_len], [np.ones(q_len * seq_len, dtype=bool)]
+        )
+    assert int(inputs.kv_page_indices[0]) == first_slot
+
+
+def test_finished_contexts_make_room_for_new_ones():
+    window = 128
+    ring = window_ring_pages(PAGE_SIZE, window)
+    pool = SlidingWindowKvPool(
+        min_window_kv_pages(PAGE_SIZE, window, 256) + 3 * ring,
+        PAGE_SIZE,
+        window,
+        "cpu",
+    )
+    # Contexts on fresh pages that finish after a few decode steps, without
+    # the controller telling the pool
+    for i in range(20):
+        context = _Sequence(first_page=100 * i)
+        assert _run(pool, [context.append(200)]) == [None]
+        for _ in range(3):
+            assert _run(pool, [context.append(1)]) == [None]
+    assert pool.reclaims > 0
+
+
+def test_reclaimed_contexts_are_refused():
+    ring = window_ring_pages(PAGE_SIZE, WINDOW)
+    pool = SlidingWindowKvPool(2 * ring, PAGE_SIZE, WINDOW, "cpu")
+    contexts = [_Sequence(first_page=100 * i) for i in range(3)]
+    for context in contexts:
+        assert _run(pool, [context.append(40)]) == [None]
+
+    # The window of the first context, idle the longest, was reclaimed for
+    # the third one, and the second one is still resident.
+    (error,) = _run(pool, [contexts[0].append(1)])
+    assert "not resident" in error
+    assert _run(pool, [contexts[1].append(1)]) == [None]
+
+
+def _forward(handler, sequence: _Sequence, tokens: list[int]):
+    """Appends `tokens` to `sequence` and returns the distribution after them."""
+    start = sequence.length
+    page_ptrs, last_len, _ = sequence.append(len(tokens))
+    (response,) = handler.forward_pass(
+        [
+            message.ForwardPassRequest(
+                input_tokens=tokens,
+                input_token_positions=list(range(start, sequence.length)),
+                input_embed_ptrs=[],
+                input_embed_positions=[],
+                adapter=None,
+                adapter_seed=None,
+                mask=[[start + i + 1] for i in range(len(tokens))],
+                kv_page_ptrs=page_ptrs,
+                kv_page_last_len=last_len,
+                output_token_indices=[len(tokens) - 1],
+                output_token_samplers=[{"sampler": 0, "top_k": 8}],
+            )
+        ]
+    )
+    return response
+
+
+def test_handler_serves_prompts_and_idle_contexts(make_handler):
+    """The separate window pool gives the results of the shared page layout."""
+    shared = make_handler("tiny-gptoss", max_batch_tokens=256)
+    pooled = make_handler(
+        "tiny-gptoss",
+        max_batch_tokens=256,
+        max_num_window_kv_pages=min_window_kv_pages(PAGE_SIZE, WINDOW, 256)
+        + 3 * window_ring_pages(PAGE_SIZE, WINDOW),
+    )
+
+    def run(handler):
+        results = []
+        prompt = _Sequence(first_page=0)
+        results.append(_forward(handler, prompt, [(3 * i) % 100 for i in range(200)]))
+        results.append(_forward(handler, prompt, [5]))
+        contexts = [_Sequence(first_page=20 + 4 * i) for i in range(4)]
+        for i, context in enumerate(contexts):
+            results.append(
+                _forward(handler, context, [(i + j) % 100 for j in range(40)])
+            )
+        results.append(_forward(handler, contexts[0], [7]))
+        return results
+
+    for expected, response in zip(run(shared), run(pooled)):
+        assert not response.error
+        ids, probs = response.dists[0]
+        assert ids == expected.dists[0][0]
+        assert probs == pytest.approx(expected.dists[0][1], abs=1e-5)
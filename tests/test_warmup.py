@@ -0,0 +1,44 @@
+"""Tests of the warm-up before registering with the controller."""
+
+from __future__ import annotations
+
+from types import SimpleNamespace
+
+import message
+from warmup import warm_up, warmup_batches
+
+
+def test_warm_up_runs_every_batch_shape(tiny_handler):
+    timings = warm_up(tiny_handler, rounds=2)
+
+    expected = warmup_batches(
+        tiny_handler.kv_page_size,
+        tiny_handler.max_batch_tokens,
+        tiny_handler.max_num_kv_pages,
+    )
+    assert [(t.kind, t.batch_size, t.num_tokens) for t in timings] == [
+        (kind, batch_size, num_tokens) for kind, batch_size, num_tokens, _ in expected
+    ]
+    assert all(len(t.round_ms) == 2 for t in timings)
+
+
+def test_refused_warm_up_passes_are_skipped(capsys):
+    def forward_pass(reqs):
+        # Refuses the prefills, as a small sliding-window KV pool would.
+        error = "too few slots" if len(reqs[0].input_tokens) > 1 else ""
+        return [
+            message.ForwardPassResponse(tokens=[], dists=[], error=error) for _ in reqs
+        ]
+
+    handler = SimpleNamespace(
+        kv_page_size=16,
+        max_batch_tokens=256,
+        max_num_kv_pages=64,
+        window_kv_pool=None,
+        device="cpu",
+        forward_pass=forward_pass,
+    )
+    timings = warm_up(handler, rounds=2)
+
+    assert {t.kind for t in timings} == {"decode"}
+    assert "too few slots" in capsys.readouterr().err
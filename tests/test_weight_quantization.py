@@ -0,0 +1,40 @@
+"""Tests of the weight-only quantized linear layers."""
+
+from __future__ import annotations
+
+import pytest
+import torch
+from torch import nn
+
+import weight_quantization
+from weight_quantization import QuantizedLinear
+
+
+def _dequantized_weight(weight: torch.Tensor, mode: str, group_size: int):
+    """Rounds `weight` to the codes of `mode`, computed independently."""
+    if mode == "int8":
+        scales = weight.abs().amax(dim=1, keepdim=True) / 127
+        return (weight / scales).round().clamp(-127, 127) * scales
+    groups = weight.view(weight.shape[0], -1, group_size)
+    low = groups.amin(dim=-1, keepdim=True)
+    scales = (groups.amax(dim=-1, keepdim=True) - low) / 15
+    codes = ((groups - low) / scales).round().clamp(0, 15)
+    return (codes * scales + low).view_as(weight)
+
+
+@pytest.mark.parametrize("mode, group_size", [("int8", 0), ("int4", 32), ("int4", 128)])
+def test_quantized_linear_matches_dequantized_weight(monkeypatch, mode, group_size):
+    # Several chunks of rows, which are quantized and packed separately
+    monkeypatch.setattr(weight_quantization, "_ROWS_PER_CHUNK", 64)
+    torch.manual_seed(0)
+    linear = nn.Linear(256, 192)
+    x = torch.randn(3, 5, 256)
+
+    quantized = QuantizedLinear.from_linear(linear, mode, group_size)
+
+    weight = _dequantized_weight(linear.weight.detach(), mode, group_size)
+    expected = x @ weight.T + linear.bias.detach()
+    torch.testing.assert_close(quantized(x), expected, atol=1e-3, rtol=1e-3)
+    # The rounding error stays within the quantization step.
+    error = (quantized(x) - linear(x)).abs().max()
+    assert 0 < error < 0.1 * linear(x).abs().max()